@@ -10,7 +10,11 @@ from typing import List, Dict, Any, Optional
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
+from app.chat.codec import BINARY_PROTOCOL, SUBPROTOCOLS, Frame, decode, jsonable
+from app.chat.connections import ClientConnection
 from app.chat.messaging import messaging_service
+from app.chat.store import MAX_SEQ
+from app.core.config import settings
 from app.models.schemas import User, Message, ChatRoom, UserAuthRequest, UserAuthResponse
 from app.core.security import verify_token
 
@@ -20,8 +24,8 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/chat/login")
 
-# Conexiones WebSocket activas por sesión
-active_connections: Dict[str, WebSocket] = {}
+# Conexiones WebSocket activas por sesión (con su cola de salida)
+active_connections: Dict[str, ClientConnection] = {}
 
 # Dependencia para obtener usuario actual mediante token
 async def get_current_user(token: str = Depends(oauth2_scheme)):
@@ -60,19 +64,66 @@ async def login_user(request: UserAuthRequest):
     )
 
 @router.get("/rooms", response_model=List[Dict[str, Any]])
-async def get_user_rooms(current_user: Dict = Depends(get_current_user)):
-    """Obtiene las salas de chat a las que pertenece el usuario."""
+async def get_user_rooms(
+    participants: bool = Query(False, description="Incluir los participantes de las salas de grupo"),
+    current_user: Dict = Depends(get_current_user)
+):
+    """
+    Obtiene las salas de chat a las que pertenece el usuario.
+    
+    Las salas privadas incluyen siempre a sus participantes; las de grupo,
+    solo con ``participants=true``.
+    """
     username = current_user["username"]
-    return await messaging_service.get_user_rooms(username)
+    return await messaging_service.get_user_rooms(username, with_participants=participants)
 
 @router.get("/rooms/{room_id}/messages", response_model=List[Dict[str, Any]])
 async def get_room_messages(
     room_id: str, 
     limit: int = Query(50, ge=1, le=100),
+    before: Optional[int] = Query(None, ge=1, le=MAX_SEQ),
+    after: Optional[int] = Query(None, ge=0, le=MAX_SEQ),
     current_user: Dict = Depends(get_current_user)
 ):
-    """Obtiene los mensajes recientes de una sala de chat."""
-    return await messaging_service.get_room_messages(room_id, limit)
+    """
+    Obtiene los mensajes de una sala de chat, paginados por secuencia.
+    
+    Sin cursores devuelve los más recientes. Para páginas anteriores se
+    pasa en ``before`` el ``seq`` del mensaje más antiguo recibido; para
+    ponerse al día, en ``after`` el del más reciente. Solo los
+    participantes de la sala pueden leerla.
+    """
+    if not await messaging_service.is_member(room_id, current_user["username"]):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="No perteneces a esta sala"
+        )
+    messages = await messaging_service.get_room_messages(room_id, limit, before=before, after=after)
+    return [jsonable(message) for message in messages]
+
+@router.get("/unread", response_model=Dict[str, int])
+async def get_unread_counts(current_user: Dict = Depends(get_current_user)):
+    """Obtiene los mensajes no leídos del usuario en cada una de sus salas."""
+    return await messaging_service.get_unread_counts(current_user["username"])
+
+@router.post("/rooms/{room_id}/read", response_model=Dict[str, Any])
+async def mark_room_read(
+    room_id: str,
+    seq: int = Query(..., ge=0, le=MAX_SEQ),
+    current_user: Dict = Depends(get_current_user)
+):
+    """
+    Marca como leídos los mensajes de una sala hasta la secuencia ``seq``.
+    
+    El cursor de lectura nunca retrocede.
+    """
+    unread = await messaging_service.mark_read(current_user["username"], room_id, seq)
+    if unread is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="No perteneces a esta sala"
+        )
+    return {"room_id": room_id, "unread": unread}
 
 @router.post("/rooms/private", response_model=Dict[str, Any])
 async def create_private_room(
@@ -89,35 +140,47 @@ async def chat_websocket(websocket: WebSocket, session_id: str):
     Endpoint WebSocket para comunicación en tiempo real.
     
     Este endpoint maneja la comunicación bidireccional para
-    el servicio de mensajería de la VPN.
+    el servicio de mensajería de la VPN. El cliente puede negociar el
+    subprotocolo ``kyber-chat.msgpack`` (tramas binarias MessagePack) o
+    ``kyber-chat.json``; sin subprotocolo se usa JSON.
+    
+    Al reconectar, el cliente envía ``{"type": "sync", "rooms": {room_id: seq}}``
+    con la última secuencia recibida de cada sala y recibe solo los mensajes
+    que le faltan (o ``resync`` si el hueco es demasiado grande).
     """
-    # Verificar que la sesión es válida
-    if session_id not in messaging_service.user_sessions:
+    # Verificar que la sesión es válida (puede haberse creado en otro worker)
+    username = await messaging_service.get_session_user(session_id)
+    if username is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         logger.warning(f"Intento de conexión WebSocket con sesión inválida: {session_id}")
         return
-        
-    username = messaging_service.user_sessions[session_id]
     
-    # Aceptar la conexión WebSocket
-    await websocket.accept()
-    logger.info(f"Conexión WebSocket aceptada para usuario: {username}")
+    # Aceptar la conexión WebSocket con el primer subprotocolo admitido que ofrezca el cliente
+    offered = websocket.scope.get("subprotocols", [])
+    subprotocol = next((protocol for protocol in offered if protocol in SUBPROTOCOLS), None)
+    await websocket.accept(subprotocol=subprotocol)
+    logger.info(f"Conexión WebSocket aceptada para usuario: {username} ({subprotocol or 'json'})")
     
-    # Almacenar conexión activa
-    active_connections[session_id] = websocket
+    # Almacenar conexión activa y registrarla en los índices de difusión
+    connection = ClientConnection(
+        websocket, username, session_id,
+        max_queue=settings.CHAT_SEND_QUEUE_SIZE,
+        policy=settings.CHAT_SLOW_CONSUMER_POLICY,
+        binary=subprotocol == BINARY_PROTOCOL
+    )
+    connection.start()
+    active_connections[session_id] = connection
+    await messaging_service.attach_connection(username, connection)
     
     # Notificar a todos los usuarios que este usuario está en línea
-    user = messaging_service.connected_users.get(username)
-    if user:
-        user.is_online = True
-        # En una implementación real, notificaríamos a los demás usuarios
+    await messaging_service.set_user_online(username, True)
+    # En una implementación real, notificaríamos a los demás usuarios
     
     try:
         # Bucle principal de recepción de mensajes
         while True:
             # Recibir mensaje del cliente
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = await receive_frame(websocket)
             
             # Procesar diferentes tipos de mensajes
             if message_data["type"] == "message":
@@ -130,7 +193,7 @@ async def chat_websocket(websocket: WebSocket, session_id: str):
                 
                 if message:
                     # Enviar confirmación al remitente
-                    await websocket.send_text(json.dumps({
+                    connection.send(Frame({
                         "type": "message_sent",
                         "message_id": message["id"],
                         "timestamp": message["timestamp"]
@@ -140,7 +203,7 @@ async def chat_websocket(websocket: WebSocket, session_id: str):
                     await broadcast_to_room(message)
                 else:
                     # Enviar error al remitente
-                    await websocket.send_text(json.dumps({
+                    connection.send(Frame({
                         "type": "error",
                         "message": "No se pudo enviar el mensaje"
                     }))
@@ -148,33 +211,84 @@ async def chat_websocket(websocket: WebSocket, session_id: str):
             elif message_data["type"] == "typing":
                 # Notificar que el usuario está escribiendo
                 room_id = message_data.get("room_id")
-                if room_id and room_id in messaging_service.chat_rooms:
-                    await broadcast_to_room({
-                        "type": "typing",
-                        "room_id": room_id,
-                        "username": username
-                    }, exclude_session=session_id)
+                if room_id and await messaging_service.is_member(room_id, username):
+                    # Se agrega por sala y se envía una vez por intervalo
+                    messaging_service.set_typing(room_id, username)
+            
+            elif message_data["type"] == "sync":
+                # Puesta al día tras reconectar: {"rooms": {room_id: última secuencia recibida}}.
+                # Los mensajes en directo pueden intercalarse; el cliente descarta los repetidos por seq.
+                rooms = message_data.get("rooms")
+                for room_id, since in (rooms.items() if isinstance(rooms, dict) else ()):
+                    if not isinstance(since, int):
+                        continue
+                    async for frame in messaging_service.iter_missed(username, room_id, since):
+                        await connection.wait_writable()
+                        connection.send(Frame(frame))
+                connection.send(Frame({"type": "sync", "done": True}))
+            
+            elif message_data["type"] == "read":
+                # Avanzar el cursor de lectura y devolver los no leídos de la sala
+                room_id = message_data.get("room_id")
+                seq = message_data.get("seq")
+                unread = None
+                if room_id and _valid_seq(seq):
+                    unread = await messaging_service.mark_read(username, room_id, seq)
+                if unread is not None:
+                    connection.send(Frame({"type": "unread", "room_id": room_id, "unread": unread}))
     
     except WebSocketDisconnect:
         # Manejar desconexión del cliente
         logger.info(f"WebSocket desconectado para usuario: {username}")
-        if session_id in active_connections:
-            del active_connections[session_id]
-        
-        if username in messaging_service.connected_users:
-            user = messaging_service.connected_users[username]
-            user.is_online = False
-            # En una implementación real, notificaríamos a los demás usuarios
+        await messaging_service.set_user_online(username, False)
+        # En una implementación real, notificaríamos a los demás usuarios
     
     except Exception as e:
         logger.error(f"Error en WebSocket para usuario {username}: {str(e)}")
-        if session_id in active_connections:
+    
+    finally:
+        if active_connections.get(session_id) is connection:
             del active_connections[session_id]
+        messaging_service.detach_connection(username, connection)
+        await connection.close()
+
+def _valid_seq(value: Any) -> bool:
+    """Comprueba que un número de secuencia recibido por el WebSocket sea utilizable."""
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= MAX_SEQ
+
+async def receive_frame(websocket: WebSocket) -> Dict[str, Any]:
+    """
+    Recibe y decodifica la siguiente trama del cliente.
+    
+    Las tramas binarias se decodifican como MessagePack y las de texto
+    como JSON, sea cual sea el subprotocolo negociado.
+    
+    Args:
+        websocket: Conexión WebSocket
+        
+    Returns:
+        Trama decodificada
+        
+    Raises:
+        WebSocketDisconnect: Si el cliente cierra la conexión
+        ValueError: Si la trama no se puede decodificar
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+    if message.get("bytes") is not None:
+        return decode(message["bytes"])
+    return json.loads(message["text"])
 
 async def broadcast_to_room(message: Dict[str, Any], exclude_session: Optional[str] = None):
     """
     Envía un mensaje a todos los participantes de una sala.
     
+    Los destinatarios salen del índice sala -> conexiones locales y la
+    trama se codifica una sola vez por protocolo. Solo se encola en la cola de salida
+    de cada conexión, así que el coste no depende del cliente más lento,
+    y se publica en el bus para los participantes de otros workers.
+    
     Args:
         message: Mensaje a enviar
         exclude_session: Sesión a excluir del broadcast (opcional)
@@ -182,20 +296,26 @@ async def broadcast_to_room(message: Dict[str, Any], exclude_session: Optional[s
     if "room_id" not in message:
         return
     
-    room_id = message["room_id"]
-    if room_id not in messaging_service.chat_rooms:
-        return
+    # Construir el índice de la sala si aún no existe en este worker
+    await messaging_service.get_room_connections(message["room_id"])
+    frame = Frame({
+        "type": "new_message",
+        "message": message
+    })
+    excluded = active_connections.get(exclude_session) if exclude_session else None
+    messaging_service.broadcast(message["room_id"], frame, exclude=excluded)
+
+def get_connection_stats() -> Dict[str, Any]:
+    """
+    Obtiene las métricas de las conexiones WebSocket de este worker.
     
-    room = messaging_service.chat_rooms[room_id]
-    for participant in room.participants:
-        # Buscar sesiones activas del participante
-        for session_id, username in messaging_service.user_sessions.items():
-            if username == participant and session_id in active_connections and session_id != exclude_session:
-                websocket = active_connections[session_id]
-                try:
-                    await websocket.send_text(json.dumps({
-                        "type": "new_message",
-                        "message": message
-                    }))
-                except Exception as e:
-                    logger.error(f"Error enviando mensaje a {username}: {str(e)}")
\ No newline at end of file
+    Returns:
+        Totales y métricas de la cola de salida de cada conexión
+    """
+    connections = [connection.get_stats() for connection in active_connections.values()]
+    return {
+        "connections": len(connections),
+        "queued": sum(stats["queueDepth"] for stats in connections),
+        "dropped": sum(stats["dropped"] for stats in connections),
+        "perConnection": connections
+    }
@@ -2,61 +2,348 @@
 Rutas de la API para gestión de conexiones VPN.
 
 Este módulo implementa los endpoints para conectar/desconectar
-la VPN y obtener su estado actual.
+la VPN y obtener su estado actual. Cada conexión es una sesión
+independiente identificada por su ``sessionId``, que los endpoints
+de una sesión exigen siempre: el ID es la prueba de que la sesión es
+del cliente. Con varios workers, las operaciones sobre una sesión de
+otro worker se le reenvían a él.
 """
-from fastapi import APIRouter, HTTPException, Depends
-from typing import Dict, Any
+import asyncio
+import logging
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Dict, Any, List, Optional
 
-from app.models.schemas import ConnectionRequest, ConnectionResponse, VpnStatus
+from app.models.schemas import (
+    ConnectionRequest, ConnectionResponse, VpnStatus, SessionInfo,
+    ShapingLimits, ShapingStatus
+)
+from app.core.config import settings
 from app.network.vpn import VPNManager
+from app.network.forward import ForwardError
+from app.network.status import StatusHub
+from app.crypto.keypool import key_pool
+from app.crypto.cookies import cookie_checker
+from app.network.admission import AdmissionRejectedError, admission_controller
+from app.network.registry import server_registry
+
+# Configurar logger
+logger = logging.getLogger(__name__)
 
 # Creamos una instancia global del gestor VPN
 # En una aplicación real, esto podría gestionarse con inyección de dependencias
 vpn_manager = VPNManager()
 
+# Publicador del flujo de estado de las sesiones de este gestor
+status_hub = StatusHub(vpn_manager, max_rate=settings.STATUS_STREAM_MAX_RATE)
+
 router = APIRouter()
 
+# Cabecera con la que se emite y se devuelve la cookie de handshake
+COOKIE_HEADER = "X-Handshake-Cookie"
+
 @router.post("/connect", response_model=ConnectionResponse)
-async def connect_to_vpn(request: ConnectionRequest):
+async def connect_to_vpn(request: ConnectionRequest, http_request: Request):
     """
-    Establece una conexión VPN con el servidor especificado.
-    
+    Establece una nueva sesión VPN con el servidor especificado.
+
+    Con ``serverId`` igual a ``"auto"`` el servidor se elige según su carga
+    y latencia. Si el nodo está bajo carga, el intercambio de claves solo
+    se realiza cuando la petición incluye en ``X-Handshake-Cookie`` la
+    cookie emitida para la dirección del cliente. Los handshakes admitidos
+    esperan turno en una cola acotada.
+
     Args:
-        request: Solicitud con el ID del servidor
-        
+        request: Solicitud con el ID del servidor y el usuario (opcional)
+        http_request: Petición HTTP (dirección del cliente y cabeceras)
+
     Returns:
-        Resultado de la operación de conexión
+        Resultado de la operación de conexión, con el ID de la sesión
+
+    Raises:
+        HTTPException: 429 con una cookie si el nodo está bajo carga y la
+            petición no trae una válida; 503 (con ``Retry-After``) si la
+            cola de handshakes está llena o no hay servidores con
+            capacidad disponible
     """
-    result = await vpn_manager.connect(request.serverId)
-    
+    client = http_request.client.host if http_request.client else ""
+    if cookie_checker.under_load() and not cookie_checker.verify(
+        http_request.headers.get(COOKIE_HEADER), client
+    ):
+        raise HTTPException(
+            status_code=429,
+            detail="Servidor bajo carga: repita la solicitud con la cookie de handshake",
+            headers={COOKIE_HEADER: cookie_checker.issue(client)}
+        )
+
+    try:
+        with cookie_checker.handshake():
+            async with admission_controller.slot():
+                result = await vpn_manager.connect(request.serverId, user=request.username)
+    except AdmissionRejectedError as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    if result.get("overloaded"):
+        raise HTTPException(
+            status_code=503,
+            detail=result["message"],
+            headers={"Retry-After": str(server_registry.retry_after())}
+        )
+
     return ConnectionResponse(
         success=result["success"],
         message=result["message"],
-        vpnIp=result.get("vpnIp")
+        vpnIp=result.get("vpnIp"),
+        sessionId=result.get("sessionId")
     )
 
+@router.get("/connect/stats", response_model=Dict[str, Any])
+async def get_connect_stats():
+    """
+    Obtiene los tiempos de cada fase de conexión, la reserva de claves y las cookies.
+
+    Returns:
+        Tiempos por fase en milisegundos y estadísticas de la reserva y
+        de las cookies de handshake
+    """
+    return {
+        "phases": vpn_manager.get_connect_stats(),
+        "keyPool": key_pool.get_stats(),
+        "cookies": cookie_checker.get_stats()
+    }
+
+async def _call_owner(session_id: str, method: str, **kwargs: Any) -> Any:
+    """
+    Ejecuta una operación sobre una sesión en el worker que la atiende.
+
+    Args:
+        session_id: ID de la sesión
+        method: Operación (disconnect, get_limits, set_limits o status)
+        **kwargs: Resto de argumentos de la operación
+
+    Returns:
+        Resultado de la operación
+
+    Raises:
+        HTTPException: 404 si la sesión no existe en ningún worker; 503 si
+            el worker que la atiende no responde
+    """
+    try:
+        result = await vpn_manager.call_owner(session_id, method, **kwargs)
+    except ForwardError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Sesión {session_id} no encontrada")
+    return result
+
 @router.post("/disconnect", response_model=ConnectionResponse)
-async def disconnect_from_vpn():
+async def disconnect_from_vpn(session_id: str = Query(...)):
     """
-    Finaliza la conexión VPN actual.
-    
+    Finaliza una sesión VPN.
+
+    Args:
+        session_id: ID de la sesión
+
     Returns:
         Resultado de la operación de desconexión
+
+    Raises:
+        HTTPException: Si la sesión no existe o su worker no responde
     """
-    result = await vpn_manager.disconnect()
-    
+    result = await _call_owner(session_id, "disconnect")
+
     return ConnectionResponse(
         success=result["success"],
         message=result["message"],
-        vpnIp=None
+        vpnIp=None,
+        sessionId=session_id
     )
 
 @router.get("/status", response_model=VpnStatus)
-async def get_vpn_status():
+async def get_vpn_status(session_id: str = Query(...)):
     """
-    Obtiene el estado actual de la conexión VPN.
-    
+    Obtiene el estado actual de una sesión VPN.
+
+    Args:
+        session_id: ID de la sesión
+
     Returns:
-        Estado actual de la VPN
+        Estado actual de la sesión
+
+    Raises:
+        HTTPException: Si la sesión no existe
+    """
+    return await get_vpn_session(session_id)
+
+async def _sse_frames(frames: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Envuelve las tramas de estado como eventos SSE (y cierra el flujo al terminar)."""
+    try:
+        async for frame in frames:
+            yield f"data: {frame}\n\n"
+    finally:
+        await frames.aclose()
+
+async def _until_disconnect(websocket: WebSocket):
+    """Espera a que el cliente cierre el WebSocket (lo que envíe se ignora)."""
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+@router.get("/status/stream")
+async def stream_vpn_status(session_id: str = Query(...),
+                            max_rate: Optional[float] = Query(None, gt=0)):
     """
-    return await vpn_manager.get_status()
+    Envía el estado de una sesión VPN como eventos SSE.
+
+    El primer evento lleva el estado completo (``full``) y los siguientes
+    solo los campos modificados (``delta``), como máximo ``max_rate``
+    veces por segundo. El flujo termina al desconectarse la sesión.
+
+    Args:
+        session_id: ID de la sesión
+        max_rate: Frecuencia máxima de actualizaciones en Hz (opcional)
+
+    Returns:
+        Respuesta ``text/event-stream``
+
+    Raises:
+        HTTPException: Si la sesión no existe o su worker no responde
+    """
+    await _call_owner(session_id, "status")
+    frames = status_hub.subscribe(session_id, max_rate)
+    return StreamingResponse(
+        _sse_frames(frames),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.websocket("/status/ws")
+async def status_websocket(websocket: WebSocket, session_id: str,
+                           max_rate: Optional[float] = None):
+    """
+    Envía el estado de una sesión VPN por WebSocket.
+
+    Las tramas tienen el mismo formato que en ``/status/stream``; la
+    conexión se cierra al desconectarse la sesión, y se rechaza si la
+    sesión no existe (o su worker no responde). Si el cliente se va, la
+    suscripción se libera sin esperar al siguiente cambio de estado.
+
+    Args:
+        websocket: Conexión WebSocket
+        session_id: ID de la sesión
+        max_rate: Frecuencia máxima de actualizaciones en Hz (opcional)
+    """
+    try:
+        await _call_owner(session_id, "status")
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    frames = status_hub.subscribe(session_id, max_rate if max_rate and max_rate > 0 else None)
+
+    async def send_frames():
+        async for frame in frames:
+            await websocket.send_text(frame)
+        await websocket.close()
+
+    sender = asyncio.ensure_future(send_frames())
+    watcher = asyncio.ensure_future(_until_disconnect(websocket))
+    try:
+        await asyncio.wait({sender, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if sender.done() and not sender.cancelled():
+            error = sender.exception()
+            if error is not None and not isinstance(error, WebSocketDisconnect):
+                logger.error(f"Error en el flujo de estado por WebSocket: {str(error)}")
+    finally:
+        sender.cancel()
+        watcher.cancel()
+        await asyncio.gather(sender, watcher, return_exceptions=True)
+        await frames.aclose()
+
+@router.get("/sessions", response_model=List[SessionInfo])
+async def list_vpn_sessions(user: Optional[str] = Query(None)):
+    """
+    Lista las sesiones VPN activas en este nodo.
+
+    Los IDs de sesión no se incluyen: son la credencial de cada cliente
+    para gestionar su propia sesión.
+
+    Args:
+        user: Filtrar por usuario (opcional)
+
+    Returns:
+        Resumen de cada sesión activa
+    """
+    return await vpn_manager.list_sessions(user)
+
+@router.get("/sessions/{session_id}", response_model=VpnStatus)
+async def get_vpn_session(session_id: str):
+    """
+    Obtiene el estado de una sesión VPN concreta (de cualquier worker).
+
+    Args:
+        session_id: ID de la sesión
+
+    Returns:
+        Estado actual de la sesión
+
+    Raises:
+        HTTPException: Si la sesión no existe
+    """
+    vpn_status = await vpn_manager.get_status(session_id)
+    if not vpn_status.connected:
+        raise HTTPException(status_code=404, detail=f"Sesión {session_id} no encontrada")
+    return vpn_status
+
+@router.delete("/sessions/{session_id}", response_model=ConnectionResponse)
+async def delete_vpn_session(session_id: str):
+    """
+    Finaliza una sesión VPN concreta.
+
+    Args:
+        session_id: ID de la sesión
+
+    Returns:
+        Resultado de la operación de desconexión
+
+    Raises:
+        HTTPException: Si la sesión no existe
+    """
+    return await disconnect_from_vpn(session_id)
+
+@router.get("/limits", response_model=ShapingStatus)
+async def get_vpn_limits(session_id: str = Query(...)):
+    """
+    Obtiene los límites de ancho de banda y el consumo de una sesión.
+
+    Args:
+        session_id: ID de la sesión
+
+    Returns:
+        Límites y consumo de la sesión
+
+    Raises:
+        HTTPException: Si la sesión no existe o su worker no responde
+    """
+    return await _call_owner(session_id, "get_limits")
+
+@router.put("/limits", response_model=ShapingStatus)
+async def update_vpn_limits(request: ShapingLimits, session_id: str = Query(...)):
+    """
+    Cambia en caliente los límites de ancho de banda y cuota de una sesión.
+
+    Args:
+        request: Nuevos límites (los campos omitidos no se modifican)
+        session_id: ID de la sesión
+
+    Returns:
+        Límites y consumo actualizados
+
+    Raises:
+        HTTPException: Si la sesión no existe o su worker no responde
+    """
+    return await _call_owner(
+        session_id, "set_limits", rate=request.rate, burst=request.burst, quota=request.quota
+    )
@@ -0,0 +1,49 @@
+"""
+Rutas de la API para métricas del nodo.
+
+Este módulo reúne en un único endpoint las estadísticas de los
+servicios internos (admisión de handshakes, cookies, reserva de claves,
+temporizadores, flujo de estado, almacén compartido y, del chat, colas
+de salida, almacén de mensajes, indicadores de escritura y bus) para su consulta desde paneles
+de monitorización.
+"""
+from fastapi import APIRouter
+from typing import Any, Dict
+
+from app.api.routes.chat import get_connection_stats
+from app.api.routes.connection import vpn_manager, status_hub
+from app.chat.messaging import messaging_service
+from app.core.bus import message_bus
+from app.core.state import state_backend
+from app.crypto.cookies import cookie_checker
+from app.crypto.keypool import key_pool
+from app.network.admission import admission_controller
+from app.network.timers import timer_wheel
+
+router = APIRouter()
+
+@router.get("/", response_model=Dict[str, Any])
+async def get_metrics():
+    """
+    Obtiene las métricas de los servicios internos de este worker.
+
+    Returns:
+        Estadísticas agrupadas por servicio
+    """
+    return {
+        "sessions": len(vpn_manager.sessions),
+        "admission": admission_controller.get_stats(),
+        "cookies": cookie_checker.get_stats(),
+        "keyPool": key_pool.get_stats(),
+        "connectPhases": vpn_manager.get_connect_stats(),
+        "forwarding": vpn_manager.forwarder.get_stats(),
+        "addressPool": vpn_manager.pool.get_stats(),
+        "timers": timer_wheel.get_stats(),
+        "statusStream": status_hub.get_stats(),
+        "state": state_backend.get_stats(),
+        "chat": get_connection_stats(),
+        "messageStore": messaging_service.store.get_stats(),
+        "messageCache": messaging_service.cache.get_stats(),
+        "typing": messaging_service.typing.get_stats(),
+        "bus": message_bus.get_stats(),
+    }
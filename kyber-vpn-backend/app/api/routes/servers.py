@@ -2,44 +2,63 @@
 Rutas de la API para gestión de servidores VPN.
 
 Este módulo implementa los endpoints relacionados con la consulta
-de servidores VPN disponibles y su información.
+de servidores VPN disponibles y su información. Los datos proceden
+del registro de servidores, que mantiene el estado y la latencia
+en vivo y cachea la respuesta serializada con un ETag.
 """
-from fastapi import APIRouter, HTTPException
-from typing import List
+from fastapi import APIRouter, HTTPException, Request, Response
+from typing import Any, Dict, List
 
-from app.core.config import settings
 from app.models.schemas import Server, ServerStatus
+from app.network.registry import server_registry
 
 router = APIRouter()
 
 @router.get("/", response_model=List[Server])
-async def get_servers():
+async def get_servers(request: Request):
     """
     Obtiene la lista de todos los servidores VPN disponibles.
-    
+
+    Si el cliente envía ``If-None-Match`` con el ETag vigente, responde
+    304 sin cuerpo.
+
     Returns:
         Lista de servidores disponibles
     """
-    # En una implementación real, esta información vendría de una base de datos
-    # o de llamadas a servicios externos
-    return settings.VPN_SERVERS
+    etag, body = server_registry.render()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.get("/health", response_model=Dict[str, Dict[str, Any]])
+async def get_servers_health():
+    """
+    Obtiene las estadísticas de salud de cada servidor.
+
+    Returns:
+        Disponibilidad reciente, RTT y jitter por servidor
+    """
+    return server_registry.get_stats()
 
 @router.get("/{server_id}", response_model=Server)
 async def get_server(server_id: str):
     """
     Obtiene información detallada de un servidor específico.
-    
+
     Args:
         server_id: ID único del servidor
-        
+
     Returns:
         Información detallada del servidor
-        
+
     Raises:
         HTTPException: Si el servidor no existe
     """
-    for server in settings.VPN_SERVERS:
-        if server["id"] == server_id:
-            return server
-    
-    raise HTTPException(status_code=404, detail=f"Servidor con ID {server_id} no encontrado")
+    server = server_registry.get(server_id)
+    if server is None:
+        raise HTTPException(status_code=404, detail=f"Servidor con ID {server_id} no encontrado")
+    return server
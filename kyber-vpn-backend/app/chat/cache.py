@@ -0,0 +1,205 @@
+"""
+Caché en memoria de los mensajes recientes de cada sala.
+
+Cada sala activa mantiene un buffer circular con sus últimos mensajes,
+contiguos por número de secuencia, delante del almacén SQLite. Las
+páginas que caen dentro del buffer (el caso habitual: la última página
+de una sala activa) se sirven sin tocar disco; el resto se piden al
+almacén.
+
+Solo se guardan buffers de salas que el worker recibe por el bus (las que
+tienen conexiones locales): los mensajes escritos en otros workers llegan
+por ahí, y sin suscripción el buffer se quedaría atrás.
+
+Las salas se ordenan por uso reciente y, cuando la memoria estimada de
+todos los buffers supera el presupuesto global, se expulsan las menos
+usadas.
+"""
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Coste fijo estimado por mensaje en memoria (diccionario y sus claves)
+MESSAGE_OVERHEAD = 400
+
+
+def _message_size(message: Dict[str, Any]) -> int:
+    """Estima la memoria que ocupa un mensaje en la caché."""
+    return MESSAGE_OVERHEAD + len(message["content"]) + len(message["id"]) + len(message["sender"])
+
+
+class _RoomRing:
+    """Últimos mensajes de una sala, contiguos por secuencia."""
+
+    __slots__ = ("messages", "size")
+
+    def __init__(self, capacity: int):
+        self.messages: Deque[Dict[str, Any]] = deque(maxlen=capacity)
+        self.size = 0
+
+    def append(self, message: Dict[str, Any]) -> int:
+        """Añade un mensaje y devuelve la variación de memoria estimada."""
+        delta = _message_size(message)
+        if len(self.messages) == self.messages.maxlen:
+            delta -= _message_size(self.messages[0])
+        self.messages.append(message)
+        self.size += delta
+        return delta
+
+    def covers(self, seq: int) -> bool:
+        """Indica si el buffer contiene todos los mensajes desde ``seq``."""
+        return bool(self.messages) and (self.messages[0]["seq"] <= seq or self.messages[0]["seq"] == 1)
+
+
+class RecentMessageCache:
+    """
+    Buffers circulares por sala con expulsión LRU bajo un presupuesto de memoria.
+    """
+
+    def __init__(self, per_room: int = 200, budget_bytes: int = 64 * 1024 * 1024):
+        """
+        Inicializa la caché.
+
+        Args:
+            per_room: Mensajes recientes que se guardan por sala
+            budget_bytes: Memoria estimada máxima de todos los buffers
+        """
+        self.per_room = per_room
+        self.budget_bytes = budget_bytes
+        self._rooms: "OrderedDict[str, _RoomRing]" = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def contains(self, room_id: str) -> bool:
+        """Indica si la sala tiene buffer en la caché."""
+        return room_id in self._rooms
+
+    def get(self, room_id: str, limit: int, before: Optional[int] = None,
+            after: Optional[int] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        Sirve una página del historial si cae dentro del buffer de la sala.
+
+        Args:
+            room_id: ID de la sala
+            limit: Número máximo de mensajes
+            before: Secuencia a partir de la que leer hacia atrás (exclusiva)
+            after: Secuencia a partir de la que leer hacia delante (exclusiva)
+
+        Returns:
+            Mensajes en orden ascendente, o None si hay que ir al almacén
+        """
+        ring = self._rooms.get(room_id)
+        if ring is None or not ring.messages:
+            self._misses += 1
+            return None
+        messages = ring.messages
+        first = messages[0]["seq"]
+        last = messages[-1]["seq"]
+
+        if after is not None:
+            if not ring.covers(after + 1):
+                self._misses += 1
+                return None
+            start = max(0, after + 1 - first)
+            page = [messages[i] for i in range(start, min(len(messages), start + limit))]
+        else:
+            end = len(messages) if before is None else max(0, min(before, last + 1) - first)
+            if not ring.covers(first + end - limit):
+                self._misses += 1
+                return None
+            page = [messages[i] for i in range(max(0, end - limit), end)]
+
+        self._hits += 1
+        self._rooms.move_to_end(room_id)
+        return page
+
+    def fill(self, room_id: str, messages: List[Dict[str, Any]]):
+        """
+        Sustituye el buffer de una sala por sus últimos mensajes leídos del almacén.
+
+        Args:
+            room_id: ID de la sala
+            messages: Mensajes más recientes de la sala, en orden ascendente
+        """
+        self._drop(room_id)
+        ring = _RoomRing(self.per_room)
+        for message in messages[-self.per_room:]:
+            ring.append(message)
+        self._rooms[room_id] = ring
+        self._bytes += ring.size
+        self._evict()
+
+    def append(self, message: Dict[str, Any]):
+        """
+        Añade un mensaje recién guardado al buffer de su sala.
+
+        Si falta algún mensaje intermedio (escrito por otro worker), el
+        buffer se reinicia para mantenerlo contiguo.
+
+        Args:
+            message: Mensaje con su ``seq`` ya asignado
+        """
+        ring = self._rooms.get(message["room_id"])
+        if ring is None:
+            if message["seq"] != 1:
+                return  # Sala fría: se cargará del almacén al pedirla
+            ring = _RoomRing(self.per_room)
+            self._rooms[message["room_id"]] = ring
+        elif ring.messages and ring.messages[-1]["seq"] != message["seq"] - 1:
+            if ring.messages[-1]["seq"] >= message["seq"]:
+                return  # Ya presente
+            self._bytes -= ring.size
+            ring = _RoomRing(self.per_room)
+            self._rooms[message["room_id"]] = ring
+        self._bytes += ring.append(message)
+        self._rooms.move_to_end(message["room_id"])
+        self._evict()
+
+    def discard(self, room_id: str):
+        """
+        Descarta el buffer de una sala.
+
+        Se usa cuando el worker deja de recibir los mensajes de la sala por
+        el bus y el buffer ya no se mantendría al día.
+
+        Args:
+            room_id: ID de la sala
+        """
+        self._drop(room_id)
+
+    def _drop(self, room_id: str):
+        """Elimina el buffer de una sala."""
+        ring = self._rooms.pop(room_id, None)
+        if ring is not None:
+            self._bytes -= ring.size
+
+    def _evict(self):
+        """Expulsa las salas menos usadas hasta volver al presupuesto."""
+        while self._bytes > self.budget_bytes and len(self._rooms) > 1:
+            _, ring = self._rooms.popitem(last=False)
+            self._bytes -= ring.size
+            self._evictions += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de la caché.
+
+        Returns:
+            Aciertos, fallos, tasa de aciertos, salas, mensajes y memoria
+        """
+        lookups = self._hits + self._misses
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "hitRate": round(self._hits / lookups, 4) if lookups else 0.0,
+            "rooms": len(self._rooms),
+            "messages": sum(len(ring.messages) for ring in self._rooms.values()),
+            "bytes": self._bytes,
+            "budgetBytes": self.budget_bytes,
+            "evictions": self._evictions,
+        }
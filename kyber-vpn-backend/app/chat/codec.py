@@ -0,0 +1,362 @@
+"""
+Codificación de las tramas del chat.
+
+El WebSocket del chat negocia uno de dos subprotocolos:
+
+- ``kyber-chat.json`` (o ninguno, para los clientes anteriores): tramas
+  de texto JSON. Los campos binarios viajan en Base64.
+- ``kyber-chat.msgpack``: tramas binarias MessagePack. Los campos
+  binarios (p. ej. un contenido cifrado) viajan como bytes sin Base64.
+
+La codificación MessagePack usa la extensión ``msgpack`` si está
+instalada; si no, un codificador propio en Python puro con las claves y
+los valores fijos del esquema de tramas precodificados.
+
+Una trama saliente se difunde a muchas conexiones, posiblemente con
+protocolos distintos, así que ``Frame`` calcula cada codificación una
+sola vez y solo si alguna conexión la necesita. Entre workers viaja la
+forma "de bus": JSON en el que los bytes se marcan como ``{"$bin": ...}``
+para poder reconstruirlos.
+"""
+import base64
+import json
+import struct
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # Sin la extensión: codificador propio en Python puro
+    msgpack = None
+
+# Subprotocolos WebSocket admitidos
+JSON_PROTOCOL = "kyber-chat.json"
+BINARY_PROTOCOL = "kyber-chat.msgpack"
+SUBPROTOCOLS = (BINARY_PROTOCOL, JSON_PROTOCOL)
+
+# Marca de los campos binarios en la forma de bus
+BIN_TAG = "$bin"
+
+# Claves y valores fijos del esquema de tramas (se codifican una sola vez)
+STATIC_STRINGS = (
+    "type", "message", "id", "seq", "sender", "room_id", "content", "timestamp",
+    "message_id", "username", "users", "unread", "messages", "done", "head",
+    "new_message", "message_sent", "typing", "read", "sync", "resync", "error",
+)
+
+_pack_uint16 = struct.Struct(">H").pack
+_pack_uint32 = struct.Struct(">I").pack
+_pack_float = struct.Struct(">d").pack
+_unpack_uint16 = struct.Struct(">H").unpack_from
+_unpack_uint32 = struct.Struct(">I").unpack_from
+_unpack_uint64 = struct.Struct(">Q").unpack_from
+_unpack_int8 = struct.Struct(">b").unpack_from
+_unpack_int16 = struct.Struct(">h").unpack_from
+_unpack_int32 = struct.Struct(">i").unpack_from
+_unpack_int64 = struct.Struct(">q").unpack_from
+_unpack_float32 = struct.Struct(">f").unpack_from
+_unpack_float64 = struct.Struct(">d").unpack_from
+
+
+def _header(length: int, fix: int, fix_limit: int, code16: bytes, code32: bytes) -> bytes:
+    """Cabecera de longitud de un mapa, array o cadena."""
+    if length < fix_limit:
+        return bytes((fix | length,))
+    if length < 0x10000:
+        return code16 + _pack_uint16(length)
+    return code32 + _pack_uint32(length)
+
+
+def _pack_str(value: str) -> bytes:
+    """Codifica una cadena (str de MessagePack)."""
+    data = value.encode("utf-8")
+    length = len(data)
+    if length < 32:
+        return bytes((0xa0 | length,)) + data
+    if length < 0x100:
+        return b"\xd9" + bytes((length,)) + data
+    return _header(length, 0, 0, b"\xda", b"\xdb") + data
+
+
+def _pack_bin(value: bytes) -> bytes:
+    """Codifica una secuencia de bytes (bin de MessagePack)."""
+    length = len(value)
+    if length < 0x100:
+        return b"\xc4" + bytes((length,)) + value
+    return _header(length, 0, 0, b"\xc5", b"\xc6") + bytes(value)
+
+
+def _pack_int(value: int) -> bytes:
+    """Codifica un entero en la representación más corta."""
+    if 0 <= value < 0x80:
+        return bytes((value,))
+    if -32 <= value < 0:
+        return bytes((value & 0xff,))
+    if 0 <= value < 1 << 64:
+        for code, size in ((b"\xcc", 1), (b"\xcd", 2), (b"\xce", 4), (b"\xcf", 8)):
+            if value < 1 << (8 * size):
+                return code + value.to_bytes(size, "big")
+    for code, size in ((b"\xd0", 1), (b"\xd1", 2), (b"\xd2", 4), (b"\xd3", 8)):
+        if -(1 << (8 * size - 1)) <= value < 1 << (8 * size - 1):
+            return code + value.to_bytes(size, "big", signed=True)
+    raise ValueError(f"Entero fuera de rango: {value}")
+
+
+_STATIC: Dict[str, bytes] = {value: _pack_str(value) for value in STATIC_STRINGS}
+
+# Codificador de la extensión, reutilizado entre tramas
+_packer = msgpack.Packer(use_bin_type=True) if msgpack is not None else None
+
+
+def _encode(obj: Any, out: List[bytes]):
+    """Añade a ``out`` la codificación de un valor."""
+    kind = type(obj)
+    if kind is str:
+        packed = _STATIC.get(obj)
+        out.append(packed if packed is not None else _pack_str(obj))
+    elif kind is dict:
+        out.append(_header(len(obj), 0x80, 16, b"\xde", b"\xdf"))
+        for key, value in obj.items():
+            packed = _STATIC.get(key)
+            out.append(packed if packed is not None else _pack_str(key))
+            _encode(value, out)
+    elif kind is int:
+        out.append(_pack_int(obj))
+    elif obj is None:
+        out.append(b"\xc0")
+    elif kind is bool:
+        out.append(b"\xc3" if obj else b"\xc2")
+    elif kind is bytes or kind is bytearray:
+        out.append(_pack_bin(obj))
+    elif kind is list or kind is tuple:
+        out.append(_header(len(obj), 0x90, 16, b"\xdc", b"\xdd"))
+        for value in obj:
+            _encode(value, out)
+    elif kind is float:
+        out.append(b"\xcb" + _pack_float(obj))
+    else:
+        raise TypeError(f"Tipo no serializable en una trama: {kind.__name__}")
+
+
+def encode(obj: Any) -> bytes:
+    """
+    Codifica un valor en MessagePack.
+
+    Args:
+        obj: Valor compuesto de dict, list, str, bytes, int, float, bool y None
+
+    Returns:
+        Trama binaria
+
+    Raises:
+        TypeError: Si algún valor no es serializable
+    """
+    if _packer is not None:
+        return _packer.pack(obj)
+    out: List[bytes] = []
+    _encode(obj, out)
+    return b"".join(out)
+
+
+def _decode(data: bytes, pos: int) -> Tuple[Any, int]:
+    """Decodifica el valor que empieza en ``pos``; devuelve el valor y la posición siguiente."""
+    code = data[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if code >= 0xa0 and code < 0xc0:
+        return _read_str(data, pos, code & 0x1f)
+    if code < 0x90:
+        return _read_map(data, pos, code & 0x0f)
+    if code < 0xa0:
+        return _read_array(data, pos, code & 0x0f)
+
+    if code == 0xc0:
+        return None, pos
+    if code == 0xc2:
+        return False, pos
+    if code == 0xc3:
+        return True, pos
+    if code == 0xc4:
+        return _read_bin(data, pos + 1, data[pos])
+    if code == 0xc5:
+        return _read_bin(data, pos + 2, _unpack_uint16(data, pos)[0])
+    if code == 0xc6:
+        return _read_bin(data, pos + 4, _unpack_uint32(data, pos)[0])
+    if code == 0xd9:
+        return _read_str(data, pos + 1, data[pos])
+    if code == 0xda:
+        return _read_str(data, pos + 2, _unpack_uint16(data, pos)[0])
+    if code == 0xdb:
+        return _read_str(data, pos + 4, _unpack_uint32(data, pos)[0])
+    if code == 0xdc:
+        return _read_array(data, pos + 2, _unpack_uint16(data, pos)[0])
+    if code == 0xdd:
+        return _read_array(data, pos + 4, _unpack_uint32(data, pos)[0])
+    if code == 0xde:
+        return _read_map(data, pos + 2, _unpack_uint16(data, pos)[0])
+    if code == 0xdf:
+        return _read_map(data, pos + 4, _unpack_uint32(data, pos)[0])
+
+    fixed = _FIXED.get(code)
+    if fixed is None:
+        raise ValueError(f"Tipo MessagePack no admitido: 0x{code:02x}")
+    unpack, size = fixed
+    if pos + size > len(data):
+        raise ValueError("Trama truncada")
+    return unpack(data, pos)[0], pos + size
+
+
+# Tipos de tamaño fijo: código -> (función de lectura, bytes)
+_FIXED: Dict[int, Tuple[Callable, int]] = {
+    0xca: (_unpack_float32, 4),
+    0xcb: (_unpack_float64, 8),
+    0xcc: (lambda data, pos: (data[pos],), 1),
+    0xcd: (_unpack_uint16, 2),
+    0xce: (_unpack_uint32, 4),
+    0xcf: (_unpack_uint64, 8),
+    0xd0: (_unpack_int8, 1),
+    0xd1: (_unpack_int16, 2),
+    0xd2: (_unpack_int32, 4),
+    0xd3: (_unpack_int64, 8),
+}
+
+
+def _read_str(data: bytes, pos: int, length: int) -> Tuple[str, int]:
+    end = pos + length
+    if end > len(data):
+        raise ValueError("Trama truncada")
+    return data[pos:end].decode("utf-8"), end
+
+
+def _read_bin(data: bytes, pos: int, length: int) -> Tuple[bytes, int]:
+    end = pos + length
+    if end > len(data):
+        raise ValueError("Trama truncada")
+    return bytes(data[pos:end]), end
+
+
+def _read_array(data: bytes, pos: int, length: int) -> Tuple[List[Any], int]:
+    items = []
+    for _ in range(length):
+        value, pos = _decode(data, pos)
+        items.append(value)
+    return items, pos
+
+
+def _read_map(data: bytes, pos: int, length: int) -> Tuple[Dict[Any, Any], int]:
+    items = {}
+    for _ in range(length):
+        key, pos = _decode(data, pos)
+        value, pos = _decode(data, pos)
+        items[key] = value
+    return items, pos
+
+
+def decode(data: bytes) -> Any:
+    """
+    Decodifica una trama MessagePack.
+
+    Args:
+        data: Trama binaria
+
+    Returns:
+        Valor decodificado
+
+    Raises:
+        ValueError: Si la trama está truncada, es inválida o tiene datos sobrantes
+    """
+    try:
+        if msgpack is not None:
+            return msgpack.unpackb(data, raw=False)
+        obj, pos = _decode(data, 0)
+    except (ValueError, IndexError, struct.error, RecursionError, TypeError) as e:
+        raise ValueError(f"Trama MessagePack inválida: {str(e)}")
+    if pos != len(data):
+        raise ValueError("Datos sobrantes tras la trama")
+    return obj
+
+
+def _bytes_to_base64(obj: Any) -> str:
+    """Representación JSON de los campos binarios para los clientes de texto."""
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.b64encode(obj).decode("ascii")
+    raise TypeError(f"Tipo no serializable en una trama: {type(obj).__name__}")
+
+
+def _untag_bytes(obj: Dict[str, Any]) -> Any:
+    """Reconstruye los campos binarios de la forma de bus."""
+    if len(obj) == 1 and BIN_TAG in obj:
+        return base64.b64decode(obj[BIN_TAG])
+    return obj
+
+
+def jsonable(message: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Adapta un mensaje para respuestas JSON (contenido binario en Base64).
+
+    Args:
+        message: Mensaje del historial
+
+    Returns:
+        El propio mensaje o una copia con el contenido en Base64
+    """
+    if isinstance(message["content"], (bytes, bytearray)):
+        return dict(message, content=_bytes_to_base64(message["content"]))
+    return message
+
+
+class Frame:
+    """
+    Trama saliente con sus codificaciones calculadas bajo demanda y una sola vez.
+    """
+
+    __slots__ = ("_obj", "_wire", "_text", "_binary", "_has_bytes")
+
+    def __init__(self, obj: Any = None, wire: Optional[str] = None):
+        """
+        Inicializa la trama a partir del valor o de su forma de bus.
+
+        Args:
+            obj: Valor de la trama
+            wire: Forma de bus recibida de otro worker
+        """
+        self._obj = obj
+        self._wire = wire
+        self._text: Optional[str] = None
+        self._binary: Optional[bytes] = None
+        self._has_bytes = wire is not None and f'"{BIN_TAG}"' in wire
+
+    @property
+    def obj(self) -> Any:
+        """Valor de la trama."""
+        if self._obj is None:
+            self._obj = json.loads(self._wire, object_hook=_untag_bytes if self._has_bytes else None)
+        return self._obj
+
+    @property
+    def wire(self) -> str:
+        """Forma de bus: JSON con los campos binarios marcados."""
+        if self._wire is None:
+            def tag(value: Any) -> Dict[str, str]:
+                self._has_bytes = True
+                return {BIN_TAG: _bytes_to_base64(value)}
+            self._wire = json.dumps(self._obj, default=tag)
+        return self._wire
+
+    @property
+    def text(self) -> str:
+        """Trama de texto JSON para los clientes del protocolo JSON."""
+        if self._text is None:
+            wire = self.wire
+            # Sin campos binarios la forma de bus es la propia trama JSON
+            self._text = json.dumps(self.obj, default=_bytes_to_base64) if self._has_bytes else wire
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        """Trama binaria para los clientes del protocolo MessagePack."""
+        if self._binary is None:
+            self._binary = encode(self.obj)
+        return self._binary
@@ -0,0 +1,247 @@
+"""
+Conexiones WebSocket del chat con cola de salida propia.
+
+Cada conexión tiene una cola acotada y una tarea escritora, de modo que
+quien envía (la difusión a una sala o el propio bucle de recepción) solo
+encola la trama y nunca espera a un cliente lento. La tarea escritora
+envía la codificación del protocolo negociado (JSON o MessagePack), que
+la trama calcula una sola vez para todas las conexiones. Cuando
+la cola de un cliente se llena se aplica la política configurada:
+
+- ``drop_oldest``: se descarta la trama más antigua.
+- ``coalesce``: se descartan primero las tramas efímeras (indicadores de
+  escritura) y, si no hay, la más antigua.
+- ``disconnect``: se cierra la conexión del cliente lento.
+
+Las tramas efímeras llevan una clave; una trama nueva con la misma clave
+sustituye a la que aún esté en cola en lugar de añadirse.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import WebSocket, status
+
+from app.chat.codec import Frame
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Políticas ante una cola de salida llena
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Peso de cada muestra en la media móvil del retraso de envío
+LAG_EWMA_ALPHA = 0.2
+
+# Identificadores opacos de las conexiones de este worker (para las métricas)
+_connection_ids = itertools.count(1)
+
+
+class ClientConnection:
+    """
+    WebSocket de un usuario con cola de salida acotada y tarea escritora.
+
+    Cada entrada de la cola es ``[trama, momento de encolado, clave]``.
+    """
+
+    def __init__(self, websocket: WebSocket, username: str, session_id: str,
+                 max_queue: int = 256, policy: str = "coalesce", binary: bool = False):
+        """
+        Inicializa la conexión.
+
+        Args:
+            websocket: Conexión WebSocket ya aceptada
+            username: Usuario propietario
+            session_id: ID de la sesión de chat
+            max_queue: Tramas que pueden esperar envío
+            policy: Política ante cola llena (``drop_oldest``, ``coalesce``
+                o ``disconnect``)
+            binary: Si el cliente negoció el protocolo binario (MessagePack)
+
+        Raises:
+            ValueError: Si la política no es válida
+        """
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Política de cola no válida: {policy}")
+        self.websocket = websocket
+        self.username = username
+        self.session_id = session_id
+        self.max_queue = max(1, max_queue)
+        self.policy = policy
+        self.binary = binary
+        self.id = next(_connection_ids)
+        self.closed = False
+        self._queue: Deque[List[Any]] = deque()
+        self._keys: Dict[str, List[Any]] = {}
+        self._wakeup = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sent = 0
+        self._bytes = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._max_depth = 0
+        self._lag = 0.0
+        self._max_lag = 0.0
+
+    def start(self):
+        """Lanza la tarea escritora."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Detiene la tarea escritora y descarta las tramas pendientes."""
+        self.closed = True
+        self._writable.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._queue.clear()
+        self._keys.clear()
+
+    def send(self, payload: Frame, key: Optional[str] = None) -> bool:
+        """
+        Encola una trama sin esperar a que se envíe.
+
+        Args:
+            payload: Trama a enviar
+            key: Clave de coalescencia para tramas efímeras (opcional)
+
+        Returns:
+            True si la trama queda en cola
+        """
+        if self.closed:
+            return False
+        now = time.monotonic()
+        if key is not None:
+            entry = self._keys.get(key)
+            if entry is not None:
+                # Sustituir la trama efímera pendiente conservando su turno
+                entry[0] = payload
+                self._coalesced += 1
+                return True
+
+        if len(self._queue) >= self.max_queue and not self._make_room(key):
+            return False
+
+        entry = [payload, now, key]
+        self._queue.append(entry)
+        if key is not None:
+            self._keys[key] = entry
+        self._max_depth = max(self._max_depth, len(self._queue))
+        self._wakeup.set()
+        return True
+
+    async def wait_writable(self):
+        """
+        Espera a que la cola de salida baje de la mitad de su capacidad.
+
+        Lo usan los envíos largos (la puesta al día tras reconectar) para
+        no desbordar la cola y descartar tramas.
+        """
+        while not self.closed and len(self._queue) > self.max_queue // 2:
+            self._writable.clear()
+            await self._writable.wait()
+
+    def _make_room(self, key: Optional[str]) -> bool:
+        """Aplica la política de cola llena; devuelve si cabe la trama nueva."""
+        if self.policy == "disconnect":
+            logger.warning(f"Cerrando conexión lenta de {self.username} ({len(self._queue)} tramas en cola)")
+            self._dropped += len(self._queue) + 1
+            self.closed = True
+            self._writable.set()
+            self._queue.clear()
+            self._keys.clear()
+            asyncio.ensure_future(self._close_slow())
+            return False
+
+        if self.policy == "coalesce":
+            victim = next((entry for entry in self._queue if entry[2] is not None), None)
+            if victim is None and key is not None:
+                # Cola llena de tramas no efímeras: se pierde la efímera nueva
+                self._dropped += 1
+                return False
+            if victim is not None:
+                self._queue.remove(victim)
+                del self._keys[victim[2]]
+                self._dropped += 1
+                return True
+
+        entry = self._queue.popleft()
+        if entry[2] is not None:
+            del self._keys[entry[2]]
+        self._dropped += 1
+        return True
+
+    async def _close_slow(self):
+        """Cierra el WebSocket de un cliente que no consume sus tramas."""
+        try:
+            await self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception as e:
+            logger.debug(f"Error cerrando WebSocket de {self.username}: {str(e)}")
+
+    async def _run(self):
+        """Bucle escritor: envía las tramas en orden de llegada."""
+        try:
+            while True:
+                while not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                entry = self._queue.popleft()
+                if entry[2] is not None:
+                    del self._keys[entry[2]]
+                if len(self._queue) <= self.max_queue // 2:
+                    self._writable.set()
+                if self.binary:
+                    data = entry[0].binary
+                    await self.websocket.send_bytes(data)
+                else:
+                    data = entry[0].text
+                    await self.websocket.send_text(data)
+                self._sent += 1
+                self._bytes += len(data)
+                lag = time.monotonic() - entry[1]
+                self._lag += LAG_EWMA_ALPHA * (lag - self._lag)
+                self._max_lag = max(self._max_lag, lag)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error enviando por WebSocket a {self.username}: {str(e)}")
+            self.closed = True
+            self._writable.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene las métricas de la conexión.
+
+        Las métricas se publican en ``/api/metrics``, así que identifican la
+        conexión con un número opaco y no con su usuario ni su sesión (el
+        ID de sesión es la credencial del cliente).
+
+        Returns:
+            Identificador opaco, protocolo, profundidad de la cola, retraso
+            de envío, bytes enviados y tramas enviadas, descartadas y
+            coalescidas
+        """
+        oldest = time.monotonic() - self._queue[0][1] if self._queue else 0.0
+        return {
+            "id": self.id,
+            "protocol": "msgpack" if self.binary else "json",
+            "queueDepth": len(self._queue),
+            "maxDepth": self._max_depth,
+            "lagMs": round(self._lag * 1000, 3),
+            "maxLagMs": round(self._max_lag * 1000, 3),
+            "oldestMs": round(oldest * 1000, 3),
+            "sent": self._sent,
+            "bytesSent": self._bytes,
+            "dropped": self._dropped,
+            "coalesced": self._coalesced,
+            "closed": self.closed,
+        }
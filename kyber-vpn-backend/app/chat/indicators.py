@@ -0,0 +1,149 @@
+"""
+Indicadores de escritura agregados por sala.
+
+Cada trama "typing" de un cliente solo renueva la caducidad del usuario
+en la sala. Los cambios reales (empieza a escribir, envía el mensaje o
+caduca) marcan la sala y, una vez por intervalo, cada sala marcada
+recibe una única trama con la lista de quién está escribiendo, solo si
+esa lista ha cambiado desde la última enviada. El coste deja de depender
+del número de pulsaciones.
+"""
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+
+class TypingTracker:
+    """
+    Usuarios escribiendo en cada sala, con caducidad y envío agregado.
+
+    Los usuarios de otros workers llegan como anuncios del bus; para que
+    no caduquen allí mientras siguen escribiendo, cada usuario se vuelve
+    a anunciar como mucho una vez cada media caducidad.
+    """
+
+    def __init__(self, ttl: float = 5.0):
+        """
+        Inicializa el registro.
+
+        Args:
+            ttl: Segundos sin pulsaciones tras los que un usuario deja de escribir
+        """
+        self.ttl = ttl
+        # room_id -> username -> [caducidad, último anuncio]
+        self._typing: Dict[str, Dict[str, List[float]]] = {}
+        self._sent: Dict[str, List[str]] = {}  # room_id -> última lista enviada
+        self._dirty: Set[str] = set()
+        self._touches = 0
+        self._announced = 0
+        self._frames = 0
+
+    def touch(self, room_id: str, username: str, now: Optional[float] = None) -> bool:
+        """
+        Registra una pulsación de un usuario de este worker.
+
+        Args:
+            room_id: ID de la sala
+            username: Nombre de usuario
+            now: Instante actual (reloj monótono)
+
+        Returns:
+            True si hay que anunciarlo al resto de workers
+        """
+        now = time.monotonic() if now is None else now
+        self._touches += 1
+        users = self._typing.setdefault(room_id, {})
+        entry = users.get(username)
+        if entry is None:
+            users[username] = [now + self.ttl, now]
+            self._dirty.add(room_id)
+        else:
+            entry[0] = now + self.ttl
+            if now - entry[1] < self.ttl / 2:
+                return False
+            entry[1] = now
+        self._announced += 1
+        return True
+
+    def renew(self, room_id: str, username: str, now: Optional[float] = None):
+        """
+        Registra el anuncio de un usuario que escribe desde otro worker.
+
+        Args:
+            room_id: ID de la sala
+            username: Nombre de usuario
+            now: Instante actual (reloj monótono)
+        """
+        now = time.monotonic() if now is None else now
+        users = self._typing.setdefault(room_id, {})
+        if username not in users:
+            self._dirty.add(room_id)
+        users[username] = [now + self.ttl, now]
+
+    def stop(self, room_id: str, username: str) -> bool:
+        """
+        Quita a un usuario de los que escriben en una sala.
+
+        Args:
+            room_id: ID de la sala
+            username: Nombre de usuario
+
+        Returns:
+            True si el usuario estaba escribiendo
+        """
+        users = self._typing.get(room_id)
+        if not users or users.pop(username, None) is None:
+            return False
+        self._dirty.add(room_id)
+        return True
+
+    def collect(self, now: Optional[float] = None) -> List[Tuple[str, List[str]]]:
+        """
+        Aplica las caducidades y obtiene las salas cuya lista ha cambiado.
+
+        Args:
+            now: Instante actual (reloj monótono)
+
+        Returns:
+            Pares (room_id, usuarios escribiendo) que hay que enviar
+        """
+        now = time.monotonic() if now is None else now
+        for room_id, users in self._typing.items():
+            expired = [username for username, entry in users.items() if entry[0] <= now]
+            for username in expired:
+                del users[username]
+            if expired:
+                self._dirty.add(room_id)
+
+        changed = []
+        for room_id in self._dirty:
+            users = sorted(self._typing.get(room_id, ()))
+            if not users:
+                self._typing.pop(room_id, None)
+            if users != self._sent.get(room_id, []):
+                changed.append((room_id, users))
+                if users:
+                    self._sent[room_id] = users
+                else:
+                    self._sent.pop(room_id, None)
+        self._dirty.clear()
+        self._frames += len(changed)
+        return changed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de los indicadores de escritura.
+
+        Returns:
+            Pulsaciones recibidas, anuncios al bus, tramas enviadas y usuarios escribiendo
+        """
+        return {
+            "touches": self._touches,
+            "announced": self._announced,
+            "frames": self._frames,
+            "rooms": len(self._typing),
+            "typing": sum(len(users) for users in self._typing.values()),
+        }
@@ -3,38 +3,115 @@ Implementación del sistema de mensajería segura para Kyber VPN.
 
 Este módulo gestiona la mensajería entre usuarios, verificando que estén
 conectados a través de la VPN y utilizando cifrado post-cuántico.
+Usuarios, sesiones, presencia y salas se guardan en el almacén de estado
+compartido, de modo que cualquier worker puede atender a cualquier
+usuario; solo las conexiones WebSocket son propias de cada proceso. La
+pertenencia a las salas se guarda como un conjunto por sala (un espacio
+de nombres con una clave por participante) más un índice usuario ->
+salas, de modo que comprobarla, añadir participantes y listar las salas
+de un usuario no depende del tamaño de las salas ni de su número total. Los
+mensajes se guardan en un almacén SQLite propio, con una caché de los
+más recientes de cada sala delante.
 """
 import asyncio
+import hashlib
 import json
 import uuid
 import logging
-from typing import Dict, List, Set, Optional, Any
+from typing import AsyncIterator, Dict, Iterable, List, Set, Optional, Any, Union
 from datetime import datetime
 import ipaddress
 
-from app.crypto.kyber import KyberManager
+from app.crypto.keypool import KeyPool, key_pool
 from app.crypto.symmetric import AESGCMCipher
 from app.models.schemas import Message, User, ChatRoom
 from app.core.config import settings
 from app.core.security import create_access_token, get_password_hash, verify_password
+from app.core.state import StateBackend, state_backend
+from app.core.bus import MessageBus, message_bus
+from app.chat.cache import RecentMessageCache
+from app.chat.codec import Frame
+from app.chat.indicators import TypingTracker
+from app.chat.store import MessageStore
+from app.network.timers import timer_wheel
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
+# Espacios de nombres en el almacén de estado compartido
+USERS = "chat_users"  # username -> datos y hash de la contraseña
+SESSIONS = "chat_sessions"  # session_id -> username
+VPN_IPS = "chat_vpn_ips"  # vpn_ip -> username
+PRESENCE = "chat_presence"  # username -> User
+ROOMS = "chat_rooms"  # room_id -> ChatRoom (sin participantes)
+ROOM_MEMBERS = "chat_room_members"  # prefijo de "chat_room_members:<room_id>": username -> True
+USER_ROOMS = "chat_user_rooms"  # prefijo de "chat_user_rooms:<username>": room_id -> True
+
+# Temas del bus que escuchan todos los workers: salas creadas y cambios
+# de los indicadores de escritura
+ROOM_EVENTS = "_rooms"
+TYPING_EVENTS = "_typing"
+
+
+def _members_namespace(room_id: str) -> str:
+    """Espacio de nombres con los participantes de una sala."""
+    return f"{ROOM_MEMBERS}:{room_id}"
+
+
+def _user_rooms_namespace(username: str) -> str:
+    """Espacio de nombres con las salas de un usuario."""
+    return f"{USER_ROOMS}:{username}"
+
+
+def _private_room_id(first: str, second: str) -> str:
+    """
+    ID de la sala privada de un par de usuarios (ya en orden canónico).
+    
+    El ID depende solo del par, así que sirve de índice para encontrar el
+    canal existente desde cualquier worker.
+    """
+    digest = hashlib.blake2s(f"{first}\0{second}".encode("utf-8"), digest_size=4).hexdigest()
+    return f"private_{first}_{second}_{digest}"
+
+
 class MessagingService:
     """Servicio de mensajería segura para usuarios de la VPN."""
     
-    def __init__(self):
-        """Inicializa el servicio de mensajería."""
-        self.connected_users: Dict[str, User] = {}  # username -> user
-        self.user_sessions: Dict[str, str] = {}  # session_id -> username
-        self.vpn_sessions: Dict[str, str] = {}  # vpn_ip -> username
+    def __init__(self, state: StateBackend = state_backend, store: Optional[MessageStore] = None,
+                 bus: MessageBus = message_bus, keys: KeyPool = key_pool):
+        """
+        Inicializa el servicio de mensajería.
+        
+        Args:
+            state: Almacén de estado compartido entre workers
+            store: Almacén de mensajes (por defecto, el configurado en CHAT_DB_PATH)
+            bus: Bus de difusión entre workers
+            keys: Reserva de pares de claves Kyber para los canales seguros
+        """
+        self.state = state
+        self.bus = bus
+        self.keys = keys
+        self.store = store or MessageStore(
+            settings.CHAT_DB_PATH,
+            commit_interval=settings.CHAT_COMMIT_INTERVAL,
+            batch_size=settings.CHAT_COMMIT_BATCH,
+        )
+        self.cache = RecentMessageCache(
+            per_room=settings.CHAT_CACHE_MESSAGES,
+            budget_bytes=settings.CHAT_CACHE_BUDGET_BYTES,
+        )
+        self.typing = TypingTracker(ttl=settings.CHAT_TYPING_TTL)
+        self._typing_timer = None
+        # Creaciones de canales seguros en curso: room_id -> resultado compartido
+        self._channel_creations: Dict[str, "asyncio.Future"] = {}
         self.user_key_pairs: Dict[str, Dict] = {}  # username -> keypair
-        self.chat_rooms: Dict[str, ChatRoom] = {}  # room_id -> room
-        self.active_connections: Dict[str, Set] = {}  # room_id -> set of websockets
+        # Índices de difusión de este worker (las conexiones no se comparten)
+        self.active_connections: Dict[str, Set] = {}  # room_id -> set of connections (locales)
+        self.user_connections: Dict[str, Set] = {}  # username -> set of connections (locales)
+        self._connection_rooms: Dict[Any, Set[str]] = {}  # connection -> salas indexadas
         
-        # Datos de usuario simulados (en producción, usaríamos una base de datos)
-        self._users_db = {
+        # Datos de usuario simulados (se cargan en el almacén al iniciar)
+        self._demo_users = {
             "usuario1": {
                 "username": "usuario1",
                 "display_name": "Usuario Demo 1",
@@ -47,21 +124,320 @@ class MessagingService:
             }
         }
         
-        # Crear una sala de chat predeterminada
-        self._create_default_room()
-        
         logger.info("Servicio de mensajería inicializado")
     
-    def _create_default_room(self):
+    async def start(self):
+        """Abre el almacén de mensajes, escucha el bus y carga los usuarios de demo y la sala predeterminada."""
+        await self.store.open()
+        self.bus.set_handler(self._on_bus_message)
+        self.bus.subscribe(ROOM_EVENTS)
+        self.bus.subscribe(TYPING_EVENTS)
+        if self._typing_timer is None:
+            self._typing_timer = timer_wheel.schedule_periodic(
+                settings.CHAT_TYPING_INTERVAL, self._flush_typing
+            )
+        for username, user_data in self._demo_users.items():
+            if await self.state.get(USERS, username) is None:
+                await self.state.set(USERS, username, user_data)
+        await self._migrate_rooms()
+        await self._create_default_room()
+    
+    async def stop(self):
+        """Detiene el envío de indicadores, confirma los mensajes pendientes y cierra el almacén."""
+        timer_wheel.cancel(self._typing_timer)
+        self._typing_timer = None
+        await self.store.close()
+    
+    async def _create_default_room(self):
         """Crea una sala de chat predeterminada para todos los usuarios."""
-        default_room = ChatRoom(
-            id="general",
-            name="Canal General",
-            participants=list(self._users_db.keys()),
-            is_group=True
-        )
-        self.chat_rooms["general"] = default_room
-        self.active_connections["general"] = set()
+        if await self.state.get(ROOMS, "general") is None:
+            default_room = ChatRoom(
+                id="general",
+                name="Canal General",
+                participants=list((await self.state.items(USERS)).keys()),
+                is_group=True
+            )
+            await self._save_room(default_room)
+    
+    async def _save_room(self, room: ChatRoom):
+        """Guarda una sala nueva en el almacén compartido e indexa a sus participantes."""
+        await self.state.set(ROOMS, room.id, room.dict(exclude={"participants"}))
+        for username in room.participants:
+            await self._index_member(room.id, username)
+    
+    async def _index_member(self, room_id: str, username: str):
+        """
+        Registra la pertenencia de un usuario a una sala en los dos índices.
+        
+        Cada pertenencia es una clave propia en ambos índices, así que las
+        altas simultáneas (incluso desde varios workers) no se pisan.
+        """
+        await self.state.set(_members_namespace(room_id), username, True)
+        await self.state.set(_user_rooms_namespace(username), room_id, True)
+    
+    async def _add_member(self, room_id: str, username: str) -> bool:
+        """
+        Añade un participante a una sala existente.
+        
+        Args:
+            room_id: ID de la sala
+            username: Nombre de usuario
+            
+        Returns:
+            True si el usuario no pertenecía ya a la sala
+        """
+        if await self.state.get(ROOMS, room_id) is None or await self.is_member(room_id, username):
+            return False
+        await self._index_member(room_id, username)
+        return True
+    
+    async def _migrate_rooms(self):
+        """
+        Pasa a los índices de pertenencia las salas guardadas con su lista de
+        participantes y las listas de salas por usuario.
+        """
+        legacy = [room for room in (await self.state.items(ROOMS)).values() if "participants" in room]
+        for room in legacy:
+            await self._save_room(ChatRoom(**room))
+        if legacy:
+            logger.info(f"Índices de pertenencia creados para {len(legacy)} salas")
+        
+        legacy_index = list((await self.state.items(USER_ROOMS)).items())
+        for username, room_ids in legacy_index:
+            for room_id in room_ids:
+                await self.state.set(_user_rooms_namespace(username), room_id, True)
+            await self.state.delete(USER_ROOMS, username)
+        if legacy_index:
+            logger.info(f"Índice de salas por usuario migrado para {len(legacy_index)} usuarios")
+    
+    async def is_member(self, room_id: str, username: str) -> bool:
+        """
+        Comprueba si un usuario pertenece a una sala.
+        
+        Args:
+            room_id: ID de la sala
+            username: Nombre de usuario
+            
+        Returns:
+            True si el usuario es participante de la sala
+        """
+        return await self.state.get(_members_namespace(room_id), username) is not None
+    
+    async def get_user_room_ids(self, username: str) -> List[str]:
+        """
+        Obtiene los IDs de las salas a las que pertenece un usuario.
+        
+        Args:
+            username: Nombre de usuario
+            
+        Returns:
+            Lista de IDs de sala (vacía si el usuario no tiene salas)
+        """
+        return list(await self.state.items(_user_rooms_namespace(username)))
+    
+    async def get_room(self, room_id: str) -> Optional[ChatRoom]:
+        """
+        Obtiene una sala de chat.
+        
+        Args:
+            room_id: ID de la sala
+            
+        Returns:
+            Sala o None si no existe
+        """
+        data = await self.state.get(ROOMS, room_id)
+        if data is None:
+            return None
+        return ChatRoom(**data, participants=list(await self.state.items(_members_namespace(room_id))))
+    
+    def _index_room(self, room_id: str, users: Iterable[str]) -> Set:
+        """
+        Añade al índice de una sala las conexiones locales de los usuarios dados.
+        
+        Los usuarios deben ser participantes de la sala con conexiones en
+        este worker. Cada conexión indexada es una referencia a la
+        suscripción del bus para esa sala.
+        """
+        connections = self.active_connections.setdefault(room_id, set())
+        for username in users:
+            for connection in self.user_connections[username]:
+                if connection not in connections:
+                    connections.add(connection)
+                    self._connection_rooms[connection].add(room_id)
+                    self.bus.subscribe(room_id)
+        return connections
+    
+    async def get_room_connections(self, room_id: str) -> Set:
+        """
+        Obtiene las conexiones de este worker que participan en una sala.
+        
+        El índice de cada sala se construye la primera vez que se pide
+        (las salas pueden haberse creado en otro worker) y después se
+        mantiene al conectar y desconectar cada WebSocket.
+        
+        Args:
+            room_id: ID de la sala
+            
+        Returns:
+            Conjunto de conexiones locales (vacío si la sala no existe)
+        """
+        connections = self.active_connections.get(room_id)
+        if connections is None:
+            if await self.state.get(ROOMS, room_id) is None:
+                return set()
+            # Se recorren los usuarios conectados a este worker, no los participantes
+            users = [username for username in list(self.user_connections)
+                     if await self.is_member(room_id, username)]
+            connections = self._index_room(room_id, users)
+        return connections
+    
+    async def attach_connection(self, username: str, connection: Any):
+        """
+        Registra una conexión local de un usuario en los índices de difusión.
+        
+        Todas las salas del usuario quedan indexadas, de modo que este
+        worker se suscribe en el bus a las que tienen conexiones locales.
+        
+        Args:
+            username: Nombre de usuario
+            connection: Conexión WebSocket aceptada (con su cola de salida)
+        """
+        self.user_connections.setdefault(username, set()).add(connection)
+        self._connection_rooms.setdefault(connection, set())
+        for room_id in await self.get_user_room_ids(username):
+            if room_id in self.active_connections:
+                self._index_room(room_id, [username])
+            else:
+                await self.get_room_connections(room_id)
+    
+    def detach_connection(self, username: str, connection: Any):
+        """
+        Elimina una conexión local de los índices de difusión.
+        
+        Args:
+            username: Nombre de usuario
+            connection: Conexión WebSocket cerrada
+        """
+        for room_id in self._connection_rooms.pop(connection, ()):
+            connections = self.active_connections.get(room_id)
+            if connections is not None and connection in connections:
+                connections.discard(connection)
+                self.bus.unsubscribe(room_id)
+                if not connections:
+                    # Sin suscripción el buffer dejaría de recibir los mensajes de otros workers
+                    self.cache.discard(room_id)
+        connections = self.user_connections.get(username)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.user_connections[username]
+    
+    def broadcast(self, room_id: str, frame: Frame, exclude: Any = None, key: Optional[str] = None):
+        """
+        Difunde una trama a los participantes de una sala en todos los workers.
+        
+        Se encola en las conexiones locales ya indexadas y se publica en el
+        bus para el resto de workers.
+        
+        Args:
+            room_id: ID de la sala
+            frame: Trama (cada protocolo se codifica una sola vez)
+            exclude: Conexión local a excluir (opcional)
+            key: Clave de coalescencia para tramas efímeras (opcional)
+        """
+        for connection in self.active_connections.get(room_id, ()):
+            if connection is not exclude:
+                connection.send(frame, key)
+        self.bus.publish(room_id, frame.wire)
+    
+    def _on_bus_message(self, topic: str, payload: str):
+        """Entrega a las conexiones locales una trama publicada por otro worker."""
+        if topic == ROOM_EVENTS:
+            event = json.loads(payload)
+            users = [username for username in event["participants"] if username in self.user_connections]
+            if users:
+                self._index_room(event["room_id"], users)
+            return
+        if topic == TYPING_EVENTS:
+            event = json.loads(payload)
+            # Solo interesan las salas con conexiones en este worker
+            if event["room_id"] in self.active_connections:
+                if event["typing"]:
+                    self.typing.renew(event["room_id"], event["username"])
+                else:
+                    self.typing.stop(event["room_id"], event["username"])
+            return
+        
+        frame = Frame(wire=payload)
+        if self.cache.contains(topic):
+            message = frame.obj.get("message", {})
+            if frame.obj.get("type") == "new_message" and "seq" in message:
+                self.cache.append(message)
+        for connection in self.active_connections.get(topic, ()):
+            connection.send(frame)
+    
+    def set_typing(self, room_id: str, username: str):
+        """
+        Registra que un usuario está escribiendo en una sala.
+        
+        Las pulsaciones repetidas solo renuevan su caducidad; el resto de
+        workers se enteran del inicio y de una renovación por media caducidad.
+        
+        Args:
+            room_id: ID de la sala
+            username: Nombre de usuario
+        """
+        if self.typing.touch(room_id, username):
+            self.bus.publish(TYPING_EVENTS, json.dumps({"room_id": room_id, "username": username, "typing": True}))
+    
+    def clear_typing(self, room_id: str, username: str):
+        """
+        Registra que un usuario ha dejado de escribir en una sala.
+        
+        Args:
+            room_id: ID de la sala
+            username: Nombre de usuario
+        """
+        if self.typing.stop(room_id, username):
+            self.bus.publish(TYPING_EVENTS, json.dumps({"room_id": room_id, "username": username, "typing": False}))
+    
+    def _flush_typing(self):
+        """Envía a las conexiones locales la lista de quién escribe en cada sala que ha cambiado."""
+        for room_id, users in self.typing.collect():
+            connections = self.active_connections.get(room_id)
+            if not connections:
+                continue
+            frame = Frame({"type": "typing", "room_id": room_id, "users": users})
+            for connection in connections:
+                connection.send(frame, f"typing:{room_id}")
+    
+    async def get_session_user(self, session_id: str) -> Optional[str]:
+        """
+        Obtiene el usuario de una sesión de chat, sea cual sea el worker que la creó.
+        
+        Args:
+            session_id: ID de la sesión
+            
+        Returns:
+            Nombre de usuario o None si la sesión no existe
+        """
+        return await self.state.get(SESSIONS, session_id)
+    
+    async def set_user_online(self, username: str, online: bool):
+        """
+        Actualiza la presencia de un usuario.
+        
+        Args:
+            username: Nombre de usuario
+            online: Si el usuario está conectado
+        """
+        data = await self.state.get(PRESENCE, username)
+        if data is None:
+            return
+        user = User(**data)
+        user.is_online = online
+        user.last_seen = datetime.now()
+        await self.state.set(PRESENCE, username, user.dict())
     
     async def register_user(self, username: str, password: str, display_name: str) -> Dict[str, Any]:
         """
@@ -76,24 +452,21 @@ class MessagingService:
             Resultado del registro
         """
         # Verificar si el usuario ya existe
-        if username in self._users_db:
+        if await self.state.get(USERS, username) is not None:
             return {"success": False, "message": "El nombre de usuario ya está en uso"}
         
         # Crear hash de la contraseña
         hashed_password = get_password_hash(password)
         
         # Almacenar usuario en la "base de datos"
-        self._users_db[username] = {
+        await self.state.set(USERS, username, {
             "username": username,
             "display_name": display_name,
             "hashed_password": hashed_password
-        }
+        })
         
         # Añadir usuario a la sala predeterminada
-        if "general" in self.chat_rooms:
-            room = self.chat_rooms["general"]
-            if username not in room.participants:
-                room.participants.append(username)
+        await self._add_member("general", username)
         
         logger.info(f"Usuario registrado: {username}")
         return {"success": True, "message": "Usuario registrado correctamente"}
@@ -125,7 +498,7 @@ class MessagingService:
             return {"success": False, "message": "Dirección IP inválida", "token": None}
         
         # Verificar credenciales
-        user_data = self._users_db.get(username)
+        user_data = await self.state.get(USERS, username)
         if not user_data:
             return {"success": False, "message": "Usuario no encontrado", "token": None}
         
@@ -142,24 +515,18 @@ class MessagingService:
         }
         token = create_access_token(token_data)
         
-        # Almacenar sesión
-        self.user_sessions[session_id] = username
-        self.vpn_sessions[vpn_ip] = username
-        
-        # Crear usuario si no existe
-        if username not in self.connected_users:
-            self.connected_users[username] = User(
-                username=username,
-                display_name=user_data["display_name"],
-                is_online=True,
-                vpn_ip=vpn_ip,
-                last_seen=datetime.now()
-            )
-        else:
-            # Actualizar estado
-            user = self.connected_users[username]
-            user.is_online = True
-            user.vpn_ip = vpn_ip
+        # Almacenar sesión (visible para todos los workers)
+        await self.state.set(SESSIONS, session_id, username)
+        await self.state.set(VPN_IPS, vpn_ip, username)
+        
+        # Crear o actualizar la presencia del usuario
+        await self.state.set(PRESENCE, username, User(
+            username=username,
+            display_name=user_data["display_name"],
+            is_online=True,
+            vpn_ip=vpn_ip,
+            last_seen=datetime.now()
+        ).dict())
         
         logger.info(f"Usuario autenticado: {username} desde IP VPN: {vpn_ip}")
         
@@ -173,100 +540,105 @@ class MessagingService:
             }
         }
     
-    async def get_user_rooms(self, username: str) -> List[Dict[str, Any]]:
+    async def get_user_rooms(self, username: str, with_participants: bool = False) -> List[Dict[str, Any]]:
         """
         Obtiene las salas de chat a las que pertenece un usuario.
         
+        Las salas privadas incluyen siempre a sus dos participantes. Listar
+        los de las salas de grupo cuesta tanto como su número de miembros,
+        así que solo se incluyen si se piden.
+        
         Args:
             username: Nombre del usuario
+            with_participants: Incluir los participantes de las salas de grupo
             
         Returns:
             Lista de salas de chat
         """
-        if username not in self._users_db:
+        if await self.state.get(USERS, username) is None:
             return []
         
         rooms = []
-        for room_id, room in self.chat_rooms.items():
-            if username in room.participants:
-                rooms.append({
-                    "id": room.id,
-                    "name": room.name,
-                    "is_group": room.is_group,
-                    "participants": room.participants,
-                    "created_at": room.created_at.isoformat()
-                })
+        for room_id in await self.get_user_room_ids(username):
+            room = await self.state.get(ROOMS, room_id)
+            if room is not None:
+                entry = {
+                    "id": room["id"],
+                    "name": room["name"],
+                    "is_group": room["is_group"],
+                    "created_at": room["created_at"]
+                }
+                if with_participants or not room["is_group"]:
+                    entry["participants"] = list(await self.state.items(_members_namespace(room_id)))
+                rooms.append(entry)
         
         return rooms
     
-    async def get_room_messages(self, room_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+    async def get_room_messages(self, room_id: str, limit: int = 50,
+                                before: Optional[int] = None,
+                                after: Optional[int] = None) -> List[Dict[str, Any]]:
         """
-        Obtiene los mensajes recientes de una sala de chat.
+        Obtiene una página del historial de una sala de chat.
+        
+        Sin cursores devuelve los mensajes más recientes; ``before`` y
+        ``after`` son números de secuencia (``seq``) de la sala. Las páginas
+        recientes de las salas con conexiones en este worker (suscritas en
+        el bus) se sirven desde la caché en memoria.
         
         Args:
             room_id: ID de la sala
             limit: Número máximo de mensajes a obtener
+            before: Devolver mensajes anteriores a esta secuencia (opcional)
+            after: Devolver mensajes posteriores a esta secuencia (opcional)
             
         Returns:
-            Lista de mensajes
-        """
-        # En una implementación real, estos mensajes vendrían de una base de datos
-        # Aquí simulamos algunos mensajes de ejemplo
-        sample_messages = [
-            {
-                "id": str(uuid.uuid4()),
-                "sender": "usuario1",
-                "room_id": room_id,
-                "content": "Hola a todos, ¿cómo están?",
-                "timestamp": (datetime.now().replace(minute=0, second=0)).isoformat(),
-                "read_by": ["usuario1"]
-            },
-            {
-                "id": str(uuid.uuid4()),
-                "sender": "usuario2",
-                "room_id": room_id,
-                "content": "Todo bien por aquí, la conexión VPN está funcionando muy bien",
-                "timestamp": (datetime.now().replace(minute=5, second=30)).isoformat(),
-                "read_by": ["usuario1", "usuario2"]
-            },
-            {
-                "id": str(uuid.uuid4()),
-                "sender": "usuario1",
-                "room_id": room_id,
-                "content": "¡Excelente! La criptografía post-cuántica hace que sea muy seguro",
-                "timestamp": (datetime.now().replace(minute=10, second=15)).isoformat(),
-                "read_by": ["usuario1"]
-            }
-        ]
-        
-        return sample_messages[:limit]
+            Lista de mensajes en orden cronológico
+        """
+        if not self.active_connections.get(room_id):
+            return await self.store.fetch(room_id, limit, before=before, after=after)
+        
+        page = self.cache.get(room_id, limit, before=before, after=after)
+        if page is not None:
+            return page
+        
+        if before is None and after is None:
+            # Última página: cargar el buffer completo de la sala
+            recent = await self.store.fetch(room_id, max(limit, self.cache.per_room))
+            if self.active_connections.get(room_id):  # Puede haberse desconectado mientras tanto
+                self.cache.fill(room_id, recent)
+            return recent[-limit:]
+        return await self.store.fetch(room_id, limit, before=before, after=after)
     
-    async def create_message(self, session_id: str, room_id: str, content: str) -> Optional[Dict[str, Any]]:
+    async def create_message(self, session_id: str, room_id: str,
+                             content: Union[str, bytes]) -> Optional[Dict[str, Any]]:
         """
         Crea un nuevo mensaje en una sala de chat.
         
         Args:
             session_id: ID de sesión del remitente
             room_id: ID de la sala de chat
-            content: Contenido del mensaje
+            content: Contenido del mensaje (texto, o bytes cifrados en el protocolo binario)
             
         Returns:
             Mensaje creado o None si hay error
         """
+        if not isinstance(content, (str, bytes)):
+            logger.warning(f"Contenido de mensaje no válido en sala {room_id}")
+            return None
+        
         # Verificar sesión válida
-        username = self.user_sessions.get(session_id)
+        username = await self.get_session_user(session_id)
         if not username:
             logger.warning(f"Intento de enviar mensaje con sesión inválida: {session_id}")
             return None
         
         # Verificar que la sala exista
-        if room_id not in self.chat_rooms:
+        if await self.state.get(ROOMS, room_id) is None:
             logger.warning(f"Intento de enviar mensaje a sala inexistente: {room_id}")
             return None
         
         # Verificar pertenencia a la sala
-        room = self.chat_rooms[room_id]
-        if username not in room.participants:
+        if not await self.is_member(room_id, username):
             logger.warning(f"Usuario {username} intenta enviar mensaje a sala {room_id} a la que no pertenece")
             return None
         
@@ -280,58 +652,186 @@ class MessagingService:
             "room_id": room_id,
             "content": content,
             "timestamp": timestamp.isoformat(),
-            "read_by": [username]
         }
         
+        # Guardar el mensaje (la secuencia se asigna al confirmar el lote)
+        try:
+            message["seq"] = await self.store.append(message)
+        except Exception as e:
+            logger.error(f"No se pudo guardar el mensaje de {username} en sala {room_id}: {str(e)}")
+            return None
+        if self.active_connections.get(room_id):
+            self.cache.append(message)
+        self.clear_typing(room_id, username)
+        # Quien escribe ha leído la sala hasta su propio mensaje
+        self.store.mark_read(username, room_id, message["seq"])
+        
         logger.info(f"Mensaje enviado por {username} a sala {room_id}")
         return message
     
+    async def iter_missed(self, username: str, room_id: str, since: int) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Genera las tramas que ponen al día una sala tras una reconexión.
+        
+        Los mensajes posteriores a ``since`` se envían en lotes de
+        CHAT_SYNC_BATCH, leídos de la caché o del almacén; la última trama
+        de la sala lleva ``done``, y solo se envía cuando el cliente ya
+        tiene todo hasta la última secuencia de la sala. Si faltan más de
+        CHAT_SYNC_MAX_GAP mensajes, o no se pueden leer todos, se genera
+        una trama ``resync`` para que el cliente recargue la sala por la API
+        de historial.
+        
+        Args:
+            username: Nombre de usuario
+            room_id: ID de la sala
+            since: Última secuencia que tiene el cliente
+            
+        Yields:
+            Tramas ``sync`` o ``resync`` (ninguna si el usuario no pertenece a la sala)
+        """
+        if not await self.is_member(room_id, username):
+            return
+        head = await self.store.head(room_id)
+        since = max(since, 0)
+        if head - since > settings.CHAT_SYNC_MAX_GAP:
+            yield {"type": "resync", "room_id": room_id, "head": head}
+            return
+        
+        cursor = since
+        while cursor < head:
+            page = await self.get_room_messages(room_id, settings.CHAT_SYNC_BATCH, after=cursor)
+            if len(page) < settings.CHAT_SYNC_BATCH and (not page or page[-1]["seq"] < head):
+                # La caché puede ir por detrás del almacén (bus con retraso)
+                page = await self.store.fetch(room_id, settings.CHAT_SYNC_BATCH, after=cursor)
+            if not page:
+                break
+            cursor = page[-1]["seq"]
+            yield {"type": "sync", "room_id": room_id, "messages": page, "done": cursor >= head}
+        if cursor < head:
+            # Mensajes que no se pueden leer: el cliente debe recargar la sala
+            yield {"type": "resync", "room_id": room_id, "head": head}
+        elif cursor == since:
+            # Sala ya al día: cerrar con una trama vacía
+            yield {"type": "sync", "room_id": room_id, "messages": [], "done": True}
+    
+    async def mark_read(self, username: str, room_id: str, seq: int) -> Optional[int]:
+        """
+        Avanza el cursor de lectura de un usuario en una sala.
+        
+        Args:
+            username: Nombre de usuario
+            room_id: ID de la sala
+            seq: Secuencia del último mensaje leído (0..MAX_SEQ)
+            
+        Returns:
+            Mensajes que siguen sin leer en la sala, o None si el usuario no pertenece a ella
+        """
+        if not await self.is_member(room_id, username):
+            return None
+        # Un cursor por delante de la sala ocultaría sus próximos mensajes
+        self.store.mark_read(username, room_id, min(seq, await self.store.head(room_id)))
+        return (await self.store.unread_counts(username, [room_id]))[room_id]
+    
+    async def get_unread_counts(self, username: str) -> Dict[str, int]:
+        """
+        Obtiene los mensajes no leídos de un usuario en cada una de sus salas.
+        
+        Args:
+            username: Nombre de usuario
+            
+        Returns:
+            Diccionario room_id -> mensajes no leídos
+        """
+        return await self.store.unread_counts(username, await self.get_user_room_ids(username))
+    
     async def create_secure_channel(self, user1: str, user2: str) -> Dict[str, Any]:
         """
-        Crea un canal seguro entre dos usuarios usando intercambio Kyber.
+        Obtiene o crea el canal seguro entre dos usuarios usando intercambio Kyber.
+        
+        Cada par de usuarios tiene un único canal: si ya existe se devuelve,
+        y las peticiones simultáneas para el mismo par comparten una sola
+        creación.
         
         Args:
             user1: Primer usuario
             user2: Segundo usuario
             
         Returns:
-            Información del canal creado
+            Información del canal (``created`` indica si se acaba de crear)
+            
+        Raises:
+            RuntimeError: Si la creación compartida que se esperaba se canceló
         """
+        if user1 == user2:
+            return {"success": False, "message": "No se puede crear un canal seguro con uno mismo"}
+        
         # Verificar que los usuarios existan
-        if user1 not in self._users_db or user2 not in self._users_db:
+        if await self.state.get(USERS, user1) is None or await self.state.get(USERS, user2) is None:
             return {"success": False, "message": "Uno o ambos usuarios no existen"}
         
-        # Generar ID para la sala
-        room_id = f"private_{user1}_{user2}_{str(uuid.uuid4())[:8]}"
+        first, second = sorted((user1, user2))
+        room_id = _private_room_id(first, second)
+        pending = self._channel_creations.get(room_id)
+        if pending is not None:
+            result = await asyncio.shield(pending)
+            return dict(result, created=False)
         
-        # Crear instancia de Kyber para intercambio de claves
-        kyber = KyberManager()
-        
-        # Generar par de claves para el intercambio
-        key_pair = kyber.generate_keypair()
+        future = asyncio.get_running_loop().create_future()
+        self._channel_creations[room_id] = future
+        try:
+            result = await self._open_private_room(room_id, first, second)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Marcarla como recogida aunque nadie más espere
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            if not future.done():
+                # Cancelada a mitad: quien espere la creación compartida no debe quedarse colgado
+                future.set_exception(RuntimeError("Creación del canal seguro interrumpida"))
+                future.exception()
+            del self._channel_creations[room_id]
+        return result
+    
+    async def _open_private_room(self, room_id: str, first: str, second: str) -> Dict[str, Any]:
+        """Devuelve la sala privada de un par de usuarios, creándola si no existe."""
+        data = await self.state.get(ROOMS, room_id)
+        if data is not None:
+            return {"success": True, "room_id": room_id, "name": data["name"], "created": False}
         
+        # Par de claves de la reserva (generado en segundo plano, fuera del bucle de eventos).
         # En una implementación real, aquí realizaríamos el intercambio
         # de claves Kyber entre los usuarios
+        kyber = await self.keys.acquire()
+        
+        # Otro worker puede haber creado la sala mientras tanto
+        data = await self.state.get(ROOMS, room_id)
+        if data is not None:
+            return {"success": True, "room_id": room_id, "name": data["name"], "created": False}
         
         # Crear sala de chat privada
         room = ChatRoom(
             id=room_id,
-            name=f"Chat privado: {user1} - {user2}",
-            participants=[user1, user2],
+            name=f"Chat privado: {first} - {second}",
+            participants=[first, second],
             is_group=False,
-            encryption_key=key_pair["public_key"]  # Simplificado para demo
+            encryption_key=kyber.get_public_key()  # Simplificado para demo
         )
         
         # Almacenar sala
-        self.chat_rooms[room_id] = room
-        self.active_connections[room_id] = set()
+        await self._save_room(room)
+        self._index_room(room.id, [username for username in room.participants if username in self.user_connections])
+        # Avisar al resto de workers por si los participantes están conectados allí
+        self.bus.publish(ROOM_EVENTS, json.dumps({"room_id": room.id, "participants": room.participants}))
         
-        logger.info(f"Canal seguro creado entre {user1} y {user2}")
+        logger.info(f"Canal seguro creado entre {first} y {second}")
         
         return {
             "success": True,
             "room_id": room_id,
-            "name": room.name
+            "name": room.name,
+            "created": True
         }
 
 # Instancia global del servicio de mensajería
@@ -0,0 +1,414 @@
+"""
+Almacenamiento persistente de mensajes del chat.
+
+Los mensajes se guardan en SQLite (modo WAL) con clave primaria
+``(room_id, seq)``, donde ``seq`` es un número de secuencia monótono por
+sala. Esa clave es a la vez el índice de las lecturas: el historial se
+pagina por cursores (``before``/``after`` sobre ``seq``) y nunca con
+OFFSET, así que leer una página cuesta lo mismo sea cual sea el tamaño
+de la sala.
+
+Las escrituras se agrupan (group commit): los mensajes que llegan dentro
+de un intervalo corto se confirman en una sola transacción, y cada
+llamada recibe su número de secuencia cuando el lote ya es durable.
+
+El estado de lectura no se guarda por mensaje: cada par (usuario, sala)
+tiene un cursor con la última secuencia leída, y cada sala su última
+secuencia (``room_heads``). Los no leídos de una sala son la diferencia
+entre ambas, así que contarlos para todas las salas de un usuario cuesta
+una búsqueda por sala. Los avances de cursor se confirman en el mismo
+lote que los mensajes.
+
+Todo el acceso a SQLite se hace en un único hilo de escritura: la espera
+por el bloqueo de otro worker (``BEGIN IMMEDIATE``) y las lecturas no
+detienen el bucle de eventos, y los lotes se confirman en orden de
+llegada.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Salas por consulta al contar no leídos (límite de parámetros de SQLite)
+SQL_VARIABLES = 500
+
+# Mayor secuencia representable (entero de 64 bits con signo de SQLite)
+MAX_SEQ = 2 ** 63 - 1
+
+
+class MessageStore:
+    """
+    Almacén de mensajes por sala con escritura agrupada y paginación por cursor.
+
+    La secuencia de cada sala se asigna dentro de la transacción de
+    escritura (``BEGIN IMMEDIATE``), de modo que es correcta aunque varios
+    workers escriban en el mismo fichero. La conexión solo se usa desde el
+    hilo de ``_executor``.
+    """
+
+    def __init__(self, path: str, commit_interval: float = 0.005, batch_size: int = 256):
+        """
+        Inicializa el almacén.
+
+        Args:
+            path: Ruta del fichero SQLite (":memory:" para pruebas)
+            commit_interval: Segundos que se espera para agrupar escrituras
+            batch_size: Mensajes que fuerzan la confirmación inmediata del lote
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self.batch_size = batch_size
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: List[Tuple[Dict[str, Any], "asyncio.Future"]] = []
+        self._cursors: Dict[Tuple[str, str], int] = {}  # (username, room_id) -> seq pendiente
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._commits = 0
+        self._written = 0
+        self._cursor_writes = 0
+
+    async def open(self):
+        """Arranca el hilo de escritura, abre la base de datos y crea las tablas si no existen."""
+        if self._executor is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-store")
+        try:
+            await self._run(self._open)
+        except BaseException:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            raise
+        logger.info(f"Almacén de mensajes en SQLite: {self.path}")
+
+    def _open(self):
+        """Abre la base de datos (en el hilo de escritura)."""
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Sin transacciones implícitas: cada lote abre la suya
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, timeout=5.0, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " room_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " id TEXT NOT NULL,"
+            " sender TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " timestamp TEXT NOT NULL,"
+            " PRIMARY KEY (room_id, seq)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS room_heads ("
+            " room_id TEXT PRIMARY KEY,"
+            " seq INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS read_cursors ("
+            " username TEXT NOT NULL,"
+            " room_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " PRIMARY KEY (username, room_id)) WITHOUT ROWID"
+        )
+        if self._conn.execute("SELECT 1 FROM room_heads LIMIT 1").fetchone() is None:
+            # Bases de datos anteriores a room_heads: calcularlas una vez
+            self._conn.execute(
+                "INSERT OR IGNORE INTO room_heads (room_id, seq) "
+                "SELECT room_id, MAX(seq) FROM messages GROUP BY room_id"
+            )
+
+    async def close(self):
+        """Confirma los mensajes pendientes, cierra la base de datos y detiene el hilo."""
+        if self._executor is None:
+            return
+        self._flush()
+        executor = self._executor
+        try:
+            await self._run(self._close)
+        finally:
+            self._executor = None
+            executor.shutdown(wait=False)
+
+    def _close(self):
+        """Cierra la conexión (en el hilo de escritura)."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _run(self, function: Callable, *args) -> "asyncio.Future":
+        """Ejecuta una función en el hilo de escritura."""
+        return asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def append(self, message: Dict[str, Any]) -> int:
+        """
+        Guarda un mensaje y espera a que su lote se confirme.
+
+        Args:
+            message: Mensaje con ``id``, ``sender``, ``room_id``, ``content``
+                y ``timestamp``
+
+        Returns:
+            Número de secuencia asignado al mensaje en su sala
+
+        Raises:
+            RuntimeError: Si el almacén no está abierto
+            Exception: El error con el que falló la transacción del lote
+        """
+        if self._executor is None:
+            raise RuntimeError("El almacén de mensajes no se ha abierto")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((message, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        else:
+            self._schedule_flush(loop)
+        return await future
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop):
+        """Programa la confirmación del lote en curso si aún no lo está."""
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.commit_interval, self._flush)
+
+    def mark_read(self, username: str, room_id: str, seq: int):
+        """
+        Avanza el cursor de lectura de un usuario en una sala.
+
+        El avance se confirma con el siguiente lote; los cursores nunca
+        retroceden.
+
+        Args:
+            username: Nombre de usuario
+            room_id: ID de la sala
+            seq: Última secuencia leída
+
+        Raises:
+            RuntimeError: Si el almacén no está abierto
+            ValueError: Si la secuencia no cabe en SQLite (haría fallar el lote entero)
+        """
+        if self._executor is None:
+            raise RuntimeError("El almacén de mensajes no se ha abierto")
+        if not 0 <= seq <= MAX_SEQ:
+            raise ValueError(f"Secuencia fuera de rango: {seq}")
+        key = (username, room_id)
+        if seq > self._cursors.get(key, 0):
+            self._cursors[key] = seq
+            self._schedule_flush(asyncio.get_running_loop())
+
+    def _flush(self):
+        """Envía al hilo de escritura, en una sola transacción, todo lo pendiente."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        cursors, self._cursors = self._cursors, {}
+        if not batch and not cursors:
+            return
+        job = self._run(self._commit, [message for message, _ in batch], cursors)
+        job.add_done_callback(lambda job: self._settle(job, batch, cursors))
+
+    def _commit(self, messages: List[Dict[str, Any]], cursors: Dict[Tuple[str, str], int]) -> List[int]:
+        """
+        Confirma un lote (en el hilo de escritura).
+
+        Args:
+            messages: Mensajes del lote, en orden de llegada
+            cursors: Avances de cursor (username, room_id) -> seq
+
+        Returns:
+            Secuencia asignada a cada mensaje
+        """
+        conn = self._conn
+        if conn is None:
+            raise RuntimeError("El almacén de mensajes está cerrado")
+        seqs: Dict[str, int] = {}
+        rows = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for message in messages:
+                room_id = message["room_id"]
+                if room_id not in seqs:
+                    head = conn.execute(
+                        "SELECT seq FROM room_heads WHERE room_id = ?", (room_id,)
+                    ).fetchone()
+                    seqs[room_id] = head[0] if head else 0
+                seqs[room_id] += 1
+                rows.append((room_id, seqs[room_id], message["id"], message["sender"],
+                             message["content"], message["timestamp"]))
+            conn.executemany(
+                "INSERT INTO messages (room_id, seq, id, sender, content, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.executemany(
+                "INSERT INTO room_heads (room_id, seq) VALUES (?, ?) "
+                "ON CONFLICT(room_id) DO UPDATE SET seq = excluded.seq",
+                seqs.items(),
+            )
+            conn.executemany(
+                "INSERT INTO read_cursors (username, room_id, seq) VALUES (?, ?, ?) "
+                "ON CONFLICT(username, room_id) DO UPDATE SET seq = MAX(seq, excluded.seq)",
+                [(username, room_id, seq) for (username, room_id), seq in cursors.items()],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            # Cualquier error (no solo de SQLite) deja la transacción abierta
+            if conn.in_transaction:
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error as e:
+                    logger.error(f"Error deshaciendo el lote de mensajes: {str(e)}")
+            raise
+        return [row[1] for row in rows]
+
+    def _settle(self, job: "asyncio.Future", batch: List[Tuple[Dict[str, Any], "asyncio.Future"]],
+                cursors: Dict[Tuple[str, str], int]):
+        """Entrega a cada ``append`` su secuencia, o el error del lote."""
+        error = job.exception() if not job.cancelled() else asyncio.CancelledError()
+        if error is not None:
+            logger.error(f"Error guardando {len(batch)} mensajes y {len(cursors)} cursores: {str(error)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        seqs = job.result()
+        self._commits += 1
+        self._written += len(seqs)
+        self._cursor_writes += len(cursors)
+        for (_, future), seq in zip(batch, seqs):
+            if not future.done():
+                future.set_result(seq)
+
+    async def fetch(self, room_id: str, limit: int = 50, before: Optional[int] = None,
+                    after: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Obtiene una página del historial de una sala.
+
+        Sin cursores devuelve los mensajes más recientes. Con ``before``,
+        los anteriores a esa secuencia; con ``after``, los posteriores.
+
+        Args:
+            room_id: ID de la sala
+            limit: Número máximo de mensajes
+            before: Secuencia a partir de la que leer hacia atrás (exclusiva)
+            after: Secuencia a partir de la que leer hacia delante (exclusiva)
+
+        Returns:
+            Mensajes en orden de secuencia ascendente
+        """
+        if self._executor is None:
+            return []
+        return await self._run(self._fetch, room_id, limit, before, after)
+
+    def _fetch(self, room_id: str, limit: int, before: Optional[int],
+               after: Optional[int]) -> List[Dict[str, Any]]:
+        """Lee una página del historial (en el hilo de escritura)."""
+        if self._conn is None:
+            return []
+        columns = "room_id, seq, id, sender, content, timestamp"
+        if after is not None:
+            rows = self._conn.execute(
+                f"SELECT {columns} FROM messages WHERE room_id = ? AND seq > ? "
+                "ORDER BY seq ASC LIMIT ?",
+                (room_id, after, limit),
+            ).fetchall()
+        else:
+            rows = self._conn.execute(
+                f"SELECT {columns} FROM messages WHERE room_id = ? AND seq < ? "
+                "ORDER BY seq DESC LIMIT ?",
+                (room_id, before if before is not None else MAX_SEQ, limit),
+            ).fetchall()
+            rows.reverse()
+        return [_row_to_message(row) for row in rows]
+
+    async def head(self, room_id: str) -> int:
+        """
+        Obtiene la última secuencia confirmada de una sala.
+
+        Args:
+            room_id: ID de la sala
+
+        Returns:
+            Secuencia del último mensaje (0 si la sala no tiene mensajes)
+        """
+        if self._executor is None:
+            return 0
+        return await self._run(self._head, room_id)
+
+    def _head(self, room_id: str) -> int:
+        """Lee la última secuencia de una sala (en el hilo de escritura)."""
+        if self._conn is None:
+            return 0
+        row = self._conn.execute("SELECT seq FROM room_heads WHERE room_id = ?", (room_id,)).fetchone()
+        return row[0] if row else 0
+
+    async def unread_counts(self, username: str, room_ids: List[str]) -> Dict[str, int]:
+        """
+        Cuenta los mensajes no leídos de un usuario en varias salas.
+
+        Args:
+            username: Nombre de usuario
+            room_ids: IDs de las salas
+
+        Returns:
+            Diccionario room_id -> mensajes posteriores a su cursor de lectura
+        """
+        if self._executor is None:
+            return {}
+        # Los avances aún sin confirmar también cuentan
+        pending = {room_id: seq for (user, room_id), seq in self._cursors.items() if user == username}
+        return await self._run(self._unread_counts, username, list(room_ids), pending)
+
+    def _unread_counts(self, username: str, room_ids: List[str], pending: Dict[str, int]) -> Dict[str, int]:
+        """Cuenta los no leídos (en el hilo de escritura)."""
+        counts = dict.fromkeys(room_ids, 0)
+        if self._conn is None:
+            return counts
+        for start in range(0, len(room_ids), SQL_VARIABLES):
+            chunk = room_ids[start:start + SQL_VARIABLES]
+            rows = self._conn.execute(
+                "SELECT h.room_id, h.seq, COALESCE(c.seq, 0) FROM room_heads h "
+                "LEFT JOIN read_cursors c ON c.username = ? AND c.room_id = h.room_id "
+                f"WHERE h.room_id IN ({', '.join('?' * len(chunk))})",
+                [username] + chunk,
+            ).fetchall()
+            for room_id, head, cursor in rows:
+                counts[room_id] = max(head - max(cursor, pending.get(room_id, 0)), 0)
+        return counts
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas del almacén.
+
+        Returns:
+            Mensajes y cursores escritos, transacciones y escrituras pendientes
+        """
+        return {
+            "written": self._written,
+            "cursorWrites": self._cursor_writes,
+            "commits": self._commits,
+            "pending": len(self._pending),
+            "pendingCursors": len(self._cursors),
+            "avgBatch": round(self._written / self._commits, 2) if self._commits else 0.0,
+        }
+
+
+def _row_to_message(row: Tuple) -> Dict[str, Any]:
+    """Convierte una fila de la tabla en el diccionario de mensaje."""
+    room_id, seq, message_id, sender, content, timestamp = row
+    return {
+        "id": message_id,
+        "seq": seq,
+        "sender": sender,
+        "room_id": room_id,
+        "content": content,
+        "timestamp": timestamp,
+    }
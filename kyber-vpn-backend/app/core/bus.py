@@ -0,0 +1,563 @@
+"""
+Bus pub/sub entre procesos para la difusión del chat.
+
+Con varios workers de gunicorn, un mensaje recibido por el WebSocket de
+un worker debe llegar a los participantes conectados a otros. Este
+módulo ofrece un bus por temas (un tema por sala) con tres
+implementaciones intercambiables:
+
+- ``memory://``: entrega entre instancias del propio proceso (un único
+  worker o pruebas).
+- ``unix:///ruta``: un broker en un socket Unix para los workers de una
+  máquina. Lo aloja el worker que obtiene el bloqueo ``<ruta>.lock``; si
+  muere, otro toma el relevo.
+- ``redis://host:puerto/db``: canales pub/sub de un servidor que hable
+  RESP (Redis, KeyDB, Valkey o un sustituto local).
+
+Cada worker solo se suscribe a las salas con WebSockets locales. Las
+publicaciones se acumulan y se envían en un único lote por iteración
+del bucle de eventos, y nunca se entregan al worker que las publicó.
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote, urlparse
+
+from app.core.config import settings
+from app.core.state import RedisConnection
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin broker Unix
+    fcntl = None
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Bytes pendientes de envío a partir de los que se descarta a un suscriptor lento
+MAX_WRITE_BUFFER = 8 * 1024 * 1024
+
+# Tamaño máximo de una trama del broker Unix (una longitud mayor se trata como corrupta)
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+# Publicaciones que se guardan mientras se reconecta con el broker Unix
+MAX_BACKLOG = 10000
+
+# Cabecera de las tramas del broker Unix: longitud del JSON (32 bits, big-endian)
+_FRAME_HEADER = struct.Struct("!I")
+
+Handler = Callable[[str, str], None]
+
+
+class MessageBus:
+    """
+    Interfaz común de los buses.
+
+    Mantiene las suscripciones locales con contador de referencias y el
+    lote de publicaciones pendientes; las subclases solo implementan el
+    transporte (``_send``, ``_on_subscribe`` y ``_on_unsubscribe``).
+    """
+
+    def __init__(self):
+        """Inicializa el bus."""
+        self.origin = uuid.uuid4().hex  # Para no recibir lo publicado por este proceso
+        self._handler: Optional[Handler] = None
+        self._routes: Dict[str, Handler] = {}  # Tema -> función propia (en lugar de la general)
+        self._topics: Dict[str, int] = {}
+        self._outbox: List[Tuple[str, str]] = []
+        self._flush_scheduled = False
+        self._published = 0
+        self._batches = 0
+        self._received = 0
+
+    def set_handler(self, handler: Handler):
+        """
+        Registra la función que recibe los mensajes de otros procesos.
+
+        Args:
+            handler: Función ``(tema, carga)``
+        """
+        self._handler = handler
+
+    def route(self, topic: str, handler: Optional[Handler]):
+        """
+        Registra la función que recibe los mensajes de un tema concreto.
+
+        Args:
+            topic: Tema
+            handler: Función ``(tema, carga)``, o None para retirarla
+        """
+        if handler is None:
+            self._routes.pop(topic, None)
+        else:
+            self._routes[topic] = handler
+
+    async def start(self):
+        """Abre las conexiones del transporte."""
+
+    async def close(self):
+        """Cierra las conexiones del transporte."""
+
+    def subscribe(self, topic: str):
+        """
+        Añade una referencia a un tema (se suscribe con la primera).
+
+        Args:
+            topic: Tema (ID de sala)
+        """
+        count = self._topics.get(topic, 0)
+        self._topics[topic] = count + 1
+        if count == 0:
+            self._on_subscribe(topic)
+
+    def unsubscribe(self, topic: str):
+        """
+        Quita una referencia a un tema (se da de baja con la última).
+
+        Args:
+            topic: Tema (ID de sala)
+        """
+        count = self._topics.get(topic, 0)
+        if count <= 1:
+            if self._topics.pop(topic, None) is not None:
+                self._on_unsubscribe(topic)
+        else:
+            self._topics[topic] = count - 1
+
+    def publish(self, topic: str, payload: str):
+        """
+        Publica una carga en un tema; se envía al final de la iteración actual.
+
+        Args:
+            topic: Tema (ID de sala)
+            payload: Trama ya serializada
+        """
+        self._outbox.append((topic, payload))
+        self._published += 1
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        """Envía en un solo lote las publicaciones acumuladas."""
+        self._flush_scheduled = False
+        batch, self._outbox = self._outbox, []
+        if batch:
+            self._batches += 1
+            try:
+                self._send(batch)
+            except Exception as e:
+                logger.error(f"Error publicando {len(batch)} mensajes en el bus: {str(e)}")
+
+    def _deliver(self, origin: str, topic: str, payload: str):
+        """Entrega un mensaje recibido si es ajeno y hay interés local."""
+        handler = self._routes.get(topic, self._handler)
+        if origin == self.origin or topic not in self._topics or handler is None:
+            return
+        self._received += 1
+        try:
+            handler(topic, payload)
+        except Exception as e:
+            logger.error(f"Error entregando mensaje del bus en {topic}: {str(e)}")
+
+    def _send(self, batch: List[Tuple[str, str]]):
+        raise NotImplementedError
+
+    def _on_subscribe(self, topic: str):
+        """Se suscribe a un tema en el transporte."""
+
+    def _on_unsubscribe(self, topic: str):
+        """Se da de baja de un tema en el transporte."""
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas del bus.
+
+        Returns:
+            Temas suscritos, mensajes publicados y recibidos y lotes enviados
+        """
+        return {
+            "backend": type(self).__name__,
+            "topics": len(self._topics),
+            "published": self._published,
+            "batches": self._batches,
+            "received": self._received,
+        }
+
+
+class MemoryBus(MessageBus):
+    """Bus entre instancias del mismo proceso."""
+
+    _peers: Set["MemoryBus"] = set()
+
+    async def start(self):
+        MemoryBus._peers.add(self)
+
+    async def close(self):
+        MemoryBus._peers.discard(self)
+
+    def _send(self, batch: List[Tuple[str, str]]):
+        for peer in list(MemoryBus._peers):
+            if peer is not self:
+                for topic, payload in batch:
+                    peer._deliver(self.origin, topic, payload)
+
+
+def _encode_frame(message: Dict[str, Any]) -> bytes:
+    """Serializa una trama del protocolo del broker (JSON precedido de su longitud)."""
+    data = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    return _FRAME_HEADER.pack(len(data)) + data
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+    """
+    Lee una trama del protocolo del broker.
+
+    Args:
+        reader: Flujo de la conexión
+
+    Returns:
+        Trama decodificada, o None si la conexión se cerró entre tramas
+
+    Raises:
+        ConnectionError: Si la conexión se cierra a mitad de una trama
+        ValueError: Si la trama es demasiado grande o no es JSON válido
+    """
+    try:
+        header = await reader.readexactly(_FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Trama incompleta") from None
+    (length,) = _FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_BYTES:
+        raise ValueError(f"Trama de {length} bytes demasiado grande")
+    try:
+        data = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Trama incompleta") from None
+    return json.loads(data)
+
+
+class UnixSocketBus(MessageBus):
+    """
+    Bus a través de un broker en un socket Unix.
+
+    Cada worker es cliente del broker. El que obtiene el bloqueo del
+    fichero ``<ruta>.lock`` además lo aloja: reenvía cada lote solo a los
+    clientes suscritos a alguno de sus temas. Las tramas llevan delante su
+    longitud, así que un lote no tiene límite de tamaño de línea. Lo que
+    se publica sin conexión con el broker se guarda (hasta MAX_BACKLOG
+    mensajes) y se envía al reconectar.
+    """
+
+    def __init__(self, path: str):
+        """
+        Inicializa el bus.
+
+        Args:
+            path: Ruta del socket Unix del broker
+        """
+        super().__init__()
+        self.path = path
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: Dict[asyncio.StreamWriter, Set[str]] = {}
+        self._serving: Set[asyncio.Task] = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._backlog: List[Tuple[str, str]] = []  # Publicaciones pendientes de conexión
+        self._dropped = 0
+
+    async def start(self):
+        if self._task is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._server is not None:
+            self._server.close()
+            for task in list(self._serving):
+                task.cancel()
+            if self._serving:
+                await asyncio.gather(*self._serving, return_exceptions=True)
+            self._clients.clear()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def _become_broker(self):
+        """Aloja el broker si el bloqueo está libre."""
+        if self._server is not None or fcntl is None:
+            return
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return
+        self._lock_fd = fd
+        # El socket que quede es de un broker anterior ya muerto
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+        logger.info(f"Broker del bus de chat escuchando en {self.path}")
+
+    async def _run(self):
+        """Mantiene la conexión con el broker (alojándolo si queda libre)."""
+        while True:
+            try:
+                await self._become_broker()
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                self._writer = writer
+                for topic in self._topics:
+                    writer.write(_encode_frame({"sub": topic}))
+                if self._backlog:
+                    backlog, self._backlog = self._backlog, []
+                    writer.write(_encode_frame({"o": self.origin, "m": backlog}))
+                    logger.info(f"Enviadas {len(backlog)} publicaciones pendientes al broker del bus")
+                while True:
+                    frame = await _read_frame(reader)
+                    if frame is None:
+                        raise ConnectionError("Broker cerrado")
+                    for topic, payload in frame["m"]:
+                        self._deliver(frame["o"], topic, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Conexión con el broker del bus perdida: {str(e)}")
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            await asyncio.sleep(0.5)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Atiende a un cliente del broker."""
+        topics: Set[str] = set()
+        self._clients[writer] = topics
+        task = asyncio.current_task()
+        self._serving.add(task)
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                if frame is None:
+                    break
+                if "sub" in frame:
+                    topics.add(frame["sub"])
+                elif "unsub" in frame:
+                    topics.discard(frame["unsub"])
+                else:
+                    self._route(writer, frame)
+        except asyncio.CancelledError:
+            pass  # Broker cerrándose
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Cliente del bus desconectado: {str(e)}")
+        finally:
+            self._serving.discard(task)
+            self._clients.pop(writer, None)
+            writer.close()
+
+    def _route(self, sender: asyncio.StreamWriter, frame: Dict[str, Any]):
+        """Reenvía un lote a cada cliente con la parte de sus temas."""
+        for writer, topics in list(self._clients.items()):
+            if writer is sender or not topics:
+                continue
+            items = [item for item in frame["m"] if item[0] in topics]
+            if not items:
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                logger.warning("Cliente del bus demasiado lento: desconectado")
+                self._clients.pop(writer, None)
+                writer.close()
+                continue
+            writer.write(_encode_frame({"o": frame["o"], "m": items}))
+
+    def _connected(self) -> bool:
+        """Indica si hay conexión abierta con el broker."""
+        return self._writer is not None and not self._writer.is_closing()
+
+    def _write(self, frame: Dict[str, Any]):
+        """
+        Escribe una trama hacia el broker si hay conexión.
+
+        Las suscripciones no se guardan: al reconectar se envían todas.
+        """
+        if self._connected():
+            self._writer.write(_encode_frame(frame))
+
+    def _send(self, batch: List[Tuple[str, str]]):
+        if self._connected():
+            self._writer.write(_encode_frame({"o": self.origin, "m": batch}))
+            return
+        # Sin broker: guardar hasta reconectar, descartando lo más antiguo
+        self._backlog.extend(batch)
+        overflow = len(self._backlog) - MAX_BACKLOG
+        if overflow > 0:
+            del self._backlog[:overflow]
+            self._dropped += overflow
+            logger.warning(f"Bus sin broker: descartadas {overflow} publicaciones antiguas")
+
+    def _on_subscribe(self, topic: str):
+        self._write({"sub": topic})
+
+    def _on_unsubscribe(self, topic: str):
+        self._write({"unsub": topic})
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        stats["connected"] = self._writer is not None
+        stats["broker"] = self._server is not None
+        stats["clients"] = len(self._clients)
+        stats["backlog"] = len(self._backlog)
+        stats["dropped"] = self._dropped
+        return stats
+
+
+class RedisBus(MessageBus):
+    """
+    Bus sobre canales pub/sub de un servidor RESP.
+
+    Cada tema es el canal ``<prefijo>:bus:<tema>``. Cada lote se agrupa
+    por tema (una publicación por tema) y se envía en una sola escritura.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, prefix: str = "kyber"):
+        """
+        Inicializa el bus.
+
+        Args:
+            host: Servidor
+            port: Puerto
+            db: Base de datos
+            password: Contraseña (opcional)
+            prefix: Prefijo de los canales
+        """
+        super().__init__()
+        self.prefix = f"{prefix}:bus:"
+        self._pub = RedisConnection(host, port, db, password)
+        self._sub = RedisConnection(host, port, db, password)
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        self._sub.close()
+        self._pub.close()
+
+    async def _listen(self):
+        """Mantiene la conexión de suscripción y entrega los mensajes."""
+        while True:
+            try:
+                await self._sub.connect()
+                for topic in self._topics:
+                    self._sub._send("SUBSCRIBE", self.prefix + topic)
+                await self._sub._writer.drain()
+                while True:
+                    reply = await self._sub.read_reply()
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        topic = reply[1].decode("utf-8")[len(self.prefix):]
+                        frame = json.loads(reply[2])
+                        for payload in frame["m"]:
+                            self._deliver(frame["o"], topic, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Suscripción del bus perdida: {str(e)}")
+            self._sub.close()
+            await asyncio.sleep(1.0)
+
+    def _send(self, batch: List[Tuple[str, str]]):
+        grouped: "OrderedDict[str, List[str]]" = OrderedDict()
+        for topic, payload in batch:
+            grouped.setdefault(topic, []).append(payload)
+        commands = [
+            ("PUBLISH", self.prefix + topic, json.dumps({"o": self.origin, "m": payloads}))
+            for topic, payloads in grouped.items()
+        ]
+        # El cerrojo de la conexión mantiene el orden entre lotes
+        task = asyncio.ensure_future(self._publish(commands))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _publish(self, commands: List[Tuple[str, ...]]):
+        try:
+            await self._pub.pipeline(commands)
+        except Exception as e:
+            logger.error(f"Error publicando en el bus RESP: {str(e)}")
+
+    def _on_subscribe(self, topic: str):
+        if self._sub.connected:
+            self._sub._send("SUBSCRIBE", self.prefix + topic)
+
+    def _on_unsubscribe(self, topic: str):
+        if self._sub.connected:
+            self._sub._send("UNSUBSCRIBE", self.prefix + topic)
+
+
+def create_message_bus(url: str) -> MessageBus:
+    """
+    Crea el bus indicado por una URL.
+
+    Args:
+        url: ``memory://``, ``unix:///ruta`` o ``redis://[:clave@]host[:puerto][/db]``
+
+    Returns:
+        Bus sin iniciar
+
+    Raises:
+        ValueError: Si el esquema no está soportado
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryBus()
+    if parsed.scheme == "unix":
+        # unix:///data/bus.sock -> ruta relativa; unix:////run/... -> absoluta
+        return UnixSocketBus(unquote(url[len("unix:///"):]))
+    if parsed.scheme == "redis":
+        db = parsed.path.lstrip("/")
+        return RedisBus(
+            host=parsed.hostname or "127.0.0.1",
+            port=parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=unquote(parsed.password) if parsed.password else None,
+        )
+    raise ValueError(f"Bus de mensajes no soportado: {url}")
+
+
+# Instancia global del bus de difusión del chat
+message_bus = create_message_bus(settings.CHAT_BUS_URL)
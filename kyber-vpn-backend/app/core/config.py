@@ -22,6 +22,12 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 8  # 8 days
     ALGORITHM: str = "HS256"
     
+    # Estado compartido entre workers: memory://, sqlite:///ruta o redis://host:puerto/db
+    STATE_BACKEND_URL: str = os.getenv("STATE_BACKEND_URL", "memory://")
+    # Posición de este proceso entre los workers de gunicorn (la fija gunicorn.conf.py)
+    WORKER_INDEX: int = int(os.getenv("WORKER_INDEX", "0"))
+    WORKER_COUNT: int = int(os.getenv("WORKER_COUNT", "1"))
+    
     # Configuración CORS
     CORS_ORIGINS: List[Union[str, AnyHttpUrl]] = [
         "http://localhost:3000",  # Frontend React en desarrollo
@@ -34,8 +40,108 @@ class Settings(BaseSettings):
     VPN_SERVER_IP: str = os.getenv("VPN_SERVER_IP", "10.8.0.1")
     TUN_NAME: str = os.getenv("TUN_NAME", "tun0")
     
+    # Pool de direcciones VPN (leases pegajosos por usuario). Con varios workers
+    # cada uno asigna de su porción de VPN_SUBNET y guarda su estado en
+    # VPN_POOL_STATE_PATH con el índice del worker como sufijo
+    VPN_LEASE_TIME: float = float(os.getenv("VPN_LEASE_TIME", "3600"))
+    VPN_LEASE_GRACE: float = float(os.getenv("VPN_LEASE_GRACE", "300"))
+    VPN_POOL_STATE_PATH: str = os.getenv("VPN_POOL_STATE_PATH", "data/ippool.json")
+    VPN_POOL_SAVE_INTERVAL: float = float(os.getenv("VPN_POOL_SAVE_INTERVAL", "5.0"))
+    
+    # Limitación de ancho de banda y cuotas por sesión (0 = sin límite)
+    SHAPING_RATE_BYTES: int = int(os.getenv("SHAPING_RATE_BYTES", "0"))
+    SHAPING_BURST_BYTES: int = int(os.getenv("SHAPING_BURST_BYTES", "0"))
+    SHAPING_POLICY: str = os.getenv("SHAPING_POLICY", "drop")  # drop, queue
+    SHAPING_QUEUE_PACKETS: int = int(os.getenv("SHAPING_QUEUE_PACKETS", "64"))
+    QUOTA_MONTHLY_BYTES: int = int(os.getenv("QUOTA_MONTHLY_BYTES", "0"))
+    QUOTA_DB_PATH: str = os.getenv("QUOTA_DB_PATH", "data/quota.db")  # Compartida por los workers de la máquina
+    QUOTA_FLUSH_INTERVAL: float = float(os.getenv("QUOTA_FLUSH_INTERVAL", "5.0"))
+    
+    # Sondas de latencia (RTT) sobre el túnel
+    LATENCY_PROBE_ACTIVE_INTERVAL: float = float(os.getenv("LATENCY_PROBE_ACTIVE_INTERVAL", "1.0"))
+    LATENCY_PROBE_IDLE_INTERVAL: float = float(os.getenv("LATENCY_PROBE_IDLE_INTERVAL", "10.0"))
+    LATENCY_PROBE_TIMEOUT: float = float(os.getenv("LATENCY_PROBE_TIMEOUT", "1.0"))
+    # Usar un servidor de eco local en lugar del servidor VPN remoto (solo para demo:
+    # mide el RTT del propio host, no el del túnel)
+    LATENCY_PROBE_LOCAL_ECHO: bool = os.getenv("LATENCY_PROBE_LOCAL_ECHO", "False").lower() == "true"
+    
+    # Comprobaciones de salud de los servidores VPN
+    # (desactivadas por defecto: los servidores de demo no son accesibles)
+    SERVER_HEALTH_CHECKS: bool = os.getenv("SERVER_HEALTH_CHECKS", "False").lower() == "true"
+    SERVER_HEALTH_INTERVAL: float = float(os.getenv("SERVER_HEALTH_INTERVAL", "30.0"))
+    SERVER_HEALTH_TIMEOUT: float = float(os.getenv("SERVER_HEALTH_TIMEOUT", "2.0"))
+    SERVER_HEALTH_CONCURRENCY: int = int(os.getenv("SERVER_HEALTH_CONCURRENCY", "16"))
+    
+    # Colocación automática de sesiones ("serverId": "auto")
+    SERVER_DEFAULT_CAPACITY: int = int(os.getenv("SERVER_DEFAULT_CAPACITY", "1000"))
+    PLACEMENT_RTT_SCALE_MS: float = float(os.getenv("PLACEMENT_RTT_SCALE_MS", "50.0"))
+    # Sesiones por servidor de cada worker en el estado compartido: intervalo de
+    # sincronización y caducidad de los recuentos de un worker que no los refresca
+    SERVER_LOAD_SYNC_INTERVAL: float = float(os.getenv("SERVER_LOAD_SYNC_INTERVAL", "1.0"))
+    SERVER_LOAD_TTL: float = float(os.getenv("SERVER_LOAD_TTL", "10.0"))
+    
+    # Trabajo periódico de las sesiones (rueda de temporizadores, 0 = desactivado)
+    TIMER_WHEEL_TICK: float = float(os.getenv("TIMER_WHEEL_TICK", "0.1"))
+    VPN_STATS_INTERVAL: float = float(os.getenv("VPN_STATS_INTERVAL", "1.0"))
+    VPN_REKEY_INTERVAL: float = float(os.getenv("VPN_REKEY_INTERVAL", "3600"))
+    VPN_IDLE_TIMEOUT: float = float(os.getenv("VPN_IDLE_TIMEOUT", "900"))
+    VPN_LEASE_SWEEP_INTERVAL: float = float(os.getenv("VPN_LEASE_SWEEP_INTERVAL", "30.0"))
+    
+    # Sesiones de otros workers: latido de cada worker en el estado compartido,
+    # caducidad de las sesiones de un worker sin latido y espera máxima de las
+    # operaciones reenviadas al worker que atiende la sesión
+    VPN_WORKER_HEARTBEAT: float = float(os.getenv("VPN_WORKER_HEARTBEAT", "5.0"))
+    VPN_WORKER_TTL: float = float(os.getenv("VPN_WORKER_TTL", "15.0"))
+    VPN_FORWARD_TIMEOUT: float = float(os.getenv("VPN_FORWARD_TIMEOUT", "2.0"))
+    
+    # Cookies de handshake: handshakes en curso a partir de los que se exigen (0 = nunca)
+    HANDSHAKE_COOKIE_THRESHOLD: int = int(os.getenv("HANDSHAKE_COOKIE_THRESHOLD", "16"))
+    HANDSHAKE_COOKIE_LIFETIME: float = float(os.getenv("HANDSHAKE_COOKIE_LIFETIME", "120"))
+    
+    # Admisión de handshakes (concurrencia 0 = un hueco por hilo de KEY_POOL_WORKERS)
+    ADMISSION_CONCURRENCY: int = int(os.getenv("ADMISSION_CONCURRENCY", "0"))
+    ADMISSION_QUEUE_SIZE: int = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+    ADMISSION_MAX_WAIT: float = float(os.getenv("ADMISSION_MAX_WAIT", "5.0"))
+    
+    # Flujo de estado por SSE/WebSocket (frecuencia máxima por suscriptor, Hz)
+    STATUS_STREAM_MAX_RATE: float = float(os.getenv("STATUS_STREAM_MAX_RATE", "1.0"))
+    
+    # Instantáneas de sesiones para reinicios en caliente ("" = desactivadas),
+    # con el índice del worker como sufijo si hay varios. Sin SNAPSHOT_NODE_KEY
+    # no se activan: cifran las claves de sesión
+    SNAPSHOT_PATH: str = os.getenv("SNAPSHOT_PATH", "data/sessions.snap")
+    SNAPSHOT_NODE_KEY: str = os.getenv("SNAPSHOT_NODE_KEY", "")
+    SNAPSHOT_INTERVAL: float = float(os.getenv("SNAPSHOT_INTERVAL", "1.0"))
+    SNAPSHOT_MAX_AGE: float = float(os.getenv("SNAPSHOT_MAX_AGE", "300"))
+    SNAPSHOT_SLOTS: int = int(os.getenv("SNAPSHOT_SLOTS", "1024"))
+    SNAPSHOT_NONCE_WINDOW: int = int(os.getenv("SNAPSHOT_NONCE_WINDOW", "1048576"))
+    
     # Configuración de criptografía
     KYBER_PARAMETER: str = os.getenv("KYBER_PARAMETER", "kyber768")  # kyber512, kyber768, kyber1024
+    # Reserva de pares de claves pregenerados en segundo plano
+    KEY_POOL_SIZE: int = int(os.getenv("KEY_POOL_SIZE", "8"))
+    KEY_POOL_WORKERS: int = int(os.getenv("KEY_POOL_WORKERS", "2"))
+    
+    # Configuración del chat
+    # Cola de salida por WebSocket y política ante clientes lentos
+    # (drop_oldest, coalesce o disconnect)
+    CHAT_SEND_QUEUE_SIZE: int = int(os.getenv("CHAT_SEND_QUEUE_SIZE", "256"))
+    CHAT_SLOW_CONSUMER_POLICY: str = os.getenv("CHAT_SLOW_CONSUMER_POLICY", "coalesce")
+    # Almacén de mensajes (SQLite) y agrupación de escrituras
+    CHAT_DB_PATH: str = os.getenv("CHAT_DB_PATH", "data/chat.db")
+    CHAT_COMMIT_INTERVAL: float = float(os.getenv("CHAT_COMMIT_INTERVAL", "0.005"))
+    CHAT_COMMIT_BATCH: int = int(os.getenv("CHAT_COMMIT_BATCH", "256"))
+    # Bus de difusión entre workers (memory://, unix:///ruta o redis://host:puerto/db)
+    CHAT_BUS_URL: str = os.getenv("CHAT_BUS_URL", "memory://")
+    # Caché de mensajes recientes por sala y presupuesto de memoria global
+    CHAT_CACHE_MESSAGES: int = int(os.getenv("CHAT_CACHE_MESSAGES", "200"))
+    CHAT_CACHE_BUDGET_BYTES: int = int(os.getenv("CHAT_CACHE_BUDGET_BYTES", str(64 * 1024 * 1024)))
+    # Indicadores de escritura: caducidad sin pulsaciones e intervalo de envío por sala
+    CHAT_TYPING_TTL: float = float(os.getenv("CHAT_TYPING_TTL", "5.0"))
+    CHAT_TYPING_INTERVAL: float = float(os.getenv("CHAT_TYPING_INTERVAL", "0.5"))
+    # Puesta al día al reconectar: mensajes por trama y hueco máximo antes de pedir resincronización completa
+    CHAT_SYNC_BATCH: int = int(os.getenv("CHAT_SYNC_BATCH", "100"))
+    CHAT_SYNC_MAX_GAP: int = int(os.getenv("CHAT_SYNC_MAX_GAP", "1000"))
     
     # Servidores VPN predefinidos (para desarrollo/demo)
     # En producción, estos datos vendrían de una base de datos
@@ -47,7 +153,8 @@ class Settings(BaseSettings):
             "ip": "192.168.1.1",
             "port": 1194,
             "status": "online",
-            "latency": 25
+            "latency": 25,
+            "capacity": 1000
         },
         {
             "id": "server2",
@@ -56,7 +163,8 @@ class Settings(BaseSettings):
             "ip": "192.168.1.2",
             "port": 1194,
             "status": "online",
-            "latency": 35
+            "latency": 35,
+            "capacity": 1000
         },
         {
             "id": "server3",
@@ -65,7 +173,8 @@ class Settings(BaseSettings):
             "ip": "192.168.1.3",
             "port": 1194,
             "status": "online",
-            "latency": 50
+            "latency": 50,
+            "capacity": 500
         }
     ]
     
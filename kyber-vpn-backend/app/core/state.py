@@ -0,0 +1,679 @@
+"""
+Estado compartido entre procesos de la aplicación.
+
+En producción gunicorn arranca varios workers, cada uno con su propia
+memoria. Este módulo ofrece un almacén clave-valor asíncrono, organizado
+en espacios de nombres, con tres implementaciones intercambiables:
+
+- ``memory://``: diccionarios en el propio proceso (desarrollo).
+- ``sqlite:///ruta``: base de datos SQLite en modo WAL compartida por
+  todos los workers de una misma máquina.
+- ``redis://host:puerto/db``: cualquier servidor que hable el protocolo
+  RESP de Redis (Redis, KeyDB, Valkey o un sustituto local).
+
+Las implementaciones compartidas cachean las lecturas en el proceso y
+invalidan las claves que escribe otro worker: SQLite mediante un registro
+de cambios que se consulta cuando ``PRAGMA data_version`` cambia, y Redis
+mediante un canal pub/sub.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import unquote, urlparse
+
+from app.core.config import settings
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Marcador de "clave inexistente" en la caché de lecturas
+_MISSING = object()
+
+# Registro de cambios de SQLite: entradas que se conservan y escrituras entre purgas
+STATE_LOG_RETAIN = 10000
+STATE_LOG_PRUNE_EVERY = 1000
+
+
+def _encode(value: Any) -> str:
+    """Serializa un valor a JSON (las fechas se guardan en ISO 8601)."""
+    return json.dumps(value, separators=(",", ":"), default=lambda o: o.isoformat())
+
+
+class StateBackend:
+    """
+    Interfaz común de los almacenes de estado.
+
+    Los valores deben ser serializables a JSON. Las subclases compartidas
+    usan la caché de lecturas de esta clase.
+    """
+
+    def __init__(self):
+        """Inicializa la caché de lecturas."""
+        self._cache: Dict[Tuple[str, str], Any] = {}
+        self._items_cache: Dict[str, Dict[str, Any]] = {}
+        # Generaciones por clave y por espacio de nombres: cambian con cada
+        # escritura o invalidación, para no cachear una lectura que se haya
+        # cruzado con ellas
+        self._epoch = 0
+        self._generations: Dict[Tuple[str, str], int] = {}
+        self._namespace_generations: Dict[str, int] = {}
+        self._hits = 0
+        self._misses = 0
+
+    async def start(self):
+        """Abre las conexiones necesarias."""
+
+    async def close(self):
+        """Cierra las conexiones abiertas."""
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        """
+        Obtiene un valor.
+
+        Args:
+            namespace: Espacio de nombres (p. ej. "users")
+            key: Clave dentro del espacio de nombres
+
+        Returns:
+            Valor almacenado o None si no existe
+        """
+        raise NotImplementedError
+
+    async def set(self, namespace: str, key: str, value: Any):
+        """
+        Guarda un valor.
+
+        Args:
+            namespace: Espacio de nombres
+            key: Clave dentro del espacio de nombres
+            value: Valor serializable a JSON
+        """
+        raise NotImplementedError
+
+    async def delete(self, namespace: str, key: str) -> bool:
+        """
+        Elimina un valor.
+
+        Args:
+            namespace: Espacio de nombres
+            key: Clave dentro del espacio de nombres
+
+        Returns:
+            True si la clave existía
+        """
+        raise NotImplementedError
+
+    async def items(self, namespace: str) -> Dict[str, Any]:
+        """
+        Obtiene todos los valores de un espacio de nombres.
+
+        Args:
+            namespace: Espacio de nombres
+
+        Returns:
+            Copia del diccionario clave -> valor
+        """
+        raise NotImplementedError
+
+    def _cached(self, namespace: str, key: str) -> Any:
+        """Busca un valor en la caché (``_MISSING`` si no está cacheado)."""
+        value = self._cache.get((namespace, key), _MISSING)
+        if value is _MISSING:
+            items = self._items_cache.get(namespace)
+            if items is not None:
+                value = items.get(key)
+        if value is _MISSING:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return value
+
+    def _generation(self, namespace: str, key: Optional[str] = None) -> Tuple[int, int]:
+        """
+        Obtiene la generación de una clave (o de todo el espacio de nombres).
+
+        Se toma antes de leer del servidor: si ha cambiado al recibir la
+        respuesta, la lectura puede estar obsoleta y no se cachea.
+        """
+        if key is None:
+            return self._epoch, self._namespace_generations.get(namespace, 0)
+        return self._epoch, self._generations.get((namespace, key), 0)
+
+    def _bump(self, namespace: str, key: str):
+        """Avanza la generación de una clave y la de su espacio de nombres."""
+        self._generations[(namespace, key)] = self._generations.get((namespace, key), 0) + 1
+        self._namespace_generations[namespace] = self._namespace_generations.get(namespace, 0) + 1
+
+    def _store(self, namespace: str, key: str, value: Any):
+        """Actualiza la caché tras una escritura propia (None = borrado)."""
+        self._bump(namespace, key)
+        self._cache[(namespace, key)] = value
+        items = self._items_cache.get(namespace)
+        if items is not None:
+            if value is None:
+                items.pop(key, None)
+            else:
+                items[key] = value
+
+    def _invalidate(self, namespace: str, key: str):
+        """Descarta de la caché una clave modificada por otro proceso."""
+        self._bump(namespace, key)
+        self._cache.pop((namespace, key), None)
+        self._items_cache.pop(namespace, None)
+
+    def _invalidate_all(self):
+        """Descarta toda la caché."""
+        self._epoch += 1
+        self._generations.clear()
+        self._namespace_generations.clear()
+        self._cache.clear()
+        self._items_cache.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de la caché de lecturas.
+
+        Returns:
+            Tipo de almacén, aciertos, fallos y entradas cacheadas
+        """
+        return {
+            "backend": type(self).__name__,
+            "hits": self._hits,
+            "misses": self._misses,
+            "cached": len(self._cache) + sum(len(items) for items in self._items_cache.values()),
+        }
+
+
+class MemoryBackend(StateBackend):
+    """Almacén en la memoria del proceso (solo para un único worker)."""
+
+    def __init__(self):
+        """Inicializa el almacén vacío."""
+        super().__init__()
+        self._data: Dict[str, Dict[str, Any]] = {}
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        return self._data.get(namespace, {}).get(key)
+
+    async def set(self, namespace: str, key: str, value: Any):
+        # Copia por serialización para no compartir objetos mutables
+        self._data.setdefault(namespace, {})[key] = json.loads(_encode(value))
+
+    async def delete(self, namespace: str, key: str) -> bool:
+        return self._data.get(namespace, {}).pop(key, None) is not None
+
+    async def items(self, namespace: str) -> Dict[str, Any]:
+        return dict(self._data.get(namespace, {}))
+
+
+class SQLiteBackend(StateBackend):
+    """
+    Almacén en SQLite (modo WAL) compartido por los workers de una máquina.
+
+    Cada escritura se anota, en la misma transacción, en un registro de
+    cambios (``state_log``). Cuando ``PRAGMA data_version`` indica que otra
+    conexión ha escrito, se leen las entradas nuevas del registro y solo se
+    descartan de la caché las claves afectadas. Las llamadas a SQLite se
+    hacen en un hilo, de modo que esperar el bloqueo de escritura de otro
+    worker no detiene el bucle de eventos.
+    """
+
+    def __init__(self, path: str):
+        """
+        Inicializa el almacén.
+
+        Args:
+            path: Ruta del fichero SQLite
+        """
+        super().__init__()
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()  # Una operación a la vez sobre la conexión
+        self._data_version: Optional[int] = None
+        self._log_seq = 0  # Última entrada del registro de cambios ya aplicada
+        self._own_seqs: Set[int] = set()  # Entradas propias aún no alcanzadas
+        self._writes = 0
+
+    async def start(self):
+        await asyncio.to_thread(self._open)
+
+    def _open(self):
+        with self._lock:
+            if self._conn is not None:
+                return
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state_log ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL)"
+            )
+            self._conn.commit()
+            self._log_seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM state_log").fetchone()[0]
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        logger.info(f"Estado compartido en SQLite: {self.path}")
+
+    async def close(self):
+        await asyncio.to_thread(self._close)
+
+    def _close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Obtiene la conexión y descarta de la caché lo que otro proceso haya cambiado.
+
+        Se llama con ``_lock`` adquirido.
+        """
+        if self._conn is None:
+            raise RuntimeError("El almacén SQLite no se ha iniciado")
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            rows = self._conn.execute(
+                "SELECT seq, namespace, key FROM state_log WHERE seq > ? ORDER BY seq",
+                (self._log_seq,),
+            ).fetchall()
+            if rows and rows[0][0] > self._log_seq + 1 and rows[0][0] not in self._own_seqs:
+                # Entradas ya purgadas del registro: no se sabe qué cambió
+                self._invalidate_all()
+            for seq, namespace, key in rows:
+                if seq in self._own_seqs:
+                    self._own_seqs.discard(seq)
+                else:
+                    self._invalidate(namespace, key)
+            if rows:
+                self._log_seq = rows[-1][0]
+        return self._conn
+
+    def _log(self, conn: sqlite3.Connection, namespace: str, key: str):
+        """Anota un cambio propio en el registro (dentro de la transacción de la escritura)."""
+        seq = conn.execute(
+            "INSERT INTO state_log (namespace, key) VALUES (?, ?)", (namespace, key)
+        ).lastrowid
+        if seq == self._log_seq + 1:
+            self._log_seq = seq
+        else:
+            self._own_seqs.add(seq)
+        self._writes += 1
+        if self._writes % STATE_LOG_PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM state_log WHERE seq <= ?", (seq - STATE_LOG_RETAIN,))
+
+    def _get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            conn = self._connection()
+            value = self._cached(namespace, key)
+            if value is not _MISSING:
+                return value
+            row = conn.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            value = json.loads(row[0]) if row else None
+            self._cache[(namespace, key)] = value
+            return value
+
+    def _set(self, namespace: str, key: str, encoded: str):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT INTO state (namespace, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value",
+                    (namespace, key, encoded),
+                )
+                self._log(conn, namespace, key)
+            self._store(namespace, key, json.loads(encoded))
+
+    def _delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                deleted = conn.execute(
+                    "DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+                ).rowcount
+                self._log(conn, namespace, key)
+            self._store(namespace, key, None)
+            return deleted > 0
+
+    def _items(self, namespace: str) -> Dict[str, Any]:
+        with self._lock:
+            conn = self._connection()
+            items = self._items_cache.get(namespace)
+            if items is None:
+                rows = conn.execute(
+                    "SELECT key, value FROM state WHERE namespace = ?", (namespace,)
+                ).fetchall()
+                items = self._items_cache[namespace] = {key: json.loads(value) for key, value in rows}
+                self._misses += 1
+            else:
+                self._hits += 1
+            # Copia: ``_store`` actualiza el diccionario cacheado desde el hilo de SQLite
+            return dict(items)
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self._get, namespace, key)
+
+    async def set(self, namespace: str, key: str, value: Any):
+        await asyncio.to_thread(self._set, namespace, key, _encode(value))
+
+    async def delete(self, namespace: str, key: str) -> bool:
+        return await asyncio.to_thread(self._delete, namespace, key)
+
+    async def items(self, namespace: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(self._items, namespace)
+
+
+class RedisError(Exception):
+    """Error devuelto por el servidor RESP."""
+
+
+RespValue = Union[None, int, bytes, List[Any]]
+
+
+class RedisConnection:
+    """Conexión mínima con un servidor que habla el protocolo RESP2."""
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None):
+        """
+        Inicializa la conexión (sin abrirla).
+
+        Args:
+            host: Servidor
+            port: Puerto
+            db: Base de datos a seleccionar
+            password: Contraseña (opcional)
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock: Optional[asyncio.Lock] = None  # Se crea dentro del bucle de eventos
+
+    async def connect(self):
+        """Abre la conexión, se autentica y selecciona la base de datos."""
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._command("AUTH", self.password)
+        if self.db:
+            await self._command("SELECT", str(self.db))
+
+    def close(self):
+        """Cierra la conexión."""
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    def _send(self, *args: Union[str, bytes]):
+        """Escribe un comando como array de bulk strings."""
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg.encode("utf-8") if isinstance(arg, str) else arg
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._writer.write(b"".join(parts))
+
+    async def read_reply(self) -> RespValue:
+        """
+        Lee una respuesta del servidor.
+
+        Returns:
+            Entero, bytes, lista o None según el tipo RESP
+
+        Raises:
+            RedisError: Si el servidor devuelve un error
+            ConnectionError: Si la conexión se cierra
+        """
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Conexión cerrada por el servidor")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            raise RedisError(payload.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self.read_reply() for _ in range(length)]
+        raise RedisError(f"Respuesta RESP desconocida: {line!r}")
+
+    async def _command(self, *args: Union[str, bytes]) -> RespValue:
+        self._send(*args)
+        await self._writer.drain()
+        return await self.read_reply()
+
+    async def execute(self, *args: Union[str, bytes]) -> RespValue:
+        """
+        Ejecuta un comando, reconectando si la conexión se había perdido.
+
+        Args:
+            *args: Comando y argumentos
+
+        Returns:
+            Respuesta del servidor
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.connected:
+                await self.connect()
+            try:
+                return await self._command(*args)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                self.close()
+                raise
+
+    async def pipeline(self, commands: List[Tuple[Union[str, bytes], ...]]) -> List[RespValue]:
+        """
+        Ejecuta varios comandos con una sola escritura y lee todas las respuestas.
+
+        Args:
+            commands: Comandos con sus argumentos
+
+        Returns:
+            Respuestas en el mismo orden
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.connected:
+                await self.connect()
+            try:
+                for args in commands:
+                    self._send(*args)
+                await self._writer.drain()
+                return [await self.read_reply() for _ in commands]
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                self.close()
+                raise
+
+
+class RedisBackend(StateBackend):
+    """
+    Almacén en un servidor RESP (Redis o compatible).
+
+    Cada espacio de nombres es un hash ``<prefijo>:<espacio>``. Tras cada
+    escritura se publica la clave modificada en un canal de invalidación
+    al que está suscrito cada worker; la caché solo se usa mientras la
+    suscripción está activa.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, prefix: str = "kyber"):
+        """
+        Inicializa el almacén.
+
+        Args:
+            host: Servidor
+            port: Puerto
+            db: Base de datos
+            password: Contraseña (opcional)
+            prefix: Prefijo de las claves y del canal de invalidación
+        """
+        super().__init__()
+        self.prefix = prefix
+        self._channel = f"{prefix}:invalidate"
+        self._origin = uuid.uuid4().hex  # Para ignorar las invalidaciones propias
+        self._conn = RedisConnection(host, port, db, password)
+        self._sub = RedisConnection(host, port, db, password)
+        self._subscribed = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+            logger.info(f"Estado compartido en RESP: {self._conn.host}:{self._conn.port}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._sub.close()
+        self._conn.close()
+
+    async def _listen(self):
+        """Mantiene la suscripción al canal de invalidación."""
+        while True:
+            try:
+                await self._sub.connect()
+                self._sub._send("SUBSCRIBE", self._channel)
+                await self._sub._writer.drain()
+                await self._sub.read_reply()  # Confirmación de la suscripción
+                self._invalidate_all()
+                self._subscribed = True
+                while True:
+                    reply = await self._sub.read_reply()
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        origin, namespace, key = reply[2].decode("utf-8").split("\n", 2)
+                        if origin != self._origin:
+                            self._invalidate(namespace, key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Suscripción de invalidación perdida: {str(e)}")
+            # Sin suscripción no se puede confiar en la caché
+            self._subscribed = False
+            self._invalidate_all()
+            self._sub.close()
+            await asyncio.sleep(1.0)
+
+    def _key(self, namespace: str) -> str:
+        return f"{self.prefix}:{namespace}"
+
+    async def _publish(self, namespace: str, key: str):
+        await self._conn.execute("PUBLISH", self._channel, f"{self._origin}\n{namespace}\n{key}")
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        if self._subscribed:
+            value = self._cached(namespace, key)
+            if value is not _MISSING:
+                return value
+        generation = self._generation(namespace, key)
+        raw = await self._conn.execute("HGET", self._key(namespace), key)
+        value = json.loads(raw) if raw is not None else None
+        # Una invalidación o escritura durante la lectura la deja sin cachear
+        if self._subscribed and self._generation(namespace, key) == generation:
+            self._cache[(namespace, key)] = value
+        return value
+
+    async def set(self, namespace: str, key: str, value: Any):
+        encoded = _encode(value)
+        await self._conn.execute("HSET", self._key(namespace), key, encoded)
+        await self._publish(namespace, key)
+        if self._subscribed:
+            self._store(namespace, key, json.loads(encoded))
+
+    async def delete(self, namespace: str, key: str) -> bool:
+        deleted = await self._conn.execute("HDEL", self._key(namespace), key)
+        await self._publish(namespace, key)
+        if self._subscribed:
+            self._store(namespace, key, None)
+        return bool(deleted)
+
+    async def items(self, namespace: str) -> Dict[str, Any]:
+        if self._subscribed:
+            items = self._items_cache.get(namespace)
+            if items is not None:
+                self._hits += 1
+                return dict(items)
+        self._misses += 1
+        generation = self._generation(namespace)
+        raw = await self._conn.execute("HGETALL", self._key(namespace))
+        items = {
+            raw[i].decode("utf-8"): json.loads(raw[i + 1])
+            for i in range(0, len(raw or []), 2)
+        }
+        if self._subscribed and self._generation(namespace) == generation:
+            self._items_cache[namespace] = items
+        return dict(items)
+
+
+def create_state_backend(url: str) -> StateBackend:
+    """
+    Crea el almacén de estado indicado por una URL.
+
+    Args:
+        url: ``memory://``, ``sqlite:///ruta`` o ``redis://[:clave@]host[:puerto][/db]``
+
+    Returns:
+        Almacén sin iniciar
+
+    Raises:
+        ValueError: Si el esquema no está soportado
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryBackend()
+    if parsed.scheme == "sqlite":
+        # sqlite:///data/state.db -> ruta relativa; sqlite:////var/... -> absoluta
+        return SQLiteBackend(unquote(url[len("sqlite:///"):]) or ":memory:")
+    if parsed.scheme == "redis":
+        db = parsed.path.lstrip("/")
+        return RedisBackend(
+            host=parsed.hostname or "127.0.0.1",
+            port=parsed.port or 6379,
+            db=int(db) if db else 0,
+            password=unquote(parsed.password) if parsed.password else None,
+        )
+    raise ValueError(f"Almacén de estado no soportado: {url}")
+
+
+# Instancia global del almacén de estado compartido
+state_backend = create_state_backend(settings.STATE_BACKEND_URL)
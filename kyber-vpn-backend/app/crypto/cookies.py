@@ -0,0 +1,172 @@
+"""
+Cookies de handshake para descartar carga durante avalanchas de conexiones.
+
+Inspirado en el mecanismo de cookies de WireGuard: mientras el número de
+handshakes en curso supera un umbral, ``/api/connect`` solo ejecuta el
+intercambio Kyber para clientes que devuelven una cookie válida. La
+cookie es un MAC (BLAKE2s) de la dirección del cliente con una clave que
+rota cada ``lifetime`` segundos, así que demuestra que el cliente recibe
+respuestas en esa dirección sin que el servidor guarde nada por cliente.
+
+Las claves de cada periodo se derivan de ``SECRET_KEY``, de modo que
+todos los workers emiten y aceptan las mismas cookies.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import struct
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from app.core.config import settings
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Tamaño del MAC de la cookie en bytes
+COOKIE_MAC_SIZE = 16
+
+
+class CookieChecker:
+    """
+    Emisor y validador de cookies de handshake sin estado por cliente.
+
+    La cookie codifica el periodo en que se emitió y su MAC; se acepta
+    durante el periodo actual y el anterior (entre ``lifetime`` y dos
+    veces ``lifetime`` segundos).
+    """
+
+    def __init__(self, secret: str, threshold: int = 16, lifetime: float = 120.0):
+        """
+        Inicializa el validador.
+
+        Args:
+            secret: Secreto del que se derivan las claves de cada periodo
+            threshold: Handshakes en curso a partir de los que se exige cookie
+                (0 = nunca)
+            lifetime: Duración de cada periodo de clave en segundos
+        """
+        self.threshold = threshold
+        self.lifetime = lifetime
+        self._master = hashlib.blake2s(secret.encode(), person=b"kyberck1").digest()
+        self._keys: Dict[int, bytes] = {}
+        self.in_flight = 0
+        self._issued = 0
+        self._accepted = 0
+        self._rejected = 0
+
+    def _epoch(self, now: Optional[float] = None) -> int:
+        """Obtiene el periodo de clave correspondiente a un instante."""
+        return int((time.time() if now is None else now) // self.lifetime)
+
+    def _key(self, epoch: int) -> bytes:
+        """Obtiene (derivándola si es necesario) la clave de un periodo."""
+        key = self._keys.get(epoch)
+        if key is None:
+            key = hashlib.blake2s(struct.pack(">Q", epoch), key=self._master).digest()
+            # Solo hacen falta el periodo actual y el anterior
+            for old in [e for e in self._keys if e < epoch - 1]:
+                del self._keys[old]
+            self._keys[epoch] = key
+        return key
+
+    def _mac(self, epoch: int, client: str) -> bytes:
+        """Calcula el MAC de la dirección del cliente en un periodo."""
+        return hashlib.blake2s(
+            client.encode(), key=self._key(epoch), digest_size=COOKIE_MAC_SIZE
+        ).digest()
+
+    def under_load(self) -> bool:
+        """
+        Indica si los handshakes nuevos deben presentar cookie.
+
+        Returns:
+            True si los handshakes en curso alcanzan el umbral
+        """
+        return 0 < self.threshold <= self.in_flight
+
+    def issue(self, client: str, now: Optional[float] = None) -> str:
+        """
+        Emite una cookie para una dirección de cliente.
+
+        Args:
+            client: Dirección IP del cliente
+            now: Instante de emisión (por defecto, el actual)
+
+        Returns:
+            Cookie en base64 URL-safe
+        """
+        epoch = self._epoch(now)
+        self._issued += 1
+        raw = struct.pack(">I", epoch & 0xFFFFFFFF) + self._mac(epoch, client)
+        return base64.urlsafe_b64encode(raw).decode()
+
+    def verify(self, cookie: Optional[str], client: str, now: Optional[float] = None) -> bool:
+        """
+        Comprueba una cookie devuelta por un cliente.
+
+        Args:
+            cookie: Cookie recibida (puede faltar)
+            client: Dirección IP del cliente
+            now: Instante de la comprobación (por defecto, el actual)
+
+        Returns:
+            True si la cookie se emitió para esa dirección en el periodo
+            actual o el anterior
+        """
+        if not cookie:
+            return False
+        try:
+            raw = base64.urlsafe_b64decode(cookie)
+        except (binascii.Error, ValueError):
+            raw = b""
+        if len(raw) != 4 + COOKIE_MAC_SIZE:
+            self._rejected += 1
+            return False
+
+        current = self._epoch(now)
+        (epoch32,) = struct.unpack(">I", raw[:4])
+        for epoch in (current, current - 1):
+            if epoch & 0xFFFFFFFF == epoch32 and hmac.compare_digest(raw[4:], self._mac(epoch, client)):
+                break
+        else:
+            self._rejected += 1
+            return False
+        self._accepted += 1
+        return True
+
+    @contextmanager
+    def handshake(self) -> Iterator[None]:
+        """Cuenta un handshake en curso mientras dura el bloque."""
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de las cookies.
+
+        Returns:
+            Handshakes en curso, umbral y cookies emitidas/aceptadas/rechazadas
+        """
+        return {
+            "inFlight": self.in_flight,
+            "threshold": self.threshold,
+            "underLoad": self.under_load(),
+            "issued": self._issued,
+            "accepted": self._accepted,
+            "rejected": self._rejected,
+        }
+
+
+# Instancia global del validador de cookies
+cookie_checker = CookieChecker(
+    settings.SECRET_KEY,
+    threshold=settings.HANDSHAKE_COOKIE_THRESHOLD,
+    lifetime=settings.HANDSHAKE_COOKIE_LIFETIME,
+)
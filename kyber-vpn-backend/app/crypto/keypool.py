@@ -0,0 +1,169 @@
+"""
+Reserva de pares de claves Kyber pregenerados.
+
+Generar un par de claves (RSA-3072 en esta simulación) cuesta casi un
+segundo de CPU. Este módulo mantiene una reserva de pares listos para
+usar, rellenada en segundo plano en un pool de hilos (la generación
+libera el GIL), de modo que el intercambio de claves de una conexión
+no bloquea el bucle de eventos. Cada par se usa una sola vez.
+"""
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from app.core.config import settings
+from app.crypto.kyber import KyberManager
+from app.crypto.symmetric import AESGCMCipher
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+
+class KeyPool:
+    """
+    Reserva de gestores Kyber con su par de claves ya generado.
+
+    Si la reserva está vacía, el par se genera bajo demanda en un pool de
+    hilos propio, para no esperar detrás de las reposiciones encoladas.
+    Tras cada extracción se repone en segundo plano.
+    """
+
+    def __init__(self, parameter_set: str = "kyber768", size: int = 8, workers: int = 2):
+        """
+        Inicializa la reserva.
+
+        Args:
+            parameter_set: Conjunto de parámetros Kyber
+            size: Número de pares a mantener preparados (0 = sin reserva)
+            workers: Hilos dedicados a reponer la reserva (y otros tantos a
+                     generar bajo demanda)
+        """
+        self.parameter_set = parameter_set
+        self.size = size
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._demand_executor: Optional[ThreadPoolExecutor] = None
+        self._ready: Deque[KyberManager] = deque()
+        self._pending = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Obtiene el pool de hilos, creándolo si es necesario."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="kyber-keygen"
+            )
+        return self._executor
+
+    def _get_demand_executor(self) -> ThreadPoolExecutor:
+        """Obtiene el pool de hilos de las generaciones bajo demanda, creándolo si es necesario."""
+        if self._demand_executor is None:
+            self._demand_executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="kyber-demand"
+            )
+        return self._demand_executor
+
+    def _generate(self) -> KyberManager:
+        """Genera un par de claves (se ejecuta en el pool de hilos)."""
+        kyber = KyberManager(parameter_set=self.parameter_set)
+        kyber.generate_keypair()
+        return kyber
+
+    def _refill(self):
+        """Lanza la generación de los pares que faltan en la reserva."""
+        loop = asyncio.get_running_loop()
+        missing = self.size - len(self._ready) - self._pending
+        for _ in range(max(0, missing)):
+            self._pending += 1
+            future = loop.run_in_executor(self._get_executor(), self._generate)
+            future.add_done_callback(self._on_generated)
+
+    def _on_generated(self, future: "asyncio.Future"):
+        """Añade a la reserva un par recién generado."""
+        self._pending -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error(f"Error generando par de claves Kyber: {str(future.exception())}")
+            return
+        self._ready.append(future.result())
+
+    async def start(self):
+        """Empieza a llenar la reserva en segundo plano."""
+        self._refill()
+        logger.info(f"Reserva de claves Kyber iniciada ({self.size} pares, {self.workers} hilos)")
+
+    async def stop(self):
+        """Detiene el pool de hilos y descarta los pares preparados."""
+        self._ready.clear()
+        for executor in (self._executor, self._demand_executor):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._demand_executor = None
+
+    async def acquire(self) -> KyberManager:
+        """
+        Obtiene un gestor Kyber con un par de claves sin usar.
+
+        Returns:
+            Gestor Kyber listo para encapsular
+        """
+        if self._ready:
+            self._hits += 1
+            kyber = self._ready.popleft()
+        else:
+            self._misses += 1
+            loop = asyncio.get_running_loop()
+            # Fuera del pool de reposición: ahí esperaría a que terminen las encoladas
+            kyber = await loop.run_in_executor(self._get_demand_executor(), self._generate)
+        self._refill()
+        return kyber
+
+    async def encapsulate(self) -> Tuple[bytes, bytes]:
+        """
+        Realiza un intercambio de claves con un par de la reserva.
+
+        Returns:
+            Tupla con (clave_compartida, ciphertext)
+        """
+        kyber = await self.acquire()
+        # En una implementación real, aquí enviaríamos la clave pública al servidor
+        # y recibiríamos un ciphertext para desencapsular la clave compartida
+        return kyber.encapsulate()
+
+    async def derive_key(self) -> bytes:
+        """
+        Obtiene una clave simétrica nueva validada para AES-256-GCM.
+
+        Returns:
+            Clave compartida de 32 bytes
+        """
+        shared_key, _ = await self.encapsulate()
+        AESGCMCipher(key=shared_key)
+        return shared_key
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de la reserva.
+
+        Returns:
+            Pares preparados, en generación y aciertos/fallos de la reserva
+        """
+        return {
+            "ready": len(self._ready),
+            "pending": self._pending,
+            "size": self.size,
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+
+# Instancia global de la reserva de claves
+key_pool = KeyPool(
+    parameter_set=settings.KYBER_PARAMETER,
+    size=settings.KEY_POOL_SIZE,
+    workers=settings.KEY_POOL_WORKERS,
+)
@@ -89,6 +89,17 @@ class KyberManager:
         except Exception as e:
             raise RuntimeError(f"Error al generar par de claves simulado: {str(e)}")
     
+    def get_public_key(self) -> Optional[str]:
+        """
+        Obtiene la clave pública del par generado.
+        
+        Returns:
+            Clave pública codificada en base64, o None si aún no hay par
+        """
+        if self._keypair is None:
+            return None
+        return base64.b64encode(self._keypair["public_key"]).decode("utf-8")
+    
     def encapsulate(self, public_key: Optional[bytes] = None) -> Tuple[bytes, bytes]:
         """
         Simula la encapsulación de una clave compartida.
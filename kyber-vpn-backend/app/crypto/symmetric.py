@@ -37,20 +37,25 @@ class AESGCMCipher:
         # Inicializar el cifrador AESGCM
         self.cipher = AESGCM(self.key)
     
-    def encrypt(self, plaintext: bytes, associated_data: Optional[bytes] = None) -> Dict[str, bytes]:
+    def encrypt(self, plaintext: bytes, associated_data: Optional[bytes] = None,
+                nonce: Optional[bytes] = None) -> Dict[str, bytes]:
         """
         Cifra datos usando AES-256-GCM.
         
         Args:
             plaintext: Datos a cifrar
             associated_data: Datos adicionales autenticados (no cifrados)
+            nonce: Nonce de 12 bytes (p. ej. un contador); si es None, aleatorio
             
         Returns:
             Diccionario con nonce y ciphertext
         """
         # Generar un nonce aleatorio de 12 bytes (96 bits)
         # IMPORTANTE: El nonce NUNCA debe reutilizarse con la misma clave
-        nonce = os.urandom(12)
+        if nonce is None:
+            nonce = os.urandom(12)
+        elif len(nonce) != 12:
+            raise ValueError("El nonce debe tener 12 bytes (96 bits)")
         
         try:
             # Cifrar los datos
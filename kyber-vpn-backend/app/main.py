@@ -14,6 +14,14 @@ from app.api.routes.servers import router as servers_router
 from app.api.routes.connection import router as connection_router
 from app.api.routes.education import router as education_router
 from app.api.routes.chat import router as chat_router  # Nueva importación
+from app.api.routes.metrics import router as metrics_router
+from app.api.routes.connection import vpn_manager, status_hub
+from app.network.registry import server_registry
+from app.network.timers import timer_wheel
+from app.crypto.keypool import key_pool
+from app.core.state import state_backend
+from app.core.bus import message_bus
+from app.chat.messaging import messaging_service
 
 # Configurar logging
 logging.basicConfig(
@@ -40,6 +48,7 @@ app.add_middleware(
     allow_credentials=False,  # Cambiar a False cuando allow_origins=["*"]
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Handshake-Cookie", "Retry-After"],
 )
 
 # Registrar rutas
@@ -47,6 +56,32 @@ app.include_router(servers_router, prefix="/api/servers", tags=["servers"])
 app.include_router(connection_router, prefix="/api", tags=["connection"])
 app.include_router(education_router, prefix="/api/education", tags=["education"])
 app.include_router(chat_router, prefix="/api/chat", tags=["chat"])  # Nueva ruta
+app.include_router(metrics_router, prefix="/api/metrics", tags=["metrics"])
+
+@app.on_event("startup")
+async def startup():
+    """Inicia los servicios en segundo plano del plano de datos."""
+    await state_backend.start()
+    await message_bus.start()
+    await messaging_service.start()
+    await timer_wheel.start()
+    await key_pool.start()
+    await vpn_manager.start()
+    await status_hub.start()
+    if settings.SERVER_HEALTH_CHECKS:
+        await server_registry.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Detiene los servicios en segundo plano y persiste su estado."""
+    await server_registry.stop()
+    await status_hub.stop()
+    await vpn_manager.stop()
+    await timer_wheel.stop()
+    await key_pool.stop()
+    await messaging_service.stop()
+    await message_bus.close()
+    await state_backend.close()
 
 @app.get("/")
 async def root():
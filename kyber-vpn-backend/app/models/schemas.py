@@ -27,6 +27,8 @@ class Server(ServerBase):
     id: str = Field(..., description="Identificador único del servidor")
     status: ServerStatus = Field(default=ServerStatus.ONLINE, description="Estado actual del servidor")
     latency: int = Field(default=0, description="Latencia estimada en ms", ge=0)
+    capacity: Optional[int] = Field(None, description="Sesiones simultáneas admitidas", ge=0)
+    load: int = Field(default=0, description="Ocupación aproximada en % (en pasos de 10)", ge=0, le=100)
     
     class Config:
         schema_extra = {
@@ -37,18 +39,22 @@ class Server(ServerBase):
                 "ip": "192.168.1.100",
                 "port": 1194,
                 "status": "online",
-                "latency": 25
+                "latency": 25,
+                "capacity": 1000,
+                "load": 0
             }
         }
 
 class ConnectionRequest(BaseModel):
     """Solicitud para conectar a un servidor VPN."""
-    serverId: str = Field(..., description="ID del servidor al que conectar")
+    serverId: str = Field(..., description="ID del servidor al que conectar o \"auto\" para elegirlo automáticamente")
+    username: Optional[str] = Field(None, description="Usuario propietario de la sesión")
     
     class Config:
         schema_extra = {
             "example": {
-                "serverId": "server1"
+                "serverId": "server1",
+                "username": "usuario1"
             }
         }
 
@@ -57,23 +63,29 @@ class ConnectionResponse(BaseModel):
     success: bool = Field(..., description="Indica si la operación fue exitosa")
     message: str = Field(..., description="Mensaje informativo")
     vpnIp: Optional[str] = Field(None, description="IP asignada al cliente en la VPN")
+    sessionId: Optional[str] = Field(None, description="ID de la sesión VPN creada")
     
     class Config:
         schema_extra = {
             "example": {
                 "success": True,
                 "message": "Conexión establecida exitosamente",
-                "vpnIp": "10.8.0.2"
+                "vpnIp": "10.8.0.2",
+                "sessionId": "3f2a9c1e8b7d4a6f9e0c1b2a3d4e5f60"
             }
         }
 
 class VpnStatus(BaseModel):
     """Estado actual de la conexión VPN."""
     connected: bool = Field(..., description="Indica si hay una conexión VPN activa")
+    sessionId: Optional[str] = Field(None, description="ID de la sesión VPN")
     uptime: int = Field(default=0, description="Tiempo de conexión en segundos")
     bytesReceived: int = Field(default=0, description="Bytes recibidos")
     bytesSent: int = Field(default=0, description="Bytes enviados")
-    latency: int = Field(default=0, description="Latencia actual en ms")
+    latency: float = Field(default=0, description="Latencia actual en ms (RTT suavizado)")
+    jitter: float = Field(default=0, description="Variación del RTT en ms")
+    packetLoss: float = Field(default=0, description="Fracción estimada de sondas perdidas (0-1)")
+    rttHistogram: Optional[List[int]] = Field(None, description="Histograma de RTT por cubos de latencia")
     vpnIp: Optional[str] = Field(None, description="IP asignada dentro de la VPN")
     server_id: Optional[str] = Field(None, description="ID del servidor conectado")
     
@@ -81,15 +93,55 @@ class VpnStatus(BaseModel):
         schema_extra = {
             "example": {
                 "connected": True,
+                "sessionId": "3f2a9c1e8b7d4a6f9e0c1b2a3d4e5f60",
                 "uptime": 3600,
                 "bytesReceived": 1048576,
                 "bytesSent": 524288,
-                "latency": 30,
+                "latency": 30.125,
+                "jitter": 2.5,
+                "packetLoss": 0.01,
+                "rttHistogram": [0, 0, 0, 0, 3, 120, 4, 1, 0, 0, 0],
                 "vpnIp": "10.8.0.2",
                 "server_id": "server1"
             }
         }
 
+class SessionInfo(BaseModel):
+    """
+    Resumen de una sesión VPN activa.
+    
+    No incluye el ID de la sesión: es la prueba de propiedad que exigen
+    /disconnect, /status y /limits.
+    """
+    user: Optional[str] = Field(None, description="Usuario propietario de la sesión")
+    server_id: str = Field(..., description="ID del servidor conectado")
+    vpnIp: str = Field(..., description="IP asignada dentro de la VPN")
+    uptime: int = Field(default=0, description="Tiempo de conexión en segundos")
+    bytesSent: int = Field(default=0, description="Bytes enviados")
+    bytesReceived: int = Field(default=0, description="Bytes recibidos")
+    latency: float = Field(default=0, description="Latencia actual en ms")
+
+class ShapingLimits(BaseModel):
+    """Límites de ancho de banda y cuota de una sesión VPN."""
+    rate: Optional[int] = Field(None, description="Tasa máxima en bytes/s (0 = ilimitada)", ge=0)
+    burst: Optional[int] = Field(None, description="Ráfaga máxima en bytes", ge=0)
+    quota: Optional[int] = Field(None, description="Cuota mensual en bytes (0 = ilimitada)", ge=0)
+    
+    class Config:
+        schema_extra = {
+            "example": {
+                "rate": 1048576,
+                "burst": 2097152,
+                "quota": 53687091200
+            }
+        }
+
+class ShapingStatus(ShapingLimits):
+    """Límites y consumo actual de una sesión VPN."""
+    used: int = Field(default=0, description="Bytes consumidos en el periodo actual")
+    queued: int = Field(default=0, description="Paquetes retenidos en cola")
+    dropped: int = Field(default=0, description="Paquetes descartados por exceder límites")
+
 class EducationalContent(BaseModel):
     """Contenido educativo sobre criptografía post-cuántica."""
     title: str
@@ -112,8 +164,8 @@ class Message(BaseModel):
     sender: str = Field(..., description="Usuario que envía el mensaje")
     room_id: str = Field(..., description="Sala donde se envía el mensaje")
     content: str = Field(..., description="Contenido cifrado del mensaje")
+    seq: Optional[int] = Field(None, description="Número de secuencia del mensaje en su sala")
     timestamp: datetime = Field(default_factory=datetime.now, description="Momento de envío")
-    read_by: List[str] = Field(default_factory=list, description="Usuarios que han leído el mensaje")
 
 class ChatRoom(BaseModel):
     """Sala de chat entre usuarios."""
@@ -0,0 +1,186 @@
+"""
+Control de admisión de handshakes.
+
+Ante una avalancha de reconexiones, lanzar todos los ``connect`` a la vez
+hace que compitan por la CPU del intercambio de claves: todos se vuelven
+lentos, los clientes agotan su tiempo de espera y reintentan. Este módulo
+limita los handshakes simultáneos al tamaño del pool de hilos de
+criptografía y encola el resto en una cola FIFO acotada.
+
+Cada petición encolada tiene un plazo. Las que no podrían completarse a
+tiempo (según el tiempo de servicio medido) se descartan al llegar su
+turno, o directamente al encolarse, y las que no caben en la cola se
+rechazan al momento con un ``Retry-After`` con jitter para repartir los
+reintentos.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Tuple
+
+from app.core.config import settings
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Peso de cada muestra en la media móvil del tiempo de servicio
+SERVICE_EWMA_ALPHA = 0.2
+
+
+class AdmissionRejectedError(RuntimeError):
+    """El handshake no se ha admitido; el cliente debe reintentar más tarde."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Límite de concurrencia con cola FIFO acotada y plazos de espera.
+
+    Al liberar un hueco se cede directamente al primer encolado que aún
+    puede cumplir su plazo, de modo que el orden de llegada se respeta.
+    """
+
+    def __init__(self, limit: int, queue_size: int = 64, max_wait: float = 5.0):
+        """
+        Inicializa el controlador.
+
+        Args:
+            limit: Handshakes simultáneos permitidos
+            queue_size: Peticiones que pueden esperar turno
+            max_wait: Plazo máximo de espera en cola en segundos
+        """
+        self.limit = max(1, limit)
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters: Deque[Tuple["asyncio.Future", float]] = deque()
+        self._service = 0.0  # Media móvil del tiempo de servicio
+        self._admitted = 0
+        self._queued = 0
+        self._rejected_full = 0
+        self._dropped_deadline = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._max_depth = 0
+
+    def _retry_after(self) -> int:
+        """Estima en cuántos segundos conviene reintentar (con jitter)."""
+        backlog = (len(self._waiters) / self.limit + 1) * max(self._service, 0.1)
+        return max(1, int(round(backlog * random.uniform(0.5, 1.5))))
+
+    def _reject(self, message: str) -> AdmissionRejectedError:
+        """Construye el error de rechazo con su ``Retry-After``."""
+        return AdmissionRejectedError(message, self._retry_after())
+
+    async def acquire(self):
+        """
+        Obtiene un hueco para un handshake, esperando turno si es necesario.
+
+        Raises:
+            AdmissionRejectedError: Si la cola está llena o el plazo de
+                espera no se puede cumplir
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self._admitted += 1
+            return
+
+        if len(self._waiters) >= self.queue_size:
+            self._rejected_full += 1
+            raise self._reject("Cola de handshakes llena")
+        # Descartar ya si la espera estimada supera el plazo
+        if (len(self._waiters) + 1) / self.limit * self._service > self.max_wait:
+            self._dropped_deadline += 1
+            raise self._reject("Tiempo de espera estimado demasiado alto")
+
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        future = loop.create_future()
+        entry = (future, start + self.max_wait)
+        self._waiters.append(entry)
+        self._queued += 1
+        self._max_depth = max(self._max_depth, len(self._waiters))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except BaseException as e:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # El hueco se cedió justo al expirar o cancelarse: devolverlo
+                self.release()
+            else:
+                future.cancel()
+                try:
+                    self._waiters.remove(entry)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self._dropped_deadline += 1
+                raise self._reject("Plazo de espera agotado") from None
+            raise
+        finally:
+            waited = time.monotonic() - start
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        self._admitted += 1
+
+    def release(self):
+        """Libera un hueco, cediéndolo al primer encolado que pueda cumplir su plazo."""
+        now = time.monotonic()
+        while self._waiters:
+            future, deadline = self._waiters.popleft()
+            if future.done():
+                continue
+            if now + self._service > deadline:
+                self._dropped_deadline += 1
+                future.set_exception(self._reject("Plazo de espera agotado"))
+                continue
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Ejecuta el bloque con un hueco admitido y mide su tiempo de servicio."""
+        await self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self._service += SERVICE_EWMA_ALPHA * (elapsed - self._service)
+            self.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de admisión.
+
+        Returns:
+            Ocupación, profundidad de la cola, tiempos de espera y rechazos
+        """
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queueDepth": len(self._waiters),
+            "queueSize": self.queue_size,
+            "maxDepth": self._max_depth,
+            "admitted": self._admitted,
+            "queued": self._queued,
+            "rejectedFull": self._rejected_full,
+            "droppedDeadline": self._dropped_deadline,
+            "avgWaitMs": round(self._wait_total / self._queued * 1000, 3) if self._queued else 0.0,
+            "maxWaitMs": round(self._wait_max * 1000, 3),
+            "serviceMs": round(self._service * 1000, 3),
+        }
+
+
+# Instancia global del control de admisión (por defecto, un hueco por hilo de claves)
+admission_controller = AdmissionController(
+    limit=settings.ADMISSION_CONCURRENCY or settings.KEY_POOL_WORKERS,
+    queue_size=settings.ADMISSION_QUEUE_SIZE,
+    max_wait=settings.ADMISSION_MAX_WAIT,
+)
@@ -0,0 +1,182 @@
+"""
+Reenvío de operaciones sobre sesiones VPN al worker que las atiende.
+
+Una sesión vive en la memoria del worker que la abrió, pero la petición
+que la desconecta, cambia sus límites o consulta su estado puede llegar
+a cualquier otro. Este módulo implementa llamadas petición-respuesta
+sobre el bus entre procesos: cada worker escucha su propio tema
+(``vpn:<id>``), ejecuta allí las operaciones que recibe y responde en el
+tema del worker que preguntó.
+"""
+import asyncio
+import inspect
+import json
+import logging
+import uuid
+from typing import Any, Callable, Dict
+
+from app.core.bus import MessageBus
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+
+class ForwardError(RuntimeError):
+    """La operación no se ha completado en el worker que atiende la sesión."""
+
+
+def worker_topic(worker: str) -> str:
+    """Tema del bus en el que escucha un worker."""
+    return f"vpn:{worker}"
+
+
+class SessionForwarder:
+    """
+    Llamadas a otros workers a través del bus.
+
+    Las operaciones se registran por nombre; sus argumentos y resultados
+    deben ser serializables a JSON.
+    """
+
+    def __init__(self, bus: MessageBus, timeout: float = 2.0):
+        """
+        Inicializa el reenviador.
+
+        Args:
+            bus: Bus entre procesos
+            timeout: Segundos máximos de espera por una respuesta
+        """
+        self.bus = bus
+        self.timeout = timeout
+        self._handlers: Dict[str, Callable[..., Any]] = {}
+        self._pending: Dict[str, "asyncio.Future"] = {}
+        self._started = False
+        self._calls = 0
+        self._served = 0
+        self._timeouts = 0
+
+    @property
+    def worker(self) -> str:
+        """Identificador de este worker (único por proceso)."""
+        return self.bus.origin
+
+    def register(self, method: str, handler: Callable[..., Any]):
+        """
+        Registra una operación que otros workers pueden invocar.
+
+        Args:
+            method: Nombre de la operación
+            handler: Función (o corrutina) que recibe los argumentos por nombre
+        """
+        self._handlers[method] = handler
+
+    def start(self):
+        """Empieza a escuchar el tema de este worker (idempotente)."""
+        if not self._started:
+            self._started = True
+            topic = worker_topic(self.worker)
+            self.bus.route(topic, self._on_message)
+            self.bus.subscribe(topic)
+
+    def stop(self):
+        """Deja de escuchar y da por fallidas las llamadas en curso."""
+        if self._started:
+            self._started = False
+            topic = worker_topic(self.worker)
+            self.bus.unsubscribe(topic)
+            self.bus.route(topic, None)
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ForwardError("Reenvío detenido"))
+        self._pending.clear()
+
+    async def invoke(self, method: str, **kwargs: Any) -> Any:
+        """
+        Ejecuta una operación registrada en este mismo worker.
+
+        Args:
+            method: Nombre de la operación
+            **kwargs: Argumentos de la operación
+
+        Returns:
+            Resultado de la operación
+
+        Raises:
+            ValueError: Si la operación no está registrada
+        """
+        handler = self._handlers.get(method)
+        if handler is None:
+            raise ValueError(f"Operación desconocida: {method}")
+        result = handler(**kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def call(self, worker: str, method: str, **kwargs: Any) -> Any:
+        """
+        Ejecuta una operación en otro worker y espera su resultado.
+
+        Args:
+            worker: Identificador del worker de destino
+            method: Nombre de la operación
+            **kwargs: Argumentos de la operación
+
+        Returns:
+            Resultado devuelto por el otro worker
+
+        Raises:
+            ForwardError: Si no responde a tiempo o la operación falla allí
+        """
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._calls += 1
+        self.bus.publish(worker_topic(worker), json.dumps({
+            "id": request_id, "reply": self.worker, "method": method, "args": kwargs,
+        }, separators=(",", ":")))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise ForwardError(f"El worker {worker} no ha respondido a {method}") from None
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _on_message(self, topic: str, payload: str):
+        """Atiende una petición de otro worker o la respuesta a una propia."""
+        message = json.loads(payload)
+        if "method" in message:
+            asyncio.ensure_future(self._serve(message))
+            return
+        future = self._pending.get(message["id"])
+        if future is None or future.done():
+            return  # Respuesta tardía a una llamada ya abandonada
+        if "error" in message:
+            future.set_exception(ForwardError(message["error"]))
+        else:
+            future.set_result(message.get("result"))
+
+    async def _serve(self, message: Dict[str, Any]):
+        """Ejecuta una operación pedida por otro worker y publica la respuesta."""
+        reply: Dict[str, Any] = {"id": message["id"]}
+        try:
+            reply["result"] = await self.invoke(message["method"], **message["args"])
+            self._served += 1
+        except Exception as e:
+            logger.error(f"Error atendiendo {message['method']} reenviado: {str(e)}")
+            reply["error"] = str(e)
+        self.bus.publish(worker_topic(message["reply"]), json.dumps(reply, separators=(",", ":")))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas del reenvío.
+
+        Returns:
+            Llamadas hechas, atendidas, agotadas y en curso
+        """
+        return {
+            "calls": self._calls,
+            "served": self._served,
+            "timeouts": self._timeouts,
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,470 @@
+"""
+Pool de direcciones IP de la VPN basado en un bitmap.
+
+Este módulo asigna a cada sesión una IP única dentro de ``VPN_SUBNET``.
+Las redes enumerables (IPv4 o IPv6 pequeñas) usan un bitmap en un
+``bytearray`` con búsqueda de huecos por palabras de 64 bits desde un
+cursor rotatorio, lo que da un coste O(1) amortizado. Las redes IPv6
+enormes, imposibles de enumerar, derivan la dirección de un hash.
+
+Los leases son "pegajosos": al liberar una IP se reserva al mismo usuario
+durante un periodo de gracia, y los leases activos caducan si no se
+renuevan. El estado puede persistirse en un fichero JSON para que un
+reinicio no reasigne las direcciones.
+
+Con varios workers cada uno gestiona una porción disjunta de la red
+(``slice_index`` de ``slice_count``), de modo que dos procesos nunca
+asignan la misma dirección ni escriben el mismo fichero de estado.
+"""
+import hashlib
+import heapq
+import ipaddress
+import json
+import logging
+import os
+import secrets
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Tamaño máximo (en direcciones) de una red gestionada con bitmap
+MAX_BITMAP_ADDRESSES = 1 << 24
+
+_FULL_WORD = (1 << 64) - 1
+
+
+class Lease:
+    """Asignación de una dirección del pool."""
+
+    __slots__ = ("offset", "user", "active", "expires_at")
+
+    ACTIVE = True
+    GRACE = False
+
+    def __init__(self, offset: int, user: Optional[str], active: bool, expires_at: float):
+        self.offset = offset
+        self.user = user
+        self.active = active
+        self.expires_at = expires_at
+
+
+class PoolExhaustedError(RuntimeError):
+    """No quedan direcciones libres en el pool."""
+
+
+class AddressPool:
+    """
+    Pool de direcciones con bitmap, leases pegajosos y persistencia.
+
+    Cada dirección se identifica por su desplazamiento respecto a la
+    dirección de red. Un bit a 1 indica que la dirección está ocupada
+    (por un lease activo, un lease en gracia o una reserva fija).
+    """
+
+    def __init__(
+        self,
+        network: str,
+        reserved: Iterable[str] = (),
+        lease_time: float = 3600.0,
+        grace_period: float = 300.0,
+        state_path: Optional[str] = None,
+        slice_index: int = 0,
+        slice_count: int = 1,
+    ):
+        """
+        Inicializa el pool.
+
+        Args:
+            network: Red en notación CIDR (IPv4 o IPv6)
+            reserved: Direcciones que nunca se asignan (p. ej. la pasarela)
+            lease_time: Segundos de validez de un lease activo sin renovar
+            grace_period: Segundos que una IP liberada queda reservada a su usuario
+            state_path: Fichero JSON donde persistir el estado (opcional)
+            slice_index: Porción de la red que gestiona este pool
+            slice_count: Número de porciones en que se divide la red
+
+        Raises:
+            ValueError: Si la porción no existe o la red no da para tantas porciones
+        """
+        self.network = ipaddress.ip_network(network, strict=False)
+        self.size = self.network.num_addresses
+        self.lease_time = lease_time
+        self.grace_period = grace_period
+        self.state_path = state_path
+        if not 0 <= slice_index < slice_count or slice_count > self.size:
+            raise ValueError(f"Porción {slice_index} de {slice_count} no válida para {self.network}")
+        # Desplazamientos [inicio, fin) asignables por este pool
+        self._start = self.size * slice_index // slice_count
+        self._end = self.size * (slice_index + 1) // slice_count
+
+        # Redes enormes (IPv6): sin bitmap, direcciones derivadas de un hash
+        self.sparse = self.size > MAX_BITMAP_ADDRESSES
+        self._bitmap = bytearray(0 if self.sparse else (self.size + 63) // 64 * 8)
+        self._cursor = self._start // 64  # Palabra de 64 bits por la que continuar la búsqueda
+
+        self._reserved = set()
+        self._leases: Dict[int, Lease] = {}
+        self._sticky: Dict[str, int] = {}  # usuario -> desplazamiento preferido
+        self._expiry: List[Tuple[float, int]] = []  # montículo (caducidad, desplazamiento)
+        self._free = self._end - self._start
+        self._dirty = False
+        self._last_save = 0.0
+
+        # Reservar red, broadcast (IPv4) y direcciones fijas
+        self._reserve(0)
+        if self.network.version == 4 and self.size > 2:
+            self._reserve(self.size - 1)
+        if not self.sparse:
+            # Las direcciones de otras porciones y el relleno de la última
+            # palabra se marcan como ocupadas
+            self._fill(0, self._start)
+            self._fill(self._end, len(self._bitmap) * 8)
+        for address in reserved:
+            offset = self._offset(address)
+            if offset is not None:
+                self._reserve(offset)
+
+        if state_path:
+            self.load()
+
+    # ---- Bitmap -------------------------------------------------------------
+
+    def _set_bit(self, offset: int):
+        self._bitmap[offset >> 3] |= 1 << (offset & 7)
+
+    def _clear_bit(self, offset: int):
+        self._bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+
+    def _test_bit(self, offset: int) -> bool:
+        if self.sparse:
+            return offset in self._leases or offset in self._reserved
+        return bool(self._bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def _fill(self, start: int, end: int):
+        """Marca como ocupados los bits [start, end) sin contarlos como reservas."""
+        while start < end and start & 7:
+            self._set_bit(start)
+            start += 1
+        while start < end and end & 7:
+            end -= 1
+            self._set_bit(end)
+        if start < end:
+            self._bitmap[start >> 3:end >> 3] = b"\xff" * ((end - start) >> 3)
+
+    def _in_slice(self, offset: int) -> bool:
+        """Indica si un desplazamiento pertenece a la porción de este pool."""
+        return self._start <= offset < self._end
+
+    def _reserve(self, offset: int):
+        if offset in self._reserved or not self._in_slice(offset):
+            return
+        self._reserved.add(offset)
+        if not self.sparse:
+            self._set_bit(offset)
+        self._free -= 1
+
+    def _find_free(self) -> Optional[int]:
+        """Busca un bit libre desde el cursor, palabra a palabra."""
+        words = memoryview(self._bitmap).cast("Q")
+        count = len(words)
+        for step in range(count):
+            index = (self._cursor + step) % count
+            word = words[index]
+            if word != _FULL_WORD:
+                self._cursor = index
+                # Localizar el byte con hueco (independiente del endianness)
+                for byte_index in range(index * 8, index * 8 + 8):
+                    byte = self._bitmap[byte_index]
+                    if byte != 0xFF:
+                        free_bit = (~byte & (byte + 1)).bit_length() - 1
+                        return byte_index * 8 + free_bit
+        return None
+
+    def _hashed_offset(self, user: Optional[str]) -> Optional[int]:
+        """Deriva un desplazamiento libre a partir de un hash (redes dispersas)."""
+        seed = user.encode("utf-8") if user else secrets.token_bytes(16)
+        for attempt in range(32):
+            digest = hashlib.blake2b(seed + attempt.to_bytes(1, "big"), digest_size=16).digest()
+            offset = self._start + int.from_bytes(digest, "big") % (self._end - self._start)
+            if not self._test_bit(offset):
+                return offset
+        return None
+
+    # ---- Conversión ---------------------------------------------------------
+
+    def _offset(self, address: Union[str, ipaddress.IPv4Address, ipaddress.IPv6Address]) -> Optional[int]:
+        """Convierte una dirección en su desplazamiento dentro de la red."""
+        address = ipaddress.ip_address(address)
+        if address not in self.network:
+            return None
+        return int(address) - int(self.network.network_address)
+
+    def _address(self, offset: int) -> str:
+        """Convierte un desplazamiento en dirección."""
+        return str(self.network.network_address + offset)
+
+    # ---- Leases -------------------------------------------------------------
+
+    def allocate(self, user: Optional[str] = None, now: Optional[float] = None) -> str:
+        """
+        Asigna una dirección, reutilizando la última del usuario si sigue reservada.
+
+        Args:
+            user: Usuario al que se asigna (None para clientes anónimos)
+            now: Marca de tiempo actual (por defecto, ``time.time()``)
+
+        Returns:
+            Dirección asignada
+
+        Raises:
+            PoolExhaustedError: Si no quedan direcciones libres
+        """
+        now = time.time() if now is None else now
+        self.expire(now)
+
+        # Lease pegajoso: recuperar la IP que el usuario liberó hace poco
+        if user is not None:
+            offset = self._sticky.get(user)
+            lease = self._leases.get(offset) if offset is not None else None
+            if lease is not None and not lease.active and lease.user == user:
+                self._activate(lease, now)
+                return self._address(offset)
+
+        offset = self._hashed_offset(user) if self.sparse else self._find_free()
+        if offset is None:
+            raise PoolExhaustedError("No quedan direcciones IP libres en la VPN")
+
+        if not self.sparse:
+            self._set_bit(offset)
+        self._free -= 1
+        lease = Lease(offset, user, Lease.ACTIVE, 0.0)
+        self._leases[offset] = lease
+        if user is not None:
+            self._sticky[user] = offset
+        self._activate(lease, now)
+        return self._address(offset)
+
+    def _activate(self, lease: Lease, now: float):
+        """Marca un lease como activo y programa su caducidad."""
+        lease.active = Lease.ACTIVE
+        lease.expires_at = now + self.lease_time
+        heapq.heappush(self._expiry, (lease.expires_at, lease.offset))
+        self._dirty = True
+
+    def claim(self, address: str, user: Optional[str] = None, now: Optional[float] = None) -> bool:
+        """
+        Reclama una dirección concreta (p. ej. al restaurar una sesión).
+
+        Args:
+            address: Dirección a reclamar
+            user: Usuario al que pertenece
+            now: Marca de tiempo actual
+
+        Returns:
+            True si la dirección queda asignada a ese usuario
+        """
+        now = time.time() if now is None else now
+        offset = self._offset(address)
+        if offset is None or offset in self._reserved or not self._in_slice(offset):
+            return False
+
+        lease = self._leases.get(offset)
+        if lease is not None:
+            if lease.user != user:
+                return False
+            self._activate(lease, now)
+            return True
+
+        if not self.sparse:
+            self._set_bit(offset)
+        self._free -= 1
+        lease = Lease(offset, user, Lease.ACTIVE, 0.0)
+        self._leases[offset] = lease
+        if user is not None:
+            self._sticky[user] = offset
+        self._activate(lease, now)
+        return True
+
+    def renew(self, address: str, now: Optional[float] = None) -> bool:
+        """
+        Renueva un lease activo.
+
+        Solo reprograma la caducidad cuando ha pasado la mitad de su vida,
+        por lo que se puede llamar con frecuencia sin coste apreciable.
+
+        Args:
+            address: Dirección asignada
+            now: Marca de tiempo actual
+
+        Returns:
+            True si el lease existe y está activo
+        """
+        now = time.time() if now is None else now
+        offset = self._offset(address)
+        lease = self._leases.get(offset) if offset is not None else None
+        if lease is None or not lease.active:
+            return False
+        if lease.expires_at - now < self.lease_time / 2:
+            self._activate(lease, now)
+        return True
+
+    def release(self, address: str, now: Optional[float] = None):
+        """
+        Libera una dirección; si tiene usuario, queda reservada durante la gracia.
+
+        Args:
+            address: Dirección a liberar
+            now: Marca de tiempo actual
+        """
+        now = time.time() if now is None else now
+        offset = self._offset(address)
+        lease = self._leases.get(offset) if offset is not None else None
+        if lease is None or not lease.active:
+            return
+
+        if lease.user is None or self.grace_period <= 0:
+            self._free_offset(offset)
+            return
+
+        lease.active = Lease.GRACE
+        lease.expires_at = now + self.grace_period
+        heapq.heappush(self._expiry, (lease.expires_at, offset))
+        self._dirty = True
+
+    def _free_offset(self, offset: int):
+        """Devuelve una dirección al pool."""
+        lease = self._leases.pop(offset, None)
+        if lease is None:
+            return
+        if lease.user is not None and self._sticky.get(lease.user) == offset:
+            del self._sticky[lease.user]
+        if not self.sparse:
+            self._clear_bit(offset)
+        self._free += 1
+        self._dirty = True
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """
+        Procesa los leases vencidos.
+
+        Un lease activo sin renovar pasa a gracia; un lease en gracia
+        vencido devuelve la dirección al pool.
+
+        Args:
+            now: Marca de tiempo actual
+
+        Returns:
+            Número de leases que han cambiado de estado
+        """
+        now = time.time() if now is None else now
+        changed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, offset = heapq.heappop(self._expiry)
+            lease = self._leases.get(offset)
+            # Entradas obsoletas del montículo (lease renovado o liberado)
+            if lease is None or lease.expires_at != expires_at:
+                continue
+            if lease.active and lease.user is not None and self.grace_period > 0:
+                logger.info(f"Lease de {self._address(offset)} caducado sin renovar")
+                lease.active = Lease.GRACE
+                lease.expires_at = expires_at + self.grace_period
+                heapq.heappush(self._expiry, (lease.expires_at, offset))
+            else:
+                self._free_offset(offset)
+            changed += 1
+        if changed:
+            self._dirty = True
+        return changed
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de ocupación del pool.
+
+        Returns:
+            Diccionario con tamaño, direcciones libres y leases por estado
+        """
+        active = sum(1 for lease in self._leases.values() if lease.active)
+        return {
+            "network": str(self.network),
+            "size": self.size,
+            "slice": [self._address(self._start), self._address(self._end - 1)],
+            "free": self._free,
+            "active": active,
+            "grace": len(self._leases) - active,
+            "sparse": self.sparse,
+        }
+
+    # ---- Persistencia -------------------------------------------------------
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Serializa el estado del pool.
+
+        Returns:
+            Diccionario serializable en JSON
+        """
+        return {
+            "network": str(self.network),
+            "leases": [
+                [lease.offset, lease.user, lease.active, lease.expires_at]
+                for lease in self._leases.values()
+            ],
+        }
+
+    def save(self):
+        """Escribe el estado en ``state_path`` de forma atómica."""
+        if not self.state_path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, self.state_path)
+        self._dirty = False
+        self._last_save = time.monotonic()
+
+    def save_if_due(self, min_interval: float):
+        """
+        Persiste el estado si hay cambios y ha pasado el intervalo mínimo.
+
+        Args:
+            min_interval: Segundos mínimos entre escrituras
+        """
+        if self._dirty and time.monotonic() - self._last_save >= min_interval:
+            try:
+                self.save()
+            except OSError as e:
+                logger.error(f"Error al guardar el pool de direcciones: {str(e)}")
+
+    def load(self):
+        """Restaura el estado desde ``state_path`` si existe y es compatible."""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error al leer el estado del pool de direcciones: {str(e)}")
+            return
+
+        if state.get("network") != str(self.network):
+            logger.warning("El estado guardado del pool corresponde a otra red; se ignora")
+            return
+
+        for offset, user, active, expires_at in state.get("leases", []):
+            if offset in self._leases or offset in self._reserved or not self._in_slice(offset):
+                continue
+            lease = Lease(offset, user, active, expires_at)
+            self._leases[offset] = lease
+            if not self.sparse:
+                self._set_bit(offset)
+            self._free -= 1
+            if user is not None:
+                self._sticky[user] = offset
+            heapq.heappush(self._expiry, (expires_at, offset))
+
+        logger.info(f"Pool de direcciones restaurado: {len(self._leases)} leases")
+        self._dirty = False
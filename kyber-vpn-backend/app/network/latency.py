@@ -0,0 +1,245 @@
+"""
+Medición real de latencia (RTT), jitter y pérdida de paquetes.
+
+Este módulo sustituye la latencia simulada por sondas keepalive reales:
+cada sonda es un datagrama UDP con número de secuencia y marca de tiempo
+que el extremo remoto (o un servidor de eco local) devuelve sin cambios.
+Las muestras se suavizan con EWMA (estilo RFC 6298) y se acumulan en un
+histograma de tamaño fijo por sesión.
+"""
+import asyncio
+import logging
+import struct
+import time
+from array import array
+from typing import Any, Dict, Optional, Tuple
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Formato de la sonda: magia, secuencia, marca de tiempo de envío (ns)
+_PROBE_MAGIC = b"KVPR"
+_PROBE_FORMAT = struct.Struct("!4sIQ")
+
+# Límites superiores (ms) de los cubos del histograma; el último es "resto"
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class RttEstimator:
+    """
+    Estimador de RTT, jitter y pérdida con suavizado EWMA.
+
+    Usa las ganancias de RFC 6298 (1/8 para el RTT, 1/4 para la variación)
+    y un histograma de cubos fijos, por lo que su tamaño no crece con el
+    número de muestras.
+    """
+
+    __slots__ = ("srtt", "rttvar", "loss", "last_rtt", "samples", "histogram")
+
+    ALPHA = 0.125
+    BETA = 0.25
+    LOSS_GAIN = 0.1
+
+    def __init__(self):
+        """Inicializa un estimador sin muestras."""
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.loss = 0.0
+        self.last_rtt = 0.0
+        self.samples = 0
+        self.histogram = array("I", [0] * (len(HISTOGRAM_BOUNDS_MS) + 1))
+
+    def on_sample(self, rtt_ms: float):
+        """
+        Incorpora una muestra de RTT.
+
+        Args:
+            rtt_ms: RTT medido en milisegundos
+        """
+        if self.samples == 0:
+            self.srtt = rtt_ms
+            self.rttvar = rtt_ms / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt_ms) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt_ms - self.srtt)
+        self.loss -= self.LOSS_GAIN * self.loss
+        self.last_rtt = rtt_ms
+        self.samples += 1
+
+        bucket = len(HISTOGRAM_BOUNDS_MS)
+        for index, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+            if rtt_ms < bound:
+                bucket = index
+                break
+        self.histogram[bucket] += 1
+
+    def on_loss(self):
+        """Registra una sonda sin respuesta."""
+        self.loss += self.LOSS_GAIN * (1.0 - self.loss)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Obtiene las métricas actuales.
+
+        Returns:
+            Diccionario con RTT suavizado, jitter, pérdida e histograma
+        """
+        return {
+            "rtt": round(self.srtt, 3),
+            "jitter": round(self.rttvar, 3),
+            "loss": round(self.loss, 4),
+            "samples": self.samples,
+            "histogram": list(self.histogram),
+        }
+
+
+class _ProbeProtocol(asyncio.DatagramProtocol):
+    """Protocolo UDP que entrega las respuestas de sonda al prober."""
+
+    def __init__(self, prober: "LatencyProber"):
+        self.prober = prober
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.prober._on_response(data)
+
+
+class LatencyProber:
+    """
+    Emisor de sondas keepalive compartido por todas las sesiones.
+
+    Usa un único socket UDP; cada sonda lleva un número de secuencia que
+    permite asociar la respuesta a su sesión sin un socket por sesión.
+    """
+
+    def __init__(self, timeout: float = 1.0):
+        """
+        Inicializa el prober.
+
+        Args:
+            timeout: Segundos de espera antes de contar una sonda como perdida
+        """
+        self.timeout = timeout
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._sequence = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    async def start(self):
+        """Abre el socket UDP de sondeo (idempotente)."""
+        if self._transport is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _ProbeProtocol(self), local_addr=("0.0.0.0", 0)
+        )
+        logger.info("Prober de latencia iniciado")
+
+    async def stop(self):
+        """Cierra el socket y cancela las sondas pendientes."""
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    async def probe(self, target: Tuple[str, int], estimator: RttEstimator) -> Optional[float]:
+        """
+        Envía una sonda y actualiza el estimador con el resultado.
+
+        Args:
+            target: Dirección (host, puerto) del extremo remoto
+            estimator: Estimador de la sesión a actualizar
+
+        Returns:
+            RTT medido en milisegundos o None si la sonda se perdió
+        """
+        await self.start()
+        self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+        sequence = self._sequence
+        future = asyncio.get_running_loop().create_future()
+        self._pending[sequence] = future
+
+        sent_ns = time.monotonic_ns()
+        try:
+            self._transport.sendto(_PROBE_FORMAT.pack(_PROBE_MAGIC, sequence, sent_ns), target)
+            received_ns = await asyncio.wait_for(future, self.timeout)
+        except (asyncio.TimeoutError, OSError):
+            estimator.on_loss()
+            return None
+        finally:
+            self._pending.pop(sequence, None)
+
+        rtt_ms = (received_ns - sent_ns) / 1_000_000
+        estimator.on_sample(rtt_ms)
+        return rtt_ms
+
+    def _on_response(self, data: bytes):
+        """Resuelve la sonda pendiente a la que corresponde una respuesta."""
+        received_ns = time.monotonic_ns()
+        if len(data) != _PROBE_FORMAT.size:
+            return
+        magic, sequence, _ = _PROBE_FORMAT.unpack(data)
+        if magic != _PROBE_MAGIC:
+            return
+        future = self._pending.get(sequence)
+        if future is not None and not future.done():
+            future.set_result(received_ns)
+
+
+class _EchoProtocol(asyncio.DatagramProtocol):
+    """Protocolo UDP que devuelve cada datagrama a su remitente."""
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.transport.sendto(data, addr)
+
+
+class EchoServer:
+    """
+    Servidor de eco UDP local.
+
+    Sustituye al extremo remoto del túnel en desarrollo y pruebas, de modo
+    que las sondas miden un RTT real (aunque local) en lugar de un valor
+    aleatorio.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        Inicializa el servidor de eco.
+
+        Args:
+            host: Dirección en la que escuchar
+            port: Puerto en el que escuchar (0 = elegido por el sistema)
+        """
+        self.host = host
+        self.port = port
+        self._transport: Optional[asyncio.DatagramTransport] = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        """Dirección (host, puerto) en la que escucha el servidor."""
+        return self.host, self.port
+
+    async def start(self) -> Tuple[str, int]:
+        """
+        Inicia el servidor de eco (idempotente).
+
+        Returns:
+            Dirección (host, puerto) en la que escucha
+        """
+        if self._transport is None:
+            loop = asyncio.get_running_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                _EchoProtocol, local_addr=(self.host, self.port)
+            )
+            self.port = self._transport.get_extra_info("sockname")[1]
+            logger.info(f"Servidor de eco UDP escuchando en {self.host}:{self.port}")
+        return self.address
+
+    async def stop(self):
+        """Detiene el servidor de eco."""
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
@@ -0,0 +1,519 @@
+"""
+Registro de servidores VPN con comprobaciones de salud en vivo.
+
+Este módulo mantiene un índice de los servidores VPN por ID y un
+comprobador en segundo plano que, en cada ronda, intenta abrir una
+conexión TCP con todos los servidores a la vez (con paralelismo acotado
+y tiempo límite). Con los resultados calcula latencia suavizada y
+disponibilidad reciente, y cachea la respuesta serializada de
+``/api/servers`` junto con un ETag para poder responder 304.
+
+También elige servidor para las conexiones automáticas: mínimo de
+conexiones ponderado por capacidad y latencia, muestreando dos
+candidatos al azar ("power of two choices") para decidir en O(1). Cada
+worker publica en el almacén de estado compartido sus sesiones por
+servidor y suma las del resto, de modo que la carga es la de todos los
+procesos. La lista pública muestra la ocupación en pasos de
+``LOAD_STEP`` %, así que abrir o cerrar sesiones no cambia el ETag salvo
+que cambie ese escalón o si el servidor admite sesiones.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.state import state_backend
+from app.network.latency import RttEstimator
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Espacio de nombres del almacén compartido con las sesiones de cada worker por servidor
+SERVER_LOAD = "server_load"
+
+# Granularidad (%) de la ocupación publicada en la lista de servidores
+LOAD_STEP = 10
+
+
+class ServerEntry:
+    """Estado en vivo de un servidor VPN."""
+
+    __slots__ = (
+        "config", "status", "latency", "rtt", "history", "successes", "last_check",
+        "local", "remote", "capacity",
+    )
+
+    def __init__(self, config: Dict[str, Any], history_size: int):
+        """
+        Inicializa el estado a partir de la configuración estática.
+
+        Args:
+            config: Datos del servidor (id, name, location, ip, port...)
+            history_size: Número de comprobaciones recientes a recordar
+        """
+        self.config = config
+        self.status = config.get("status", "online")
+        self.latency = int(config.get("latency", 0))
+        self.rtt = RttEstimator()
+        self.history: Deque[bool] = deque(maxlen=history_size)
+        self.successes = 0
+        self.last_check = 0.0
+        self.local = 0  # Sesiones de este worker
+        self.remote = 0  # Sesiones del resto de workers (última sincronización)
+        self.capacity = int(config.get("capacity", settings.SERVER_DEFAULT_CAPACITY))
+
+    @property
+    def sessions(self) -> int:
+        """Sesiones activas en el servidor entre todos los workers."""
+        return self.local + self.remote
+
+    @property
+    def load(self) -> int:
+        """Ocupación en %, redondeada hacia abajo a múltiplos de ``LOAD_STEP``."""
+        if self.capacity <= 0:
+            return 100
+        return min(100, self.sessions * 100 // self.capacity // LOAD_STEP * LOAD_STEP)
+
+    def placement(self) -> Tuple[str, int, bool, int]:
+        """Datos que afectan a la colocación y a la lista pública."""
+        return self.status, self.latency, self.accepting, self.load
+
+    @property
+    def accepting(self) -> bool:
+        """Indica si el servidor puede admitir nuevas sesiones."""
+        return self.status == "online" and self.sessions < self.capacity
+
+    def score(self, rtt_scale_ms: float) -> float:
+        """
+        Coste de asignar una sesión más a este servidor (menor es mejor).
+
+        Args:
+            rtt_scale_ms: Latencia que duplica el coste de un servidor
+
+        Returns:
+            Carga relativa tras la asignación, penalizada por la latencia
+        """
+        return (self.sessions + 1) / self.capacity * (1 + self.latency / rtt_scale_ms)
+
+    @property
+    def availability(self) -> float:
+        """Fracción de comprobaciones recientes con éxito (1.0 sin datos)."""
+        if not self.history:
+            return 1.0
+        return self.successes / len(self.history)
+
+    def record(self, ok: bool, rtt_ms: Optional[float]) -> bool:
+        """
+        Registra el resultado de una comprobación.
+
+        Args:
+            ok: Si el servidor respondió
+            rtt_ms: Tiempo de conexión en milisegundos (si respondió)
+
+        Returns:
+            True si cambió algún dato visible en la API
+        """
+        if len(self.history) == self.history.maxlen and self.history[0]:
+            self.successes -= 1
+        self.history.append(ok)
+        self.last_check = time.time()
+
+        previous = (self.status, self.latency)
+        if ok:
+            self.successes += 1
+            self.rtt.on_sample(rtt_ms)
+            self.latency = int(round(self.rtt.srtt))
+            if self.status == "offline":
+                self.status = "online"
+        else:
+            self.rtt.on_loss()
+            if self.status == "online":
+                self.status = "offline"
+        return (self.status, self.latency) != previous
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Vista pública del servidor para la API.
+
+        Returns:
+            Diccionario compatible con el esquema ``Server``
+        """
+        data = dict(self.config)
+        data["status"] = self.status
+        data["latency"] = self.latency
+        data["capacity"] = self.capacity
+        data["load"] = self.load
+        return data
+
+
+class ServerRegistry:
+    """
+    Registro de servidores VPN indexado por ID.
+
+    Las búsquedas por ID son O(1). La lista pública se serializa una sola
+    vez por versión: solo se regenera cuando cambia el estado, la latencia,
+    la ocupación publicada o la admisión de sesiones de algún servidor.
+    """
+
+    def __init__(
+        self,
+        servers: List[Dict[str, Any]],
+        interval: float = 30.0,
+        timeout: float = 2.0,
+        concurrency: int = 16,
+        history_size: int = 20,
+        worker: Optional[str] = None,
+        load_ttl: float = 10.0,
+    ):
+        """
+        Inicializa el registro.
+
+        Args:
+            servers: Configuración estática de los servidores
+            interval: Segundos entre rondas de comprobación
+            timeout: Segundos máximos por comprobación
+            concurrency: Comprobaciones simultáneas como máximo
+            history_size: Comprobaciones recientes usadas para la disponibilidad
+            worker: Clave de este worker en el almacén compartido (por defecto, su índice)
+            load_ttl: Segundos tras los que se ignoran las sesiones publicadas por
+                      un worker que ha dejado de refrescarlas
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.history_size = history_size
+        self.worker = worker if worker is not None else str(settings.WORKER_INDEX)
+        self.load_ttl = load_ttl
+
+        self.version = 0
+        self._rendered: Optional[Tuple[int, str, bytes]] = None
+        self._task: Optional[asyncio.Task] = None
+        # Último recuento propio publicado y cuándo
+        self._published: Optional[Dict[str, int]] = None
+        self._published_at = 0.0
+
+        self._servers: Dict[str, ServerEntry] = {}
+        # Servidores que admiten sesiones, con índice para altas/bajas en O(1)
+        self._accepting: List[str] = []
+        self._accepting_index: Dict[str, int] = {}
+        for server in servers:
+            self.register(server)
+
+    def register(self, server: Dict[str, Any]):
+        """
+        Añade o reemplaza un servidor.
+
+        Args:
+            server: Configuración del servidor
+        """
+        entry = ServerEntry(dict(server), self.history_size)
+        previous = self._servers.get(server["id"])
+        if previous is not None:
+            entry.local = previous.local
+            entry.remote = previous.remote
+        self._servers[server["id"]] = entry
+        self._update_accepting(server["id"])
+        self._invalidate()
+
+    def unregister(self, server_id: str) -> bool:
+        """
+        Elimina un servidor.
+
+        Args:
+            server_id: ID del servidor
+
+        Returns:
+            True si el servidor existía
+        """
+        if self._servers.pop(server_id, None) is None:
+            return False
+        self._update_accepting(server_id)
+        self._invalidate()
+        return True
+
+    def _update_accepting(self, server_id: str):
+        """Sincroniza un servidor con la lista de candidatos para la colocación."""
+        entry = self._servers.get(server_id)
+        accepting = entry is not None and entry.accepting
+        index = self._accepting_index.get(server_id)
+        if accepting and index is None:
+            self._accepting_index[server_id] = len(self._accepting)
+            self._accepting.append(server_id)
+        elif not accepting and index is not None:
+            # Eliminar intercambiando con el último elemento
+            last = self._accepting.pop()
+            del self._accepting_index[server_id]
+            if last != server_id:
+                self._accepting[index] = last
+                self._accepting_index[last] = index
+
+    def choose(self, rtt_scale_ms: float = 50.0) -> Optional[str]:
+        """
+        Elige servidor para una sesión nueva.
+
+        Muestrea dos servidores que admiten sesiones y se queda con el de
+        menor coste (conexiones por capacidad, penalizadas por latencia).
+
+        Args:
+            rtt_scale_ms: Latencia que duplica el coste de un servidor
+
+        Returns:
+            ID del servidor elegido o None si todos están llenos o caídos
+        """
+        candidates = self._accepting
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        if self._servers[second].score(rtt_scale_ms) < self._servers[first].score(rtt_scale_ms):
+            return second
+        return first
+
+    def retry_after(self) -> int:
+        """
+        Segundos que conviene esperar antes de reintentar si ningún servidor admite sesiones.
+
+        Es el intervalo entre comprobaciones de salud (cuando un servidor
+        caído puede volver), con jitter para repartir los reintentos.
+
+        Returns:
+            Segundos para la cabecera ``Retry-After``
+        """
+        return max(1, int(round(self.interval * random.uniform(0.5, 1.5))))
+
+    def is_accepting(self, server_id: str) -> bool:
+        """Indica si un servidor puede admitir nuevas sesiones."""
+        return server_id in self._accepting_index
+
+    def session_opened(self, server_id: str):
+        """
+        Contabiliza una sesión nueva de este worker en un servidor.
+
+        Args:
+            server_id: ID del servidor
+        """
+        entry = self._servers.get(server_id)
+        if entry is not None:
+            before = entry.placement()
+            entry.local += 1
+            self._refresh(server_id, before)
+
+    def session_closed(self, server_id: str):
+        """
+        Descuenta una sesión cerrada de este worker en un servidor.
+
+        Args:
+            server_id: ID del servidor
+        """
+        entry = self._servers.get(server_id)
+        if entry is not None and entry.local > 0:
+            before = entry.placement()
+            entry.local -= 1
+            self._refresh(server_id, before)
+
+    def _refresh(self, server_id: str, before: Tuple[str, int, bool, int]):
+        """
+        Propaga un cambio en la carga de un servidor.
+
+        Args:
+            server_id: ID del servidor
+            before: Resultado de ``placement()`` antes del cambio
+        """
+        self._update_accepting(server_id)
+        if self._servers[server_id].placement() != before:
+            self._invalidate()
+
+    async def sync_load(self):
+        """
+        Publica las sesiones de este worker y recoge las del resto.
+
+        El recuento propio se escribe cuando cambia y, como latido, cada
+        mitad de ``load_ttl``; los workers que no lo refrescan (caídos) dejan
+        de contar al caducar.
+        """
+        now = time.time()
+        local = {server_id: entry.local for server_id, entry in self._servers.items() if entry.local}
+        try:
+            if local != self._published or now - self._published_at >= self.load_ttl / 2:
+                await state_backend.set(SERVER_LOAD, self.worker, {"servers": local, "updatedAt": now})
+                self._published = local
+                self._published_at = now
+            records = await state_backend.items(SERVER_LOAD)
+        except Exception as e:
+            logger.warning(f"No se pudo sincronizar la carga de los servidores: {str(e)}")
+            return
+
+        remote: Dict[str, int] = {}
+        for worker, record in records.items():
+            if worker == self.worker or now - record["updatedAt"] > self.load_ttl:
+                continue
+            for server_id, count in record["servers"].items():
+                remote[server_id] = remote.get(server_id, 0) + count
+        for server_id, entry in self._servers.items():
+            count = remote.get(server_id, 0)
+            if count != entry.remote:
+                before = entry.placement()
+                entry.remote = count
+                self._refresh(server_id, before)
+
+    async def withdraw_load(self):
+        """Retira del almacén compartido las sesiones publicadas por este worker."""
+        try:
+            await state_backend.delete(SERVER_LOAD, self.worker)
+        except Exception as e:
+            logger.warning(f"No se pudo retirar la carga de este worker: {str(e)}")
+        self._published = None
+
+    def _invalidate(self):
+        """Descarta la respuesta serializada tras un cambio."""
+        self.version += 1
+        self._rendered = None
+
+    def get(self, server_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Obtiene la vista pública de un servidor por su ID.
+
+        Args:
+            server_id: ID del servidor
+
+        Returns:
+            Datos del servidor o None si no existe
+        """
+        entry = self._servers.get(server_id)
+        return entry.to_dict() if entry else None
+
+    def get_entry(self, server_id: str) -> Optional[ServerEntry]:
+        """Obtiene el estado interno de un servidor por su ID."""
+        return self._servers.get(server_id)
+
+    def list_servers(self) -> List[Dict[str, Any]]:
+        """
+        Obtiene la vista pública de todos los servidores.
+
+        Returns:
+            Lista de servidores con estado y latencia en vivo
+        """
+        return [entry.to_dict() for entry in self._servers.values()]
+
+    def render(self) -> Tuple[str, bytes]:
+        """
+        Obtiene la lista serializada y su ETag, cacheada por versión.
+
+        Returns:
+            Tupla (etag, cuerpo JSON)
+        """
+        if self._rendered is None or self._rendered[0] != self.version:
+            body = json.dumps(self.list_servers(), separators=(",", ":")).encode("utf-8")
+            # ETag derivado del contenido: coincide entre procesos con los mismos datos
+            etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+            self._rendered = (self.version, etag, body)
+        return self._rendered[1], self._rendered[2]
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Obtiene las estadísticas de salud de cada servidor.
+
+        Returns:
+            Diccionario ID -> sesiones, disponibilidad, RTT, jitter y última comprobación
+        """
+        return {
+            server_id: {
+                "status": entry.status,
+                "sessions": entry.sessions,
+                "availability": round(entry.availability, 3),
+                "rtt": entry.rtt.snapshot(),
+                "last_check": entry.last_check,
+            }
+            for server_id, entry in self._servers.items()
+        }
+
+    async def _check(self, entry: ServerEntry, semaphore: asyncio.Semaphore) -> bool:
+        """
+        Comprueba un servidor abriendo una conexión TCP.
+
+        Args:
+            entry: Servidor a comprobar
+            semaphore: Semáforo que limita el paralelismo
+
+        Returns:
+            True si cambió algún dato visible del servidor
+        """
+        host = entry.config.get("health_host", entry.config["ip"])
+        port = entry.config.get("health_port", entry.config["port"])
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), self.timeout
+                )
+            except (asyncio.TimeoutError, OSError):
+                return entry.record(False, None)
+            rtt_ms = (time.monotonic() - started) * 1000
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        return entry.record(True, rtt_ms)
+
+    async def check_all(self):
+        """Comprueba todos los servidores de forma concurrente."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        entries = [entry for entry in self._servers.values()
+                   if entry.status != "maintenance"]
+        results = await asyncio.gather(
+            *(self._check(entry, semaphore) for entry in entries),
+            return_exceptions=True,
+        )
+        changed = False
+        for entry, result in zip(entries, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error comprobando servidor {entry.config['id']}: {str(result)}")
+            elif result:
+                changed = True
+                self._update_accepting(entry.config["id"])
+        if changed:
+            self._invalidate()
+
+    async def _run(self):
+        """Bucle de comprobaciones periódicas."""
+        try:
+            while True:
+                await self.check_all()
+                await asyncio.sleep(self.interval)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error en el comprobador de servidores: {str(e)}")
+
+    async def start(self):
+        """Inicia el comprobador en segundo plano (idempotente)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Comprobador de salud iniciado para {len(self._servers)} servidores")
+
+    async def stop(self):
+        """Detiene el comprobador en segundo plano."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Instancia global del registro de servidores
+server_registry = ServerRegistry(
+    settings.VPN_SERVERS,
+    interval=settings.SERVER_HEALTH_INTERVAL,
+    timeout=settings.SERVER_HEALTH_TIMEOUT,
+    concurrency=settings.SERVER_HEALTH_CONCURRENCY,
+    load_ttl=settings.SERVER_LOAD_TTL,
+)
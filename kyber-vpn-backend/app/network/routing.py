@@ -0,0 +1,397 @@
+"""
+Tabla de rutas con coincidencia de prefijo más largo (LPM) para la VPN.
+
+Este módulo implementa una tabla de "allowed IPs" al estilo WireGuard:
+cada prefijo IPv4/IPv6 se asocia a un destino (sesión o peer) y la
+búsqueda de un paquete recorre un trie binario compacto, por lo que el
+coste depende de la longitud del prefijo y no del número de sesiones.
+"""
+import ipaddress
+import logging
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Tipos aceptados como dirección o prefijo
+Address = Union[str, int, ipaddress.IPv4Address, ipaddress.IPv6Address]
+Prefix = Union[str, ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+# Marcador de "sin hijo" / "sin valor" en los arrays del trie
+_NONE = -1
+
+
+class _BinaryTrie:
+    """
+    Trie binario almacenado en arrays planos.
+
+    Cada nodo ocupa dos posiciones en ``_children`` (hijo 0 e hijo 1) y una
+    en ``_slots`` (índice del valor asociado o -1). Esta representación es
+    mucho más compacta que un objeto por nodo y permite recorrer el trie
+    de forma vectorizada con NumPy.
+    """
+
+    def __init__(self, bits: int):
+        """
+        Inicializa un trie vacío.
+
+        Args:
+            bits: Longitud máxima de las direcciones (32 para IPv4, 128 para IPv6)
+        """
+        self.bits = bits
+        self._children = array("i", [_NONE, _NONE])
+        self._slots = array("i", [_NONE])
+        self._free_nodes: List[int] = []
+        # Copia NumPy para búsquedas por lotes (se invalida al modificar)
+        self._np_cache: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    def _new_node(self) -> int:
+        """Reserva un nodo, reutilizando nodos liberados cuando es posible."""
+        if self._free_nodes:
+            node = self._free_nodes.pop()
+            self._children[2 * node] = _NONE
+            self._children[2 * node + 1] = _NONE
+            self._slots[node] = _NONE
+            return node
+        self._children.extend((_NONE, _NONE))
+        self._slots.append(_NONE)
+        return len(self._slots) - 1
+
+    def insert(self, key: int, length: int, slot: int) -> int:
+        """
+        Inserta un prefijo en el trie.
+
+        Args:
+            key: Dirección de red como entero
+            length: Longitud del prefijo en bits
+            slot: Índice del valor a asociar
+
+        Returns:
+            Índice del valor reemplazado o -1 si el prefijo era nuevo
+        """
+        node = 0
+        for depth in range(length):
+            bit = (key >> (self.bits - 1 - depth)) & 1
+            child = self._children[2 * node + bit]
+            if child == _NONE:
+                child = self._new_node()
+                self._children[2 * node + bit] = child
+            node = child
+
+        previous = self._slots[node]
+        self._slots[node] = slot
+        self._np_cache = None
+        return previous
+
+    def remove(self, key: int, length: int) -> int:
+        """
+        Elimina un prefijo y poda las ramas que quedan vacías.
+
+        Args:
+            key: Dirección de red como entero
+            length: Longitud del prefijo en bits
+
+        Returns:
+            Índice del valor eliminado o -1 si el prefijo no existía
+        """
+        path = [0]
+        node = 0
+        for depth in range(length):
+            bit = (key >> (self.bits - 1 - depth)) & 1
+            node = self._children[2 * node + bit]
+            if node == _NONE:
+                return _NONE
+            path.append(node)
+
+        previous = self._slots[node]
+        if previous == _NONE:
+            return _NONE
+        self._slots[node] = _NONE
+
+        # Podar nodos hoja sin valor, de abajo hacia arriba (nunca la raíz)
+        for depth in range(length, 0, -1):
+            node = path[depth]
+            if (self._slots[node] != _NONE
+                    or self._children[2 * node] != _NONE
+                    or self._children[2 * node + 1] != _NONE):
+                break
+            parent = path[depth - 1]
+            bit = (key >> (self.bits - depth)) & 1
+            self._children[2 * parent + bit] = _NONE
+            self._free_nodes.append(node)
+
+        self._np_cache = None
+        return previous
+
+    def lookup(self, key: int) -> int:
+        """
+        Busca el prefijo más largo que contiene una dirección.
+
+        Args:
+            key: Dirección como entero
+
+        Returns:
+            Índice del valor encontrado o -1 si ninguna ruta coincide
+        """
+        children = self._children
+        slots = self._slots
+        node = 0
+        best = slots[0]
+        shift = self.bits - 1
+        while shift >= 0:
+            node = children[2 * node + ((key >> shift) & 1)]
+            if node == _NONE:
+                break
+            slot = slots[node]
+            if slot != _NONE:
+                best = slot
+            shift -= 1
+        return best
+
+    def lookup_batch(self, words: Sequence[np.ndarray]) -> np.ndarray:
+        """
+        Busca un lote de direcciones recorriendo el trie nivel a nivel.
+
+        Args:
+            words: Columnas uint64 de la dirección, de la más a la menos
+                   significativa (una para IPv4, dos para IPv6)
+
+        Returns:
+            Array con el índice del valor de cada dirección (-1 si no hay ruta)
+        """
+        if self._np_cache is None:
+            self._np_cache = (
+                np.frombuffer(self._children, dtype=np.int32).copy(),
+                np.frombuffer(self._slots, dtype=np.int32).copy(),
+            )
+        children, slots = self._np_cache
+
+        count = len(words[0])
+        node = np.zeros(count, dtype=np.int64)
+        best = np.full(count, slots[0], dtype=np.int64)
+        alive = np.ones(count, dtype=bool)
+        word_bits = 64 if len(words) > 1 else self.bits
+
+        for depth in range(self.bits):
+            word = words[depth // word_bits]
+            shift = np.uint64(word_bits - 1 - depth % word_bits)
+            bits = ((word >> shift) & np.uint64(1)).astype(np.int64)
+
+            nxt = np.where(alive, children[2 * np.maximum(node, 0) + bits], _NONE)
+            alive = nxt != _NONE
+            if not alive.any():
+                break
+            node = nxt
+            found = np.where(alive, slots[np.maximum(node, 0)], _NONE)
+            best = np.where(found != _NONE, found, best)
+
+        return best
+
+    def node_count(self) -> int:
+        """Devuelve el número de nodos en uso."""
+        return len(self._slots) - len(self._free_nodes)
+
+
+class RoutingTable:
+    """
+    Tabla de rutas LPM para IPv4 e IPv6.
+
+    Asocia prefijos (por ejemplo ``10.8.0.2/32`` o ``fd00::/64``) a un valor
+    arbitrario, normalmente el ID de una sesión o de un peer. Las búsquedas
+    individuales cuestan O(longitud del prefijo) y las búsquedas por lotes
+    sobre arrays NumPy recorren el trie de forma vectorizada.
+    """
+
+    def __init__(self):
+        """Inicializa una tabla de rutas vacía."""
+        self._tries: Dict[int, _BinaryTrie] = {4: _BinaryTrie(32), 6: _BinaryTrie(128)}
+        self._values: List[Any] = []
+        self._free_slots: List[int] = []
+        self._routes: Dict[Union[ipaddress.IPv4Network, ipaddress.IPv6Network], int] = {}
+        # Array de objetos para traducir índices en búsquedas por lotes
+        self._values_array: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def __contains__(self, prefix: Prefix) -> bool:
+        return self._parse_prefix(prefix) in self._routes
+
+    @staticmethod
+    def _parse_prefix(prefix: Prefix) -> Union[ipaddress.IPv4Network, ipaddress.IPv6Network]:
+        """Normaliza un prefijo a un objeto de red de ``ipaddress``."""
+        if isinstance(prefix, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            return prefix
+        return ipaddress.ip_network(prefix, strict=False)
+
+    def insert(self, prefix: Prefix, value: Any) -> None:
+        """
+        Añade o reemplaza una ruta.
+
+        Args:
+            prefix: Prefijo en notación CIDR (una IP sin máscara se trata como /32 o /128)
+            value: Destino asociado al prefijo
+        """
+        network = self._parse_prefix(prefix)
+        if network in self._routes:
+            self._values[self._routes[network]] = value
+            self._values_array = None
+            return
+
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._values[slot] = value
+        else:
+            slot = len(self._values)
+            self._values.append(value)
+
+        self._tries[network.version].insert(
+            int(network.network_address), network.prefixlen, slot
+        )
+        self._routes[network] = slot
+        self._values_array = None
+        logger.debug(f"Ruta añadida: {network} -> {value}")
+
+    def remove(self, prefix: Prefix) -> Optional[Any]:
+        """
+        Elimina una ruta.
+
+        Args:
+            prefix: Prefijo a eliminar
+
+        Returns:
+            Valor asociado a la ruta eliminada o None si no existía
+        """
+        network = self._parse_prefix(prefix)
+        slot = self._routes.pop(network, None)
+        if slot is None:
+            return None
+
+        self._tries[network.version].remove(int(network.network_address), network.prefixlen)
+        value = self._values[slot]
+        self._values[slot] = None
+        self._free_slots.append(slot)
+        self._values_array = None
+        logger.debug(f"Ruta eliminada: {network}")
+        return value
+
+    def lookup(self, address: Address, version: Optional[int] = None) -> Optional[Any]:
+        """
+        Obtiene el destino de una dirección por coincidencia de prefijo más largo.
+
+        Args:
+            address: Dirección IP (texto, objeto ``ipaddress`` o entero)
+            version: Versión IP, obligatoria solo si ``address`` es un entero
+
+        Returns:
+            Valor de la ruta más específica o None si ninguna coincide
+        """
+        if isinstance(address, int):
+            key = address
+            version = version or 4
+        else:
+            if isinstance(address, str):
+                address = ipaddress.ip_address(address)
+            key = int(address)
+            version = address.version
+
+        slot = self._tries[version].lookup(key)
+        return None if slot == _NONE else self._values[slot]
+
+    def lookup_batch(self, addresses: Union[np.ndarray, Iterable[Address]],
+                     version: int = 4) -> np.ndarray:
+        """
+        Busca el destino de un lote de direcciones.
+
+        Args:
+            addresses: Array ``uint32`` de direcciones IPv4, array ``(N, 2)``
+                       ``uint64`` (parte alta, parte baja) de direcciones IPv6,
+                       o un iterable de direcciones que se convertirá con
+                       ``addresses_to_array``
+            version: Versión IP del lote
+
+        Returns:
+            Array de objetos con el valor de cada dirección (None si no hay ruta)
+        """
+        if not isinstance(addresses, np.ndarray):
+            addresses = addresses_to_array(addresses, version)
+
+        if version == 4:
+            words = [addresses.astype(np.uint64, copy=False).reshape(-1)]
+        else:
+            if addresses.ndim != 2 or addresses.shape[1] != 2:
+                raise ValueError("Las direcciones IPv6 deben tener forma (N, 2)")
+            addresses = addresses.astype(np.uint64, copy=False)
+            words = [addresses[:, 0], addresses[:, 1]]
+
+        slots = self._tries[version].lookup_batch(words)
+
+        if self._values_array is None:
+            # La última posición (índice -1) es None: sirve para "sin ruta"
+            self._values_array = np.empty(len(self._values) + 1, dtype=object)
+            self._values_array[:-1] = self._values
+            self._values_array[-1] = None
+        return self._values_array[slots]
+
+    def routes(self) -> List[Tuple[str, Any]]:
+        """
+        Lista las rutas configuradas.
+
+        Returns:
+            Lista de tuplas (prefijo, valor)
+        """
+        return [(str(network), self._values[slot]) for network, slot in self._routes.items()]
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Obtiene estadísticas de ocupación de la tabla.
+
+        Returns:
+            Diccionario con número de rutas y de nodos por familia
+        """
+        return {
+            "routes": len(self._routes),
+            "ipv4_nodes": self._tries[4].node_count(),
+            "ipv6_nodes": self._tries[6].node_count(),
+        }
+
+
+def addresses_to_array(addresses: Iterable[Address], version: int = 4) -> np.ndarray:
+    """
+    Convierte un iterable de direcciones al formato de ``lookup_batch``.
+
+    Args:
+        addresses: Direcciones en texto, objetos ``ipaddress`` o enteros
+        version: Versión IP de las direcciones
+
+    Returns:
+        Array ``uint32`` (IPv4) o array ``(N, 2)`` ``uint64`` (IPv6)
+    """
+    values = [int(ipaddress.ip_address(a)) if not isinstance(a, int) else a for a in addresses]
+    if version == 4:
+        return np.array(values, dtype=np.uint32)
+    mask = (1 << 64) - 1
+    return np.array([(v >> 64, v & mask) for v in values], dtype=np.uint64).reshape(-1, 2)
+
+
+def packet_destination(packet: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Extrae la dirección de destino de la cabecera de un paquete IP.
+
+    Args:
+        packet: Paquete IP en bruto
+
+    Returns:
+        Tupla (versión, dirección como entero) o None si el paquete no es válido
+    """
+    if not packet:
+        return None
+    version = packet[0] >> 4
+    if version == 4 and len(packet) >= 20:
+        return 4, int.from_bytes(packet[16:20], "big")
+    if version == 6 and len(packet) >= 40:
+        return 6, int.from_bytes(packet[24:40], "big")
+    return None
@@ -0,0 +1,534 @@
+"""
+Limitación de ancho de banda y cuotas de tráfico por sesión.
+
+Este módulo implementa el subsistema de "shaping" del plano de datos:
+un token bucket por sesión que se evalúa en la ruta de envío con
+aritmética entera (sin temporizadores por paquete) y una contabilidad de
+cuotas mensuales que se acumula en memoria y se vuelca periódicamente,
+por lotes, a una base de datos SQLite.
+
+La base de datos de cuotas la comparten todos los workers de la máquina:
+cada volcado suma el consumo propio y relee el total de las cuentas
+activas, de modo que la cuota se aplica sobre el consumo de todos los
+workers (con el retraso de un intervalo de volcado).
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Los tokens se guardan en "byte-nanosegundos" para refrescar con enteros
+_NS_PER_SECOND = 1_000_000_000
+
+# Cuentas por consulta al releer totales (límite de parámetros de SQLite)
+SQL_VARIABLES = 500
+
+
+class ShapingPolicy(str, Enum):
+    """Acción a tomar con un paquete que excede el límite de la sesión."""
+    DROP = "drop"
+    QUEUE = "queue"
+
+
+class ShapingDecision(str, Enum):
+    """Resultado de evaluar un paquete en la ruta de envío."""
+    SEND = "send"
+    QUEUED = "queued"
+    DROPPED = "dropped"
+
+
+class TokenBucket:
+    """
+    Token bucket con aritmética entera.
+
+    El bucket se rellena de forma perezosa en cada consulta a partir del
+    tiempo transcurrido, por lo que no necesita ninguna tarea periódica.
+    Una tasa de 0 significa "sin límite".
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "last_ns")
+
+    def __init__(self, rate: int, burst: int, now_ns: Optional[int] = None):
+        """
+        Inicializa el bucket lleno.
+
+        Args:
+            rate: Tasa sostenida en bytes por segundo (0 = ilimitada)
+            burst: Tamaño máximo de ráfaga en bytes
+            now_ns: Marca de tiempo monotónica en nanosegundos
+        """
+        self.rate = rate
+        self.burst = max(burst, rate)
+        self.tokens = self.burst * _NS_PER_SECOND
+        self.last_ns = time.monotonic_ns() if now_ns is None else now_ns
+
+    def _refill(self, now_ns: int):
+        """Añade los tokens acumulados desde la última consulta."""
+        elapsed = now_ns - self.last_ns
+        if elapsed > 0:
+            self.tokens = min(self.tokens + elapsed * self.rate, self.burst * _NS_PER_SECOND)
+            self.last_ns = now_ns
+
+    def consume(self, size: int, now_ns: Optional[int] = None) -> bool:
+        """
+        Intenta consumir tokens para un paquete.
+
+        Args:
+            size: Tamaño del paquete en bytes
+            now_ns: Marca de tiempo monotónica en nanosegundos
+
+        Returns:
+            True si el paquete cabe en el bucket
+        """
+        if self.rate <= 0:
+            return True
+        self._refill(time.monotonic_ns() if now_ns is None else now_ns)
+        needed = size * _NS_PER_SECOND
+        if self.tokens < needed:
+            return False
+        self.tokens -= needed
+        return True
+
+    def set_rate(self, rate: int, burst: int, now_ns: Optional[int] = None):
+        """
+        Cambia la tasa y la ráfaga conservando los tokens acumulados.
+
+        Args:
+            rate: Nueva tasa en bytes por segundo (0 = ilimitada)
+            burst: Nuevo tamaño de ráfaga en bytes
+            now_ns: Marca de tiempo monotónica en nanosegundos
+        """
+        now_ns = time.monotonic_ns() if now_ns is None else now_ns
+        if self.rate > 0:
+            self._refill(now_ns)
+        self.rate = rate
+        self.burst = max(burst, rate)
+        self.tokens = min(self.tokens, self.burst * _NS_PER_SECOND)
+        self.last_ns = now_ns
+
+
+class QuotaStore:
+    """
+    Almacenamiento persistente del consumo de cuota.
+
+    Guarda los bytes consumidos por cuenta y periodo (mes) en SQLite. Las
+    escrituras se agrupan en una sola transacción por volcado. Los métodos
+    son síncronos; desde el bucle de eventos se llaman con ``call``, que
+    los ejecuta en un único hilo propio para no compartir la conexión
+    entre hilos a la vez.
+    """
+
+    def __init__(self, path: str):
+        """
+        Inicializa el almacenamiento. La base de datos se abre en ``open``.
+
+        Args:
+            path: Ruta del fichero SQLite (":memory:" para pruebas)
+        """
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def call(self, function: Callable, *args) -> Any:
+        """
+        Ejecuta un método del almacenamiento en su hilo.
+
+        Args:
+            function: Método síncrono (p. ej. ``store.get_usage``)
+            *args: Argumentos del método
+
+        Returns:
+            Resultado del método
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quota-store")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def open(self):
+        """Abre la base de datos y crea la tabla si no existe."""
+        if self._conn is not None:
+            return
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota_usage ("
+            " account TEXT NOT NULL,"
+            " period TEXT NOT NULL,"
+            " bytes INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (account, period))"
+        )
+        self._conn.commit()
+
+    def get_usage(self, account: str, period: str) -> int:
+        """
+        Obtiene los bytes consumidos por una cuenta en un periodo.
+
+        Args:
+            account: Identificador de la cuenta
+            period: Periodo en formato "AAAA-MM"
+
+        Returns:
+            Bytes consumidos
+        """
+        row = self._conn.execute(
+            "SELECT bytes FROM quota_usage WHERE account = ? AND period = ?",
+            (account, period),
+        ).fetchone()
+        return row[0] if row else 0
+
+    def add_usage(self, period: str, deltas: Dict[str, int], accounts: Iterable[str] = ()) -> Dict[str, int]:
+        """
+        Suma un lote de consumos y relee los totales en una única transacción.
+
+        Args:
+            period: Periodo en formato "AAAA-MM"
+            deltas: Bytes a sumar por cuenta
+            accounts: Cuentas adicionales cuyo total se quiere conocer
+
+        Returns:
+            Bytes consumidos (por todos los workers) de cada cuenta de
+            ``deltas`` y ``accounts``
+        """
+        wanted = list(set(deltas) | set(accounts))
+        totals = dict.fromkeys(wanted, 0)
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO quota_usage (account, period, bytes) VALUES (?, ?, ?) "
+                "ON CONFLICT(account, period) DO UPDATE SET bytes = bytes + excluded.bytes",
+                [(account, period, delta) for account, delta in deltas.items()],
+            )
+            for start in range(0, len(wanted), SQL_VARIABLES):
+                chunk = wanted[start:start + SQL_VARIABLES]
+                rows = self._conn.execute(
+                    "SELECT account, bytes FROM quota_usage "
+                    f"WHERE period = ? AND account IN ({', '.join('?' * len(chunk))})",
+                    [period] + chunk,
+                ).fetchall()
+                totals.update(rows)
+        return totals
+
+    def close(self):
+        """Cierra la conexión con la base de datos."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def aclose(self):
+        """Cierra la conexión desde el bucle de eventos y detiene el hilo."""
+        if self._executor is None:
+            self.close()
+            return
+        await self.call(self.close)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+
+
+def current_period() -> str:
+    """Devuelve el periodo de facturación actual ("AAAA-MM" en UTC)."""
+    return time.strftime("%Y-%m", time.gmtime())
+
+
+class _ShapedSession:
+    """Estado de shaping de una sesión."""
+
+    __slots__ = ("account", "bucket", "queue", "dropped", "quota")
+
+    def __init__(self, account: str, bucket: TokenBucket, quota: int):
+        self.account = account
+        self.bucket = bucket
+        self.queue: Optional[Deque[bytes]] = None  # Se crea solo si hace falta
+        self.dropped = 0
+        self.quota = quota
+
+
+class TrafficShaper:
+    """
+    Gestor de límites de ancho de banda y cuotas por sesión.
+
+    La decisión por paquete (``admit``) es O(1) y no crea tareas ni
+    temporizadores. Una única tarea en segundo plano vuelca el consumo de
+    cuota a disco y vacía las colas de los paquetes retenidos.
+    """
+
+    def __init__(
+        self,
+        store: QuotaStore,
+        policy: ShapingPolicy = ShapingPolicy.DROP,
+        default_rate: int = 0,
+        default_burst: int = 0,
+        default_quota: int = 0,
+        queue_limit: int = 64,
+        flush_interval: float = 5.0,
+    ):
+        """
+        Inicializa el gestor de shaping.
+
+        Args:
+            store: Almacenamiento persistente de cuotas
+            policy: Política para paquetes que exceden el límite
+            default_rate: Tasa por defecto en bytes/s (0 = ilimitada)
+            default_burst: Ráfaga por defecto en bytes
+            default_quota: Cuota mensual por defecto en bytes (0 = ilimitada)
+            queue_limit: Paquetes máximos retenidos por sesión con la política QUEUE
+            flush_interval: Segundos entre volcados de cuota y vaciado de colas
+        """
+        self.store = store
+        self.policy = ShapingPolicy(policy)
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.default_quota = default_quota
+        self.queue_limit = queue_limit
+        self.flush_interval = flush_interval
+
+        self._sessions: Dict[str, _ShapedSession] = {}
+        self._period = current_period()
+        self._usage: Dict[str, int] = {}    # cuenta -> bytes ya persistidos
+        self._pending: Dict[str, int] = {}  # cuenta -> bytes pendientes de volcar
+        self._backlogged: Set[str] = set()  # sesiones con paquetes en cola
+        self._transmit: Optional[Callable[[str, bytes], Awaitable[None]]] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def start(self, transmit: Callable[[str, bytes], Awaitable[None]]):
+        """
+        Abre el almacenamiento de cuotas e inicia la tarea de volcado periódico.
+
+        Args:
+            transmit: Corrutina que envía un paquete liberado de la cola
+        """
+        await self.store.call(self.store.open)
+        self._transmit = transmit
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Detiene la tarea periódica, vuelca el consumo pendiente y cierra el almacenamiento."""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        await self.store.aclose()
+
+    async def add_session(self, session_id: str, account: str):
+        """
+        Registra una sesión con los límites por defecto.
+
+        Args:
+            session_id: ID de la sesión
+            account: Cuenta a la que se imputa la cuota (p. ej. el usuario)
+        """
+        if account not in self._usage:
+            self._usage[account] = await self.store.call(
+                self.store.get_usage, account, self._period
+            )
+        self._sessions[session_id] = _ShapedSession(
+            account,
+            TokenBucket(self.default_rate, self.default_burst),
+            self.default_quota,
+        )
+
+    def remove_session(self, session_id: str):
+        """
+        Elimina una sesión. El consumo pendiente se vuelca en el próximo ciclo.
+
+        Args:
+            session_id: ID de la sesión
+        """
+        self._sessions.pop(session_id, None)
+        self._backlogged.discard(session_id)
+
+    def set_limits(
+        self,
+        session_id: str,
+        rate: Optional[int] = None,
+        burst: Optional[int] = None,
+        quota: Optional[int] = None,
+    ) -> bool:
+        """
+        Cambia en caliente los límites de una sesión.
+
+        Args:
+            session_id: ID de la sesión
+            rate: Nueva tasa en bytes/s (None = sin cambios, 0 = ilimitada)
+            burst: Nueva ráfaga en bytes (None = sin cambios)
+            quota: Nueva cuota mensual en bytes (None = sin cambios, 0 = ilimitada)
+
+        Returns:
+            True si la sesión existe
+        """
+        shaped = self._sessions.get(session_id)
+        if shaped is None:
+            return False
+        bucket = shaped.bucket
+        bucket.set_rate(
+            bucket.rate if rate is None else rate,
+            bucket.burst if burst is None else burst,
+        )
+        if quota is not None:
+            shaped.quota = quota
+        logger.info(f"Límites actualizados para sesión {session_id}: "
+                    f"rate={bucket.rate} burst={bucket.burst} quota={shaped.quota}")
+        return True
+
+    def admit(self, session_id: str, packet: bytes) -> ShapingDecision:
+        """
+        Decide si un paquete puede enviarse ahora.
+
+        Args:
+            session_id: ID de la sesión emisora
+            packet: Paquete a enviar
+
+        Returns:
+            SEND si puede enviarse, QUEUED si quedó retenido o DROPPED si se descartó
+        """
+        shaped = self._sessions.get(session_id)
+        if shaped is None:
+            return ShapingDecision.SEND
+
+        size = len(packet)
+        account = shaped.account
+        if shaped.quota > 0:
+            used = self._usage.get(account, 0) + self._pending.get(account, 0)
+            if used + size > shaped.quota:
+                shaped.dropped += 1
+                return ShapingDecision.DROPPED
+
+        # Respetar el orden: si hay cola, el paquete nuevo va detrás
+        if not shaped.queue and shaped.bucket.consume(size):
+            self._pending[account] = self._pending.get(account, 0) + size
+            return ShapingDecision.SEND
+
+        # Un paquete mayor que la ráfaga nunca cabría: no se encola
+        if self.policy == ShapingPolicy.QUEUE and size <= shaped.bucket.burst:
+            if shaped.queue is None:
+                shaped.queue = deque()
+            if len(shaped.queue) < self.queue_limit:
+                shaped.queue.append(packet)
+                self._backlogged.add(session_id)
+                return ShapingDecision.QUEUED
+
+        shaped.dropped += 1
+        return ShapingDecision.DROPPED
+
+    def release(self, session_id: str) -> List[bytes]:
+        """
+        Extrae de la cola los paquetes que ya caben en el bucket.
+
+        Args:
+            session_id: ID de la sesión
+
+        Returns:
+            Paquetes listos para enviarse, en orden
+        """
+        shaped = self._sessions.get(session_id)
+        if shaped is None or not shaped.queue:
+            return []
+
+        released = []
+        now_ns = time.monotonic_ns()
+        queue = shaped.queue
+        while queue and shaped.bucket.consume(len(queue[0]), now_ns):
+            packet = queue.popleft()
+            self._pending[shaped.account] = self._pending.get(shaped.account, 0) + len(packet)
+            released.append(packet)
+        if not queue:
+            self._backlogged.discard(session_id)
+        return released
+
+    async def flush(self):
+        """
+        Vuelca a disco, en un solo lote, el consumo acumulado.
+
+        En la misma transacción se releen los totales de las cuentas
+        activas, que incluyen lo consumido a través de otros workers.
+        """
+        period = current_period()
+        pending, self._pending = self._pending, {}
+        active = {shaped.account for shaped in self._sessions.values()}
+        if pending or active:
+            try:
+                totals = await self.store.call(self.store.add_usage, self._period, pending, active)
+            except Exception as e:
+                logger.error(f"Error al volcar consumo de cuota: {str(e)}")
+                # Conservar los deltas para el siguiente intento
+                for account, delta in pending.items():
+                    self._pending[account] = self._pending.get(account, 0) + delta
+                return
+            if period == self._period:
+                # Lo acumulado durante el volcado sigue en _pending y se suma aparte
+                self._usage.update(totals)
+
+        if period != self._period:
+            # Nuevo mes: las cuotas empiezan de cero
+            logger.info(f"Nuevo periodo de cuotas: {period}")
+            self._period = period
+            self._usage = {account: 0 for account in self._usage}
+
+        # Olvidar cuentas sin sesiones activas
+        active = {shaped.account for shaped in self._sessions.values()}
+        for account in list(self._usage):
+            if account not in active and account not in self._pending:
+                del self._usage[account]
+
+    async def _flush_loop(self):
+        """
+        Tarea única de mantenimiento: vacía colas y vuelca cuotas.
+
+        Un error en una iteración se registra y no detiene la tarea.
+        """
+        last_flush = time.monotonic()
+        while True:
+            try:
+                # Las colas se vacían con más frecuencia que el volcado a disco
+                await asyncio.sleep(min(self.flush_interval, 0.1))
+                if self._transmit is not None:
+                    for session_id in list(self._backlogged):
+                        for packet in self.release(session_id):
+                            try:
+                                await self._transmit(session_id, packet)
+                            except Exception as e:
+                                logger.error(f"Error enviando paquete retenido de sesión {session_id}: {str(e)}")
+
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    last_flush = time.monotonic()
+                    await self.flush()
+            except asyncio.CancelledError:
+                return
+            except Exception as e:
+                logger.error(f"Error en tarea de shaping: {str(e)}")
+
+    def get_session_stats(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Obtiene los límites y el consumo de una sesión.
+
+        Args:
+            session_id: ID de la sesión
+
+        Returns:
+            Diccionario con límites y consumo, o None si la sesión no existe
+        """
+        shaped = self._sessions.get(session_id)
+        if shaped is None:
+            return None
+        account = shaped.account
+        return {
+            "rate": shaped.bucket.rate,
+            "burst": shaped.bucket.burst,
+            "quota": shaped.quota,
+            "used": self._usage.get(account, 0) + self._pending.get(account, 0),
+            "queued": len(shaped.queue) if shaped.queue else 0,
+            "dropped": shaped.dropped,
+        }
@@ -0,0 +1,350 @@
+"""
+Instantáneas de sesiones VPN para reinicios en caliente.
+
+Este módulo guarda el estado de cada sesión (clave simétrica sellada con
+la clave del nodo, contadores, nonce reservado y concesión de IP) en un
+fichero proyectado en memoria con un registro de tamaño fijo por sesión.
+Cada escritura solo toca el registro de la sesión que ha cambiado, y al
+ser memoria compartida con el núcleo sobrevive a la caída del proceso.
+
+Al arrancar, el nodo restaura las sesiones del fichero y sigue
+atendiéndolas sin repetir el intercambio Kyber. Los nonces de AES-GCM
+son contadores cuyo límite se reserva en la instantánea antes de usarse,
+de modo que tras restaurar se continúa desde el límite reservado: nunca
+se reutiliza un nonce y como mucho se saltan ``nonce_window`` valores.
+"""
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo exclusivo del fichero
+    fcntl = None
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"KVSS"
+_VERSION = 1
+# Cabecera: magic, versión, tamaño de registro, número de registros,
+# momento de la última escritura y comprobación de la clave del nodo
+_HEADER = struct.Struct("<4sHHId16s")
+_HEADER_SIZE = 64
+# Registro: crc, estado, ID de sesión, usuario, servidor, IP VPN, creación,
+# última actividad, bytes enviados/recibidos, límite de nonce y clave sellada
+_RECORD = struct.Struct("<IB3x16s64s32s16sddQQQ12s48s20x")
+_RECORD_FREE = 0
+_RECORD_USED = 1
+
+
+def derive_node_key(secret: str) -> bytes:
+    """
+    Deriva la clave del nodo con la que se sellan las claves de sesión.
+
+    Args:
+        secret: Secreto configurado del nodo
+
+    Returns:
+        Clave AES-256 de 32 bytes
+    """
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"kyber-vpn-snapshot"
+    ).derive(secret.encode("utf-8"))
+
+
+def _pack_ip(address: str) -> bytes:
+    ip = ipaddress.ip_address(address)
+    if ip.version == 4:
+        ip = ipaddress.IPv6Address(f"::ffff:{ip}")
+    return ip.packed
+
+
+def _unpack_ip(data: bytes) -> str:
+    ip = ipaddress.IPv6Address(data)
+    return str(ip.ipv4_mapped or ip)
+
+
+def _pad(value: Optional[str], size: int) -> Optional[bytes]:
+    data = (value or "").encode("utf-8")
+    return data if len(data) <= size else None
+
+
+class SessionSnapshot:
+    """
+    Fichero de instantáneas proyectado en memoria.
+
+    Con varios workers, cada uno usa el fichero de su índice (como el
+    estado del pool de direcciones), de modo que un worker reiniciado
+    recupera las sesiones que dejó el anterior con ese mismo índice. El
+    fichero se bloquea con ``flock`` para que dos procesos no lo compartan.
+    """
+
+    def __init__(self, path: str, node_key: bytes, slots: int = 1024, nonce_window: int = 1 << 20):
+        """
+        Inicializa la instantánea (sin abrir el fichero).
+
+        Args:
+            path: Ruta del fichero de este worker
+            node_key: Clave del nodo para sellar las claves de sesión
+            slots: Registros iniciales (el fichero crece si hacen falta más)
+            nonce_window: Nonces reservados por adelantado en cada escritura
+        """
+        self.path = path
+        self.nonce_window = nonce_window
+        self._aead = AESGCM(node_key)
+        self._key_check = AESGCM(node_key).encrypt(b"\0" * 12, b"", _MAGIC)
+        self._initial_slots = slots
+        self._slots = 0
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._slot_of: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._sealed: Dict[str, tuple] = {}  # session_id -> (clave, nonce, sellada)
+        self._writes = 0
+
+    # ---- Fichero ------------------------------------------------------------
+
+    def open(self):
+        """
+        Abre (o crea) el fichero de instantáneas de este proceso.
+
+        Raises:
+            RuntimeError: Si otro proceso tiene abierto el mismo fichero
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        handle = open(self.path, "a+b")
+        if fcntl:
+            try:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                raise RuntimeError(f"La instantánea {self.path} está en uso por otro proceso") from None
+        self._file = handle
+
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _HEADER_SIZE or not self._valid_header(size):
+            self._format(self._initial_slots)
+        else:
+            self._map = mmap.mmap(self._file.fileno(), size)
+            self._slots = (size - _HEADER_SIZE) // _RECORD.size
+        logger.info(f"Instantánea de sesiones en {self.path} ({self._slots} registros)")
+
+    def _valid_header(self, size: int) -> bool:
+        """Comprueba que el fichero existente es compatible con este nodo."""
+        self._file.seek(0)
+        magic, version, record_size, slots, _, key_check = _HEADER.unpack(
+            self._file.read(_HEADER.size)
+        )
+        if magic != _MAGIC or version != _VERSION or record_size != _RECORD.size:
+            return False
+        if key_check != self._key_check[:16]:
+            logger.warning("La instantánea se selló con otra clave de nodo; se descarta")
+            return False
+        return size == _HEADER_SIZE + slots * _RECORD.size
+
+    def _format(self, slots: int):
+        """Crea un fichero vacío con ``slots`` registros."""
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(0)
+        self._file.truncate(_HEADER_SIZE + slots * _RECORD.size)
+        self._map = mmap.mmap(self._file.fileno(), _HEADER_SIZE + slots * _RECORD.size)
+        self._slots = slots
+        self._write_header()
+        self._slot_of.clear()
+        self._free = list(range(slots - 1, -1, -1))
+
+    def _write_header(self):
+        self._map[:_HEADER.size] = _HEADER.pack(
+            _MAGIC, _VERSION, _RECORD.size, self._slots, time.time(), self._key_check[:16]
+        )
+
+    def _grow(self):
+        """Duplica el número de registros del fichero."""
+        old_slots = self._slots
+        new_slots = old_slots * 2
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(_HEADER_SIZE + new_slots * _RECORD.size)
+        self._map = mmap.mmap(self._file.fileno(), _HEADER_SIZE + new_slots * _RECORD.size)
+        self._slots = new_slots
+        self._write_header()
+        self._free.extend(range(new_slots - 1, old_slots - 1, -1))
+
+    def close(self):
+        """Vuelca las páginas pendientes y libera el fichero."""
+        if self._map is not None:
+            self._write_header()
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()  # Libera también el flock
+            self._file = None
+
+    # ---- Registros ------------------------------------------------------------
+
+    def load(self, max_age: float) -> List[Dict[str, Any]]:
+        """
+        Lee las sesiones guardadas y prepara la lista de registros libres.
+
+        Args:
+            max_age: Antigüedad máxima de la instantánea en segundos
+
+        Returns:
+            Sesiones restaurables con su clave ya desellada
+        """
+        written_at = _HEADER.unpack(self._map[:_HEADER.size])[4]
+        too_old = time.time() - written_at > max_age
+        if too_old:
+            logger.info("Instantánea demasiado antigua: no se restauran sesiones")
+
+        sessions = []
+        self._slot_of.clear()
+        self._free = []
+        for slot in range(self._slots - 1, -1, -1):
+            offset = _HEADER_SIZE + slot * _RECORD.size
+            record = self._map[offset:offset + _RECORD.size]
+            crc, state = struct.unpack_from("<IB", record)
+            data = None
+            if state == _RECORD_USED and not too_old and crc == zlib.crc32(record[4:]):
+                data = self._decode(record)
+            if data is None:
+                if state != _RECORD_FREE:
+                    self._map[offset:offset + _RECORD.size] = bytes(_RECORD.size)
+                self._free.append(slot)
+                continue
+            self._slot_of[data["id"]] = slot
+            sessions.append(data)
+        sessions.sort(key=lambda data: data["created_at"])
+        return sessions
+
+    def _decode(self, record: bytes) -> Optional[Dict[str, Any]]:
+        """Decodifica un registro y desella su clave (None si no es válido)."""
+        (_, _, session_id, user, server_id, vpn_ip, created_at, last_activity,
+         bytes_sent, bytes_received, nonce_limit, seal_nonce, sealed) = _RECORD.unpack(record)
+        session_id = session_id.hex()
+        try:
+            key = self._aead.decrypt(seal_nonce, sealed, session_id.encode())
+        except Exception:
+            logger.warning(f"Clave sellada inválida para la sesión {session_id}")
+            return None
+        self._sealed[session_id] = (key, seal_nonce, sealed)
+        user = user.rstrip(b"\0").decode("utf-8")
+        return {
+            "id": session_id,
+            "user": user or None,
+            "server_id": server_id.rstrip(b"\0").decode("utf-8"),
+            "vpn_ip": _unpack_ip(vpn_ip),
+            "key": key,
+            "created_at": created_at,
+            "last_activity": last_activity,
+            "bytes_sent": bytes_sent,
+            "bytes_received": bytes_received,
+            "nonce_limit": nonce_limit,
+        }
+
+    def _seal(self, session_id: str, key: bytes) -> tuple:
+        """Sella una clave de sesión (cacheado mientras la clave no cambie)."""
+        sealed = self._sealed.get(session_id)
+        if sealed is None or sealed[0] != key:
+            nonce = os.urandom(12)
+            sealed = (key, nonce, self._aead.encrypt(nonce, key, session_id.encode()))
+            self._sealed[session_id] = sealed
+        return sealed
+
+    def write(self, session) -> bool:
+        """
+        Guarda (o actualiza) el registro de una sesión.
+
+        Args:
+            session: Sesión VPN (``app.network.sessions.Session``)
+
+        Returns:
+            True si se escribió; False si la sesión no cabe en el formato
+        """
+        if self._map is None:
+            return False
+        user = _pad(session.user, 64)
+        server_id = _pad(session.server_id, 32)
+        if user is None or server_id is None or len(session.key) != 32:
+            return False
+
+        _, seal_nonce, sealed = self._seal(session.id, session.key)
+        body = _RECORD.pack(
+            0, _RECORD_USED, bytes.fromhex(session.id), user, server_id,
+            _pack_ip(session.vpn_ip), session.created_at, session.last_activity,
+            session.bytes_sent, session.bytes_received, session.nonce_limit,
+            seal_nonce, sealed,
+        )
+        record = struct.pack("<I", zlib.crc32(body[4:])) + body[4:]
+
+        slot = self._slot_of.get(session.id)
+        if slot is None:
+            if not self._free:
+                self._grow()
+            slot = self._free.pop()
+            self._slot_of[session.id] = slot
+        offset = _HEADER_SIZE + slot * _RECORD.size
+        if self._map[offset:offset + _RECORD.size] != record:
+            self._map[offset:offset + _RECORD.size] = record
+            self._writes += 1
+        return True
+
+    def reserve_nonces(self, session) -> bool:
+        """
+        Reserva el siguiente bloque de nonces de una sesión antes de usarlo.
+
+        Args:
+            session: Sesión cuyo contador ha alcanzado el límite reservado
+
+        Returns:
+            True si la reserva quedó guardada en la instantánea
+        """
+        session.nonce_limit = session.tx_counter + self.nonce_window
+        return self.write(session)
+
+    def remove(self, session_id: str):
+        """
+        Borra el registro de una sesión cerrada.
+
+        Args:
+            session_id: ID de la sesión
+        """
+        self._sealed.pop(session_id, None)
+        slot = self._slot_of.pop(session_id, None)
+        if slot is None or self._map is None:
+            return
+        offset = _HEADER_SIZE + slot * _RECORD.size
+        self._map[offset:offset + _RECORD.size] = bytes(_RECORD.size)
+        self._free.append(slot)
+
+    def touch(self):
+        """Actualiza la marca de tiempo de la instantánea."""
+        if self._map is not None:
+            self._write_header()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de la instantánea.
+
+        Returns:
+            Fichero, registros totales y ocupados, y escrituras realizadas
+        """
+        return {
+            "path": self.path,
+            "slots": self._slots,
+            "used": len(self._slot_of),
+            "writes": self._writes,
+        }
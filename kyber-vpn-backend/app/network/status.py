@@ -0,0 +1,284 @@
+"""
+Flujo de estado de las sesiones VPN.
+
+En lugar de que cada cliente consulte ``/api/status`` periódicamente,
+este módulo muestrea el estado de las sesiones con suscriptores (una
+sola vez por intervalo, sea cual sea su número) y lo publica como
+actualizaciones delta: solo los campos que cambian respecto a la
+versión que ya tiene el suscriptor.
+
+Cada trama se serializa una única vez y se comparte entre todos los
+suscriptores de la misma sesión que parten de la misma versión. Un
+suscriptor lento no acumula tramas: recibe la diferencia entre su
+última versión y la actual, limitada a su frecuencia máxima.
+
+Las sesiones de otro worker también se pueden seguir: su estado se pide
+al worker que las atiende en cada intervalo de muestreo.
+"""
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.network.forward import ForwardError
+from app.network.timers import Timer, timer_wheel
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Versiones anteriores conservadas para calcular deltas de suscriptores atrasados
+STATUS_HISTORY = 8
+
+
+class StatusChannel:
+    """
+    Estado publicado de una sesión y sus tramas serializadas.
+
+    Las versiones son consecutivas; ``frames`` guarda, para la versión
+    actual, la trama ya serializada desde cada versión de partida.
+    """
+
+    __slots__ = ("session_id", "subscribers", "version", "state", "history",
+                 "frames", "changed", "closed", "remote")
+
+    def __init__(self, session_id: str):
+        """
+        Inicializa el canal.
+
+        Args:
+            session_id: ID de la sesión publicada
+        """
+        self.session_id = session_id
+        self.subscribers = 0
+        self.version = 0
+        self.state: Dict[str, Any] = {}
+        self.history: Deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=STATUS_HISTORY)
+        self.frames: Dict[int, str] = {}
+        self.changed = asyncio.Event()
+        self.closed = False
+        self.remote = False  # La sesión la atiende otro worker
+
+    def publish(self, state: Dict[str, Any]) -> bool:
+        """
+        Publica un nuevo estado si difiere del actual.
+
+        Args:
+            state: Estado completo de la sesión
+
+        Returns:
+            True si se ha creado una versión nueva
+        """
+        if state == self.state:
+            return False
+        if self.version:
+            self.history.append((self.version, self.state))
+        self.version += 1
+        self.state = state
+        self.frames = {}
+        # Despertar a los suscriptores en espera con un evento nuevo para la siguiente versión
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+        return True
+
+    def _base(self, since: int) -> Optional[Dict[str, Any]]:
+        """Obtiene el estado de una versión anterior, si se conserva."""
+        if not self.history or since < self.history[0][0]:
+            return None
+        version, state = self.history[since - self.history[0][0]]
+        return state if version == since else None
+
+    def frame(self, since: int) -> Tuple[str, bool]:
+        """
+        Obtiene la trama que lleva a un suscriptor a la versión actual.
+
+        Args:
+            since: Última versión recibida por el suscriptor (0 = ninguna)
+
+        Returns:
+            Tupla con (trama JSON, True si se ha serializado en esta llamada)
+        """
+        frame = self.frames.get(since)
+        if frame is not None:
+            return frame, False
+
+        base = self._base(since)
+        if base is None:
+            payload = {"seq": self.version, "full": True, "status": self.state}
+        else:
+            delta = {key: value for key, value in self.state.items() if base.get(key) != value}
+            payload = {"seq": self.version, "since": since, "delta": delta}
+        frame = json.dumps(payload, separators=(",", ":"))
+        self.frames[since] = frame
+        return frame, True
+
+
+class StatusHub:
+    """
+    Publicador del estado de las sesiones para SSE y WebSocket.
+
+    Un temporizador de la rueda global muestrea las sesiones con
+    suscriptores a la frecuencia máxima configurada; las sesiones sin
+    suscriptores no tienen canal ni coste.
+    """
+
+    def __init__(self, manager, max_rate: float = 1.0):
+        """
+        Inicializa el publicador.
+
+        Args:
+            manager: Gestor VPN del que se muestrean las sesiones
+            max_rate: Frecuencia máxima de actualizaciones por suscriptor (Hz)
+        """
+        self.manager = manager
+        self.max_rate = max_rate
+        self._channels: Dict[str, StatusChannel] = {}
+        self._timer: Optional[Timer] = None
+        self._polling: Optional[asyncio.Future] = None
+        self._encoded = 0
+        self._sent = 0
+
+    async def start(self):
+        """Programa el muestreo periódico en la rueda de temporizadores."""
+        if self._timer is None:
+            self._timer = timer_wheel.schedule_periodic(1.0 / self.max_rate, self._sample)
+
+    async def stop(self):
+        """Cancela el muestreo y cierra los flujos abiertos."""
+        timer_wheel.cancel(self._timer)
+        self._timer = None
+        if self._polling is not None:
+            self._polling.cancel()
+            self._polling = None
+        for channel in self._channels.values():
+            channel.closed = True
+            channel.publish(dict(channel.state, connected=False))
+
+    def _sample(self):
+        """Publica el estado actual de cada sesión con suscriptores."""
+        remote = []
+        for channel in self._channels.values():
+            if channel.closed:
+                continue
+            if channel.remote:
+                remote.append(channel)
+                continue
+            session = self.manager.sessions.get(channel.session_id)
+            if session is None:
+                # Sesión cerrada: última actualización y fin del flujo
+                channel.closed = True
+                channel.publish(self.manager.status_fields(None))
+            else:
+                channel.publish(self.manager.status_fields(session))
+        # Las consultas a otros workers no retrasan el muestreo local
+        if remote and (self._polling is None or self._polling.done()):
+            self._polling = asyncio.ensure_future(self._poll_remote(remote))
+
+    async def _poll_remote(self, channels: List[StatusChannel]):
+        """Publica el estado de sesiones de otros workers, pidiéndoselo a cada uno."""
+        results = await asyncio.gather(
+            *(self.manager.call_owner(channel.session_id, "status") for channel in channels),
+            return_exceptions=True,
+        )
+        for channel, fields in zip(channels, results):
+            if isinstance(fields, ForwardError):
+                # Se reintenta en el siguiente muestreo; si el worker ha caído,
+                # su sesión deja de existir al caducar su latido
+                logger.warning(f"Estado remoto no disponible: {str(fields)}")
+            elif isinstance(fields, Exception):
+                logger.error(f"Error consultando una sesión remota: {str(fields)}")
+            elif fields is None:
+                channel.closed = True
+                channel.publish(self.manager.status_fields(None))
+            else:
+                channel.publish(fields)
+
+    def _channel(self, session_id: str) -> StatusChannel:
+        """Obtiene o crea el canal de una sesión."""
+        channel = self._channels.get(session_id)
+        if channel is None:
+            channel = StatusChannel(session_id)
+            self._channels[session_id] = channel
+        return channel
+
+    def _release(self, channel: StatusChannel):
+        """Da de baja a un suscriptor y elimina el canal si queda vacío."""
+        channel.subscribers -= 1
+        if channel.subscribers <= 0 and self._channels.get(channel.session_id) is channel:
+            del self._channels[channel.session_id]
+
+    async def subscribe(self, session_id: str,
+                        max_rate: Optional[float] = None) -> AsyncIterator[str]:
+        """
+        Genera las tramas de estado de una sesión.
+
+        La primera trama contiene el estado completo y las siguientes
+        solo los campos modificados. El flujo termina tras publicar la
+        desconexión de la sesión. Si la sesión es de otro worker, su
+        estado se le pide a él.
+
+        Args:
+            session_id: ID de la sesión
+            max_rate: Frecuencia máxima pedida por el cliente (Hz), acotada
+                por la configurada
+
+        Yields:
+            Tramas JSON con el estado o su delta
+        """
+        session = self.manager.resolve_session(session_id)
+        fields = None
+        if session is None:
+            try:
+                fields = await self.manager.call_owner(session_id, "status")
+            except ForwardError as e:
+                logger.warning(f"Estado remoto no disponible: {str(e)}")
+            if fields is None:
+                # Sin sesión en ningún worker: un único estado desconectado
+                channel = StatusChannel(session_id)
+                channel.publish(self.manager.status_fields(None))
+                yield channel.frame(0)[0]
+                return
+
+        rate = self.max_rate if not max_rate else min(max_rate, self.max_rate)
+        interval = 1.0 / rate
+        channel = self._channel(session_id)
+        channel.subscribers += 1
+        if not channel.version:
+            channel.remote = session is None
+            channel.publish(fields if session is None else self.manager.status_fields(session))
+
+        seen = 0
+        try:
+            while True:
+                if channel.version == seen:
+                    if channel.closed:
+                        return
+                    await channel.changed.wait()
+                frame, encoded = channel.frame(seen)
+                if encoded:
+                    self._encoded += 1
+                self._sent += 1
+                seen = channel.version
+                yield frame
+                if channel.closed and channel.version == seen:
+                    return
+                # Coalescer: los cambios durante la espera se envían juntos
+                await asyncio.sleep(interval)
+        finally:
+            self._release(channel)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas del flujo de estado.
+
+        Returns:
+            Canales, suscriptores y tramas serializadas frente a enviadas
+        """
+        return {
+            "channels": len(self._channels),
+            "subscribers": sum(channel.subscribers for channel in self._channels.values()),
+            "framesEncoded": self._encoded,
+            "framesSent": self._sent,
+            "maxRate": self.max_rate,
+        }
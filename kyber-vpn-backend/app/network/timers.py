@@ -0,0 +1,322 @@
+"""
+Rueda de temporizadores jerárquica.
+
+Este módulo implementa un único servicio de temporizadores movido por
+una sola tarea asyncio. Los temporizadores se reparten en varios niveles
+de 64 ranuras (el primero con resolución de un tick y cada nivel
+siguiente 64 veces más grueso); al dar la vuelta un nivel, su ranura se
+redistribuye en los niveles inferiores. Programar y cancelar son O(1)
+y el coste por tick solo depende de los temporizadores que vencen.
+
+Se usa para el trabajo periódico de las sesiones (keepalives,
+estadísticas, renovación de claves, caducidad de concesiones y
+desconexión por inactividad) en lugar de una tarea por sesión.
+"""
+import asyncio
+import inspect
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from app.core.config import settings
+
+# Configurar logger
+logger = logging.getLogger(__name__)
+
+# Geometría de la rueda: 4 niveles de 64 ranuras (64^4 ticks de horizonte)
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SLOTS - 1
+WHEEL_LEVELS = 4
+WHEEL_HORIZON = 1 << (WHEEL_BITS * WHEEL_LEVELS)
+
+
+class Timer:
+    """
+    Temporizador programado en la rueda.
+
+    Se guarda en un diccionario de ranura (usado como conjunto ordenado),
+    de modo que cancelarlo solo requiere borrarlo de esa ranura.
+    """
+
+    __slots__ = ("expires", "interval", "callback", "args", "cancelled", "_slot", "_running")
+
+    def __init__(self, expires: int, interval: Optional[float], callback: Callable, args: tuple):
+        """
+        Inicializa el temporizador.
+
+        Args:
+            expires: Tick en el que vence
+            interval: Periodo en segundos (None para temporizadores de un solo uso)
+            callback: Función o corrutina a invocar al vencer
+            args: Argumentos posicionales para la función
+        """
+        self.expires = expires
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._slot: Optional[Dict["Timer", None]] = None
+        self._running: Optional[asyncio.Task] = None
+
+
+class TimerWheel:
+    """
+    Rueda de temporizadores jerárquica con una sola tarea de avance.
+
+    Las funciones síncronas se ejecutan dentro del tick. Las corrutinas
+    se lanzan como tareas de corta duración; un temporizador periódico
+    no vuelve a lanzarse mientras su ejecución anterior siga en curso.
+    """
+
+    def __init__(self, tick: float = 0.1):
+        """
+        Inicializa la rueda.
+
+        Args:
+            tick: Resolución en segundos
+        """
+        self.tick = tick
+        self._wheels: List[List[Dict[Timer, None]]] = [
+            [{} for _ in range(WHEEL_SLOTS)] for _ in range(WHEEL_LEVELS)
+        ]
+        self._current = 0  # Último tick procesado
+        self._origin = time.monotonic()
+        self._count = 0
+        self._fired = 0
+        self._running: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _ticks(self, delay: float) -> int:
+        """Convierte un retardo en segundos a ticks (al menos uno)."""
+        return max(1, int(round(delay / self.tick)))
+
+    def _insert(self, timer: Timer):
+        """Coloca un temporizador en la ranura que le corresponde."""
+        # Solo la redistribución de una ranura llega con vencimiento en el
+        # tick actual: va al nivel 0, que se procesa justo después
+        expires = max(timer.expires, self._current)
+        delta = expires - self._current
+        if delta >= WHEEL_HORIZON:
+            # Fuera del horizonte: se reubica al acercarse el vencimiento
+            expires = self._current + WHEEL_HORIZON - 1
+            delta = WHEEL_HORIZON - 1
+
+        level = 0
+        while delta >= 1 << (WHEEL_BITS * (level + 1)):
+            level += 1
+        slot = self._wheels[level][(expires >> (WHEEL_BITS * level)) & WHEEL_MASK]
+        slot[timer] = None
+        timer._slot = slot
+
+    def schedule(self, delay: float, callback: Callable, *args: Any) -> Timer:
+        """
+        Programa una llamada única.
+
+        Args:
+            delay: Segundos hasta el vencimiento
+            callback: Función o corrutina a invocar
+            *args: Argumentos para la función
+
+        Returns:
+            Temporizador programado (para cancelarlo o reprogramarlo)
+        """
+        timer = Timer(self._current + self._ticks(delay), None, callback, args)
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def schedule_periodic(self, interval: float, callback: Callable, *args: Any,
+                          first_delay: Optional[float] = None) -> Timer:
+        """
+        Programa una llamada periódica.
+
+        Args:
+            interval: Segundos entre ejecuciones
+            callback: Función o corrutina a invocar
+            *args: Argumentos para la función
+            first_delay: Segundos hasta la primera ejecución (por defecto, el periodo)
+
+        Returns:
+            Temporizador programado (para cancelarlo o reprogramarlo)
+        """
+        delay = interval if first_delay is None else first_delay
+        timer = Timer(self._current + self._ticks(delay), interval, callback, args)
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def reschedule(self, timer: Timer, delay: float, interval: Optional[float] = None):
+        """
+        Mueve un temporizador a un nuevo vencimiento.
+
+        Args:
+            timer: Temporizador a mover
+            delay: Segundos hasta el nuevo vencimiento
+            interval: Nuevo periodo (None para conservar el actual)
+        """
+        if timer.cancelled:
+            return
+        if interval is not None:
+            timer.interval = interval
+        if timer._slot is not None:
+            del timer._slot[timer]
+        else:
+            self._count += 1
+        timer.expires = self._current + self._ticks(delay)
+        self._insert(timer)
+
+    def cancel(self, timer: Optional[Timer]):
+        """
+        Cancela un temporizador (idempotente).
+
+        Args:
+            timer: Temporizador a cancelar
+        """
+        if timer is None or timer.cancelled:
+            return
+        timer.cancelled = True
+        if timer._slot is not None:
+            del timer._slot[timer]
+            timer._slot = None
+            self._count -= 1
+
+    def _cascade(self, level: int):
+        """Redistribuye la ranura actual de un nivel en los inferiores."""
+        index = (self._current >> (WHEEL_BITS * level)) & WHEEL_MASK
+        slot = self._wheels[level][index]
+        if slot:
+            self._wheels[level][index] = {}
+            for timer in slot:
+                self._insert(timer)
+
+    def advance(self, ticks: int = 1):
+        """
+        Avanza la rueda y ejecuta los temporizadores vencidos.
+
+        Args:
+            ticks: Número de ticks a procesar
+        """
+        for _ in range(ticks):
+            self._current += 1
+            level = 1
+            while level < WHEEL_LEVELS and not self._current & ((1 << (WHEEL_BITS * level)) - 1):
+                self._cascade(level)
+                level += 1
+
+            index = self._current & WHEEL_MASK
+            slot = self._wheels[0][index]
+            if not slot:
+                continue
+            self._wheels[0][index] = {}
+            # Se recorre una copia: un callback puede cancelar o reprogramar
+            # otro temporizador de esta misma ranura
+            for timer in list(slot):
+                if timer._slot is not slot:
+                    continue  # Cancelado o reprogramado por un callback anterior
+                timer._slot = None
+                if timer.expires > self._current:
+                    # Temporizador más allá del horizonte inicial
+                    self._insert(timer)
+                    continue
+                try:
+                    self._fire(timer)
+                except Exception as e:
+                    logger.error(f"Error al ejecutar un temporizador: {str(e)}")
+
+    def _fire(self, timer: Timer):
+        """Ejecuta un temporizador vencido y lo vuelve a armar si es periódico."""
+        if timer.interval is not None:
+            timer.expires = self._current + self._ticks(timer.interval)
+            self._insert(timer)
+        else:
+            self._count -= 1
+
+        if timer._running is not None:
+            if not timer._running.done():
+                return  # La ejecución anterior sigue en curso
+            timer._running = None
+
+        self._fired += 1
+        try:
+            result = timer.callback(*timer.args)
+        except Exception as e:
+            logger.error(f"Error en temporizador {getattr(timer.callback, '__name__', timer.callback)}: {str(e)}")
+            return
+
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            timer._running = task
+            self._running.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        """Recoge el resultado de una ejecución asíncrona."""
+        self._running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error en temporizador asíncrono: {str(task.exception())}")
+
+    async def _run(self):
+        """
+        Bucle de avance: procesa los ticks transcurridos según el reloj.
+
+        Un error en un tick se registra y no detiene la rueda.
+        """
+        while True:
+            try:
+                target = int((time.monotonic() - self._origin) / self.tick)
+                if target > self._current:
+                    self.advance(target - self._current)
+                next_tick = self._origin + (self._current + 1) * self.tick
+                await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            except asyncio.CancelledError:
+                return
+            except Exception as e:
+                logger.error(f"Error en la rueda de temporizadores: {str(e)}")
+                await asyncio.sleep(self.tick)
+
+    async def start(self):
+        """Inicia la tarea de avance (idempotente)."""
+        if self._task is None:
+            # Alinear el reloj con el tick actual para no procesar ticks atrasados
+            self._origin = time.monotonic() - self._current * self.tick
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Rueda de temporizadores iniciada (tick {self.tick * 1000:.0f} ms)")
+
+    async def stop(self):
+        """Detiene la tarea de avance y las ejecuciones en curso."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        running = list(self._running)
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        self._running.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Obtiene estadísticas de la rueda.
+
+        Returns:
+            Temporizadores pendientes, ejecuciones y tareas en curso
+        """
+        return {
+            "tick": self.tick,
+            "current": self._current,
+            "pending": self._count,
+            "fired": self._fired,
+            "running": len(self._running),
+        }
+
+
+# Instancia global de la rueda de temporizadores
+timer_wheel = TimerWheel(tick=settings.TIMER_WHEEL_TICK)
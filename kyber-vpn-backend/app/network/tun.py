@@ -60,7 +60,7 @@ class TunManager:
         """
         # Validar la dirección IP
         try:
-            ipaddress.IPv4Address(ip_address)
+            ipaddress.ip_address(ip_address)
         except ValueError:
             logger.error(f"Dirección IP inválida: {ip_address}")
             raise ValueError(f"Dirección IP inválida: {ip_address}")
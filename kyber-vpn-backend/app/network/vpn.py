@@ -6,22 +6,56 @@ los componentes de criptografía post-cuántica (CRYSTALS-Kyber), cifrado
 simétrico (AES-256-GCM) y gestión de interfaces de red (TUN/TAP).
 """
 import asyncio
-import time
-import os
 import ipaddress
+import os
+import time
 import random
+import uuid
 import logging
-from typing import Dict, Any, Optional, Callable, Tuple
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Set, Tuple
 
+from app.core.bus import MessageBus, message_bus
 from app.core.config import settings
-from app.crypto.kyber import KyberManager
-from app.crypto.symmetric import AESGCMCipher
+from app.core.state import state_backend
+from app.crypto.keypool import key_pool
 from app.network.tun import TunManager
+from app.network.routing import RoutingTable, packet_destination
+from app.network.shaping import QuotaStore, ShapingDecision, TrafficShaper
+from app.network.latency import EchoServer, LatencyProber
+from app.network.sessions import Session, SessionTable
+from app.network.ippool import AddressPool
+from app.network.snapshot import SessionSnapshot, derive_node_key
+from app.network.registry import server_registry
+from app.network.forward import ForwardError, SessionForwarder
+from app.network.timers import Timer, timer_wheel
 from app.models.schemas import VpnStatus
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
+# Espacio de nombres del almacén compartido con el resumen de cada sesión
+SHARED_SESSIONS = "vpn_sessions"
+
+# Espacio de nombres con el último latido de cada worker: las sesiones de un
+# worker sin latido reciente no se tienen en cuenta y se acaban purgando
+VPN_WORKERS = "vpn_workers"
+
+
+def _worker_path(path: str) -> str:
+    """Ruta de un fichero propio de este worker (sin cambios con un solo worker)."""
+    if not path or settings.WORKER_COUNT <= 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}-{settings.WORKER_INDEX}{extension}"
+
+
+def _public_summary(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Campos de una sesión que se pueden listar públicamente."""
+    return {key: record[key] for key in
+            ("user", "server_id", "vpnIp", "uptime", "bytesSent", "bytesReceived", "latency")
+            if key in record}
+
+
 class VPNManager:
     """
     Gestor principal de la VPN educativa resistente a ataques cuánticos.
@@ -29,235 +63,910 @@ class VPNManager:
     Esta clase integra todos los componentes necesarios para implementar
     una VPN educativa que utiliza criptografía post-cuántica para el
     intercambio de claves y cifrado simétrico para la protección de datos.
+    Atiende múltiples sesiones simultáneas, registradas en una tabla
+    indexada por ID de sesión, IP VPN y usuario.
     """
     
-    def __init__(self):
-        """Inicializa el gestor de VPN."""
-        self.kyber = KyberManager(parameter_set=settings.KYBER_PARAMETER)
-        self.aes = None  # Se inicializará durante la conexión
-        self.tun = None  # Se inicializará durante la conexión
+    def __init__(self, bus: Optional[MessageBus] = None):
+        """
+        Inicializa el gestor de VPN.
+        
+        Args:
+            bus: Bus entre workers para reenviar operaciones (por defecto, el global)
+        """
+        # Interfaz TUN compartida por todas las sesiones del nodo
+        self.tun = TunManager(name=settings.TUN_NAME)
+        
+        # Sesiones activas
+        self.sessions = SessionTable()
         
-        # Estado de la conexión
-        self.connected = False
-        self.server = None
-        self.connection_time = 0
-        self.vpn_ip = None
-        self.bytes_sent = 0
-        self.bytes_received = 0
-        self.latency = 0
+        # Pool de direcciones VPN (la pasarela nunca se asigna); cada
+        # worker asigna solo de su porción de la subred
+        self.pool = AddressPool(
+            settings.VPN_SUBNET,
+            reserved=[settings.VPN_SERVER_IP],
+            lease_time=settings.VPN_LEASE_TIME,
+            grace_period=settings.VPN_LEASE_GRACE,
+            state_path=_worker_path(settings.VPN_POOL_STATE_PATH),
+            slice_index=settings.WORKER_INDEX,
+            slice_count=settings.WORKER_COUNT,
+        )
+        
+        # Tabla de rutas (allowed IPs): IP de destino -> sesión
+        self.routes = RoutingTable()
+        
+        # Limitación de ancho de banda y cuotas por sesión
+        self.shaper = TrafficShaper(
+            QuotaStore(settings.QUOTA_DB_PATH),
+            policy=settings.SHAPING_POLICY,
+            default_rate=settings.SHAPING_RATE_BYTES,
+            default_burst=settings.SHAPING_BURST_BYTES,
+            default_quota=settings.QUOTA_MONTHLY_BYTES,
+            queue_limit=settings.SHAPING_QUEUE_PACKETS,
+            flush_interval=settings.QUOTA_FLUSH_INTERVAL,
+        )
+        
+        # Sondas de latencia reales (con eco local opcional para demo)
+        self.prober = LatencyProber(timeout=settings.LATENCY_PROBE_TIMEOUT)
+        self.echo_server = EchoServer() if settings.LATENCY_PROBE_LOCAL_ECHO else None
+        
+        # Temporizadores globales (caducidad de concesiones y persistencia del pool)
+        self._timers: List[Timer] = []
+        
+        # Operaciones sobre sesiones que otros workers pueden pedir a este
+        self.forwarder = SessionForwarder(bus or message_bus, timeout=settings.VPN_FORWARD_TIMEOUT)
+        self.forwarder.register("disconnect", self.disconnect)
+        self.forwarder.register("get_limits", self.get_limits)
+        self.forwarder.register("set_limits", self.set_limits)
+        self.forwarder.register("status", self._session_status)
+        
+        # Tiempos de cada fase de la conexión: fase -> contadores en ms
+        self.connect_timings: Dict[str, Dict[str, float]] = {}
+        self._tun_ready: Optional[asyncio.Future] = None
+        
+        # Instantánea de sesiones para reinicios en caliente. Guarda claves de
+        # sesión, así que exige una clave de nodo configurada explícitamente
+        self.snapshot: Optional[SessionSnapshot] = None
+        if settings.SNAPSHOT_PATH and not settings.SNAPSHOT_NODE_KEY:
+            logger.warning("Instantánea de sesiones desactivada: falta SNAPSHOT_NODE_KEY")
+        elif settings.SNAPSHOT_PATH:
+            self.snapshot = SessionSnapshot(
+                _worker_path(settings.SNAPSHOT_PATH),
+                derive_node_key(settings.SNAPSHOT_NODE_KEY),
+                slots=settings.SNAPSHOT_SLOTS,
+                nonce_window=settings.SNAPSHOT_NONCE_WINDOW,
+            )
+    
+    async def start(self):
+        """
+        Inicia los servicios compartidos del plano de datos.
+        
+        El trabajo periódico se programa en la rueda de temporizadores
+        global, que debe arrancarse aparte.
+        """
+        await self.shaper.start(self._transmit)
+        await self.prober.start()
+        if self.echo_server:
+            await self.echo_server.start()
+        self.forwarder.start()
+        # Latido antes de publicar sesiones: sin él se considerarían huérfanas
+        await self._heartbeat()
+        self._timers = [
+            timer_wheel.schedule_periodic(settings.VPN_LEASE_SWEEP_INTERVAL, self._expire_leases),
+            timer_wheel.schedule_periodic(settings.VPN_POOL_SAVE_INTERVAL, self._save_pool),
+            timer_wheel.schedule_periodic(settings.SERVER_LOAD_SYNC_INTERVAL, server_registry.sync_load),
+            timer_wheel.schedule_periodic(settings.VPN_WORKER_HEARTBEAT, self._heartbeat),
+        ]
+        if self.snapshot:
+            try:
+                self.snapshot.open()
+                await self._restore_sessions()
+            except (OSError, RuntimeError) as e:
+                logger.error(f"Instantánea de sesiones no disponible: {str(e)}")
+                self.snapshot = None
+            else:
+                self._timers.append(timer_wheel.schedule_periodic(
+                    settings.SNAPSHOT_INTERVAL, self._write_snapshot
+                ))
+    
+    async def stop(self):
+        """
+        Detiene los servicios compartidos.
         
-        # Tareas en segundo plano
-        self.status_task = None
+        Con instantáneas activas, las sesiones no se cierran: se guardan
+        (junto con sus concesiones de IP) para que el siguiente proceso
+        las restaure. Sin ellas, se cierran todas. En ambos casos se
+        retiran del almacén compartido: el proceso que las restaure las
+        volverá a publicar.
+        """
+        for timer in self._timers:
+            timer_wheel.cancel(timer)
+        self._timers = []
+        if self.snapshot:
+            self._write_snapshot()
+            self.snapshot.close()
+            for session in self.sessions:
+                for timer in session.timers.values():
+                    timer_wheel.cancel(timer)
+                session.timers.clear()
+                await self._publish_session(session, removed=True)
+            logger.info(f"{len(self.sessions)} sesiones guardadas para el reinicio")
+        else:
+            for session in self.sessions:
+                await self._cleanup(session)
+        try:
+            await state_backend.delete(VPN_WORKERS, self.forwarder.worker)
+        except Exception as e:
+            logger.warning(f"No se pudo retirar el latido de este worker: {str(e)}")
+        self.forwarder.stop()
+        await server_registry.withdraw_load()
+        await self.tun.stop()
+        self._tun_ready = None
+        self.pool.save()
+        await self.shaper.stop()
+        await self.prober.stop()
+        if self.echo_server:
+            await self.echo_server.stop()
     
-    async def connect(self, server_id: str) -> Dict[str, Any]:
+    async def connect(self, server_id: str, user: Optional[str] = None) -> Dict[str, Any]:
         """
-        Establece una conexión VPN con el servidor especificado.
+        Establece una nueva sesión VPN con el servidor especificado.
         
         Args:
-            server_id: ID del servidor al que conectar
+            server_id: ID del servidor al que conectar, o "auto" para elegir
+                       el servidor según carga y latencia
+            user: Usuario propietario de la sesión (opcional)
             
         Returns:
             Diccionario con información de la conexión establecida
         """
-        if self.connected:
-            logger.warning("Intento de conexión mientras ya existe una conexión activa")
-            return {"success": False, "message": "Ya existe una conexión VPN activa"}
+        # Elegir servidor automáticamente si se solicita
+        if server_id == "auto":
+            server_id = server_registry.choose(settings.PLACEMENT_RTT_SCALE_MS)
+            if server_id is None:
+                logger.warning("Conexión rechazada: todos los servidores están llenos o caídos")
+                return {
+                    "success": False,
+                    "message": "Todos los servidores están al máximo de capacidad",
+                    "overloaded": True
+                }
         
         # Buscar el servidor solicitado
-        server = None
-        for s in settings.VPN_SERVERS:
-            if s["id"] == server_id:
-                server = s
-                break
-        
+        server = server_registry.get(server_id)
         if not server:
             logger.error(f"Servidor con ID {server_id} no encontrado")
             return {"success": False, "message": f"Servidor con ID {server_id} no encontrado"}
         
+        if not server_registry.is_accepting(server_id):
+            logger.warning(f"Conexión rechazada: servidor {server_id} lleno o no disponible")
+            return {
+                "success": False,
+                "message": f"El servidor {server['name']} no admite más conexiones",
+                "overloaded": True
+            }
+        
         logger.info(f"Iniciando conexión a servidor VPN: {server['name']} ({server['ip']})")
         
+        # Reservar la plaza antes del handshake para no sobrepasar la
+        # capacidad con conexiones simultáneas
+        server_registry.session_opened(server_id)
+        
+        session = None
+        timings: Dict[str, float] = {}
+        started = time.perf_counter()
         try:
-            # Paso 1: Iniciar negociación con criptografía post-cuántica (Kyber)
-            logger.debug("Generando par de claves Kyber")
-            keypair = self.kyber.generate_keypair()
-            
-            # En una implementación real, aquí enviaríamos la clave pública al servidor
-            # y recibiríamos un ciphertext para desencapsular la clave compartida
-            
-            # Simulamos el intercambio para este ejemplo educativo
-            logger.debug("Simulando intercambio de claves Kyber con el servidor")
-            shared_key, _ = self.kyber.encapsulate()
-            
-            # Paso 2: Inicializar cifrado AES con la clave derivada de Kyber
-            logger.debug("Inicializando cifrado AES-256-GCM")
-            self.aes = AESGCMCipher(key=shared_key)
-            
-            # Paso 3: Configurar interfaz TUN
-            self.tun = TunManager(name=settings.TUN_NAME)
-            
-            # Asignar IP del rango VPN
-            subnet = ipaddress.IPv4Network(settings.VPN_SUBNET)
-            self.vpn_ip = str(subnet[2])  # Primera IP disponible después de red y gateway
-            
-            logger.info(f"Asignando IP VPN: {self.vpn_ip}")
-            
-            # En una implementación real, aquí crearíamos realmente la interfaz TUN
-            # await self.tun.create_interface(self.vpn_ip)
-            # self.tun.set_packet_callback(self._process_packet)
-            # asyncio.create_task(self.tun.start())
+            # Fases independientes en paralelo: intercambio Kyber con una
+            # clave de la reserva, interfaz TUN compartida y concesión de IP
+            results = await self._run_phases(
+                {
+                    "keys": key_pool.derive_key(),
+                    "tun": self._prepare_tun(),
+                    "lease": self._lease_address(user),
+                },
+                timings,
+                rollback={"lease": self.pool.release},
+            )
+            shared_key = results["keys"]
+            vpn_ip = results["lease"]
             
-            # Actualizar estado
-            self.server = server
-            self.connected = True
-            self.connection_time = time.time()
-            self.bytes_sent = 0
-            self.bytes_received = 0
-            self.latency = server.get("latency", 0)
+            # Registrar la sesión, su ruta y sus límites
+            try:
+                session = Session(uuid.uuid4().hex, user, server["id"], vpn_ip, shared_key)
+                self.sessions.add(session)
+            except Exception:
+                self.pool.release(vpn_ip)
+                raise
+            await self._activate_session(session)
             
-            # Iniciar tarea de monitoreo en segundo plano
-            self.status_task = asyncio.create_task(self._update_status_task())
+            timings["total"] = (time.perf_counter() - started) * 1000
+            self._record_timings(timings)
             
-            logger.info(f"Conexión VPN establecida: {self.vpn_ip} -> {server['name']}")
+            logger.info(f"Conexión VPN establecida: {vpn_ip} -> {server['name']} "
+                        f"(sesión {session.id}, {len(self.sessions)} activas)")
             
             return {
                 "success": True,
                 "message": f"Conexión establecida con {server['name']}",
-                "vpnIp": self.vpn_ip
+                "vpnIp": vpn_ip,
+                "sessionId": session.id
             }
             
         except Exception as e:
             logger.error(f"Error al establecer conexión VPN: {str(e)}")
             # Limpiar recursos en caso de error
-            await self._cleanup()
+            if session is not None:
+                await self._cleanup(session)
+            else:
+                server_registry.session_closed(server_id)
             return {
                 "success": False,
                 "message": f"Error al establecer conexión: {str(e)}"
             }
     
-    async def disconnect(self) -> Dict[str, Any]:
+    def resolve_session(self, session_id: str) -> Optional[Session]:
         """
-        Finaliza la conexión VPN activa.
+        Obtiene una sesión local por su ID.
+        
+        El ID (aleatorio, solo lo conoce quien abrió la sesión) es lo único
+        que identifica al cliente, así que no hay sesión "por defecto".
+        
+        Args:
+            session_id: ID de la sesión
+            
+        Returns:
+            Sesión encontrada o None
+        """
+        return self.sessions.get(session_id)
+    
+    async def disconnect(self, session_id: str) -> Dict[str, Any]:
+        """
+        Finaliza una sesión VPN.
+        
+        Args:
+            session_id: ID de la sesión
         
         Returns:
             Diccionario con el resultado de la operación
         """
-        if not self.connected:
-            return {"success": True, "message": "No hay conexión activa"}
+        session = self.resolve_session(session_id)
+        if session is None:
+            return {"success": False, "message": f"Sesión {session_id} no encontrada"}
         
-        logger.info("Desconectando VPN")
+        logger.info(f"Desconectando sesión VPN {session.id}")
         
         try:
-            await self._cleanup()
+            await self._cleanup(session)
             return {"success": True, "message": "Desconexión exitosa"}
         except Exception as e:
             logger.error(f"Error al desconectar VPN: {str(e)}")
             return {"success": False, "message": f"Error al desconectar: {str(e)}"}
     
-    async def _cleanup(self):
-        """Limpia todos los recursos de la conexión VPN."""
-        # Cancelar tareas en segundo plano
-        if self.status_task:
-            self.status_task.cancel()
-            try:
-                await self.status_task
-            except asyncio.CancelledError:
-                pass
-            self.status_task = None
+    async def _cleanup(self, session: Session):
+        """
+        Libera todos los recursos de una sesión.
+        
+        Args:
+            session: Sesión a liberar
+        """
+        # Retirar la sesión de los índices antes de esperar a sus tareas
+        self.sessions.remove(session.id)
+        self.routes.remove(session.vpn_ip)
+        self.shaper.remove_session(session.id)
+        server_registry.session_closed(session.server_id)
+        self.pool.release(session.vpn_ip)
+        if self.snapshot:
+            self.snapshot.remove(session.id)
+        
+        # Cancelar el trabajo periódico pendiente
+        for timer in session.timers.values():
+            timer_wheel.cancel(timer)
+        session.timers.clear()
+        session.key = b""
+        await self._publish_session(session, removed=True)
+        
+        logger.info(f"Recursos de la sesión {session.id} liberados")
+    
+    async def get_status(self, session_id: str) -> VpnStatus:
+        """
+        Obtiene el estado actual de una sesión VPN.
         
-        # Cerrar interfaz TUN si existe
-        if self.tun:
+        Args:
+            session_id: ID de la sesión
+        
+        Returns:
+            Estado actual de la sesión (desconectado si no existe)
+        """
+        session = self.resolve_session(session_id)
+        if session is None:
+            # La sesión puede pertenecer a otro worker: se pregunta a ese worker
             try:
-                await self.tun.stop()
-            except Exception as e:
-                logger.error(f"Error al cerrar interfaz TUN: {str(e)}")
+                fields = await self.call_owner(session_id, "status")
+            except ForwardError as e:
+                logger.warning(f"Estado de la sesión {session_id} no disponible: {str(e)}")
+                fields = None
+            return VpnStatus(**(fields or self.status_fields(None)))
+        
+        return VpnStatus(
+            rttHistogram=list(session.rtt.histogram), **self.status_fields(session)
+        )
+    
+    def status_fields(self, session: Optional[Session]) -> Dict[str, Any]:
+        """
+        Construye el estado de una sesión local como diccionario plano.
+        
+        Es la base de ``get_status`` y del flujo de estado, que lo
+        muestrea con frecuencia y no necesita construir el modelo.
+        
+        Args:
+            session: Sesión local (None para el estado desconectado)
+        
+        Returns:
+            Campos de ``VpnStatus`` salvo el histograma de RTT
+        """
+        if session is None:
+            return {
+                "connected": False,
+                "sessionId": None,
+                "uptime": 0,
+                "bytesReceived": 0,
+                "bytesSent": 0,
+                "latency": 0,
+                "jitter": 0,
+                "packetLoss": 0,
+                "vpnIp": None,
+                "server_id": None,
+            }
+        
+        rtt = session.rtt.snapshot()
+        return {
+            "connected": True,
+            "sessionId": session.id,
+            # Calcular tiempo de conexión
+            "uptime": int(time.time() - session.created_at),
+            "bytesReceived": session.bytes_received,
+            "bytesSent": session.bytes_sent,
+            "latency": session.latency,
+            "jitter": rtt["jitter"],
+            "packetLoss": rtt["loss"],
+            "vpnIp": session.vpn_ip,
+            "server_id": session.server_id,
+        }
+    
+    async def list_sessions(self, user: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Lista las sesiones activas de todos los workers.
+        
+        Las sesiones de este proceso se devuelven con sus datos en vivo y
+        las del resto, con el resumen publicado en el almacén compartido.
+        
+        Args:
+            user: Filtrar por usuario (opcional)
             
-            self.tun = None
+        Returns:
+            Lista con el resumen de cada sesión
+        """
+        sessions = self.sessions.get_by_user(user) if user else self.sessions
+        # Sin el ID de sesión: basta conocerlo para desconectar o limitar la sesión
+        result = [_public_summary(session.to_dict()) for session in sessions]
+        try:
+            shared = await state_backend.items(SHARED_SESSIONS)
+        except Exception as e:
+            logger.warning(f"No se pudieron leer las sesiones compartidas: {str(e)}")
+            return result
+        workers = await self._live_workers()
+        for session_id, record in shared.items():
+            if (session_id in self.sessions or record.get("worker") not in workers
+                    or (user and record["user"] != user)):
+                continue
+            summary = _public_summary(record)
+            summary["uptime"] = int(time.time() - record["createdAt"])
+            result.append(summary)
+        return result
+    
+    async def _publish_session(self, session: Session, removed: bool = False):
+        """
+        Publica (o retira) el resumen de una sesión en el almacén compartido.
         
-        # Reiniciar estado
-        self.connected = False
-        self.server = None
-        self.connection_time = 0
-        self.vpn_ip = None
-        self.bytes_sent = 0
-        self.bytes_received = 0
-        self.latency = 0
-        self.aes = None
+        Args:
+            session: Sesión a publicar
+            removed: Si la sesión se ha cerrado
+        """
+        try:
+            if removed:
+                await state_backend.delete(SHARED_SESSIONS, session.id)
+            else:
+                record = session.to_dict()
+                record["createdAt"] = session.created_at
+                record["worker"] = self.forwarder.worker
+                await state_backend.set(SHARED_SESSIONS, session.id, record)
+        except Exception as e:
+            # El estado compartido no debe impedir el funcionamiento local
+            logger.warning(f"No se pudo publicar la sesión {session.id}: {str(e)}")
+    
+    async def _shared_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Obtiene el resumen publicado de una sesión de otro worker que sigue vivo."""
+        try:
+            record = await state_backend.get(SHARED_SESSIONS, session_id)
+            if record is None:
+                return None
+            beat = await state_backend.get(VPN_WORKERS, record.get("worker", ""))
+        except Exception as e:
+            logger.warning(f"No se pudo leer la sesión compartida {session_id}: {str(e)}")
+            return None
+        if beat is None or time.time() - beat["updatedAt"] > settings.VPN_WORKER_TTL:
+            return None
+        return record
+    
+    async def _live_workers(self) -> Set[str]:
+        """Workers con un latido reciente en el almacén compartido."""
+        try:
+            beats = await state_backend.items(VPN_WORKERS)
+        except Exception as e:
+            logger.warning(f"No se pudieron leer los latidos de los workers: {str(e)}")
+            return set()
+        now = time.time()
+        return {worker for worker, beat in beats.items()
+                if now - beat["updatedAt"] <= settings.VPN_WORKER_TTL}
+    
+    async def _heartbeat(self):
+        """
+        Renueva el latido de este worker y purga las sesiones de los caídos.
         
-        logger.info("Recursos VPN liberados")
+        Un worker que muere sin cerrar sus sesiones deja de renovar su
+        latido; cuando caduca, el primer worker que lo detecta borra su
+        latido y las sesiones que había publicado.
+        """
+        now = time.time()
+        try:
+            await state_backend.set(VPN_WORKERS, self.forwarder.worker,
+                                    {"updatedAt": now, "pid": os.getpid()})
+            beats = await state_backend.items(VPN_WORKERS)
+            dead = {worker for worker, beat in beats.items()
+                    if now - beat["updatedAt"] > settings.VPN_WORKER_TTL}
+            if not dead:
+                return
+            purged = 0
+            for session_id, record in (await state_backend.items(SHARED_SESSIONS)).items():
+                if record.get("worker") in dead:
+                    await state_backend.delete(SHARED_SESSIONS, session_id)
+                    purged += 1
+            for worker in dead:
+                await state_backend.delete(VPN_WORKERS, worker)
+            logger.info(f"{purged} sesiones de {len(dead)} workers sin latido purgadas")
+        except Exception as e:
+            logger.warning(f"No se pudo renovar el latido de este worker: {str(e)}")
     
-    async def get_status(self) -> VpnStatus:
+    async def call_owner(self, session_id: str, method: str, **kwargs: Any) -> Optional[Any]:
         """
-        Obtiene el estado actual de la conexión VPN.
+        Ejecuta una operación sobre una sesión en el worker que la atiende.
         
+        Las sesiones locales se atienden aquí; las de otro worker vivo se
+        reenvían a él por el bus.
+        
+        Args:
+            session_id: ID de la sesión
+            method: Operación registrada (disconnect, get_limits, set_limits o status)
+            **kwargs: Resto de argumentos de la operación
+            
         Returns:
-            Estado actual de la VPN
-        """
-        if not self.connected:
-            return VpnStatus(
-                connected=False,
-                uptime=0,
-                bytesReceived=0,
-                bytesSent=0,
-                latency=0,
-                vpnIp=None,
-                server_id=None
-            )
+            Resultado de la operación, o None si la sesión no existe en ningún worker
+            
+        Raises:
+            ForwardError: Si el worker que la atiende no responde a tiempo
+        """
+        if session_id in self.sessions:
+            return await self.forwarder.invoke(method, session_id=session_id, **kwargs)
+        record = await self._shared_session(session_id)
+        if record is None or record["worker"] == self.forwarder.worker:
+            return None
+        return await self.forwarder.call(record["worker"], method, session_id=session_id, **kwargs)
+    
+    def _session_status(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Estado de una sesión local para otros workers (None si ya no existe)."""
+        session = self.sessions.get(session_id)
+        return self.status_fields(session) if session is not None else None
+    
+    async def _probe_target(self, session: Session) -> Tuple[str, int]:
+        """
+        Obtiene la dirección a la que enviar las sondas de latencia.
         
-        # Calcular tiempo de conexión
-        uptime = int(time.time() - self.connection_time)
+        Args:
+            session: Sesión a sondear
         
-        return VpnStatus(
-            connected=True,
-            uptime=uptime,
-            bytesReceived=self.bytes_received,
-            bytesSent=self.bytes_sent,
-            latency=self.latency,
-            vpnIp=self.vpn_ip,
-            server_id=self.server["id"] if self.server else None
-        )
+        Returns:
+            Dirección (host, puerto) del servidor VPN o del eco local
+        """
+        if self.echo_server:
+            return await self.echo_server.start()
+        server = server_registry.get(session.server_id)
+        return server["ip"], server["port"]
+    
+    async def _activate_session(self, session: Session):
+        """
+        Registra una sesión ya añadida a la tabla: ruta, límites, trabajo
+        periódico, instantánea y publicación para el resto de workers.
+        
+        Args:
+            session: Sesión a activar
+        """
+        self.routes.insert(session.vpn_ip, session.id)
+        await self.shaper.add_session(session.id, account=session.user or session.id)
+        self._schedule_session(session)
+        if self.snapshot:
+            self.snapshot.reserve_nonces(session)
+        await self._publish_session(session)
+    
+    async def _restore_sessions(self):
+        """Restaura las sesiones guardadas en la instantánea por el proceso anterior."""
+        now = time.time()
+        restored = 0
+        for record in self.snapshot.load(settings.SNAPSHOT_MAX_AGE):
+            session_id = record["id"]
+            idle = now - record["last_activity"]
+            if (server_registry.get(record["server_id"]) is None
+                    or (settings.VPN_IDLE_TIMEOUT > 0 and idle >= settings.VPN_IDLE_TIMEOUT)
+                    or not self.pool.claim(record["vpn_ip"], record["user"], now)):
+                self.snapshot.remove(session_id)
+                continue
+            
+            session = Session(session_id, record["user"], record["server_id"],
+                              record["vpn_ip"], record["key"])
+            session.created_at = record["created_at"]
+            session.last_activity = record["last_activity"]
+            session.bytes_sent = record["bytes_sent"]
+            session.bytes_received = record["bytes_received"]
+            # Continuar desde el límite reservado: los nonces intermedios se descartan
+            session.tx_counter = record["nonce_limit"]
+            session.nonce_limit = record["nonce_limit"]
+            try:
+                self.sessions.add(session)
+            except ValueError:
+                self.snapshot.remove(session_id)
+                continue
+            server_registry.session_opened(session.server_id)
+            await self._activate_session(session)
+            restored += 1
+        if restored:
+            logger.info(f"{restored} sesiones restauradas desde la instantánea")
+    
+    def _write_snapshot(self):
+        """Guarda en la instantánea los registros de las sesiones que han cambiado."""
+        for session in self.sessions:
+            self.snapshot.write(session)
+        self.snapshot.touch()
     
-    async def _update_status_task(self):
-        """Tarea en segundo plano para actualizar estadísticas de la VPN."""
+    async def _run_phases(self, phases: Dict[str, Awaitable], timings: Dict[str, float],
+                          rollback: Optional[Dict[str, Callable[[Any], Any]]] = None) -> Dict[str, Any]:
+        """
+        Ejecuta fases independientes de la conexión de forma concurrente.
+        
+        Si una fase falla (o la conexión se cancela), se cancelan las que
+        siguen en curso y se deshacen las que ya terminaron.
+        
+        Args:
+            phases: Nombre de la fase -> corrutina a ejecutar
+            timings: Diccionario donde anotar la duración de cada fase en ms
+            rollback: Nombre de la fase -> función que deshace su resultado
+            
+        Returns:
+            Nombre de la fase -> resultado
+            
+        Raises:
+            Exception: El error de la primera fase que falle
+        """
+        async def timed(name: str, phase: Awaitable) -> Any:
+            phase_started = time.perf_counter()
+            try:
+                return await phase
+            finally:
+                timings[name] = (time.perf_counter() - phase_started) * 1000
+        
+        tasks = {name: asyncio.ensure_future(timed(name, phase)) for name, phase in phases.items()}
         try:
-            while self.connected:
-                # En una implementación real, estas estadísticas vendrían
-                # de mediciones reales del tráfico y pings al servidor
-                
-                # Simular algunas estadísticas para propósitos educativos
-                self.latency = random.randint(
-                    max(1, self.server.get("latency", 30) - 10),
-                    self.server.get("latency", 30) + 10
-                )
-                
-                # Simular tráfico
-                traffic_increment = random.randint(1024, 8192)
-                self.bytes_sent += traffic_increment
-                self.bytes_received += traffic_increment * 2  # Más datos recibidos que enviados
-                
-                await asyncio.sleep(1.0)  # Actualizar cada segundo
+            await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            error = next((task.exception() for task in tasks.values()
+                          if task.done() and not task.cancelled() and task.exception()), None)
+            if error is not None:
+                raise error
+            return {name: task.result() for name, task in tasks.items()}
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            for name, undo in (rollback or {}).items():
+                task = tasks.get(name)
+                if task is not None and not task.cancelled() and task.exception() is None:
+                    undo(task.result())
+            raise
+    
+    async def _prepare_tun(self):
+        """Crea la interfaz TUN compartida si aún no existe (una sola vez)."""
+        if self._tun_ready is None:
+            self._tun_ready = asyncio.ensure_future(self._create_tun())
+        try:
+            # Protegida: cancelar una conexión no aborta la creación compartida
+            await asyncio.shield(self._tun_ready)
         except asyncio.CancelledError:
-            # Tarea cancelada normalmente durante la desconexión
-            pass
-        except Exception as e:
-            logger.error(f"Error en tarea de actualización de estado: {str(e)}")
-            # No reactivamos la tarea automáticamente para evitar bucles de error
+            raise
+        except Exception:
+            self._tun_ready = None  # Permitir reintentarlo en la próxima conexión
+            raise
+    
+    async def _create_tun(self):
+        """Crea y configura la interfaz TUN compartida."""
+        netmask = str(ipaddress.ip_network(settings.VPN_SUBNET, strict=False).netmask)
+        await self.tun.create_interface(settings.VPN_SERVER_IP, netmask)
+        self.tun.set_packet_callback(self._process_packet)
+        # En una implementación real, aquí se iniciaría la lectura de paquetes:
+        # asyncio.create_task(self.tun.start())
+    
+    async def _lease_address(self, user: Optional[str]) -> str:
+        """
+        Asigna una IP del rango VPN (se reutiliza la del usuario si sigue reservada).
+        
+        Args:
+            user: Usuario propietario de la sesión
+            
+        Returns:
+            IP asignada
+        """
+        vpn_ip = self.pool.allocate(user)
+        logger.info(f"Asignando IP VPN: {vpn_ip}")
+        return vpn_ip
+    
+    def _record_timings(self, timings: Dict[str, float]):
+        """
+        Acumula los tiempos de una conexión completada.
+        
+        Args:
+            timings: Fase -> duración en ms
+        """
+        for name, elapsed in timings.items():
+            stats = self.connect_timings.get(name)
+            if stats is None:
+                stats = self.connect_timings[name] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["last"] = elapsed
+            if elapsed > stats["max"]:
+                stats["max"] = elapsed
+    
+    def get_connect_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Obtiene los tiempos medios, máximos y últimos de cada fase de conexión.
+        
+        Returns:
+            Fase -> estadísticas en milisegundos
+        """
+        return {
+            name: {
+                "count": stats["count"],
+                "avg_ms": round(stats["total"] / stats["count"], 3),
+                "max_ms": round(stats["max"], 3),
+                "last_ms": round(stats["last"], 3),
+            }
+            for name, stats in self.connect_timings.items()
+        }
+    
+    def _schedule_session(self, session: Session):
+        """
+        Programa el trabajo periódico de una sesión en la rueda de temporizadores.
+        
+        Args:
+            session: Sesión recién establecida
+        """
+        timers = session.timers
+        timers["keepalive"] = timer_wheel.schedule_periodic(
+            settings.LATENCY_PROBE_ACTIVE_INTERVAL, self._keepalive, session, first_delay=0
+        )
+        timers["stats"] = timer_wheel.schedule_periodic(
+            settings.VPN_STATS_INTERVAL, self._update_stats, session
+        )
+        if settings.VPN_REKEY_INTERVAL > 0:
+            timers["rekey"] = timer_wheel.schedule_periodic(
+                settings.VPN_REKEY_INTERVAL, self._rekey, session
+            )
+        if settings.VPN_IDLE_TIMEOUT > 0:
+            timers["idle"] = timer_wheel.schedule(
+                settings.VPN_IDLE_TIMEOUT, self._check_idle, session
+            )
+    
+    async def _keepalive(self, session: Session):
+        """
+        Sondea la latencia del túnel y renueva la concesión de la IP.
+        
+        La frecuencia se adapta: alta mientras hay tráfico y baja cuando
+        la sesión está inactiva.
+        
+        Args:
+            session: Sesión a sondear
+        """
+        if session.id not in self.sessions:
+            return
+        active = time.time() - session.last_activity < settings.LATENCY_PROBE_IDLE_INTERVAL
+        interval = (settings.LATENCY_PROBE_ACTIVE_INTERVAL if active
+                    else settings.LATENCY_PROBE_IDLE_INTERVAL)
+        timer = session.timers.get("keepalive")
+        if timer is not None and timer.interval != interval:
+            timer_wheel.reschedule(timer, interval, interval=interval)
+        
+        self.pool.renew(session.vpn_ip)
+        await self.prober.probe(await self._probe_target(session), session.rtt)
+        session.latency = round(session.rtt.srtt, 3)
+    
+    async def _update_stats(self, session: Session):
+        """
+        Actualiza las estadísticas de tráfico de una sesión.
+        
+        Args:
+            session: Sesión a actualizar
+        """
+        if session.id not in self.sessions:
+            return
+        # En una implementación real, el tráfico vendría del túnel;
+        # simulamos algunos paquetes para propósitos educativos
+        # (el envío pasa por la ruta con shaping)
+        traffic_increment = random.randint(1024, 8192)
+        await self.send_packet(session.id, bytes(traffic_increment))
+        session.bytes_received += traffic_increment * 2  # Más datos recibidos que enviados
+    
+    async def _rekey(self, session: Session):
+        """
+        Renueva la clave simétrica de una sesión con un nuevo intercambio Kyber.
+        
+        Args:
+            session: Sesión a renovar
+        """
+        shared_key = await key_pool.derive_key()
+        if session.id in self.sessions:
+            session.key = shared_key
+            # Clave nueva: los nonces vuelven a empezar desde cero
+            session.tx_counter = 0
+            session.nonce_limit = 0
+            if self.snapshot:
+                self.snapshot.reserve_nonces(session)
+            logger.info(f"Clave de la sesión {session.id} renovada")
+    
+    def _check_idle(self, session: Session):
+        """
+        Desconecta una sesión sin tráfico durante el tiempo máximo de inactividad.
+        
+        Args:
+            session: Sesión a comprobar
+            
+        Returns:
+            Corrutina de desconexión, o None si la sesión sigue activa
+        """
+        if session.id not in self.sessions:
+            return None
+        idle = time.time() - session.last_activity
+        if idle < settings.VPN_IDLE_TIMEOUT:
+            timer_wheel.reschedule(session.timers["idle"], settings.VPN_IDLE_TIMEOUT - idle)
+            return None
+        logger.info(f"Sesión {session.id} inactiva durante {int(idle)} s: desconectando")
+        return self.disconnect(session.id)
+    
+    def _expire_leases(self):
+        """Libera las concesiones de IP caducadas."""
+        expired = self.pool.expire()
+        if expired:
+            logger.info(f"{expired} concesiones de IP caducadas liberadas")
+    
+    def _save_pool(self):
+        """Persiste el estado del pool si ha cambiado desde el último guardado."""
+        self.pool.save_if_due(0)
+    
+    def set_limits(self, session_id: str, rate: Optional[int] = None,
+                   burst: Optional[int] = None,
+                   quota: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Cambia en caliente los límites de ancho de banda y cuota de una sesión.
+        
+        Args:
+            session_id: ID de la sesión
+            rate: Tasa en bytes/s (0 = ilimitada, None = sin cambios)
+            burst: Ráfaga en bytes (None = sin cambios)
+            quota: Cuota mensual en bytes (0 = ilimitada, None = sin cambios)
+            
+        Returns:
+            Límites y consumo actualizados, o None si la sesión no existe
+        """
+        session = self.resolve_session(session_id)
+        if session is None:
+            return None
+        self.shaper.set_limits(session.id, rate=rate, burst=burst, quota=quota)
+        return self.shaper.get_session_stats(session.id)
+    
+    def get_limits(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Obtiene los límites y el consumo de una sesión.
+        
+        Args:
+            session_id: ID de la sesión
+        
+        Returns:
+            Límites y consumo, o None si la sesión no existe
+        """
+        session = self.resolve_session(session_id)
+        if session is None:
+            return None
+        return self.shaper.get_session_stats(session.id)
+    
+    async def send_packet(self, session_id: str, packet: bytes) -> ShapingDecision:
+        """
+        Envía un paquete por el túnel aplicando los límites de la sesión.
+        
+        Args:
+            session_id: ID de la sesión emisora
+            packet: Paquete IP en claro
+            
+        Returns:
+            Decisión del shaper (enviado, en cola o descartado)
+        """
+        if session_id not in self.sessions:
+            return ShapingDecision.DROPPED
+        
+        decision = self.shaper.admit(session_id, packet)
+        if decision == ShapingDecision.SEND:
+            await self._transmit(session_id, packet)
+        return decision
+    
+    async def _transmit(self, session_id: str, packet: bytes):
+        """
+        Cifra y envía un paquete ya admitido por el shaper.
+        
+        Args:
+            session_id: ID de la sesión emisora
+            packet: Paquete IP en claro
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        
+        # Nonce = contador; antes de pasar del límite reservado se guarda
+        # un nuevo límite en la instantánea para no reutilizarlo tras reiniciar
+        session.tx_counter += 1
+        if self.snapshot and session.tx_counter >= session.nonce_limit:
+            self.snapshot.reserve_nonces(session)
+        
+        # En una implementación real, el resultado se enviaría al servidor VPN
+        session.cipher.encrypt(packet, nonce=session.tx_counter.to_bytes(12, "big"))
+        session.bytes_sent += len(packet)
+        session.last_activity = time.time()
+    
+    def route_packet(self, packet: bytes) -> Optional[str]:
+        """
+        Determina la sesión destino de un paquete IP descifrado.
+        
+        Args:
+            packet: Paquete IP en bruto
+            
+        Returns:
+            ID de la sesión destino o None si no hay ruta
+        """
+        destination = packet_destination(packet)
+        if destination is None:
+            return None
+        version, address = destination
+        return self.routes.lookup(address, version=version)
     
     async def _process_packet(self, packet: bytes):
         """
         Procesa un paquete recibido de la interfaz TUN.
         
-        En una implementación real, este método cifraría el paquete
-        con AES-GCM y lo enviaría al servidor VPN.
+        Busca la sesión destino en la tabla de rutas y lo envía, cifrado
+        con AES-GCM, por el túnel de esa sesión.
         
         Args:
             packet: Datos del paquete recibido
         """
-        if not self.connected or not self.aes:
-            return
-        
         try:
-            # Aquí iría la lógica para procesar, cifrar y enviar el paquete
-            # En una implementación real de VPN
-            pass
+            # Descartar paquetes sin ruta conocida antes de cifrarlos
+            session_id = self.route_packet(packet)
+            if session_id is None:
+                logger.debug("Paquete descartado: sin ruta para el destino")
+                return
+            
+            await self.send_packet(session_id, packet)
         except Exception as e:
             logger.error(f"Error al procesar paquete: {str(e)}")
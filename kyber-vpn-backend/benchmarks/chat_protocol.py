@@ -0,0 +1,105 @@
+"""
+Comparativa de los protocolos del WebSocket del chat (JSON frente a MessagePack).
+
+Mide, por trama, el tiempo de codificación de las tramas salientes, el
+de decodificación de las entrantes y el tamaño en la red, para un
+mensaje de texto, un mensaje con contenido cifrado (que en JSON viaja en
+Base64) y un indicador de escritura. Si la extensión ``msgpack`` está
+instalada se mide también el codificador propio en Python puro.
+
+Uso (desde kyber-vpn-backend/):
+
+    python -m benchmarks.chat_protocol [--iterations N]
+"""
+import argparse
+import json
+import os
+import timeit
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple
+
+from app.chat import codec
+
+
+def _frames() -> List[Tuple[str, Dict[str, Any], Dict[str, Any]]]:
+    """Tramas de ejemplo: (nombre, trama saliente, trama entrante equivalente)."""
+    message = {
+        "id": str(uuid.uuid4()),
+        "seq": 48213,
+        "sender": "usuario1",
+        "room_id": "general",
+        "content": "¿Nos vemos a las cinco en la sala de reuniones?",
+        "timestamp": datetime.now().isoformat(),
+        "read_by": ["usuario1"],
+    }
+    ciphertext = os.urandom(12 + 256 + 16)  # nonce + mensaje + etiqueta AES-GCM
+    return [
+        ("texto",
+         {"type": "new_message", "message": message},
+         {"type": "message", "room_id": "general", "content": message["content"]}),
+        ("cifrado 256 B",
+         {"type": "new_message", "message": dict(message, content=ciphertext)},
+         {"type": "message", "room_id": "general", "content": ciphertext}),
+        ("escritura",
+         {"type": "typing", "room_id": "general", "users": ["usuario1", "usuario2"]},
+         {"type": "typing", "room_id": "general"}),
+    ]
+
+
+def _per_call(function: Callable, iterations: int) -> float:
+    """Microsegundos por llamada (mejor de tres repeticiones)."""
+    return min(timeit.repeat(function, number=iterations, repeat=3)) / iterations * 1e6
+
+
+def _codecs() -> List[Tuple[str, Callable, Callable]]:
+    """Codificadores MessagePack disponibles: (nombre, codificar, decodificar)."""
+    def encode_python(obj: Any) -> bytes:
+        out: List[bytes] = []
+        codec._encode(obj, out)
+        return b"".join(out)
+
+    def decode_python(data: bytes) -> Any:
+        return codec._decode(data, 0)[0]
+
+    codecs = []
+    if codec.msgpack is not None:
+        codecs.append(("msgpack", codec.encode, codec.decode))
+    codecs.append(("msgpack (Python)", encode_python, decode_python))
+    return codecs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--iterations", type=int, default=20000, help="Tramas por medición")
+    args = parser.parse_args()
+
+    print(f"{'trama':<15} {'protocolo':<18} {'codificar µs':>13} {'decodificar µs':>15} {'bytes':>7}")
+    for name, outbound, inbound in _frames():
+        # JSON: los bytes viajan en Base64, como en Frame.text
+        def encode_json(obj: Any) -> str:
+            return json.dumps(obj, default=codec._bytes_to_base64)
+
+        inbound_text = encode_json(inbound)
+        rows = [(
+            "json",
+            _per_call(lambda: encode_json(outbound), args.iterations),
+            _per_call(lambda: json.loads(inbound_text), args.iterations),
+            len(encode_json(outbound).encode("utf-8")),
+        )]
+        for codec_name, encode, decode in _codecs():
+            inbound_binary = encode(inbound)
+            rows.append((
+                codec_name,
+                _per_call(lambda: encode(outbound), args.iterations),
+                _per_call(lambda: decode(inbound_binary), args.iterations),
+                len(encode(outbound)),
+            ))
+        json_size = rows[0][3]
+        for protocol, encode_us, decode_us, size in rows:
+            saved = f"({100 * (size - json_size) / json_size:+.0f}%)" if protocol != "json" else ""
+            print(f"{name:<15} {protocol:<18} {encode_us:>13.2f} {decode_us:>15.2f} {size:>7} {saved}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,28 @@
 # filepath: c:\Users\57304\Documents\Kyber-VPN\kyber-vpn-backend\gunicorn.conf.py
 import multiprocessing
+import os
 
 # Configuración para producción en Azure
 bind = "0.0.0.0:8000"
 workers = multiprocessing.cpu_count() * 2 + 1
 worker_class = "uvicorn.workers.UvicornWorker"
-timeout = 120
\ No newline at end of file
+timeout = 120
+
+# Con varios workers, sesiones y chat deben vivir en un almacén compartido
+# (SQLite en esta máquina salvo que se configure un servidor Redis)
+os.environ.setdefault("STATE_BACKEND_URL", "sqlite:///data/state.db")
+# y la difusión del chat debe llegar a los WebSockets de todos los workers
+os.environ.setdefault("CHAT_BUS_URL", "unix:///data/chat-bus.sock")
+
+
+def pre_fork(server, worker):
+    """Asigna al nuevo worker el menor índice libre (un worker reiniciado hereda el del caído)."""
+    used = {getattr(other, "kyber_index", None) for other in server.WORKERS.values()}
+    worker.kyber_index = next(index for index in range(len(used) + 1) if index not in used)
+
+
+def post_fork(server, worker):
+    """Publica el índice del worker para la configuración (p. ej. su porción del pool de IPs)."""
+    # La aplicación se importa después del fork (sin preload_app), así que la ve en settings
+    os.environ["WORKER_INDEX"] = str(worker.kyber_index)
+    os.environ["WORKER_COUNT"] = str(server.num_workers)
@@ -0,0 +1,93 @@
+"""Pruebas del control de admisión de handshakes."""
+import asyncio
+
+import pytest
+
+from app.network.admission import AdmissionController, AdmissionRejectedError
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    controller = AdmissionController(limit=1, queue_size=4, max_wait=1.0)
+    order = []
+
+    async def handshake(name):
+        async with controller.slot():
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        await asyncio.gather(*(handshake(name) for name in "abcd"))
+
+    asyncio.run(scenario())
+    assert order == list("abcd")
+    stats = controller.get_stats()
+    assert stats["admitted"] == 4 and stats["queued"] == 3
+    assert stats["active"] == 0 and stats["queueDepth"] == 0
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    controller = AdmissionController(limit=1, queue_size=1, max_wait=1.0)
+
+    async def scenario():
+        await controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejectedError) as error:
+            await controller.acquire()
+        assert error.value.retry_after >= 1
+        controller.release()
+        await waiter
+        controller.release()
+
+    asyncio.run(scenario())
+    assert controller.get_stats()["rejectedFull"] == 1
+    assert controller.active == 0
+
+
+def test_waiter_past_its_deadline_is_dropped():
+    controller = AdmissionController(limit=1, queue_size=4, max_wait=0.05)
+
+    async def scenario():
+        await controller.acquire()
+        with pytest.raises(AdmissionRejectedError):
+            await controller.acquire()
+        controller.release()
+
+    asyncio.run(scenario())
+    stats = controller.get_stats()
+    assert stats["droppedDeadline"] == 1
+    assert stats["active"] == 0 and stats["queueDepth"] == 0
+
+
+def test_expected_wait_over_deadline_is_rejected_upfront():
+    controller = AdmissionController(limit=1, queue_size=4, max_wait=1.0)
+    controller._service = 2.0
+
+    async def scenario():
+        await controller.acquire()
+        with pytest.raises(AdmissionRejectedError):
+            await controller.acquire()
+        controller.release()
+
+    asyncio.run(scenario())
+    assert controller.get_stats()["queued"] == 0
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    controller = AdmissionController(limit=1, queue_size=4, max_wait=1.0)
+
+    async def scenario():
+        await controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        controller.release()
+        assert controller.active == 0
+        # El hueco liberado sigue disponible
+        await asyncio.wait_for(controller.acquire(), 0.1)
+        controller.release()
+
+    asyncio.run(scenario())
+    assert controller.active == 0
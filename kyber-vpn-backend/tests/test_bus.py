@@ -0,0 +1,86 @@
+"""Pruebas del bus de difusión entre workers."""
+import asyncio
+
+import pytest
+
+from app.core.bus import MemoryBus, UnixSocketBus, fcntl
+
+
+async def _wait_for(condition, timeout: float = 3.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("Condición no alcanzada a tiempo")
+        await asyncio.sleep(0.01)
+
+
+def test_memory_bus_delivers_to_other_subscribed_peers():
+    received = []
+
+    async def scenario():
+        first, second, third = MemoryBus(), MemoryBus(), MemoryBus()
+        for bus in (first, second, third):
+            await bus.start()
+        second.set_handler(lambda topic, payload: received.append((topic, payload)))
+        second.subscribe("general")
+        first.subscribe("general")
+        first.publish("general", "hola")
+        first.publish("dev", "sin interés")
+        await asyncio.sleep(0)
+        for bus in (first, second, third):
+            await bus.close()
+
+    asyncio.run(scenario())
+    assert received == [("general", "hola")]
+
+
+@pytest.mark.skipif(fcntl is None, reason="El broker Unix necesita fcntl")
+def test_unix_bus_delivers_large_batches(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    received = []
+    payload = "x" * 70000  # Más que el límite de línea por defecto de asyncio (64 KiB)
+
+    async def scenario():
+        broker, client = UnixSocketBus(path), UnixSocketBus(path)
+        client.set_handler(lambda topic, data: received.append((topic, data)))
+        await broker.start()
+        await _wait_for(lambda: broker.get_stats()["connected"])
+        await client.start()
+        client.subscribe("general")
+        await _wait_for(lambda: len(broker._clients) == 2 and any(broker._clients.values()))
+
+        for index in range(3):
+            broker.publish("general", payload + str(index))
+        await _wait_for(lambda: len(received) == 3)
+        assert broker.get_stats()["connected"]
+        await client.close()
+        await broker.close()
+
+    asyncio.run(scenario())
+    assert [data for _, data in received] == [payload + str(index) for index in range(3)]
+
+
+@pytest.mark.skipif(fcntl is None, reason="El broker Unix necesita fcntl")
+def test_unix_bus_keeps_publications_until_connected(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    received = []
+
+    async def scenario():
+        listener = UnixSocketBus(path)
+        listener.set_handler(lambda topic, data: received.append(data))
+        await listener.start()
+        listener.subscribe("general")
+        await _wait_for(lambda: listener.get_stats()["connected"])
+
+        publisher = UnixSocketBus(path)
+        publisher.publish("general", "antes de conectar")
+        await asyncio.sleep(0)
+        assert publisher.get_stats()["backlog"] == 1
+
+        await publisher.start()
+        await _wait_for(lambda: received == ["antes de conectar"])
+        assert publisher.get_stats()["backlog"] == 0
+        await publisher.close()
+        await listener.close()
+
+    asyncio.run(scenario())
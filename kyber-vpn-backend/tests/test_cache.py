@@ -0,0 +1,93 @@
+"""Pruebas de la caché de mensajes recientes."""
+import asyncio
+
+from app.chat.cache import RecentMessageCache
+from app.chat.messaging import SESSIONS, MessagingService
+from app.chat.store import MessageStore
+from app.core.bus import MemoryBus
+from app.core.state import MemoryBackend
+
+
+def _message(room_id: str, seq: int):
+    return {"id": f"m{seq}", "seq": seq, "sender": "alice", "room_id": room_id,
+            "content": f"mensaje {seq}", "timestamp": "2024-01-01T00:00:00"}
+
+
+def test_pages_inside_the_ring_are_served_from_memory():
+    cache = RecentMessageCache(per_room=5)
+    cache.fill("general", [_message("general", seq) for seq in range(11, 21)])
+
+    assert [m["seq"] for m in cache.get("general", 3)] == [18, 19, 20]
+    assert [m["seq"] for m in cache.get("general", 2, before=18)] == [16, 17]
+    assert [m["seq"] for m in cache.get("general", 10, after=17)] == [18, 19, 20]
+    # Fuera del buffer: al almacén
+    assert cache.get("general", 3, before=16) is None
+    assert cache.get("general", 3, after=10) is None
+    assert cache.get("otra", 3) is None
+
+
+def test_append_keeps_the_ring_contiguous():
+    cache = RecentMessageCache(per_room=5)
+    cache.append(_message("general", 1))
+    cache.append(_message("general", 2))
+    cache.append(_message("general", 2))  # Repetido: se ignora
+    assert [m["seq"] for m in cache.get("general", 10)] == [1, 2]
+
+    # Hueco (mensaje de otro worker no recibido): el buffer se reinicia
+    cache.append(_message("general", 5))
+    assert cache.get("general", 10, after=2) is None
+    assert [m["seq"] for m in cache.get("general", 1)] == [5]
+
+    # Sala fría a partir de un mensaje intermedio: no se crea buffer
+    cache.append(_message("dev", 7))
+    assert not cache.contains("dev")
+
+
+def test_least_recently_used_rooms_are_evicted_over_budget():
+    cache = RecentMessageCache(per_room=10, budget_bytes=3000)
+    cache.fill("a", [_message("a", seq) for seq in range(1, 4)])
+    cache.fill("b", [_message("b", seq) for seq in range(1, 4)])
+    cache.get("a", 1)
+    cache.fill("c", [_message("c", seq) for seq in range(1, 4)])
+    assert cache.contains("a") and cache.contains("c") and not cache.contains("b")
+    assert cache.get_stats()["evictions"] == 1
+
+
+class _Connection:
+    """Conexión local mínima: acumula las tramas enviadas."""
+
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame, key=None):
+        self.frames.append(frame)
+
+
+def test_ring_is_dropped_when_the_worker_stops_receiving_the_room(tmp_path):
+    path = str(tmp_path / "chat.db")
+    state = MemoryBackend()
+    # Dos workers: mismo estado y misma base de datos, buses sin conectar entre sí
+    first = MessagingService(state=state, store=MessageStore(path), bus=MemoryBus())
+    second = MessagingService(state=state, store=MessageStore(path), bus=MemoryBus())
+
+    async def scenario():
+        await first.start()
+        await second.start()
+        await state.set(SESSIONS, "s1", "usuario1")
+        connection = _Connection()
+        await first.attach_connection("usuario1", connection)
+        await first.create_message("s1", "general", "uno")
+        assert [m["content"] for m in await first.get_room_messages("general")] == ["uno"]
+        assert first.cache.contains("general")
+
+        first.detach_connection("usuario1", connection)
+        assert not first.cache.contains("general")
+
+        await second.create_message("s1", "general", "dos")
+        assert [m["content"] for m in await first.get_room_messages("general")] == ["uno", "dos"]
+        assert [m["content"] for m in await first.get_room_messages("general", after=1)] == ["dos"]
+        assert not first.cache.contains("general")
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,78 @@
+"""Pruebas de la codificación de las tramas del chat."""
+import base64
+import json
+
+import pytest
+
+from app.chat import codec
+from app.chat.codec import BIN_TAG, Frame, jsonable
+
+SAMPLES = [
+    0, 127, 128, 255, 256, 65535, 65536, 2 ** 32, 2 ** 64 - 1,
+    -1, -32, -33, -128, -129, -32768, -32769, -2 ** 31 - 1, -2 ** 63,
+    1.5, True, False, None,
+    "", "hola", "ñ" * 40, "x" * 300, "y" * 70000,
+    b"", b"\x00\xff" * 10, b"z" * 300, b"z" * 70000,
+    [], list(range(20)), {"type": "typing", "users": ["a", "b"]},
+    {f"k{index}": index for index in range(20)},
+    {"type": "new_message", "message": {"id": "m1", "seq": 48213, "content": b"\x01" * 284}},
+]
+
+
+def _pure_encode(obj):
+    out = []
+    codec._encode(obj, out)
+    return b"".join(out)
+
+
+@pytest.mark.parametrize("value", SAMPLES)
+def test_pure_python_codec_round_trips(value, monkeypatch):
+    monkeypatch.setattr(codec, "msgpack", None)
+    assert codec.decode(_pure_encode(value)) == value
+
+
+@pytest.mark.skipif(codec.msgpack is None, reason="Sin la extensión msgpack")
+@pytest.mark.parametrize("value", SAMPLES)
+def test_pure_python_codec_matches_the_extension(value):
+    packed = codec.msgpack.packb(value, use_bin_type=True)
+    assert _pure_encode(value) == packed
+    assert codec._decode(packed, 0) == (value, len(packed))
+
+
+@pytest.mark.parametrize("pure", [True, False])
+def test_invalid_frames_raise_value_error(pure, monkeypatch):
+    if pure:
+        monkeypatch.setattr(codec, "msgpack", None)
+    elif codec.msgpack is None:
+        pytest.skip("Sin la extensión msgpack")
+    frame = codec.encode({"type": "message", "content": "hola"})
+    for data in (frame[:-1], frame + b"\x00", b"\xc1", b"\xdb\xff\xff\xff\xff"):
+        with pytest.raises(ValueError):
+            codec.decode(data)
+
+
+def test_unsupported_types_are_rejected():
+    with pytest.raises(TypeError):
+        _pure_encode({"value": object()})
+    with pytest.raises(ValueError):
+        _pure_encode(2 ** 64)
+
+
+def test_frame_encodes_each_protocol_from_the_bus_form():
+    content = b"\x00cifrado\xff"
+    frame = Frame({"type": "new_message", "message": {"seq": 1, "content": content}})
+    assert json.loads(frame.wire)["message"]["content"] == {BIN_TAG: base64.b64encode(content).decode()}
+
+    received = Frame(wire=frame.wire)
+    assert received.obj["message"]["content"] == content
+    assert json.loads(received.text)["message"]["content"] == base64.b64encode(content).decode()
+    assert codec.decode(received.binary)["message"]["content"] == content
+
+    plain = Frame({"type": "typing", "users": ["a"]})
+    assert plain.text is plain.wire
+
+
+def test_jsonable_encodes_binary_content_only():
+    message = {"id": "m1", "content": "texto"}
+    assert jsonable(message) is message
+    assert jsonable({"id": "m2", "content": b"\x01"})["content"] == "AQ=="
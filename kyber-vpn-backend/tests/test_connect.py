@@ -0,0 +1,139 @@
+"""Pruebas de las fases de conexión y de la reserva de claves."""
+import asyncio
+import threading
+from importlib import import_module
+
+import pytest
+
+from app.core.config import settings
+from app.crypto.keypool import KeyPool
+from app.network.registry import ServerRegistry
+
+vpn_module = import_module("app.network.vpn")
+
+
+def test_key_pool_miss_does_not_wait_for_refills(monkeypatch):
+    release = threading.Event()
+
+    def generate(self):
+        # Las reposiciones se quedan bloqueadas hasta el final de la prueba
+        if threading.current_thread().name.startswith("kyber-keygen"):
+            release.wait(5.0)
+        return threading.current_thread().name
+
+    monkeypatch.setattr(KeyPool, "_generate", generate)
+    pool = KeyPool(size=4, workers=1)
+
+    async def scenario():
+        await pool.start()
+        try:
+            generated_by = await asyncio.wait_for(pool.acquire(), 2.0)
+            assert generated_by.startswith("kyber-demand")
+            assert pool.get_stats()["misses"] == 1
+        finally:
+            release.set()
+            await pool.stop()
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def manager(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "QUOTA_DB_PATH", str(tmp_path / "quota.db"))
+    monkeypatch.setattr(settings, "VPN_POOL_STATE_PATH", str(tmp_path / "ippool.json"))
+    monkeypatch.setattr(settings, "SNAPSHOT_PATH", "")
+    registry = ServerRegistry([{"id": "s1", "name": "s1", "location": "local", "ip": "127.0.0.1",
+                                "port": 1194, "status": "online", "latency": 0, "capacity": 2}])
+    monkeypatch.setattr(vpn_module, "server_registry", registry)
+    return vpn_module.VPNManager()
+
+
+def test_phases_run_concurrently_and_are_timed(manager):
+    async def phase(value):
+        await asyncio.sleep(0.05)
+        return value
+
+    async def scenario():
+        timings = {}
+        started = asyncio.get_running_loop().time()
+        results = await manager._run_phases({"a": phase(1), "b": phase(2)}, timings)
+        assert results == {"a": 1, "b": 2}
+        assert asyncio.get_running_loop().time() - started < 0.09
+        assert set(timings) == {"a", "b"} and all(ms > 0 for ms in timings.values())
+
+    asyncio.run(scenario())
+
+
+def test_failed_phase_cancels_the_rest_and_rolls_back(manager):
+    undone = []
+
+    async def scenario():
+        slow_cancelled = asyncio.Event()
+
+        async def done():
+            return "10.8.0.9"
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                slow_cancelled.set()
+                raise
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("handshake fallido")
+
+        timings = {}
+        with pytest.raises(RuntimeError, match="handshake fallido"):
+            await manager._run_phases({"lease": done(), "tun": slow(), "keys": fail()},
+                                      timings, rollback={"lease": undone.append, "tun": undone.append})
+        assert slow_cancelled.is_set()
+        # Solo se deshace la fase que terminó
+        assert undone == ["10.8.0.9"]
+
+    asyncio.run(scenario())
+
+
+def test_connect_failure_releases_lease_and_slot(manager, monkeypatch):
+    class FailingKeys:
+        async def derive_key(self):
+            await asyncio.sleep(0.01)
+            raise RuntimeError("sin claves")
+
+    monkeypatch.setattr(vpn_module, "key_pool", FailingKeys())
+    registry = vpn_module.server_registry
+
+    async def scenario():
+        result = await manager.connect("s1", user="alice")
+        assert result["success"] is False and "sin claves" in result["message"]
+        assert registry.get_entry("s1").sessions == 0
+        stats = manager.pool.get_stats()
+        assert stats["active"] == 0
+        assert len(manager.sessions) == 0
+
+    asyncio.run(scenario())
+
+
+def test_connect_registers_the_session(manager, monkeypatch):
+    class Keys:
+        async def derive_key(self):
+            return bytes(32)
+
+    monkeypatch.setattr(vpn_module, "key_pool", Keys())
+    registry = vpn_module.server_registry
+
+    async def scenario():
+        await manager.shaper.start(manager._transmit)
+        result = await manager.connect("s1", user="alice")
+        assert result["success"] is True
+        session = manager.resolve_session(result["sessionId"])
+        assert session.vpn_ip == result["vpnIp"]
+        assert registry.get_entry("s1").sessions == 1
+        assert set(manager.connect_timings) >= {"keys", "tun", "lease", "total"}
+
+        await manager.disconnect(session.id)
+        assert registry.get_entry("s1").sessions == 0 and manager.pool.get_stats()["active"] == 0
+        await manager.shaper.stop()
+
+    asyncio.run(scenario())
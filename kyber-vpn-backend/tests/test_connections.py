@@ -0,0 +1,164 @@
+"""Pruebas de la cola de salida de las conexiones WebSocket del chat."""
+import asyncio
+import json
+
+import pytest
+
+from app.chat.codec import Frame
+from app.chat.connections import ClientConnection
+
+
+class _WebSocket:
+    """WebSocket mínimo: cada envío espera un permiso de ``permits``."""
+
+    def __init__(self, permits: int = 1000):
+        self.permits = asyncio.Semaphore(permits)
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data):
+        await self.permits.acquire()
+        self.sent.append(json.loads(data)["n"])
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+def _frame(number: int) -> Frame:
+    return Frame({"n": number})
+
+
+def _queued(connection: ClientConnection):
+    return [entry[0].obj["n"] for entry in connection._queue]
+
+
+async def _drain(connection: ClientConnection, websocket: _WebSocket, count: int):
+    connection.start()
+    for _ in range(100):
+        if len(websocket.sent) >= count:
+            return
+        await asyncio.sleep(0)
+    raise AssertionError("La tarea escritora no ha vaciado la cola")
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    async def scenario():
+        websocket = _WebSocket()
+        connection = ClientConnection(websocket, "alice", "s", max_queue=2, policy="drop_oldest")
+        for number in range(4):
+            assert connection.send(_frame(number))
+        assert _queued(connection) == [2, 3]
+        await _drain(connection, websocket, 2)
+        assert websocket.sent == [2, 3]
+        stats = connection.get_stats()
+        assert stats["dropped"] == 2 and stats["sent"] == 2 and stats["maxDepth"] == 2
+        await connection.close()
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_drops_ephemeral_frames_first():
+    async def scenario():
+        websocket = _WebSocket()
+        connection = ClientConnection(websocket, "alice", "s", max_queue=3, policy="coalesce")
+        connection.send(_frame(0))
+        connection.send(_frame(1), "typing:general")
+        connection.send(_frame(2))
+        # Cola llena: sale la trama efímera aunque no sea la más antigua
+        assert connection.send(_frame(3))
+        assert _queued(connection) == [0, 2, 3] and connection._keys == {}
+        # Sin tramas efímeras en cola, la efímera nueva es la que se pierde...
+        assert not connection.send(_frame(4), "typing:general")
+        assert _queued(connection) == [0, 2, 3]
+        # ...y una trama normal desplaza a la más antigua
+        assert connection.send(_frame(5))
+        assert _queued(connection) == [2, 3, 5]
+        assert connection.get_stats()["dropped"] == 3
+        await connection.close()
+
+    asyncio.run(scenario())
+
+
+def test_frames_with_the_same_key_replace_the_pending_one():
+    async def scenario():
+        websocket = _WebSocket()
+        connection = ClientConnection(websocket, "alice", "s", max_queue=8)
+        connection.send(_frame(0), "typing:general")
+        connection.send(_frame(1))
+        connection.send(_frame(2), "typing:general")
+        connection.send(_frame(3), "typing:dev")
+        # La trama nueva ocupa el turno de la pendiente
+        assert _queued(connection) == [2, 1, 3]
+        assert connection.get_stats()["coalesced"] == 1
+
+        await _drain(connection, websocket, 3)
+        assert websocket.sent == [2, 1, 3] and connection._keys == {}
+        # Una vez enviada, la misma clave vuelve a encolarse
+        connection.send(_frame(4), "typing:general")
+        await _drain(connection, websocket, 4)
+        assert websocket.sent[-1] == 4
+        await connection.close()
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_policy_closes_the_slow_client():
+    async def scenario():
+        websocket = _WebSocket()
+        connection = ClientConnection(websocket, "alice", "s", max_queue=2, policy="disconnect")
+        assert connection.send(_frame(0)) and connection.send(_frame(1))
+        assert not connection.send(_frame(2))
+        assert connection.closed and not connection._queue
+        await asyncio.sleep(0)
+        assert websocket.close_code == 1013
+        assert not connection.send(_frame(3))
+        assert connection.get_stats()["dropped"] == 3
+        await connection.close()
+
+    asyncio.run(scenario())
+
+
+def test_invalid_policy_is_rejected():
+    with pytest.raises(ValueError):
+        ClientConnection(_WebSocket(), "alice", "s", policy="ignore")
+
+
+def test_wait_writable_blocks_until_the_queue_drains_to_half():
+    async def scenario():
+        websocket = _WebSocket(permits=0)
+        connection = ClientConnection(websocket, "alice", "s", max_queue=4)
+        for number in range(4):
+            connection.send(_frame(number))
+        connection.start()
+        waiter = asyncio.ensure_future(connection.wait_writable())
+        await asyncio.sleep(0)
+        # La primera trama sale de la cola al empezar su envío: quedan 3
+        assert len(connection._queue) == 3 and not waiter.done()
+
+        # Al enviarse, sale la siguiente y la cola baja a la mitad
+        websocket.permits.release()
+        await asyncio.wait_for(waiter, 1.0)
+        assert len(connection._queue) == 2 and websocket.sent == [0]
+
+        # Cerrar la conexión libera a quien espera
+        for number in range(4, 6):
+            connection.send(_frame(number))
+        waiter = asyncio.ensure_future(connection.wait_writable())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        await connection.close()
+        await asyncio.wait_for(waiter, 1.0)
+
+    asyncio.run(scenario())
+
+
+def test_stats_do_not_expose_the_user_or_session():
+    async def scenario():
+        first = ClientConnection(_WebSocket(), "alice", "secreto")
+        second = ClientConnection(_WebSocket(), "alice", "secreto")
+        stats = first.get_stats()
+        assert "username" not in stats and "sessionId" not in stats
+        assert "secreto" not in json.dumps(stats) and "alice" not in json.dumps(stats)
+        assert stats["id"] != second.get_stats()["id"]
+
+    asyncio.run(scenario())
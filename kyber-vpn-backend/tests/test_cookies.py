@@ -0,0 +1,98 @@
+"""Pruebas de las cookies de handshake y de su exigencia en /api/connect."""
+import base64
+from importlib import import_module
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.crypto.cookies import CookieChecker
+
+# El paquete de rutas exporta los routers con el nombre de cada módulo
+connection_routes = import_module("app.api.routes.connection")
+
+
+def test_cookie_is_bound_to_the_client_address():
+    checker = CookieChecker("secreto", lifetime=120.0)
+    cookie = checker.issue("10.0.0.1", now=1000.0)
+    assert checker.verify(cookie, "10.0.0.1", now=1000.0)
+    assert not checker.verify(cookie, "10.0.0.2", now=1000.0)
+    assert not checker.verify(None, "10.0.0.1", now=1000.0)
+    assert not checker.verify("no-es-base64!", "10.0.0.1", now=1000.0)
+
+    # Un solo bit cambiado en el MAC invalida la cookie
+    raw = bytearray(base64.urlsafe_b64decode(cookie))
+    raw[-1] ^= 1
+    assert not checker.verify(base64.urlsafe_b64encode(bytes(raw)).decode(), "10.0.0.1", now=1000.0)
+
+    stats = checker.get_stats()
+    assert stats["issued"] == 1 and stats["accepted"] == 1 and stats["rejected"] == 3
+
+
+def test_cookie_expires_after_the_previous_period():
+    checker = CookieChecker("secreto", lifetime=120.0)
+    cookie = checker.issue("10.0.0.1", now=0.0)
+    assert checker.verify(cookie, "10.0.0.1", now=119.0)
+    assert checker.verify(cookie, "10.0.0.1", now=239.0)  # Periodo anterior: aún válida
+    assert not checker.verify(cookie, "10.0.0.1", now=240.0)
+    # Las claves de periodos anteriores al previo se descartan
+    checker.issue("10.0.0.1", now=240.0)
+    assert list(checker._keys) == [2]
+
+
+def test_cookies_follow_the_shared_secret():
+    worker = CookieChecker("secreto", lifetime=120.0)
+    other_worker = CookieChecker("secreto", lifetime=120.0)
+    rotated = CookieChecker("secreto-nuevo", lifetime=120.0)
+    cookie = worker.issue("10.0.0.1", now=500.0)
+    # Los workers con el mismo secreto aceptan las cookies de los demás;
+    # al rotar el secreto, las emitidas con el anterior dejan de valer
+    assert other_worker.verify(cookie, "10.0.0.1", now=500.0)
+    assert not rotated.verify(cookie, "10.0.0.1", now=500.0)
+
+
+def test_handshake_counts_in_flight_and_sets_the_load_flag():
+    checker = CookieChecker("secreto", threshold=2)
+    with checker.handshake():
+        assert not checker.under_load()
+        with checker.handshake():
+            assert checker.under_load() and checker.in_flight == 2
+    assert checker.in_flight == 0 and not checker.under_load()
+    assert not CookieChecker("secreto", threshold=0).under_load()
+
+
+class _Manager:
+    def __init__(self):
+        self.connects = 0
+
+    async def connect(self, server_id, user=None):
+        self.connects += 1
+        return {"success": True, "message": "ok", "vpnIp": "10.8.0.2", "sessionId": "s"}
+
+
+def test_connect_requires_a_cookie_under_load(monkeypatch):
+    checker = CookieChecker("secreto", threshold=1)
+    manager = _Manager()
+    monkeypatch.setattr(connection_routes, "cookie_checker", checker)
+    monkeypatch.setattr(connection_routes, "vpn_manager", manager)
+    app = FastAPI()
+    app.include_router(connection_routes.router, prefix="/api")
+    client = TestClient(app)
+    request = {"serverId": "server1"}
+
+    # Sin carga no hace falta cookie
+    assert client.post("/api/connect", json=request).status_code == 200
+
+    with checker.handshake():  # Un handshake en curso alcanza el umbral
+        refused = client.post("/api/connect", json=request)
+        assert refused.status_code == 429
+        cookie = refused.headers[connection_routes.COOKIE_HEADER]
+        assert manager.connects == 1
+
+        bad = client.post("/api/connect", json=request,
+                          headers={connection_routes.COOKIE_HEADER: cookie[:-4] + "AAAA"})
+        assert bad.status_code == 429
+
+        accepted = client.post("/api/connect", json=request,
+                               headers={connection_routes.COOKIE_HEADER: cookie})
+        assert accepted.status_code == 200 and accepted.json()["sessionId"] == "s"
+        assert manager.connects == 2
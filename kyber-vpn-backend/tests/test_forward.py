@@ -0,0 +1,176 @@
+"""Pruebas de las sesiones compartidas entre workers y del reenvío de operaciones."""
+import asyncio
+import json
+from importlib import import_module
+
+import pytest
+
+from app.core.bus import MemoryBus
+from app.core.config import settings
+from app.core.state import MemoryBackend
+from app.network.forward import ForwardError
+from app.network.registry import ServerRegistry
+
+vpn_module = import_module("app.network.vpn")
+registry_module = import_module("app.network.registry")
+
+
+class _Keys:
+    async def derive_key(self):
+        return bytes(32)
+
+
+@pytest.fixture
+def workers(monkeypatch, tmp_path):
+    """Crea gestores VPN que comparten estado y se comunican por un bus en memoria."""
+    backend = MemoryBackend()
+    monkeypatch.setattr(vpn_module, "state_backend", backend)
+    monkeypatch.setattr(registry_module, "state_backend", backend)
+    monkeypatch.setattr(vpn_module, "key_pool", _Keys())
+    monkeypatch.setattr(vpn_module, "server_registry", ServerRegistry([
+        {"id": "s1", "name": "s1", "location": "local", "ip": "127.0.0.1",
+         "port": 1194, "status": "online", "latency": 0, "capacity": 10},
+    ]))
+    monkeypatch.setattr(settings, "SNAPSHOT_PATH", "")
+    monkeypatch.setattr(settings, "VPN_FORWARD_TIMEOUT", 0.2)
+
+    def create(name: str):
+        monkeypatch.setattr(settings, "QUOTA_DB_PATH", str(tmp_path / f"quota-{name}.db"))
+        monkeypatch.setattr(settings, "VPN_POOL_STATE_PATH", str(tmp_path / f"ippool-{name}.json"))
+        return vpn_module.VPNManager(bus=MemoryBus())
+
+    return create
+
+
+async def _start(manager):
+    await manager.forwarder.bus.start()
+    await manager.start()
+
+
+async def _stop(manager):
+    await manager.stop()
+    await manager.forwarder.bus.close()
+
+
+def test_operations_are_forwarded_to_the_owner(workers):
+    owner, other = workers("a"), workers("b")
+
+    async def scenario():
+        await _start(owner)
+        await _start(other)
+        session_id = (await owner.connect("s1", user="alice"))["sessionId"]
+
+        status = await other.call_owner(session_id, "status")
+        assert status["connected"] and status["sessionId"] == session_id
+        assert (await other.get_status(session_id)).connected
+        assert [entry["user"] for entry in await other.list_sessions()] == ["alice"]
+
+        limits = await other.call_owner(session_id, "set_limits", rate=1000, burst=2000, quota=None)
+        assert limits["rate"] == 1000
+        assert owner.get_limits(session_id)["burst"] == 2000
+
+        assert (await other.call_owner(session_id, "disconnect"))["success"]
+        assert session_id not in owner.sessions
+        assert await other.call_owner(session_id, "status") is None
+        assert await other.call_owner("desconocida", "get_limits") is None
+
+        await _stop(other)
+        await _stop(owner)
+
+    asyncio.run(scenario())
+
+
+def test_unresponsive_owner_raises(workers):
+    owner, other = workers("a"), workers("b")
+
+    async def scenario():
+        await _start(owner)
+        await _start(other)
+        session_id = (await owner.connect("s1", user="alice"))["sessionId"]
+        # El worker sigue con latido, pero ya no atiende el bus
+        await owner.forwarder.bus.close()
+        with pytest.raises(ForwardError):
+            await other.call_owner(session_id, "disconnect")
+        assert other.forwarder.get_stats()["timeouts"] == 1
+        await _stop(other)
+        await owner.stop()
+
+    asyncio.run(scenario())
+
+
+def test_sessions_of_a_dead_worker_expire_and_are_purged(workers, monkeypatch):
+    owner, other = workers("a"), workers("b")
+
+    async def scenario():
+        await _start(owner)
+        await _start(other)
+        session_id = (await owner.connect("s1", user="alice"))["sessionId"]
+        assert await other._shared_session(session_id) is not None
+
+        # El worker muere sin cerrar nada: su latido deja de renovarse
+        now = vpn_module.time.time()
+        monkeypatch.setattr(vpn_module.time, "time", lambda: now + settings.VPN_WORKER_TTL + 1)
+        assert await other._shared_session(session_id) is None
+        assert await other.list_sessions() == []
+        assert await other.call_owner(session_id, "status") is None
+
+        await other._heartbeat()
+        backend = vpn_module.state_backend
+        assert await backend.items(vpn_module.SHARED_SESSIONS) == {}
+        assert list(await backend.items(vpn_module.VPN_WORKERS)) == [other.forwarder.worker]
+        await _stop(other)
+        await _stop(owner)
+
+    asyncio.run(scenario())
+
+
+def test_snapshot_stop_withdraws_shared_sessions(workers, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "SNAPSHOT_PATH", str(tmp_path / "sessions.snap"))
+    monkeypatch.setattr(settings, "SNAPSHOT_NODE_KEY", "clave-de-nodo")
+    owner = workers("a")
+    assert owner.snapshot is not None
+
+    async def scenario():
+        await _start(owner)
+        session_id = (await owner.connect("s1", user="alice"))["sessionId"]
+        backend = vpn_module.state_backend
+        assert session_id in await backend.items(vpn_module.SHARED_SESSIONS)
+
+        await _stop(owner)
+        # La sesión queda en la instantánea, pero no en el estado compartido
+        assert session_id in owner.sessions
+        assert await backend.items(vpn_module.SHARED_SESSIONS) == {}
+        assert await backend.items(vpn_module.VPN_WORKERS) == {}
+
+    asyncio.run(scenario())
+
+
+def test_status_stream_follows_a_session_of_another_worker(workers):
+    from app.network.status import StatusHub
+
+    owner, other = workers("a"), workers("b")
+    hub = StatusHub(other, max_rate=100.0)
+
+    async def scenario():
+        await _start(owner)
+        await _start(other)
+        session_id = (await owner.connect("s1", user="alice"))["sessionId"]
+
+        frames = hub.subscribe(session_id)
+        first = json.loads(await frames.__anext__())
+        assert first["full"] and first["status"]["sessionId"] == session_id
+        assert hub._channels[session_id].remote
+
+        await owner.disconnect(session_id)
+        hub._sample()
+        await hub._polling
+        last = json.loads(await frames.__anext__())
+        assert last["delta"]["connected"] is False
+        with pytest.raises(StopAsyncIteration):
+            await frames.__anext__()
+        assert hub._channels == {}
+
+        await _stop(other)
+        await _stop(owner)
+
+    asyncio.run(scenario())
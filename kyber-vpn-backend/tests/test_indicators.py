@@ -0,0 +1,58 @@
+"""Pruebas de los indicadores de escritura agregados por sala."""
+from app.chat.indicators import TypingTracker
+
+
+def test_typing_users_expire_after_the_ttl():
+    tracker = TypingTracker(ttl=5.0)
+    tracker.touch("general", "alice", now=0.0)
+    tracker.touch("general", "bob", now=3.0)
+    assert tracker.collect(now=1.0) == [("general", ["alice", "bob"])]
+
+    # Cada pulsación renueva la caducidad del usuario
+    tracker.touch("general", "alice", now=4.0)
+    assert tracker.collect(now=7.5) == []
+    assert tracker.collect(now=8.0) == [("general", ["alice"])]
+    assert tracker.collect(now=8.5) == []
+    assert tracker.collect(now=9.0) == [("general", [])]
+    assert tracker.get_stats()["rooms"] == 0
+
+
+def test_touches_are_announced_once_per_half_ttl():
+    tracker = TypingTracker(ttl=4.0)
+    assert tracker.touch("general", "alice", now=0.0)
+    assert not tracker.touch("general", "alice", now=1.0)
+    assert not tracker.touch("general", "alice", now=1.9)
+    assert tracker.touch("general", "alice", now=2.0)
+    assert not tracker.touch("general", "alice", now=3.5)
+    assert tracker.touch("general", "alice", now=4.0)
+    stats = tracker.get_stats()
+    assert stats["touches"] == 6 and stats["announced"] == 3
+
+    # Los anuncios de otros workers mantienen al usuario sin volver a anunciarlo
+    tracker.renew("general", "bob", now=0.0)
+    tracker.renew("general", "bob", now=3.0)
+    assert tracker.collect(now=6.5) == [("general", ["alice", "bob"])]
+    assert tracker.get_stats()["announced"] == 3
+
+
+def test_frames_are_sent_only_when_the_list_changes():
+    tracker = TypingTracker(ttl=5.0)
+    tracker.touch("general", "alice", now=0.0)
+    tracker.touch("dev", "bob", now=0.0)
+    assert sorted(tracker.collect(now=0.5)) == [("dev", ["bob"]), ("general", ["alice"])]
+
+    # Pulsaciones repetidas o anuncios de quien ya escribe no generan tramas
+    for instant in (1.0, 2.0, 3.0):
+        tracker.touch("general", "alice", now=instant)
+        tracker.renew("dev", "bob", now=instant)
+    assert tracker.collect(now=3.5) == []
+
+    # Un usuario que deja de escribir y vuelve antes del envío no cambia la lista
+    assert tracker.stop("general", "alice")
+    tracker.touch("general", "alice", now=4.0)
+    assert tracker.collect(now=4.5) == []
+
+    assert tracker.stop("dev", "bob")
+    assert not tracker.stop("dev", "bob")
+    assert tracker.collect(now=5.0) == [("dev", [])]
+    assert tracker.get_stats()["frames"] == 3
@@ -0,0 +1,77 @@
+"""Pruebas del pool de direcciones VPN."""
+import ipaddress
+
+import pytest
+
+from app.network.ippool import AddressPool, PoolExhaustedError
+
+
+def _drain(pool: AddressPool):
+    addresses = []
+    while True:
+        try:
+            addresses.append(pool.allocate())
+        except PoolExhaustedError:
+            return addresses
+
+
+def test_allocates_unique_addresses_until_exhausted():
+    pool = AddressPool("10.8.0.0/28", reserved=["10.8.0.1"])
+    addresses = _drain(pool)
+    assert len(addresses) == len(set(addresses)) == 16 - 3
+    assert "10.8.0.0" not in addresses and "10.8.0.1" not in addresses and "10.8.0.15" not in addresses
+    assert pool.get_stats()["free"] == 0
+
+
+def test_sticky_lease_returns_the_same_address():
+    pool = AddressPool("10.8.0.0/24", grace_period=60)
+    address = pool.allocate("alice", now=0)
+    pool.release(address, now=1)
+    assert pool.allocate("bob", now=2) != address
+    assert pool.allocate("alice", now=3) == address
+
+    pool.release(address, now=4)
+    assert pool.expire(now=100) == 1
+    assert pool.get_stats()["grace"] == 0
+
+
+def test_worker_slices_are_disjoint():
+    pools = [AddressPool("10.8.0.0/24", reserved=["10.8.0.1"], slice_index=index, slice_count=3)
+             for index in range(3)]
+    allocated = [_drain(pool) for pool in pools]
+
+    flat = [address for addresses in allocated for address in addresses]
+    assert len(flat) == len(set(flat)) == 256 - 3
+    for index, addresses in enumerate(allocated):
+        first, last = pools[index].get_stats()["slice"]
+        low, high = int(ipaddress.ip_address(first)), int(ipaddress.ip_address(last))
+        assert all(low <= int(ipaddress.ip_address(address)) <= high for address in addresses)
+    # Una dirección de otra porción no se puede reclamar
+    assert not pools[0].claim(allocated[2][0])
+
+
+def test_sparse_network_stays_in_its_slice():
+    pool = AddressPool("fd00::/64", slice_index=1, slice_count=4)
+    first, last = (int(ipaddress.ip_address(address)) for address in pool.get_stats()["slice"])
+    for user in ("alice", "bob", None):
+        assert first <= int(ipaddress.ip_address(pool.allocate(user))) <= last
+
+
+def test_invalid_slice_is_rejected():
+    with pytest.raises(ValueError):
+        AddressPool("10.8.0.0/30", slice_index=0, slice_count=8)
+    with pytest.raises(ValueError):
+        AddressPool("10.8.0.0/24", slice_index=3, slice_count=3)
+
+
+def test_state_round_trip_keeps_only_own_slice(tmp_path):
+    path = str(tmp_path / "pool.json")
+    pool = AddressPool("10.8.0.0/24", state_path=path, slice_index=0, slice_count=2)
+    address = pool.allocate("alice")
+    pool.save()
+
+    restored = AddressPool("10.8.0.0/24", state_path=path, slice_index=0, slice_count=2)
+    assert restored.get_stats()["active"] == 1
+    assert not restored.claim(address, "bob")
+    other = AddressPool("10.8.0.0/24", state_path=path, slice_index=1, slice_count=2)
+    assert other.get_stats()["active"] == 0
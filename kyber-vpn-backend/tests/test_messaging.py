@@ -0,0 +1,276 @@
+"""Pruebas del servicio de mensajería (pertenencia, lectura y canales)."""
+import asyncio
+import sqlite3
+from importlib import import_module
+
+import pytest
+
+from app.chat.codec import Frame
+from app.chat.messaging import SESSIONS, USER_ROOMS, MessagingService
+from app.chat.store import MAX_SEQ, MessageStore
+from app.core.bus import MemoryBus
+from app.core.state import MemoryBackend, SQLiteBackend
+from app.models.schemas import ChatRoom
+
+
+def _service(tmp_path, state=None) -> MessagingService:
+    return MessagingService(
+        state=state or MemoryBackend(),
+        store=MessageStore(str(tmp_path / "chat.db")),
+        bus=MemoryBus(),
+    )
+
+
+def test_concurrent_joins_keep_every_room(tmp_path):
+    state = SQLiteBackend(str(tmp_path / "state.db"))
+    service = _service(tmp_path, state)
+
+    async def scenario():
+        await state.start()
+        await service.start()
+        rooms = [f"sala{index}" for index in range(20)]
+        for room_id in rooms:
+            await service._save_room(ChatRoom(id=room_id, name=room_id, participants=[], is_group=True))
+        await asyncio.gather(*(service._add_member(room_id, "alice") for room_id in rooms))
+        assert sorted(await service.get_user_room_ids("alice")) == sorted(rooms)
+        await service.stop()
+        await state.close()
+
+    asyncio.run(scenario())
+
+
+def test_legacy_room_lists_are_migrated(tmp_path):
+    state = MemoryBackend()
+    service = _service(tmp_path, state)
+
+    async def scenario():
+        await state.set(USER_ROOMS, "usuario1", ["general", "antigua"])
+        await service.start()
+        assert sorted(await service.get_user_room_ids("usuario1")) == ["antigua", "general"]
+        assert await state.items(USER_ROOMS) == {}
+        await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_group_participants_are_listed_only_when_asked(tmp_path):
+    service = _service(tmp_path)
+
+    async def scenario():
+        await service.start()
+        await service.create_secure_channel("usuario1", "usuario2")
+        rooms = {room["id"]: room for room in await service.get_user_rooms("usuario1")}
+        assert "participants" not in rooms["general"]
+        private = next(room for room in rooms.values() if not room["is_group"])
+        assert sorted(private["participants"]) == ["usuario1", "usuario2"]
+
+        rooms = await service.get_user_rooms("usuario1", with_participants=True)
+        general = next(room for room in rooms if room["id"] == "general")
+        assert sorted(general["participants"]) == ["usuario1", "usuario2"]
+        await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_read_cursor_is_clamped_to_the_room_head(tmp_path):
+    service = _service(tmp_path)
+
+    async def scenario():
+        await service.start()
+        await service.state.set(SESSIONS, "s1", "usuario1")
+        await service.create_message("s1", "general", "uno")
+        assert await service.mark_read("usuario2", "general", MAX_SEQ) == 0
+        await service.create_message("s1", "general", "dos")
+        assert await service.mark_read("usuario2", "general", 0) == 1
+        assert await service.get_unread_counts("usuario2") == {"general": 1}
+        await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_read_route_rejects_sequences_beyond_sqlite_range():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    chat_routes = import_module("app.api.routes.chat")
+    app = FastAPI()
+    app.include_router(chat_routes.router)
+    app.dependency_overrides[chat_routes.get_current_user] = lambda: {"username": "usuario1", "session_id": "s1"}
+    client = TestClient(app)
+    assert client.post("/rooms/general/read", params={"seq": MAX_SEQ + 1}).status_code == 422
+    assert client.get("/rooms/general/messages", params={"after": MAX_SEQ + 1}).status_code == 422
+    assert not chat_routes._valid_seq(MAX_SEQ + 1)
+    assert not chat_routes._valid_seq(True)
+    assert chat_routes._valid_seq(MAX_SEQ)
+
+
+class _Rooms:
+    """Servicio de mensajería mínimo para las rutas: una sala con un participante."""
+
+    async def is_member(self, room_id, username):
+        return room_id == "general" and username == "usuario1"
+
+    async def get_room_messages(self, room_id, limit, before=None, after=None):
+        return [{"id": "m1", "room_id": room_id, "seq": 1, "content": "hola"}]
+
+
+def test_room_messages_are_only_readable_by_members(monkeypatch):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    chat_routes = import_module("app.api.routes.chat")
+    monkeypatch.setattr(chat_routes, "messaging_service", _Rooms())
+    app = FastAPI()
+    app.include_router(chat_routes.router)
+    user = {"username": "usuario1", "session_id": "s1"}
+    app.dependency_overrides[chat_routes.get_current_user] = lambda: user
+    client = TestClient(app)
+
+    response = client.get("/rooms/general/messages")
+    assert response.status_code == 200 and response.json()[0]["content"] == "hola"
+    assert client.get("/rooms/privada/messages").status_code == 403
+    user["username"] = "intruso"
+    assert client.get("/rooms/general/messages").status_code == 403
+
+
+class _Connection:
+    """Conexión local mínima: acumula las tramas enviadas."""
+
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame, key=None):
+        self.frames.append(frame)
+
+
+def test_sync_reads_past_a_stale_cache(tmp_path):
+    path = str(tmp_path / "chat.db")
+    state = MemoryBackend()
+    # Dos workers cuyo bus no entrega: el buffer del primero se queda atrás
+    first = MessagingService(state=state, store=MessageStore(path), bus=MemoryBus())
+    second = MessagingService(state=state, store=MessageStore(path), bus=MemoryBus())
+
+    async def scenario():
+        await first.start()
+        await second.start()
+        await state.set(SESSIONS, "s1", "usuario1")
+        await first.attach_connection("usuario1", _Connection())
+        await first.create_message("s1", "general", "uno")
+        for content in ("dos", "tres", "cuatro"):
+            await second.create_message("s1", "general", content)
+
+        frames = [frame async for frame in first.iter_missed("usuario1", "general", 1)]
+        assert [m["seq"] for frame in frames for m in frame["messages"]] == [2, 3, 4]
+        assert frames[-1]["done"] and all(frame["type"] == "sync" for frame in frames)
+
+        # Sin mensajes legibles hasta la cabeza: resync, nunca un done vacío
+        conn = sqlite3.connect(path)
+        conn.execute("DELETE FROM messages WHERE seq > 2")
+        conn.commit()
+        conn.close()
+        frames = [frame async for frame in first.iter_missed("usuario1", "general", 2)]
+        assert frames == [{"type": "resync", "room_id": "general", "head": 4}]
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(scenario())
+
+
+def test_secure_channel_rejects_self_and_survives_cancellation(tmp_path):
+    service = _service(tmp_path)
+    opened = asyncio.Event()
+
+    async def slow_open(room_id, first, second):
+        opened.set()
+        await asyncio.sleep(10)
+
+    async def scenario():
+        await service.start()
+        result = await service.create_secure_channel("usuario1", "usuario1")
+        assert result["success"] is False
+
+        service._open_private_room = slow_open
+        creator = asyncio.ensure_future(service.create_secure_channel("usuario1", "usuario2"))
+        await opened.wait()
+        waiter = asyncio.ensure_future(service.create_secure_channel("usuario2", "usuario1"))
+        await asyncio.sleep(0)
+        creator.cancel()
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(waiter, 1.0)
+        assert service._channel_creations == {}
+        await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_connection_index_follows_attach_and_detach(tmp_path):
+    service = _service(tmp_path)
+    topics = service.bus._topics
+
+    async def scenario():
+        await service.start()
+        first, second, other = _Connection(), _Connection(), _Connection()
+        await service.attach_connection("usuario1", first)
+        await service.attach_connection("usuario1", second)
+        await service.attach_connection("usuario2", other)
+        assert service.active_connections["general"] == {first, second, other}
+        assert service._connection_rooms[first] == {"general"}
+        # Una referencia del bus por cada conexión indexada
+        assert topics["general"] == 3
+
+        # Una sala nueva solo indexa las conexiones de sus participantes, una vez
+        await service._save_room(ChatRoom(id="dev", name="dev", participants=["usuario1"], is_group=True))
+        assert await service.get_room_connections("dev") == {first, second}
+        assert service._index_room("dev", ["usuario1"]) == {first, second}
+        assert topics["dev"] == 2
+        assert service._connection_rooms[first] == {"general", "dev"}
+        assert await service.get_room_connections("inexistente") == set()
+
+        service.detach_connection("usuario1", first)
+        assert topics["general"] == 2 and topics["dev"] == 1
+        assert first not in service._connection_rooms
+        service.detach_connection("usuario1", second)
+        assert "dev" not in topics and topics["general"] == 1
+        assert "usuario1" not in service.user_connections
+        service.detach_connection("usuario2", other)
+        assert "general" not in topics
+        # Desconectar dos veces no descuadra las referencias
+        service.detach_connection("usuario2", other)
+        assert service.active_connections["general"] == set()
+        await service.stop()
+
+    asyncio.run(scenario())
+
+
+def test_broadcast_reaches_local_and_remote_connections(tmp_path):
+    state = MemoryBackend()
+    first = MessagingService(state=state, store=MessageStore(str(tmp_path / "a.db")), bus=MemoryBus())
+    second = MessagingService(state=state, store=MessageStore(str(tmp_path / "b.db")), bus=MemoryBus())
+
+    async def scenario():
+        for service in (first, second):
+            await service.bus.start()
+            await service.start()
+        sender, local, remote = _Connection(), _Connection(), _Connection()
+        await first.attach_connection("usuario1", sender)
+        await first.attach_connection("usuario2", local)
+        await second.attach_connection("usuario2", remote)
+
+        frame = Frame({"type": "new_message", "message": {"room_id": "general", "content": "hola"}})
+        first.broadcast("general", frame, exclude=sender)
+        await asyncio.sleep(0)
+        assert sender.frames == [] and local.frames == [frame]
+        # El otro worker recibe la trama por el bus, sin volver a entregarla aquí
+        assert [received.obj for received in remote.frames] == [frame.obj]
+        assert len(local.frames) == 1
+
+        # Sin conexiones locales el worker se da de baja y deja de recibir
+        second.detach_connection("usuario2", remote)
+        first.broadcast("general", frame)
+        await asyncio.sleep(0)
+        assert len(remote.frames) == 1 and len(sender.frames) == 1
+        for service in (first, second):
+            await service.stop()
+            await service.bus.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,165 @@
+"""Pruebas del registro de servidores contra servidores locales de prueba."""
+import asyncio
+import random
+import socket
+from importlib import import_module
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.core.state import MemoryBackend
+from app.network.registry import ServerRegistry
+
+# El paquete de rutas exporta los routers con el nombre de cada módulo
+registry_module = import_module("app.network.registry")
+servers_routes = import_module("app.api.routes.servers")
+
+
+def _server(server_id: str, port: int, **extra):
+    return dict({"id": server_id, "name": server_id, "location": "local", "ip": "127.0.0.1",
+                 "port": port, "status": "online", "latency": 0, "capacity": 10}, **extra)
+
+
+def _closed_port() -> int:
+    """Puerto local en el que no escucha nadie."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_health_checks_against_local_servers():
+    async def scenario():
+        listener = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        registry = ServerRegistry(
+            [_server("up", port), _server("down", _closed_port()),
+             _server("paused", _closed_port(), status="maintenance")],
+            timeout=1.0,
+        )
+        version = registry.version
+        await registry.check_all()
+
+        stats = registry.get_stats()
+        assert stats["up"]["status"] == "online" and stats["up"]["rtt"]["samples"] == 1
+        assert stats["down"]["status"] == "offline" and stats["down"]["availability"] == 0.0
+        assert stats["paused"]["status"] == "maintenance" and stats["paused"]["last_check"] == 0.0
+        assert registry.version > version
+        assert registry.is_accepting("up") and not registry.is_accepting("down")
+
+        # El servidor vuelve: la siguiente ronda lo marca en línea
+        listener.close()
+        await listener.wait_closed()
+        await registry.check_all()
+        assert registry.get_stats()["up"]["status"] == "offline"
+        listener = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", port)
+        await registry.check_all()
+        assert registry.get_stats()["up"]["status"] == "online"
+        assert registry.get_stats()["up"]["availability"] == round(2 / 3, 3)
+        listener.close()
+        await listener.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_etag_and_not_modified(monkeypatch):
+    registry = ServerRegistry([_server("a", 1), _server("b", 2)])
+    monkeypatch.setattr(servers_routes, "server_registry", registry)
+    app = FastAPI()
+    app.include_router(servers_routes.router, prefix="/api/servers")
+    client = TestClient(app)
+
+    response = client.get("/api/servers/")
+    etag = response.headers["etag"]
+    assert response.status_code == 200
+    assert [server["id"] for server in response.json()] == ["a", "b"]
+
+    cached = client.get("/api/servers/", headers={"If-None-Match": f'"otro", {etag}'})
+    assert cached.status_code == 304 and cached.content == b""
+    assert cached.headers["etag"] == etag
+
+    # Un cambio visible (la ocupación pasa al 10 %) genera otro ETag
+    registry.session_opened("a")
+    changed = client.get("/api/servers/", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["etag"] != etag
+    assert changed.json()[0]["load"] == 10
+    # Sin cambios, la respuesta serializada se reutiliza
+    assert registry.render()[1] is registry.render()[1]
+
+
+def test_p2c_placement_balances_by_capacity():
+    random.seed(7)
+    registry = ServerRegistry([
+        _server("small", 1, capacity=100),
+        _server("large", 2, capacity=300),
+        _server("far", 3, capacity=300, latency=100),
+    ])
+    for _ in range(300):
+        server_id = registry.choose(rtt_scale_ms=50.0)
+        registry.session_opened(server_id)
+
+    sessions = {server_id: registry.get_entry(server_id).sessions
+                for server_id in ("small", "large", "far")}
+    assert sum(sessions.values()) == 300
+    # La carga relativa queda equilibrada y la latencia penaliza al lejano
+    assert sessions["large"] > sessions["far"]
+    assert abs(sessions["large"] / 300 - sessions["small"] / 100) < 0.15
+
+
+def test_placement_skips_full_and_offline_servers():
+    registry = ServerRegistry([_server("a", 1, capacity=1), _server("b", 2, capacity=1)])
+    registry.session_opened(registry.choose())
+    remaining = registry.choose()
+    registry.session_opened(remaining)
+    assert registry.choose() is None
+    assert not registry.is_accepting("a") and not registry.is_accepting("b")
+
+    assert 15 <= registry.retry_after() <= 45
+
+    registry.session_closed("a")
+    assert registry.choose() == "a"
+    registry.get_entry("a").record(False, None)
+    registry._update_accepting("a")
+    assert registry.choose() is None
+
+
+def test_sessions_only_invalidate_on_placement_changes():
+    registry = ServerRegistry([_server("a", 1, capacity=100)])
+    version = registry.version
+    for _ in range(9):
+        registry.session_opened("a")
+    assert registry.version == version  # Sigue por debajo del 10 %
+    registry.session_opened("a")
+    assert registry.version == version + 1 and registry.get("a")["load"] == 10
+    registry.session_closed("a")
+    assert registry.version == version + 2
+
+
+def test_load_is_shared_between_workers(monkeypatch):
+    monkeypatch.setattr(registry_module, "state_backend", MemoryBackend())
+    servers = [_server("a", 1, capacity=2), _server("b", 2, capacity=2)]
+    first = ServerRegistry(servers, worker="0", load_ttl=10.0)
+    second = ServerRegistry(servers, worker="1", load_ttl=10.0)
+
+    async def scenario():
+        first.session_opened("a")
+        first.session_opened("a")
+        await first.sync_load()
+        await second.sync_load()
+        # El segundo worker ve lleno el servidor que ocupa el primero
+        assert second.get_entry("a").sessions == 2 and not second.is_accepting("a")
+        assert second.choose() == "b"
+
+        first.session_closed("a")
+        await first.sync_load()
+        await second.sync_load()
+        assert second.get_entry("a").sessions == 1 and second.is_accepting("a")
+
+        # Un worker que deja de refrescar su recuento deja de contar
+        monkeypatch.setattr(registry_module.time, "time", lambda: first._published_at + 11.0)
+        await second.sync_load()
+        assert second.get_entry("a").sessions == 0
+
+        await first.withdraw_load()
+        assert "0" not in await registry_module.state_backend.items(registry_module.SERVER_LOAD)
+
+    asyncio.run(scenario())
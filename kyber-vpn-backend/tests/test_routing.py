@@ -0,0 +1,85 @@
+"""Pruebas de la tabla de rutas LPM."""
+import ipaddress
+
+import numpy as np
+
+from app.network.routing import RoutingTable, addresses_to_array, packet_destination
+
+
+def test_longest_prefix_wins():
+    table = RoutingTable()
+    table.insert("10.0.0.0/8", "amplia")
+    table.insert("10.8.0.0/24", "subred")
+    table.insert("10.8.0.2", "sesion")
+
+    assert table.lookup("10.8.0.2") == "sesion"
+    assert table.lookup("10.8.0.3") == "subred"
+    assert table.lookup("10.9.0.1") == "amplia"
+    assert table.lookup("192.168.1.1") is None
+
+
+def test_default_route_and_ipv6():
+    table = RoutingTable()
+    table.insert("0.0.0.0/0", "defecto4")
+    table.insert("fd00::/64", "ula")
+    table.insert("fd00::2/128", "sesion")
+
+    assert table.lookup("8.8.8.8") == "defecto4"
+    assert table.lookup("fd00::2") == "sesion"
+    assert table.lookup("fd00::3") == "ula"
+    assert table.lookup("fd01::1") is None
+
+
+def test_replace_and_remove_prunes_nodes():
+    table = RoutingTable()
+    empty_nodes = table.get_stats()["ipv4_nodes"]
+    table.insert("10.8.0.0/24", "a")
+    table.insert("10.8.0.0/24", "b")
+    assert len(table) == 1
+    assert table.lookup("10.8.0.7") == "b"
+
+    assert table.remove("10.8.0.0/24") == "b"
+    assert table.remove("10.8.0.0/24") is None
+    assert table.lookup("10.8.0.7") is None
+    assert table.get_stats()["ipv4_nodes"] == empty_nodes
+
+
+def test_removed_slot_is_reused():
+    table = RoutingTable()
+    table.insert("10.8.0.2", "a")
+    table.remove("10.8.0.2")
+    table.insert("10.8.0.3", "b")
+    assert table.lookup("10.8.0.2") is None
+    assert table.lookup("10.8.0.3") == "b"
+
+
+def test_lookup_batch_matches_single_lookups():
+    table = RoutingTable()
+    table.insert("10.0.0.0/8", "amplia")
+    table.insert("10.8.0.0/24", "subred")
+    table.insert("10.8.0.2", "sesion")
+    addresses = ["10.8.0.2", "10.8.0.3", "10.9.0.1", "192.168.1.1"]
+
+    result = table.lookup_batch(addresses)
+    assert list(result) == [table.lookup(address) for address in addresses]
+
+    table6 = RoutingTable()
+    table6.insert("fd00::/64", "ula")
+    table6.insert("fd00::2/128", "sesion")
+    addresses6 = ["fd00::2", "fd00::3", "fe80::1"]
+    result6 = table6.lookup_batch(addresses_to_array(addresses6, 6), version=6)
+    assert list(result6) == ["sesion", "ula", None]
+
+
+def test_lookup_by_integer_and_packet_destination():
+    table = RoutingTable()
+    table.insert("10.8.0.2", "sesion")
+    header = bytearray(20)
+    header[0] = 0x45
+    header[16:20] = ipaddress.ip_address("10.8.0.2").packed
+
+    version, key = packet_destination(bytes(header))
+    assert version == 4
+    assert table.lookup(key, version) == "sesion"
+    assert packet_destination(b"\x45") is None
+    assert np.array_equal(addresses_to_array(["10.8.0.2"]), np.array([key], dtype=np.uint32))
@@ -0,0 +1,91 @@
+"""Pruebas de la tabla de sesiones VPN."""
+import asyncio
+
+import pytest
+
+from app.network.sessions import Session, SessionTable
+
+
+def _session(session_id: str, user: str, vpn_ip: str) -> Session:
+    return Session(session_id, user, "server1", vpn_ip, bytes(32))
+
+
+def test_table_indexes_by_id_ip_and_user():
+    table = SessionTable()
+    table.add(_session("a", "alice", "10.8.0.2"))
+    table.add(_session("b", "alice", "10.8.0.3"))
+
+    assert table.get("a").vpn_ip == "10.8.0.2"
+    assert table.get_by_ip("10.8.0.3").id == "b"
+    assert {session.id for session in table.get_by_user("alice")} == {"a", "b"}
+    with pytest.raises(ValueError):
+        table.add(_session("c", "bob", "10.8.0.2"))
+
+    table.remove("a")
+    assert table.get("a") is None
+    assert not table.ip_in_use("10.8.0.2")
+    assert [session.id for session in table.get_by_user("alice")] == ["b"]
+
+
+def test_cipher_follows_the_session_key():
+    session = _session("a", "alice", "10.8.0.2")
+    assert session._cipher is None  # Sin tráfico no se construye
+    cipher = session.cipher
+    assert session.cipher is cipher
+    nonce = (1).to_bytes(12, "big")
+    assert cipher.decrypt(nonce, cipher.encrypt(b"ping", nonce=nonce)["ciphertext"]) == b"ping"
+
+    session.key = b"\x01" * 32
+    assert session.cipher is not cipher
+    assert session.cipher.key == b"\x01" * 32
+
+    session.key = b""
+    assert session.cipher is None
+
+
+def test_snapshot_requires_an_explicit_node_key(monkeypatch, tmp_path):
+    from app.core.config import settings
+    from app.network.vpn import VPNManager
+
+    monkeypatch.setattr(settings, "SNAPSHOT_PATH", str(tmp_path / "sessions.snap"))
+    monkeypatch.setattr(settings, "SNAPSHOT_NODE_KEY", "")
+    assert VPNManager().snapshot is None
+
+    monkeypatch.setattr(settings, "SNAPSHOT_NODE_KEY", "clave-de-nodo")
+    assert VPNManager().snapshot is not None
+
+
+def test_session_listing_hides_session_ids(monkeypatch):
+    from app.network.vpn import VPNManager
+
+    manager = VPNManager()
+    manager.sessions.add(_session("secreto", "alice", "10.8.0.2"))
+
+    async def scenario():
+        return await manager.list_sessions()
+
+    listing = asyncio.run(scenario())
+    assert listing and all("sessionId" not in entry for entry in listing)
+    assert "secreto" not in repr(listing)
+
+
+def test_snapshot_file_is_keyed_by_worker_index(monkeypatch, tmp_path):
+    from app.core.config import settings
+    from app.network.snapshot import SessionSnapshot, derive_node_key
+    from app.network.vpn import VPNManager
+
+    monkeypatch.setattr(settings, "SNAPSHOT_PATH", str(tmp_path / "sessions.snap"))
+    monkeypatch.setattr(settings, "SNAPSHOT_NODE_KEY", "clave-de-nodo")
+    monkeypatch.setattr(settings, "WORKER_COUNT", 4)
+    monkeypatch.setattr(settings, "WORKER_INDEX", 2)
+    snapshot = VPNManager().snapshot
+    assert snapshot.path == str(tmp_path / "sessions-2.snap")
+
+    # Un worker reiniciado con el mismo índice vuelve al mismo fichero, pero
+    # no mientras otro proceso lo tenga abierto
+    snapshot.open()
+    try:
+        with pytest.raises(RuntimeError):
+            SessionSnapshot(snapshot.path, derive_node_key("clave-de-nodo")).open()
+    finally:
+        snapshot.close()
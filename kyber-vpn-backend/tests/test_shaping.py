@@ -0,0 +1,107 @@
+"""Pruebas del shaping por sesión y de las cuotas."""
+import asyncio
+
+from app.network.shaping import QuotaStore, ShapingDecision, TokenBucket, TrafficShaper
+
+
+def test_token_bucket_refills_with_elapsed_time():
+    bucket = TokenBucket(rate=1000, burst=1000, now_ns=0)
+    assert bucket.consume(1000, now_ns=0)
+    assert not bucket.consume(1, now_ns=0)
+    assert bucket.consume(500, now_ns=500_000_000)
+
+
+def test_quota_store_opens_on_start(tmp_path):
+    path = tmp_path / "quota.db"
+    shaper = TrafficShaper(QuotaStore(str(path)), default_quota=100)
+    assert not path.exists()
+
+    async def scenario():
+        async def transmit(session_id, packet):
+            pass
+
+        await shaper.start(transmit)
+        await shaper.add_session("s1", "alice")
+        assert shaper.admit("s1", b"x" * 60) == ShapingDecision.SEND
+        assert shaper.admit("s1", b"x" * 60) == ShapingDecision.DROPPED
+        await shaper.stop()
+
+    asyncio.run(scenario())
+    assert path.exists()
+    store = QuotaStore(str(path))
+    store.open()
+    assert store.get_usage("alice", shaper._period) == 60
+    store.close()
+
+
+def test_flush_loop_survives_transmit_errors():
+    shaper = TrafficShaper(QuotaStore(":memory:"), policy="queue", default_rate=100,
+                           default_burst=100, flush_interval=0.01)
+    sent = []
+
+    async def scenario():
+        async def transmit(session_id, packet):
+            sent.append(packet)
+            if len(sent) == 1:
+                raise OSError("interfaz caída")
+
+        await shaper.start(transmit)
+        await shaper.add_session("s1", "alice")
+        assert shaper.admit("s1", b"a" * 100) == ShapingDecision.SEND
+        assert shaper.admit("s1", b"b" * 2) == ShapingDecision.QUEUED
+        assert shaper.admit("s1", b"c" * 2) == ShapingDecision.QUEUED
+        for _ in range(100):
+            if len(sent) >= 2:
+                break
+            await asyncio.sleep(0.02)
+        assert not shaper._flush_task.done()
+        await shaper.stop()
+
+    asyncio.run(scenario())
+    assert sent == [b"b" * 2, b"c" * 2]
+
+
+def test_quota_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "quota.db")
+    first = TrafficShaper(QuotaStore(path), default_quota=100)
+    second = TrafficShaper(QuotaStore(path), default_quota=100)
+
+    async def scenario():
+        async def transmit(session_id, packet):
+            pass
+
+        for shaper in (first, second):
+            await shaper.start(transmit)
+            await shaper.add_session("s", "alice")
+        assert first.admit("s", b"x" * 60) == ShapingDecision.SEND
+        assert second.admit("s", b"x" * 30) == ShapingDecision.SEND
+        await first.flush()
+        await second.flush()
+        await first.flush()
+        # Cada worker ve el consumo del otro
+        assert first.admit("s", b"x" * 20) == ShapingDecision.DROPPED
+        assert second.admit("s", b"x" * 20) == ShapingDecision.DROPPED
+        assert first.admit("s", b"x" * 10) == ShapingDecision.SEND
+        for shaper in (first, second):
+            await shaper.stop()
+
+    asyncio.run(scenario())
+
+
+def test_quota_store_runs_on_one_thread(tmp_path):
+    import threading
+
+    store = QuotaStore(str(tmp_path / "quota.db"))
+    threads = set()
+
+    def usage(account):
+        threads.add(threading.current_thread())
+        return store.get_usage(account, "2024-01")
+
+    async def scenario():
+        await store.call(store.open)
+        await asyncio.gather(*(store.call(usage, f"u{index}") for index in range(20)))
+        await store.aclose()
+
+    asyncio.run(scenario())
+    assert len(threads) == 1 and threading.main_thread() not in threads
@@ -0,0 +1,119 @@
+"""Pruebas del almacén de estado compartido en SQLite."""
+import asyncio
+import threading
+
+from app.core import state
+from app.core.state import SQLiteBackend
+
+
+def test_other_worker_write_only_invalidates_that_key(tmp_path):
+    path = str(tmp_path / "state.db")
+
+    async def scenario():
+        first, second = SQLiteBackend(path), SQLiteBackend(path)
+        await first.start()
+        await second.start()
+        await first.set("users", "alice", {"n": 1})
+        await first.set("rooms", "general", {"name": "General"})
+        assert await second.get("users", "alice") == {"n": 1}
+        assert await second.get("rooms", "general") == {"name": "General"}
+
+        await first.set("users", "alice", {"n": 2})
+        assert await second.get("users", "alice") == {"n": 2}
+        # La otra clave sigue en caché
+        assert ("rooms", "general") in second._cache
+        assert (await second.items("users")) == {"alice": {"n": 2}}
+
+        assert await first.delete("users", "alice")
+        assert await second.get("users", "alice") is None
+        assert await second.items("users") == {}
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+def test_pruned_log_invalidates_everything(tmp_path, monkeypatch):
+    monkeypatch.setattr(state, "STATE_LOG_RETAIN", 2)
+    monkeypatch.setattr(state, "STATE_LOG_PRUNE_EVERY", 1)
+    path = str(tmp_path / "state.db")
+
+    async def scenario():
+        first, second = SQLiteBackend(path), SQLiteBackend(path)
+        await first.start()
+        await second.start()
+        await first.set("rooms", "general", 1)
+        assert await second.get("rooms", "general") == 1
+        for i in range(5):
+            await first.set("users", f"u{i}", i)
+        await first.set("rooms", "general", 2)
+        assert await second.get("rooms", "general") == 2
+        await first.close()
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_calls_run_off_the_event_loop(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "state.db"))
+    threads = []
+    original = backend._set
+
+    def spy(*args):
+        threads.append(threading.current_thread())
+        return original(*args)
+
+    backend._set = spy
+
+    async def scenario():
+        await backend.start()
+        await backend.set("users", "alice", 1)
+        await backend.close()
+
+    asyncio.run(scenario())
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_sqlite_items_returns_a_copy(tmp_path):
+    async def scenario():
+        backend = SQLiteBackend(str(tmp_path / "state.db"))
+        await backend.start()
+        await backend.set("users", "alice", 1)
+        listed = await backend.items("users")
+        await backend.set("users", "bob", 2)
+        # La escritura posterior no altera lo ya devuelto (ni al revés)
+        assert listed == {"alice": 1}
+        listed["eve"] = 3
+        assert await backend.items("users") == {"alice": 1, "bob": 2}
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_redis_read_racing_an_invalidation_is_not_cached():
+    backend = state.RedisBackend()
+    backend._subscribed = True
+    stored = {"alice": b'{"n":1}'}
+
+    async def execute(*args):
+        if args[0] == "HGET":
+            stale = stored[args[2]]
+            # Otro worker escribe y su invalidación llega antes que la respuesta
+            stored[args[2]] = b'{"n":2}'
+            backend._invalidate("users", args[2])
+            return stale
+        if args[0] == "HGETALL":
+            stale = [b"alice", stored["alice"]]
+            backend._invalidate("users", "alice")
+            return stale
+        raise AssertionError(args)
+
+    backend._conn.execute = execute
+
+    async def scenario():
+        assert await backend.get("users", "alice") == {"n": 1}
+        assert ("users", "alice") not in backend._cache
+        assert await backend.items("users") == {"alice": {"n": 2}}
+        assert "users" not in backend._items_cache
+
+    asyncio.run(scenario())
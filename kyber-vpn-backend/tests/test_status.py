@@ -0,0 +1,151 @@
+"""Pruebas del flujo de estado de las sesiones (deltas, SSE y WebSocket)."""
+import asyncio
+import json
+from importlib import import_module
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from app.network.status import STATUS_HISTORY, StatusChannel, StatusHub
+
+# El paquete de rutas exporta los routers con el nombre de cada módulo
+connection_routes = import_module("app.api.routes.connection")
+
+
+class _Manager:
+    """Gestor VPN mínimo: sesiones como diccionarios de estado."""
+
+    def __init__(self):
+        self.sessions = {}
+
+    def resolve_session(self, session_id):
+        return self.sessions.get(session_id)
+
+    def status_fields(self, session):
+        if session is None:
+            return {"connected": False, "bytesSent": 0}
+        return dict(session, connected=True)
+
+    async def call_owner(self, session_id, method, **kwargs):
+        session = self.sessions.get(session_id)
+        return self.status_fields(session) if session is not None else None
+
+
+def test_channel_encodes_deltas_from_each_version():
+    channel = StatusChannel("s")
+    assert channel.publish({"a": 1, "b": 1})
+    assert not channel.publish({"a": 1, "b": 1})  # Sin cambios no hay versión nueva
+    channel.publish({"a": 1, "b": 2})
+    channel.publish({"a": 3, "b": 2})
+
+    assert json.loads(channel.frame(0)[0]) == {"seq": 3, "full": True, "status": {"a": 3, "b": 2}}
+    assert json.loads(channel.frame(2)[0]) == {"seq": 3, "since": 2, "delta": {"a": 3}}
+    assert json.loads(channel.frame(1)[0]) == {"seq": 3, "since": 1, "delta": {"a": 3, "b": 2}}
+    # La trama de cada versión de partida se serializa una sola vez
+    frame, encoded = channel.frame(2)
+    assert not encoded and frame == channel.frame(2)[0]
+
+    # Una versión que ya no se conserva recibe el estado completo
+    for value in range(STATUS_HISTORY + 1):
+        channel.publish({"a": 10 + value, "b": 2})
+    assert json.loads(channel.frame(1)[0])["full"]
+
+
+def test_subscription_gets_full_then_deltas_and_ends_with_the_session():
+    manager = _Manager()
+    manager.sessions["s"] = {"bytesSent": 0}
+    hub = StatusHub(manager, max_rate=1000.0)
+
+    async def scenario():
+        frames = hub.subscribe("s")
+        assert json.loads(await frames.__anext__())["status"] == {"bytesSent": 0, "connected": True}
+        assert hub.get_stats()["subscribers"] == 1
+
+        manager.sessions["s"] = {"bytesSent": 10}
+        hub._sample()
+        assert json.loads(await frames.__anext__())["delta"] == {"bytesSent": 10}
+
+        del manager.sessions["s"]
+        hub._sample()
+        assert json.loads(await frames.__anext__())["delta"] == {"bytesSent": 0, "connected": False}
+        with pytest.raises(StopAsyncIteration):
+            await frames.__anext__()
+        assert hub._channels == {}
+
+        # Una sesión inexistente recibe un único estado desconectado
+        assert [json.loads(frame)["status"]["connected"] async for frame in hub.subscribe("x")] == [False]
+
+    asyncio.run(scenario())
+
+
+def test_subscribers_share_frames_and_release_the_channel():
+    manager = _Manager()
+    manager.sessions["s"] = {"bytesSent": 0}
+    hub = StatusHub(manager, max_rate=1000.0)
+
+    async def scenario():
+        first, second = hub.subscribe("s"), hub.subscribe("s")
+        await first.__anext__()
+        await second.__anext__()
+        manager.sessions["s"] = {"bytesSent": 5}
+        hub._sample()
+        assert await first.__anext__() == await second.__anext__()
+        assert hub.get_stats()["framesEncoded"] == 2 and hub.get_stats()["framesSent"] == 4
+
+        await first.aclose()
+        assert hub._channels["s"].subscribers == 1
+        await second.aclose()
+        assert hub._channels == {}
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def client(monkeypatch):
+    manager = _Manager()
+    hub = StatusHub(manager, max_rate=1000.0)
+    monkeypatch.setattr(connection_routes, "vpn_manager", manager)
+    monkeypatch.setattr(connection_routes, "status_hub", hub)
+    app = FastAPI()
+    app.include_router(connection_routes.router, prefix="/api")
+    return TestClient(app), manager, hub
+
+
+def test_sse_stream_frames_and_teardown(client):
+    _, manager, hub = client
+    manager.sessions["s"] = {"bytesSent": 0}
+
+    async def scenario():
+        response = await connection_routes.stream_vpn_status("s", None)
+        assert response.media_type == "text/event-stream"
+        body = response.body_iterator
+        first = await body.__anext__()
+        assert first.startswith("data: ") and first.endswith("\n\n")
+        assert json.loads(first[len("data: "):])["full"]
+
+        # El cliente se va: cerrar el flujo libera el canal
+        await body.aclose()
+        assert hub._channels == {}
+
+    asyncio.run(scenario())
+
+    test_client = client[0]
+    assert test_client.get("/api/status/stream", params={"session_id": "x"}).status_code == 404
+
+
+def test_websocket_stream_and_client_disconnect(client):
+    test_client, manager, hub = client
+    manager.sessions["s"] = {"bytesSent": 0}
+
+    with test_client.websocket_connect("/api/status/ws?session_id=s") as websocket:
+        assert json.loads(websocket.receive_text())["status"]["bytesSent"] == 0
+        assert hub.get_stats()["subscribers"] == 1
+    # Sin más cambios de estado, el cierre del cliente basta para liberar el canal
+    assert hub._channels == {}
+
+    with pytest.raises(WebSocketDisconnect) as closed:
+        with test_client.websocket_connect("/api/status/ws?session_id=x") as websocket:
+            websocket.receive_text()
+    assert closed.value.code == 1008
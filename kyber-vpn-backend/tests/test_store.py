@@ -0,0 +1,118 @@
+"""Pruebas del almacén de mensajes del chat."""
+import asyncio
+import sqlite3
+import uuid
+from datetime import datetime
+
+import pytest
+
+from app.chat.store import MessageStore
+
+
+def _message(room_id: str, content: str = "hola", sender: str = "alice"):
+    return {
+        "id": str(uuid.uuid4()),
+        "sender": sender,
+        "room_id": room_id,
+        "content": content,
+        "timestamp": datetime.now().isoformat(),
+    }
+
+
+def test_group_commit_assigns_sequences_per_room(tmp_path):
+    store = MessageStore(str(tmp_path / "chat.db"))
+
+    async def scenario():
+        await store.open()
+        seqs = await asyncio.gather(*(
+            store.append(_message("general" if i % 2 else "dev", str(i))) for i in range(10)
+        ))
+        assert sorted(seqs[1::2]) == [1, 2, 3, 4, 5]
+        assert sorted(seqs[0::2]) == [1, 2, 3, 4, 5]
+        assert await store.head("general") == 5
+        assert [m["content"] for m in await store.fetch("general", 2)] == ["7", "9"]
+        assert [m["seq"] for m in await store.fetch("general", 2, before=3)] == [1, 2]
+        assert [m["seq"] for m in await store.fetch("general", 10, after=3)] == [4, 5]
+        await store.close()
+
+    asyncio.run(scenario())
+    assert store.get_stats()["commits"] < 10
+
+
+def test_unread_counts_include_pending_cursors(tmp_path):
+    store = MessageStore(str(tmp_path / "chat.db"))
+
+    async def scenario():
+        await store.open()
+        for _ in range(4):
+            await store.append(_message("general"))
+        assert await store.unread_counts("bob", ["general", "vacia"]) == {"general": 4, "vacia": 0}
+        store.mark_read("bob", "general", 3)
+        assert await store.unread_counts("bob", ["general"]) == {"general": 1}
+        store.mark_read("bob", "general", 1)  # Los cursores no retroceden
+        await store.close()
+
+    asyncio.run(scenario())
+
+    async def reopened():
+        again = MessageStore(str(tmp_path / "chat.db"))
+        await again.open()
+        assert await again.unread_counts("bob", ["general"]) == {"general": 1}
+        await again.close()
+
+    asyncio.run(reopened())
+
+
+def test_failed_batch_is_rolled_back_and_reported(tmp_path):
+    store = MessageStore(str(tmp_path / "chat.db"))
+
+    async def scenario():
+        await store.open()
+        broken = _message("general")
+        del broken["sender"]
+        results = await asyncio.gather(
+            store.append(_message("general")), store.append(broken), return_exceptions=True
+        )
+        assert all(isinstance(result, KeyError) for result in results)
+
+        with pytest.raises(ValueError):
+            store.mark_read("bob", "general", 2 ** 63)
+        # Un error fuera de SQLite a mitad de la transacción también se deshace
+        store._cursors[("bob", "general")] = 2 ** 64
+        with pytest.raises(OverflowError):
+            await store.append(_message("general"))
+
+        # La transacción se deshizo: el almacén sigue escribiendo
+        assert await store.append(_message("general")) == 1
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_waiting_for_another_writer_does_not_block_the_loop(tmp_path):
+    path = str(tmp_path / "chat.db")
+    store = MessageStore(path)
+
+    async def scenario():
+        await store.open()
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.ensure_future(ticker())
+        append = asyncio.ensure_future(store.append(_message("general")))
+        await asyncio.sleep(0.2)
+        assert not append.done() and ticks >= 10
+        other.execute("ROLLBACK")
+        other.close()
+        assert await append == 1
+        task.cancel()
+        await store.close()
+
+    asyncio.run(scenario())
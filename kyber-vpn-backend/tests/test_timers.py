@@ -0,0 +1,91 @@
+"""Pruebas de la rueda de temporizadores."""
+import asyncio
+
+from app.network.timers import WHEEL_SLOTS, TimerWheel
+
+
+def test_one_shot_and_periodic_timers_fire_on_time():
+    wheel = TimerWheel(tick=1.0)
+    fired = []
+    wheel.schedule(3, fired.append, "once")
+    periodic = wheel.schedule_periodic(2, fired.append, "every")
+
+    wheel.advance(6)
+    assert fired == ["every", "once", "every", "every"]
+    wheel.cancel(periodic)
+    wheel.advance(10)
+    assert len(fired) == 4
+    assert len(wheel) == 0
+
+
+def test_long_delays_cascade_through_the_levels():
+    wheel = TimerWheel(tick=1.0)
+    fired = []
+    for delay in (WHEEL_SLOTS - 1, WHEEL_SLOTS, WHEEL_SLOTS ** 2 + 5):
+        wheel.schedule(delay, lambda delay=delay: fired.append((delay, wheel._current)))
+
+    wheel.advance(WHEEL_SLOTS ** 2 + 10)
+    assert fired == [(delay, delay) for delay in (WHEEL_SLOTS - 1, WHEEL_SLOTS, WHEEL_SLOTS ** 2 + 5)]
+
+
+def test_callback_may_cancel_or_move_timers_in_its_own_slot():
+    wheel = TimerWheel(tick=1.0)
+    fired = []
+    timers = {}
+
+    def first():
+        fired.append("first")
+        wheel.cancel(timers["second"])
+        wheel.reschedule(timers["third"], 5)
+        wheel.schedule(1, fired.append, "new")
+
+    timers["first"] = wheel.schedule(2, first)
+    timers["second"] = wheel.schedule(2, fired.append, "second")
+    timers["third"] = wheel.schedule(2, fired.append, "third")
+    timers["fourth"] = wheel.schedule(2, fired.append, "fourth")
+
+    wheel.advance(2)
+    assert fired == ["first", "fourth"]
+    wheel.advance(5)
+    assert fired == ["first", "fourth", "new", "third"]
+    assert len(wheel) == 0
+
+
+def test_failing_callback_does_not_stop_the_wheel():
+    wheel = TimerWheel(tick=1.0)
+    fired = []
+
+    def broken():
+        raise RuntimeError("fallo")
+
+    wheel.schedule_periodic(1, broken)
+    wheel.schedule_periodic(1, fired.append, "ok")
+    wheel.advance(3)
+    assert fired == ["ok", "ok", "ok"]
+
+
+def test_running_wheel_survives_and_skips_overlapping_coroutines():
+    async def scenario():
+        wheel = TimerWheel(tick=0.01)
+        runs = []
+
+        async def slow():
+            runs.append("start")
+            await asyncio.sleep(0.05)
+
+        def cancel_other():
+            wheel.cancel(victim)
+
+        wheel.schedule_periodic(0.01, slow)
+        wheel.schedule(0.02, cancel_other)
+        victim = wheel.schedule(0.02, runs.append, "victim")
+        await wheel.start()
+        await asyncio.sleep(0.2)
+        assert not wheel._task.done()
+        await wheel.stop()
+        return runs
+
+    runs = asyncio.run(scenario())
+    assert "victim" not in runs
+    # Cada ejecución dura cinco ticks: no se solapan
+    assert 2 <= runs.count("start") <= 5